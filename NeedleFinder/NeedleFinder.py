@@ -35,6 +35,7 @@ import random
 import csv
 import ConfigParser
 import inspect
+import sys
 import SimpleITK as sitk
 import sitkUtils
 import os.path
@@ -42,6 +43,8 @@ import time as t
 import vtk, qt, ctk, slicer
 import shutil
 import fnmatch
+import contextlib
+import threading
 from functools import partial
 import xml.etree.ElementTree
 from xml.etree.ElementTree import tostring
@@ -49,13 +52,16 @@ from xml.etree.ElementTree import tostring
 import EditorLib
 from Editor import EditorWidget
 
+import NeedleFinderLib
+
 # profiling/debugging helper functions:
+# (frame names without inspect.stack(), which reads the source lines of the whole stack at every call)
 def whoami():
-    return inspect.stack()[1][3]
+    return sys._getframe(1).f_code.co_name
 def whosdaddy():
-    return inspect.stack()[2][3]
+    return sys._getframe(2).f_code.co_name
 def whosgranny():
-    return inspect.stack()[3][3]
+    return sys._getframe(3).f_code.co_name
 def lineno():
     # Returns the current line number in our program
     return int(inspect.currentframe().f_back.f_lineno)
@@ -77,24 +83,33 @@ def breakbox(text):
   ret = messageBox = qt.QMessageBox.question(dialog, 'Profiling:', text+' Continue?', qt.QMessageBox.Ok, qt.QMessageBox.Cancel)
   if ret != qt.QMessageBox.Ok:
     raise #allows the debugger to start when attached and exceptions are caught
+debugLog = None
+def writeDebugLog(msg):
+  # /tmp/debug.log, opened once (line buffered) instead of for every message
+  global debugLog
+  try:
+    if debugLog is None:
+      debugLog = open("/tmp/debug.log", "a", 1)
+    debugLog.write(msg+'\n')
+  except:
+    pass
 def profprint(className=""):
-  if profiling:
-    profString = "%s.%s -----------------------" % (className, whosdaddy())
-    print profString
-    if loggingInfos:
-      try:
-        with open("/tmp/debug.log", "a") as myfile:
-          myfile.write(profString+'\n')
-      except:
-        pass
+  if profiling or NeedleFinderLib.tracer.enabled:
+    name = sys._getframe(1).f_code.co_name
+    NeedleFinderLib.tracer.mark(name)
+    if profiling:
+      profString = "%s.%s -----------------------" % (className, name)
+      print profString
+      if loggingInfos:
+        writeDebugLog(profString)
 def logprint(className="", msg = ""):
   if loggingInfos:
     msg += ' from %s.%s' % (className, whosdaddy())
-    try:
-      with open("/tmp/debug.log", "a") as myfile:
-        myfile.write(msg+'\n')
-    except:
-      pass
+    writeDebugLog(msg)
+def vprint(level, *args):
+  # console output of the detectors, cf. verbosity
+  if verbosity >= level:
+    print ' '.join(str(arg) for arg in args)
 def profbox(className=""):
   if profiling: strg = "%s.%s -----------------------" % (className, whosdaddy()); print strg; msgbox(strg)
 def getClassName(self):
@@ -103,12 +118,20 @@ def getClassName(self):
 # global constants:
 profiling = True
 loggingInfos = False
+verbosity = 1 # console output of the detectors 15_1 and _RM: 0 none, 1 per run, 2 per needle and cone step (the step records)
+tracing = False # record NeedleFinderLib.tracer spans, marks and counters from the start (cf. the Tracing option)
 #if profiling: msgbox("turned on")
 frequent = False
 MAXNEEDLES = MAXCOL = 206 # we have no more than 206 distinct colors defines here for display
 conesColor=300 # color for visualizing the search cones in label volume (for debugging, None turns it off)
 conesColor=None
 outlierThresh_mm=3 #or 2,3, 3.4 or 4 mm
+matchingThresh_mm=None # auto and manual needles with tips farther apart are not matched (None: no threshold)
+needleModelInterpolation = True # interpolate the needle model of 15_1 (False: nearest table entry, as before)
+# field data of the needle tubes, cf. NeedleFinderLogic.needleTube
+centerlineArrayName = 'NeedleCenterline' # curve samples [RAS], from the tip down
+controlPointsArrayName = 'NeedleControlPoints' # control points of the curve [RAS]
+tubeRadiusArrayName = 'NeedleTubeRadius'
 
 #
 # NeedleFinder
@@ -653,6 +676,22 @@ class NeedleFinderWidget:
     self.drawFiducialPoints.setChecked(0)
     parameterFrame.addRow(self.drawFiducialPoints)
 
+    self.featureVolumes = qt.QCheckBox('Cached gradient feature volumes?')
+    self.featureVolumes.toolTip = "Compute the center and ring-mean terms of the gradient once per volume and needle radius instead of at every sample."
+    self.featureVolumes.setChecked(1)
+    parameterFrame.addRow(self.featureVolumes)
+
+    # NumPy or VTK backend for the cone search
+    self.vectorizedConeSearch = qt.QCheckBox('Vectorized cone search (NumPy)?')
+    self.vectorizedConeSearch.toolTip = "Score all rays of a search cone at once. Uncheck to use the voxel by voxel VTK loop (same results, slower)."
+    self.vectorizedConeSearch.setChecked(1)
+    parameterFrame.addRow(self.vectorizedConeSearch)
+
+    self.roiDetection = qt.QCheckBox('ROI-bounded detection?')
+    self.roiDetection.toolTip = "Versions 1, 2 and 6: crop the volume once around the tips and the axial limit and track the needles in it. Needles leaving the ROI are tracked again on the whole volume."
+    self.roiDetection.setChecked(0)
+    parameterFrame.addRow(self.roiDetection)
+
     # Auto find Tips: Tracking in +z and -z direction
     self.autoStopTip = qt.QCheckBox('Tracking in both directions')
     self.autoStopTip.setChecked(0)
@@ -671,6 +710,23 @@ class NeedleFinderWidget:
     self.realNeedleLength.setValue(240)
     parameterFrame.addRow(realNeedleLengthLabel, self.realNeedleLength)
 
+    # Level of detail of the needle tubes
+    self.tubeSides = qt.QSpinBox()
+    self.tubeSides.setMinimum(3)
+    self.tubeSides.setMaximum(100)
+    self.tubeSides.setValue(12)
+    self.tubeSides.toolTip = "Number of sides of the needle tubes displayed in the scene. Measurements use the centerline stored with the tubes, not the tube points."
+    tubeSidesLabel = qt.QLabel('Needle tube sides: ')
+    parameterFrame.addRow(tubeSidesLabel, self.tubeSides)
+
+    self.exportTubeSides = qt.QSpinBox()
+    self.exportTubeSides.setMinimum(3)
+    self.exportTubeSides.setMaximum(200)
+    self.exportTubeSides.setValue(50)
+    self.exportTubeSides.toolTip = "Number of sides of the needle tubes in export quality (screenshots, saved models)."
+    exportTubeSidesLabel = qt.QLabel('Needle tube sides (export): ')
+    parameterFrame.addRow(exportTubeSidesLabel, self.exportTubeSides)
+
     # Max Needle Length?
     self.maxLength = qt.QCheckBox('Max Needle Length?')
     self.maxLength.setChecked(1)
@@ -779,6 +835,40 @@ class NeedleFinderWidget:
     algoLabel = qt.QLabel("Needle detection version: ")
     parameterFrame.addRow(algoLabel, self.algoVersParameter)
 
+    # threads
+    self.detectionThreads = qt.QSpinBox()
+    self.detectionThreads.setMinimum(1)
+    self.detectionThreads.setMaximum(64)
+    self.detectionThreads.setValue(1)
+    self.detectionThreads.toolTip = "Track the needles of versions 1, 2, 3, 6 (and the first pass of 4, 5) concurrently. 1 is sequential. Threads only overlap in NumPy, so this helps with large cones and feature volumes."
+    detectionThreadsLabel = qt.QLabel("Detection threads: ")
+    parameterFrame.addRow(detectionThreadsLabel, self.detectionThreads)
+
+    # coarse-to-fine cone search (version 6)
+    self.coarseTopK = qt.QSpinBox()
+    self.coarseTopK.setMinimum(1)
+    self.coarseTopK.setMaximum(20)
+    self.coarseTopK.setValue(4)
+    self.coarseTopK.toolTip = "Version 6: number of the best rays of the coarse search refined at full resolution."
+    coarseTopKLabel = qt.QLabel("Coarse-to-fine top-k: ")
+    parameterFrame.addRow(coarseTopKLabel, self.coarseTopK)
+
+    self.coarseBudget = qt.QSpinBox()
+    self.coarseBudget.setMinimum(1)
+    self.coarseBudget.setMaximum(100)
+    self.coarseBudget.setValue(35)
+    self.coarseBudget.toolTip = "Version 6: maximal number of rays refined at full resolution, in % of the rays of a cone. Above, or if the coarse search is ambiguous, the cone is searched exhaustively."
+    coarseBudgetLabel = qt.QLabel("Coarse-to-fine budget (%): ")
+    parameterFrame.addRow(coarseBudgetLabel, self.coarseBudget)
+
+    self.memoryBudget = qt.QSpinBox()
+    self.memoryBudget.setMinimum(0)
+    self.memoryBudget.setMaximum(65536)
+    self.memoryBudget.setValue(0)
+    self.memoryBudget.toolTip = "ROI-bounded detection: memory of the crop and the feature volumes in MB (0: no limit). Over it, the feature volumes and then the copy of the ROI are dropped."
+    memoryBudgetLabel = qt.QLabel("Detection memory budget (MB): ")
+    parameterFrame.addRow(memoryBudgetLabel, self.memoryBudget)
+
     # Research/dev. area#################################
     self.__devFrame = ctk.ctkCollapsibleButton()
     self.__devFrame.text = "R&&D (Developers)"
@@ -821,6 +911,15 @@ class NeedleFinderWidget:
     self.hideContourButton.connect('clicked()', logic.hideIsoSurfaces)
     self.hideContourButton.setEnabled(0)
 
+    self.isoValues = qt.QLineEdit('10')
+    self.isoValues.toolTip = "Distances [mm] to the needle tubes of the radiation isosurfaces, separated by commas, e.g. 10, 20, 30"
+    self.isoResolution = qt.QDoubleSpinBox()
+    self.isoResolution.setMinimum(0.25)
+    self.isoResolution.setMaximum(10)
+    self.isoResolution.setSingleStep(0.25)
+    self.isoResolution.setValue(1.5)
+    self.isoResolution.toolTip = "Voxel size [mm] of the distance fields of the radiation isosurfaces"
+
     self.filterButton = qt.QPushButton('Preprocessing')
     self.filterButton.checkable = False
     self.filterButton.connect('clicked()', logic.filterWithSITK)
@@ -837,6 +936,33 @@ class NeedleFinderWidget:
     self.setAsValNeedlesButton.setEnabled(1)
     self.setAsValNeedlesButton.setStyleSheet("background-color: qlineargradient(x1: 0, y1: 0, x2: 0, y2: 1, stop: 0 #f7f700, stop: 1 #dbdb00)");
 
+    self.loadArtifactButton = qt.QPushButton('Load Detection Artifact')
+    self.loadArtifactButton.toolTip = "Recreate the needles of the last run of a detection artifact file (.needles.jsonl) of parSearch"
+    self.loadArtifactButton.connect('clicked()', self.onLoadDetectionArtifact)
+
+    self.verbosity = qt.QSpinBox()
+    self.verbosity.setRange(0, 2)
+    self.verbosity.setValue(verbosity)
+    self.verbosity.toolTip = "Console output of the detectors 15_1 and RM: 0 none, 1 per run, 2 per needle and cone step (the step records, slow); the steps are recorded anyway"
+    self.verbosity.connect('valueChanged(int)', self.onVerbosityChanged)
+
+    self.dumpStepLogButton = qt.QPushButton('Dump Step Diagnostics')
+    self.dumpStepLogButton.toolTip = "Save the buffered step records of the last detections (JSON lines)"
+    self.dumpStepLogButton.connect('clicked()', self.onDumpStepLog)
+
+    self.tracingCheckBox = qt.QCheckBox('Tracing')
+    self.tracingCheckBox.setChecked(tracing)
+    self.tracingCheckBox.toolTip = "Record the timed spans, profprint calls and counters of the detection (per needle)"
+    self.tracingCheckBox.connect('toggled(bool)', NeedleFinderLib.tracer.enable)
+
+    self.exportTraceButton = qt.QPushButton('Export Trace')
+    self.exportTraceButton.toolTip = "Print the tracing statistics and save them as a Chrome trace (chrome://tracing, Perfetto)"
+    self.exportTraceButton.connect('clicked()', self.onExportTrace)
+
+    self.exportTubesButton = qt.QPushButton('Export Quality Needle Tubes')
+    self.exportTubesButton.checkable = True
+    self.exportTubesButton.connect('toggled(bool)', self.onExportTubesToggled)
+
     # ## create segmentation editor environment:
     editorWidgetParent = slicer.qMRMLWidget()
     editorWidgetParent.setLayout(qt.QVBoxLayout())
@@ -874,9 +1000,16 @@ class NeedleFinderWidget:
     devFrame.addRow(self.renderObturatorNeedlesButton)
     devFrame.addRow(self.displayContourButton)
     devFrame.addRow(self.hideContourButton)
+    devFrame.addRow(qt.QLabel('Isosurface distances (mm): '), self.isoValues)
+    devFrame.addRow(qt.QLabel('Isosurface voxel size (mm): '), self.isoResolution)
     devFrame.addRow(self.filterButton)
     devFrame.addRow(self.parSearchButton)
     devFrame.addRow(self.setAsValNeedlesButton)
+    devFrame.addRow(self.loadArtifactButton)
+    devFrame.addRow(self.tracingCheckBox, self.exportTraceButton)
+    devFrame.addRow(qt.QLabel('Detector verbosity: '), self.verbosity)
+    devFrame.addRow(self.dumpStepLogButton)
+    devFrame.addRow(self.exportTubesButton)
     devFrame.addRow(self.templateRegistrationButton)
 
     #put frames on the tab########################################
@@ -1103,7 +1236,7 @@ class NeedleFinderWidget:
     profprint()
     self.logic.resetNeedleDetection()
     self.logic.resetNeedleValidation()
-    pass
+    self.logic.removeSceneObservers()
 
   def refreshObservers(self):
     """ When the layout changes, drop the observers from
@@ -1190,6 +1323,55 @@ class NeedleFinderWidget:
     logic = self.logic
     logic.placeAxialLimitMarker(assign=False)
 
+  def onLoadDetectionArtifact(self):
+    """
+    Recreate the needles of a run of parSearch from its detection artifact file
+    """
+    # research #button
+    profprint()
+    fileName = qt.QFileDialog.getOpenFileName(self.parent, 'Detection Artifact', self.logDir or '/tmp',
+                                              'Detection artifacts (*.needles.jsonl)')
+    if fileName:
+      self.logic.loadDetectionArtifact(fileName)
+
+  def onVerbosityChanged(self, level):
+    # research
+    global verbosity
+    verbosity = level
+
+  def onDumpStepLog(self):
+    """
+    Save the step records of the detectors buffered by the logic
+    """
+    # research #button
+    profprint()
+    fileName = qt.QFileDialog.getSaveFileName(self.parent, 'Step Diagnostics', (self.logDir or '/tmp') + '/steps.jsonl',
+                                              'Step diagnostics (*.jsonl)')
+    if fileName:
+      self.logic.dumpStepLog(fileName)
+
+  def onExportTrace(self):
+    """
+    Save the trace of NeedleFinderLib.tracer and start a new one
+    """
+    # research #button
+    profprint()
+    fileName = qt.QFileDialog.getSaveFileName(self.parent, 'Chrome Trace', (self.logDir or '/tmp') + '/trace.json',
+                                              'Chrome traces (*.json)')
+    if fileName:
+      self.logic.exportTrace(fileName)
+
+  def onExportTubesToggled(self, checked):
+    """
+    Switch the needle tubes of the scene between the interactive and the export level of detail
+    """
+    # productive #button
+    profprint()
+    if checked:
+      self.logic.rebuildNeedleTubes(self.exportTubeSides.value)
+    else:
+      self.logic.rebuildNeedleTubes(self.tubeSides.value)
+
   def onStartStopGivingObturatorNeedleTipsToggled(self, checked):
     """
     Start/stop giving obturator needle tips
@@ -1397,38 +1579,35 @@ class NeedleFinderWidget:
                 shape = list(labelImage.GetDimensions())
                 spcg=self.labelMapNode.GetSpacing()
                 org=self.labelMapNode.GetOrigin()
-                if widget.algoVersParameter.value >4:
+                if widget.algoVersParameter.value == 5:
                   print "wanding"
                   self.wandLogics[sliceLogic].apply(xy)
                   #>>> exp05 walk up (proximal) the found chip from wanding
                   print "shape: ",shape
                   shape.reverse()
                   ijkMid=None
-                  labelArray = vtk.util.numpy_support.vtk_to_numpy(labelImage.GetPointData().GetScalars()).reshape(shape)
+                  labels = self.logic.getVolumeAccessor(labelImage)
+                  labelArray = labels.writableArray() # [i,j,k]
                   #labelArray[labelArray!=self.currentLabel] = 0 #slow, clear old chips
                   #TODO: replace this part by better tip estimation algo
+                  ixMin, ixMax = max(int(ixStart-10/spcg[0]),0), min(int(ixStart+10/spcg[0]),shape[2]) #CONST 10mm
+                  jxMin, jxMax = max(int(jxStart-10/spcg[1]),0), min(int(jxStart+10/spcg[1]),shape[1]) #CONST 10mm
                   for kx in range(max(int(kxStart)-0,0),min(int(kxStart+20/spcg[2]),shape[0])): #CONST 20mm
                     print "kx",kx
                     #scan xy slice
                     ijkTipEstimate=ijkMid
-                    ijkMid=np.array([0,0,0]) # center of mass of pixels in a slice
-                    midPtCtr=0
-                    for ix in range(max(int(ixStart-10/spcg[0]),0),min(int(ixStart+10/spcg[0]),shape[2])): #CONST 10mm
-                      for jx in range(max(int(jxStart-10/spcg[1]),0),min(int(jxStart+10/spcg[1]),shape[1])): #CONST 10mm
-                        #try: labelArray[kx,jx,ix]
-                        #except: print "range error ix,jx:", ix, jx
-                        if labelArray[kx,jx,ix]==self.currentLabel:
-                          print "curLab, labelArr[x]= ",self.currentLabel,labelArray[kx,jx,ix]
-                          ijkMid+=[ix,jx,kx]
-                          midPtCtr+=1
-                        if labelArray[kx,jx,ix] and labelArray[kx,jx,ix]!=self.currentLabel: labelArray[kx,jx,ix]=0 # delete old chip?
-                        #labelArray[kx,jx,ix]=306 # display in label volume for debugging
+                    window = labels.array[ixMin:ixMax, jxMin:jxMax, kx]
+                    chip = numpy.argwhere(window==self.currentLabel)
+                    midPtCtr=len(chip)
+                    oldChips = (window!=0) & (window!=self.currentLabel)
+                    if oldChips.any(): labelArray[ixMin:ixMax, jxMin:jxMax, kx][oldChips]=0 # delete old chip?
                     if not midPtCtr:
                       print "empty slice found ijkTipEstimate=", ijkTipEstimate
                       break
                     else:
                       print "non-empty slice found"
                       #pause()
+                      ijkMid=np.array([chip[:,0].sum()+ixMin*midPtCtr, chip[:,1].sum()+jxMin*midPtCtr, kx*midPtCtr]) # center of mass of pixels in a slice
                       ijkMid/=float(midPtCtr)
                 else:
                   # TODO: place better alg. here:
@@ -1741,11 +1920,30 @@ class NeedleFinderLogic:
     self.modelCTL = None
     self.contourNode = None
     self.lastNeedleNames = []
+    self.sceneBatchDepth = 0
+    self.pendingTableRows = [] # report table rows of the needles added in a sceneBatch
     self.enableScreenshots = 0
     self.screenshotScaleFactor = 1
     self.estimatorReference = 0
     self.controlPoints = []
+    self.volumeAccessors = {}
+    self.volumeAccessorsLock = threading.Lock()
+    self.featureCache = NeedleFinderLib.FeatureCache(2)
+    self.detectionVolumeNode = None # volume of ijk2ras/ras2ijk during a detection run
+    self.transforms = NeedleFinderLib.TransformCache()
+    self.needleIndex = NeedleFinderLib.NeedleGeometryIndex(self.needleGeometry)
+    self.isoFields = NeedleFinderLib.DistanceFieldCompositor()
+    self.isoImage = None # vtkImageData sharing the field array of isoFields
+    self.isoField = None
+    self.isoContour = None
+    self.resultSinks = {} # file name -> NeedleFinderLib.ResultsSink, cf. exportEvaluation
+    self.artifactWriters = {} # file name -> NeedleFinderLib.DetectionArtifactWriter, cf. saveDetectionArtifact
+    self.stepLog = NeedleFinderLib.StepLog() # step records of 15_1 and _RM, cf. verbosity
+    self.sceneObserverTags = [slicer.mrmlScene.AddObserver(event, self.needleIndex.invalidate) for event in
+                              (slicer.vtkMRMLScene.NodeAddedEvent, slicer.vtkMRMLScene.NodeRemovedEvent,
+                               slicer.vtkMRMLScene.EndImportEvent, slicer.vtkMRMLScene.EndCloseEvent)]
     self.observerTags = {}
+    NeedleFinderLib.tracer.enable(tracing)
     self.observeManualNeedles()
     self.lastTime = t.time()
 
@@ -2049,50 +2247,73 @@ class NeedleFinderLogic:
 
     return True
 
+  @NeedleFinderLib.traced()
   def drawIsoSurfaces(self):
     """ Draw isosurfaces from models of the visible needles only.
     This shall indicate radiation influence zones.
+    The distance field of each needle is cached (cf. NeedleFinderLib.DistanceFieldCompositor), so that only the
+    needles modified since the last call are sampled again, and the contour is updated in place.
     """
     # research
     profprint()
+    widget = slicer.modules.NeedleFinderWidget
+    try:
+      isoValues = sorted(float(v) for v in widget.isoValues.text.replace(';', ',').split(',') if v.strip())
+    except ValueError:
+      isoValues = []
+    if not isoValues:
+      isoValues = [10.]
+    self.isoFields.configure(widget.isoResolution.value, max(isoValues))
+
+    needles = {}
+    visible = []
+    for modelNode in self.needleIndex.nodes(slicer.mrmlScene):
+      if modelNode.GetAttribute("nth") != None:
+        geometry = self.needleIndex.geometry(modelNode)
+        needles[modelNode.GetID()] = (modelNode.GetPolyData().GetMTime(), geometry.points, geometry.radius)
+        if modelNode.GetDisplayVisibility() == 1:
+          visible.append(modelNode.GetID())
+    contourNode = slicer.mrmlScene.GetNodeByID(self.contourNode) if self.contourNode else None
+    if not visible and contourNode is None:
+      return
+    widget.hideContourButton.setEnabled(1)
 
-    slicer.modules.NeedleFinderWidget.hideContourButton.setEnabled(1)
-    modelNodes = slicer.util.getNodes('vtkMRMLModelNode*')
-
-    v = vtk.vtkAppendPolyData()
-    canContinue = 0
-    for modelNode in modelNodes.values():
-      print "for"
-      if modelNode.GetAttribute("nth") != None and modelNode.GetDisplayVisibility() == 1 :
-        canContinue = 1
-        v.AddInputData(modelNode.GetPolyData())
-
-    if canContinue == 1:
-      modeller = vtk.vtkImplicitModeller()
-      modeller.SetInputConnection(v.GetOutputPort())
-      modeller.SetSampleDimensions(60, 60, 60)
-      modeller.SetCapping(0)
-      modeller.AdjustBoundsOn()
-      modeller.SetProcessModeToPerVoxel()
-      modeller.SetAdjustDistance(1)
-      modeller.SetMaximumDistance(1.0)
-      modeller.Update()
-
-      contourFilter = vtk.vtkContourFilter()
-      contourFilter.SetNumberOfContours(1)
-      contourFilter.SetInputConnection(modeller.GetOutputPort())
-      contourFilter.ComputeNormalsOn()
-      contourFilter.ComputeScalarsOn()
-      contourFilter.UseScalarTreeOn()
-      contourFilter.SetValue(1, 10)
-      # contourFilter.SetValue(2,13)
-      # contourFilter.SetValue(3,15)
-      # contourFilter.SetValue(4,20)
-      # contourFilter.SetValue(5,25)
-      contourFilter.Update()
-      isoSurface = contourFilter.GetOutputDataObject(0)
-
-      self.AddContour(isoSurface)
+    computed = self.isoFields.computed
+    lattice, field = self.isoFields.update(needles, visible)
+    if lattice is None:
+      return
+    if self.isoImage is None or self.isoField is not field:
+      # new lattice: image sharing the field array, contour filter on it
+      image = vtk.vtkImageData()
+      image.SetDimensions(*lattice.dims)
+      image.SetOrigin(*lattice.origin)
+      image.SetSpacing(lattice.spacing, lattice.spacing, lattice.spacing)
+      scalars = vtk.util.numpy_support.numpy_to_vtk(field.ravel(order='F'), deep=0, array_type=vtk.VTK_FLOAT)
+      scalars.SetName('ImageScalars')
+      image.GetPointData().SetScalars(scalars)
+      self.isoField = field # keep the shared array alive
+      self.isoImage = image
+      if self.isoContour is None:
+        contourFilter = vtk.vtkContourFilter()
+        contourFilter.ComputeNormalsOn()
+        contourFilter.ComputeScalarsOn()
+        contourFilter.UseScalarTreeOn()
+        self.isoContour = contourFilter
+      self.isoContour.SetInputData(image)
+    self.isoImage.Modified()
+    self.isoContour.SetNumberOfContours(len(isoValues))
+    for i, isoValue in enumerate(isoValues):
+      self.isoContour.SetValue(i, isoValue)
+    self.isoContour.Update()
+    print "isosurfaces: %d of %d needles sampled, lattice %s at %g mm" % (self.isoFields.computed - computed, len(visible),
+                                                                           lattice.dims, lattice.spacing)
+
+    if contourNode is None or contourNode.GetPolyData() is not self.isoContour.GetOutput():
+      self.AddContour(self.isoContour.GetOutput())
+      contourNode = slicer.mrmlScene.GetNodeByID(self.contourNode)
+    if len(isoValues) > 1:
+      contourNode.GetDisplayNode().SetScalarRange(isoValues[0], isoValues[-1])
+    contourNode.GetPolyData().Modified()
 
   def hideIsoSurfaces(self):
     """
@@ -2130,6 +2351,9 @@ class NeedleFinderLogic:
     else:
       displayNode.SliceIntersectionVisibilityOn()
       displayNode.SetVisibility(1)
+    if self.contourNode and slicer.mrmlScene.GetNodeByID(self.contourNode):
+      # only the field of this needle is added or removed
+      self.drawIsoSurfaces()
 
   def reformatSagittalView4Needle(self, ID):
     """
@@ -2172,11 +2396,9 @@ class NeedleFinderLogic:
     volumeNode = slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetBackgroundLayer().GetVolumeNode()
     imageData = volumeNode.GetImageData()
     imageDimensions = imageData.GetDimensions()
-    m = vtk.vtkMatrix4x4()
     minZ = None
     mindist = None
-    volumeNode.GetIJKToRASMatrix(m)
-    Z = m.GetElement(2, 3)
+    Z = self.volumeTransform(volumeNode).ijkToRAS[2, 3]
     needleNode = slicer.mrmlScene.GetNodeByID(ID)
     polydata = needleNode.GetPolyData()
     nb = polydata.GetNumberOfPoints()
@@ -2335,7 +2557,7 @@ class NeedleFinderLogic:
     displayNode.SetInputPolyData(modelNode.GetPolyData())
     scene.AddNode(modelNode)
 
-    # self.contourNode = modelNode.GetID()
+    self.contourNode = modelNode.GetID()
 
     qt.QApplication.processEvents()
 
@@ -2485,21 +2707,7 @@ class NeedleFinderLogic:
     """
     # productive #math #coordinate-space-conversion #frequent
     if frequent: profprint()
-    m = vtk.vtkMatrix4x4()
-    if volumeNode == None:
-      volumeNode = slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetBackgroundLayer().GetVolumeNode()
-    volumeNode.GetIJKToRASMatrix(m)
-    ras = [0, 0, 0]
-    k = vtk.vtkMatrix4x4()
-    o = vtk.vtkMatrix4x4()
-    k.SetElement(0, 3, A[0])
-    k.SetElement(1, 3, A[1])
-    k.SetElement(2, 3, A[2])
-    k.Multiply4x4(m, k, o)
-    ras[0] = o.GetElement(0, 3)
-    ras[1] = o.GetElement(1, 3)
-    ras[2] = o.GetElement(2, 3)
-    return ras
+    return self.volumeTransform(volumeNode).ijk2ras(A)
 
   def ras2ijk(self, A, volumeNode = None):
     """
@@ -2508,22 +2716,130 @@ class NeedleFinderLogic:
     """
     # productive #math #coordinate-space-conversion #frequent
     if frequent: profprint()
-    m = vtk.vtkMatrix4x4()
+    return self.volumeTransform(volumeNode).ras2ijk(A)
+
+  def ijk2rasArray(self, points, volumeNode = None):
+    """
+    Convert an N x 3 array of IJK coordinates to RAS coordinates, cf. ijk2ras.
+    """
+    # productive #math #coordinate-space-conversion
+    if frequent: profprint()
+    return self.volumeTransform(volumeNode).ijk2rasArray(points)
+
+  def ras2ijkArray(self, points, volumeNode = None):
+    """
+    Convert an N x 3 array of RAS coordinates to IJK coordinates, cf. ras2ijk.
+    """
+    # productive #math #coordinate-space-conversion
+    if frequent: profprint()
+    return self.volumeTransform(volumeNode).ras2ijkArray(points)
+
+  def detectionVolume(self):
+    """
+    The volume the detection runs on: the one set for the current detection run, or the active volume on the red slice.
+    """
+    # productive #frequent
+    if self.detectionVolumeNode != None:
+      return self.detectionVolumeNode
+    return slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetBackgroundLayer().GetVolumeNode()
+
+  def volumeTransform(self, volumeNode = None):
+    """
+    Cached IJK <-> RAS NeedleFinderLib.AffineTransform of volumeNode (by default the detection volume), read again
+    from the node only after it was modified.
+    """
+    # productive #math #coordinate-space-conversion #frequent
+    if frequent: profprint()
     if volumeNode == None:
-        volumeNode = slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetBackgroundLayer().GetVolumeNode()
-    volumeNode.GetIJKToRASMatrix(m)
-    m.Invert()
-    ijk = [0, 0, 0]
-    k = vtk.vtkMatrix4x4()
-    o = vtk.vtkMatrix4x4()
-    k.SetElement(0, 3, A[0])
-    k.SetElement(1, 3, A[1])
-    k.SetElement(2, 3, A[2])
-    k.Multiply4x4(m, k, o)
-    ijk[0] = o.GetElement(0, 3)
-    ijk[1] = o.GetElement(1, 3)
-    ijk[2] = o.GetElement(2, 3)
-    return ijk
+      volumeNode = self.detectionVolume()
+    return self.transforms.get(volumeNode)
+
+  def getVolumeAccessor(self, volume):
+    """
+    Return a NeedleFinderLib.VolumeAccessor (zero-copy, read-only [i, j, k] NumPy view) for a volume node or its
+    image data. Accessors are cached per image and rebuilt only when the image was modified since; the cache is locked,
+    the accessors can be shared by detection threads.
+    """
+    # productive #frequent
+    if frequent: profprint()
+    if volume is None:
+      return None
+    if volume.IsA('vtkMRMLVolumeNode'):
+      volume = volume.GetImageData()
+    with self.volumeAccessorsLock:
+      accessor = self.volumeAccessors.get(volume)
+      if accessor is None or not accessor.isUpToDate(volume):
+        if len(self.volumeAccessors) >= 4: # don't keep views of closed volumes alive
+          self.volumeAccessors.clear()
+        accessor = NeedleFinderLib.VolumeAccessor.fromImageData(volume)
+        self.volumeAccessors[volume] = accessor
+    return accessor
+
+  def getNeedleFeatures(self, volume, radiusNeedle, radiusNeedleCorner):
+    """
+    Return the cached NeedleFinderLib.NeedleFeatures (center and ring-mean terms of the gradient) of a VolumeAccessor
+    for the needle radius in voxels, or None if the feature volumes are switched off in the GUI.
+    """
+    # productive
+    if frequent: profprint()
+    widget = slicer.modules.NeedleFinderWidget
+    if volume is None or not widget.featureVolumes.isChecked():
+      return None
+    return self.featureCache.get(volume, radiusNeedle, radiusNeedleCorner)
+
+  def detectionParameters(self, **changes):
+    """
+    The detection parameters of the GUI as NeedleFinderLib.DetectionParameters, with the given values changed.
+    """
+    # productive
+    widget = slicer.modules.NeedleFinderWidget
+    parameters = NeedleFinderLib.DetectionParameters(
+      algoVersParameter=widget.algoVersParameter.value,
+      radiusMax=widget.radiusMax.value,
+      gradientPonderation=widget.gradientPonderation.value,
+      sigmaValue=widget.sigmaValue.value,
+      exponent=widget.exponent.value,
+      gradient=widget.gradient.isChecked(),
+      gaussianAttenuation=widget.gaussianAttenuationButton.isChecked(),
+      numberOfPointsPerNeedle=widget.numberOfPointsPerNeedle.value,
+      nbRotatingIterations=widget.nbRotatingIterations.value,
+      radiusNeedleParameter=widget.radiusNeedleParameter.value,
+      lenghtNeedleParameter=widget.lenghtNeedleParameter.value,
+      axialSegmentationLimit=widget.axialSegmentationLimit,
+      maxLength=widget.maxLength.isChecked(),
+      autoCorrectTip=widget.autoCorrectTip.isChecked(),
+      autoStopTip=widget.autoStopTip.isChecked(),
+      needleModelInterpolation=needleModelInterpolation,
+      featureVolumes=widget.featureVolumes.isChecked(),
+      vectorizedConeSearch=widget.vectorizedConeSearch.isChecked(),
+      coarseTopK=widget.coarseTopK.value,
+      coarseBudget=widget.coarseBudget.value,
+      roiDetection=widget.roiDetection.isChecked(),
+      memoryBudget=widget.memoryBudget.value)
+    return parameters.update(**changes)
+
+  def needleDetector(self, imageData, imgLabelData=None, spacing=None, parameters=None, tips=None):
+    """
+    Headless NeedleFinderLib.NeedleDetector on the voxels of imageData (zero-copy), with the IJK to RAS matrix of the
+    volume of the red slice and the GUI parameters by default; its step records go to the step log.
+    Without the vectorized cone search it reads the voxels through VTK, as the former loops did.
+    With the ROI-bounded detection and the tips to track, a NeedleFinderLib.ROIDetector on their ROI.
+    """
+    # productive
+    profprint()
+    if parameters == None:
+      parameters = self.detectionParameters()
+    detector = NeedleFinderLib.NeedleDetector(self.getVolumeAccessor(imageData), self.volumeTransform(),
+                                              parameters, self.getVolumeAccessor(imgLabelData), spacing, self.featureCache)
+    detector.stepLog = self.stepLog
+    if not parameters.vectorizedConeSearch:
+      detector.imageVoxels = NeedleFinderLib.ImageDataVoxels(imageData)
+      if imgLabelData:
+        detector.labelVoxels = NeedleFinderLib.ImageDataVoxels(imgLabelData)
+    if tips and parameters.roiDetection and parameters.algoVersParameter in NeedleFinderLib.ROIDetector.versions:
+      detector = NeedleFinderLib.ROIDetector(detector, tips)
+      print detector.report()
+    return detector
 
   def needleDetection(self):
     """
@@ -2549,9 +2865,7 @@ class NeedleFinderLogic:
     parameterNode.SetParameter("IslandEffect,minimumSize", '0')
     islandTool.removeIslands()
     # select the image node from the Red slice viewer
-    m = vtk.vtkMatrix4x4()
     volumeNode = slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetBackgroundLayer().GetVolumeNode()
-    volumeNode.GetIJKToRASMatrix(m)
     imageData = volumeNode.GetImageData()
     spacing = volumeNode.GetSpacing()
     # chrono starts
@@ -2822,26 +3136,27 @@ class NeedleFinderLogic:
     """
     # research #frequent
     if frequent: profprint()
+    volume = self.getVolumeAccessor(imageData)
     radiusNeedle = int(round(radiusNeedleParameter / float(spacing[0])))
     radiusNeedleCorner = int(round((radiusNeedleParameter / float(spacing[0]) / 1.414)))
     ijk[0] = int(round(ijk[0]))
     ijk[1] = int(round(ijk[1]))
     ijk[2] = int(round(ijk[2]))
-    center = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1], ijk[2], 0)
-    center += imageData.GetScalarComponentAsDouble(ijk[0] + 1, ijk[1], ijk[2], 0)
-    center += imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + 1, ijk[2], 0)
-    center += imageData.GetScalarComponentAsDouble(ijk[0] - 1, ijk[1], ijk[2], 0)
-    center += imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - 1, ijk[2], 0)
+    center = volume.value(ijk[0], ijk[1], ijk[2])
+    center += volume.value(ijk[0] + 1, ijk[1], ijk[2])
+    center += volume.value(ijk[0], ijk[1] + 1, ijk[2])
+    center += volume.value(ijk[0] - 1, ijk[1], ijk[2])
+    center += volume.value(ijk[0], ijk[1] - 1, ijk[2])
 
     if gradientPonderation != 0:
-      g1 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedle, ijk[1], ijk[2], 0)
-      g2 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedle, ijk[1], ijk[2], 0)
-      g3 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + radiusNeedle, ijk[2], 0)
-      g4 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - radiusNeedle, ijk[2], 0)
-      g5 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-      g6 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-      g7 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-      g8 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
+      g1 = volume.value(ijk[0] + radiusNeedle, ijk[1], ijk[2])
+      g2 = volume.value(ijk[0] - radiusNeedle, ijk[1], ijk[2])
+      g3 = volume.value(ijk[0], ijk[1] + radiusNeedle, ijk[2])
+      g4 = volume.value(ijk[0], ijk[1] - radiusNeedle, ijk[2])
+      g5 = volume.value(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2])
+      g6 = volume.value(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2])
+      g7 = volume.value(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2])
+      g8 = volume.value(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2])
 
       total = center / float(5) - ((g1 + g2 + g3 + g4 + g5 + g6 + g7 + g8) / float(8)) * gradientPonderation
     else:
@@ -2896,69 +3211,23 @@ class NeedleFinderLogic:
 
   def findTip(self, A, imageData, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y, Z):
     """
-    Find tip
+    Find tip: the minimum of the Gaussian weighted center-minus-ring response summed over the tip slice and the 3 below,
+    in a 2X x 2Y window around A [ijk] (vectorized, cf. NeedleFinderLib.TipSearch)
     """
     # productive #onClick
     profprint()
-    radiusNeedle = int(radiusNeedle)
-    A = [int(A[0]), int(A[1]), int(A[2])]
-    print A
-    minTotalTip = 0
-    X = int(X)
-    Y = int(Y)
-    Z = int(Z)
-    for I in range(-X, X):
-      i = int(I / float(coeff))
-      for J in range(-Y, Y):
-        j = int(J / float(coeff))
-        for k in range(1):
-          v0 = 0
-          totalTip = 0
-          for l in range (-3, 1):
-            v0 = 8 * imageData.GetScalarComponentAsDouble(A[0] + i, A[1] + j, A[2] + k + l, 0)
-
-            v1 = imageData.GetScalarComponentAsDouble(A[0] + radiusNeedle + i, A[1] + j, A[2] + k + l, 0)
-            v2 = imageData.GetScalarComponentAsDouble(A[0] - radiusNeedle + i, A[1] + j, A[2] + k + l, 0)
-            v3 = imageData.GetScalarComponentAsDouble(A[0] + i, A[1] + radiusNeedle + j, A[2] + k + l, 0)
-            v4 = imageData.GetScalarComponentAsDouble(A[0] + i, A[1] - radiusNeedle + j, A[2] + k + l, 0)
-
-            totalTip += v0 - ((v1 + v2 + v3 + v4) / float(4)) * gradientPonderation
-
-          rgauss = (i ** 2
-                            + j ** 2
-                            + k ** 2) ** 0.5
-
-          gaussianAttenuation = math.exp(-(rgauss / float(10)) ** 2 / float((2 * (sigmaValue / float(10)) ** 2)))
-          totalTip = gaussianAttenuation * totalTip
-
-          # totalTip = v0
-          if totalTip < minTotalTip or minTotalTip == 0:
-            minTotalTip = totalTip
-            IBest = A[0] + i
-            JBest = A[1] + j
-            KBest = A[2] + k
-            P = [ 0 for n in range(5)]
-            P[0] = [A[0] + i, A[1] + j, A[2] + k + l]
-            P[1] = [A[0] + radiusNeedle + i, A[1] + j, A[2] + k + l]
-            P[2] = [A[0] - radiusNeedle + i, A[1] + j, A[2] + k + l]
-            P[3] = [A[0] + i, A[1] + radiusNeedle + j, A[2] + k + l]
-            P[4] = [A[0] + i, A[1] - radiusNeedle + j, A[2] + k + l]
-
-    """
-    # Draw template
-    for pi in range(5):
-      fiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-      fiducial.Initialize(slicer.mrmlScene)
-      fiducial.SetName(str(pi))
-      fiducial.SetFiducialCoordinates(self.ijk2ras(P[pi]))
-    """
-    # print "bestTip:",IBest,JBest,KBest, minTotalTip
-    # print "initialtip:", A
-    AInit = A
-
-    A = [IBest, JBest, KBest]
+    volume = self.getVolumeAccessor(imageData)
+    print [int(A[0]), int(A[1]), int(A[2])]
+    return NeedleFinderLib.findTip(volume.array, A, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y)
 
-    return A
+  def findTips(self, tips, imageData, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y):
+    """
+    findTip for many tips [ijk] in one call
+    """
+    # productive
+    profprint()
+    volume = self.getVolumeAccessor(imageData)
+    return NeedleFinderLib.findTips(volume.array, tips, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y)
 
   #------------------------------------------------------------------------------
   #
@@ -3020,6 +3289,7 @@ class NeedleFinderLogic:
     '''
     Ruibin: comment on this interpolation...
     '''
+    V = self.getVolumeAccessor(V)
     if interpswitch ==1:
         xf = int(math.floor(x))
         yf = int(math.floor(y))
@@ -3031,15 +3301,15 @@ class NeedleFinderLogic:
         yd = y - yf
         zd = z - zf
         zdd= 1-zd
-        i1 = V.GetScalarComponentAsDouble(xf,yf,zf,0)*zdd + V.GetScalarComponentAsDouble(xf,yf,zc,0)*zd
-        i2 = V.GetScalarComponentAsDouble(xf,yc,zf,0)*zdd + V.GetScalarComponentAsDouble(xf,yc,zc,0)*zd
-        j1 = V.GetScalarComponentAsDouble(xc,yf,zf,0)*zdd + V.GetScalarComponentAsDouble(xc,yf,zc,0)*zd
-        j2 = V.GetScalarComponentAsDouble(xc,yc,zf,0)*zdd + V.GetScalarComponentAsDouble(xc,yc,zc,0)*zd
+        i1 = V.value(xf,yf,zf)*zdd + V.value(xf,yf,zc)*zd
+        i2 = V.value(xf,yc,zf)*zdd + V.value(xf,yc,zc)*zd
+        j1 = V.value(xc,yf,zf)*zdd + V.value(xc,yf,zc)*zd
+        j2 = V.value(xc,yc,zf)*zdd + V.value(xc,yc,zc)*zd
         w1 = i1*(1-yd) + i2*yd
         w2 = j1*(1-yd) + j2*yd
         value = w1*(1-xd) + w2*xd
     else:
-        value = V.GetScalarComponentAsDouble(int(round(x)),int(round(y)),int(round(z)),0)
+        value = V.value(int(round(x)),int(round(y)),int(round(z)))
     return value
 
   def needleDetectionAPI(self, args={}, tips = [], imageData = None, spacing=[1,1,1], script=False, names="", segLimit=[]):
@@ -3066,29 +3336,8 @@ class NeedleFinderLogic:
     else:
       labelData=None
     # select algo version
-    NeedleIndex0=0
-    if not script:
-      NeedleIndex0 = len(self.returnTipsFromNeedleModels('Detection')[0])+1
-    if widget.algoVersParameter.value in range(0,4):
-      #print 'tips', tips
-      for NeedleIndex in range(len(tips)):
-          A = tips[NeedleIndex]
-          #print 'tip: ',A
-          colorVar = NeedleIndex0+NeedleIndex
-          if names == "":
-            strName = 'auto-seg_%d' % colorVar
-          else:
-            strName = names[NeedleIndex]
-          print 'strName: ',strName
-          if widget.algoVersParameter.value == 0:
-              self.needleDetectionThreadCurrentDev(A, imageData, colorVar, spacing, script, labelData, manualName=strName)
-          elif widget.algoVersParameter.value == 1:
-              self.needleDetectionThread13_1(A, imageData, colorVar, spacing, script, labelData, manName=strName,bDrawNeedle=True)
-          elif widget.algoVersParameter.value == 2:
-              self.needleDetectionThread13_2(A, imageData, colorVar, spacing, script, labelData,manualName=strName)
-          elif widget.algoVersParameter.value == 3:
-              self.needleDetectionThread15_1(A, imageData, labelData, widget.tempPointList, colorVar, spacing, bUp=False, bScript=script, strManualName=strName,bDrawNeedle=True)
-          NeedleIndex+=1
+    if widget.algoVersParameter.value in (0, 1, 2, 3, 6):
+      self.detectNeedles(tips, imageData, labelData, spacing, script, names)
 
     if widget.algoVersParameter.value == 4: # 1 with Ruibins post-processing
         widget.algoVersParameter.value = 1
@@ -3098,9 +3347,10 @@ class NeedleFinderLogic:
         widget.algoVersParameter.value = 3
         self.needleDetectionThread_RM(tips, imageData, labelData, widget.tempPointList, spacing, bUp=False, bScript=script,  names=names)
         widget.algoVersParameter.value = 5
-    if not widget.algoVersParameter.value in range(0,6):
+    if not widget.algoVersParameter.value in range(0,7):
       msgbox ("/!\ needleDetectionThread %d not defined"%widget.algoVersParameter.value)
 
+  @NeedleFinderLib.traced()
   def needleDetectionThread(self, tips = [], imageData = None, spacing=[1,1,1], script=False, names=""):
     """ Ruibin: comment...
     Switches between the versions of the algorithm. For comparison tests.
@@ -3113,50 +3363,138 @@ class NeedleFinderLogic:
       labelData=widget.labelMapNode.GetImageData()
     else:
       labelData=None
-    # select algo version
+    # all coordinate conversions of the run use the transform of this volume
+    previousVolumeNode = self.detectionVolumeNode
+    self.detectionVolumeNode = self.detectionVolume()
+    try:
+      # select algo version
+      if widget.algoVersParameter.value in (0, 1, 2, 3, 6):
+        self.detectNeedles(tips, imageData, labelData, spacing, script, names)
+
+      if widget.algoVersParameter.value == 4: # 1 with Ruibins post-processing
+          widget.algoVersParameter.value = 1
+          self.needleDetectionThread_RM(tips, imageData, labelData, widget.tempPointList, spacing, bUp=False, bScript=script,  names=names)
+          widget.algoVersParameter.value = 4
+      elif widget.algoVersParameter.value == 5: # 3 with Ruibins post-processing
+          widget.algoVersParameter.value = 3
+          self.needleDetectionThread_RM(tips, imageData, labelData, widget.tempPointList, spacing, bUp=False, bScript=script,  names=names)
+          widget.algoVersParameter.value = 5
+      if not widget.algoVersParameter.value in range(0,7):
+        msgbox ("/!\ needleDetectionThread %d not defined"%widget.algoVersParameter.value)
+    finally:
+      self.detectionVolumeNode = previousVolumeNode
+
+  def detectNeedles(self, tips, imageData, labelData, spacing, script=False, names=""):
+    """
+    Track one needle per tip with the single needle version 0-3 or 6 selected by algoVersParameter and add it to the scene.
+    With more than one detection thread (and when the version allows it, cf. concurrentDetection) all tips are tracked
+    concurrently first, then the needles are added to the scene on the main thread, in the order of the tips and with
+    the same colors and names as in the sequential loop.
+    """
+    # productive
+    profprint()
+    widget = slicer.modules.NeedleFinderWidget
+    algo = widget.algoVersParameter.value
     NeedleIndex0=0
     if not script:
       NeedleIndex0 = len(self.returnTipsFromNeedleModels('Detection')[0])+1
-    if widget.algoVersParameter.value in range(0,4):
-      #print 'tips', tips
+    colorVars = [NeedleIndex0+NeedleIndex for NeedleIndex in range(len(tips))]
+    if names == "":
+      strNames = ['auto-seg_%d' % colorVar for colorVar in colorVars]
+    else:
+      strNames = [names[NeedleIndex] for NeedleIndex in range(len(tips))]
+
+    if self.concurrentDetection(algo, len(tips)):
+      # the parameters are read here, the jobs don't touch the GUI at all
+      detector = self.needleDetector(imageData, labelData, spacing, tips=tips)
+      forks = [detector.fork() for tip in tips]
+      jobs = [partial(forks[NeedleIndex].track, tips[NeedleIndex], name=strNames[NeedleIndex]) for NeedleIndex in range(len(tips))]
+      lastRecord = self.stepLog.last
+      results = self.runDetectionJobs(jobs)
+      # detector state and scene mutation on the main thread only, in tip order
+      detector.merge(forks)
+      print 'strNames: ',strNames
+      if algo == 3:
+        colorVars = (205)% MAXCOL # as in needleDetectionThread15_1
+        self.printStepRecords(lastRecord)
+        for warning in detector.warnings: vprint(1, warning)
+      self.addNeedlesToScene([result[0] for result in results], colorVars, 'Detection', script, 0, manualNames=strNames)
+      if isinstance(detector, NeedleFinderLib.ROIDetector): print detector.report()
+      return
+
+    detector = None
+    if widget.roiDetection.isChecked() and algo in NeedleFinderLib.ROIDetector.versions and not conesColor:
+      # one crop for all needles
+      detector = self.needleDetector(imageData, labelData, spacing, self.detectionParameters(algoVersParameter=algo), tips)
+    tipsCorrected = algo == 0 and widget.autoCorrectTip.isChecked()
+    if tipsCorrected:
+      # all tips refined in one call, as in NeedleDetector.detect
+      tipDetector = self.needleDetector(imageData, labelData, spacing, self.detectionParameters(algoVersParameter=0))
+      tips = tipDetector.correctTips(tips)
+    with self.sceneBatch():
       for NeedleIndex in range(len(tips)):
           A = tips[NeedleIndex]
-          #print 'tip: ',A
-          colorVar = NeedleIndex0+NeedleIndex
-          if names == "":
-            strName = 'auto-seg_%d' % colorVar
-          else:
-            strName = names[NeedleIndex]
+          colorVar = colorVars[NeedleIndex]
+          strName = strNames[NeedleIndex]
           print 'strName: ',strName
-          if widget.algoVersParameter.value == 0:
-              self.needleDetectionThreadCurrentDev(A, imageData, colorVar, spacing, script, labelData, manualName=strName)
-          elif widget.algoVersParameter.value == 1:
+          if detector:
+              self.trackNeedle(algo, A, imageData, colorVar, spacing, script, labelData, strName, True, detector=detector)
+          elif algo == 0:
+              self.needleDetectionThreadCurrentDev(A, imageData, colorVar, spacing, script, labelData, manualName=strName, tipCorrected=tipsCorrected)
+          elif algo == 1:
               self.needleDetectionThread13_1(A, imageData, colorVar, spacing, script, labelData, manName=strName,bDrawNeedle=True)
-          elif widget.algoVersParameter.value == 2:
+          elif algo == 2:
               self.needleDetectionThread13_2(A, imageData, colorVar, spacing, script, labelData,manualName=strName)
-          elif widget.algoVersParameter.value == 3:
+          elif algo == 3:
               self.needleDetectionThread15_1(A, imageData, labelData, widget.tempPointList, colorVar, spacing, bUp=False, bScript=script, strManualName=strName,bDrawNeedle=True)
-          NeedleIndex+=1
+          elif algo == 6:
+              self.trackNeedle(6, A, imageData, colorVar, spacing, script, labelData, strName, True)
+    if detector: print detector.report()
 
-    if widget.algoVersParameter.value == 4: # 1 with Ruibins post-processing
-        widget.algoVersParameter.value = 1
-        self.needleDetectionThread_RM(tips, imageData, labelData, widget.tempPointList, spacing, bUp=False, bScript=script,  names=names)
-        widget.algoVersParameter.value = 4
-    elif widget.algoVersParameter.value == 5: # 3 with Ruibins post-processing
-        widget.algoVersParameter.value = 3
-        self.needleDetectionThread_RM(tips, imageData, labelData, widget.tempPointList, spacing, bUp=False, bScript=script,  names=names)
-        widget.algoVersParameter.value = 5
-    if not widget.algoVersParameter.value in range(0,6):
-      msgbox ("/!\ needleDetectionThread %d not defined"%widget.algoVersParameter.value)
+  def concurrentDetection(self, algo, nNeedles):
+    """
+    True if the needles of the single needle version algo can be tracked by several threads:
+    only the headless NeedleFinderLib.NeedleDetector versions run in the threads, and only when the tracking doesn't
+    touch the scene (no fiducials, no search cones in the label map, no up-tracking). Version 0 refines all tips at
+    once and keeps its estimator reference, it stays sequential. The logic state (estimatorReference, conesColor) is
+    only read and written on the main thread, cf. runDetectionJobs.
+    """
+    # productive
+    widget = slicer.modules.NeedleFinderWidget
+    return (widget.detectionThreads.value > 1 and nNeedles > 1 and algo in NeedleFinderLib.NeedleDetector.versions
+            and algo != 0 and not conesColor
+            and not widget.drawFiducialPoints.isChecked() and not widget.autoStopTip.isChecked())
+
+  def runDetectionJobs(self, jobs):
+    """
+    Run single needle tracking jobs (track of a fork of a NeedleFinderLib detector built on the main thread, bound to
+    a tip) on a pool of detection threads and return their results in the order of the jobs.
+    The jobs only write to their own fork and to the step log: the caller merges the forks after the join
+    (detector.merge) and reads the warnings there. The estimator reference and conesColor of the logic are never
+    written by the jobs (version 0 and the search cones stay sequential, cf. concurrentDetection).
+    The detector holds a snapshot of the GUI parameters, the voxel views and the IJK to RAS matrix: the jobs don't
+    read any widget or scene node. The threads only overlap where NumPy releases the GIL (the gathers and reductions
+    of large cones, the feature volumes), the Python of the step loop is serialized.
+    """
+    # productive
+    profprint()
+    from multiprocessing.pool import ThreadPool
+    widget = slicer.modules.NeedleFinderWidget
+    pool = ThreadPool(min(widget.detectionThreads.value, len(jobs)))
+    try:
+      return pool.map(lambda job: job(), jobs)
+    finally:
+      pool.close()
+      pool.join()
 
   def needleDetectionThread_RM(self, tips, imgData, imgLabelData, lrasTempPoints, fvSpacing, bUp=False, bScript=False, names="", tipOnly=False):
-    print "RM15____________________________Thread"
+    vprint(2, "RM15____________________________Thread")
     profprint()
     t0 = time.clock()
     bDraw=True
     #msgbox("Detour: \!/ This site is under heavy construction. /!\ ")
     widget = slicer.modules.NeedleFinderWidget
-    print "\n"*10 #<<< fast forward in console to create visual break
+    vprint(2, "\n"*10) #<<< fast forward in console to create visual break
     # ## load parameters from GUI
     iRadiusMax_mm = widget.radiusMax.value
     iGradientPonderation = widget.gradientPonderation.value
@@ -3171,7 +3509,7 @@ class NeedleFinderLogic:
     global conesColor
     if conesColor: conesColor=(conesColor+1)%308;
     if conesColor==0: conesColor=300
-    print "conesColor= ", conesColor
+    vprint(2, "conesColor= ", conesColor)
     ### initialisation of some parameters
     fModelNeedleLength_mm=187
     fModelSegmentLength_mm=fModelNeedleLength_mm/20.
@@ -3181,24 +3519,41 @@ class NeedleFinderLogic:
     ControlPointsPackageIJK=[]
     NumberOfNeedles = len(tips)
 
-    for NeedleIndex in range(NumberOfNeedles):
-        print "The ",NeedleIndex+1," Needle"
+    if widget.algoVersParameter.value in (1, 3) and self.concurrentDetection(widget.algoVersParameter.value, NumberOfNeedles):
+        # first pass, all needles at once; the feedback passes depend on each other and stay sequential
+        detector = self.needleDetector(imgData, imgLabelData, fvSpacing, tips=tips)
+        forks = [detector.fork() for tip in tips]
+        jobs = [partial(forks[NeedleIndex].track, tips[NeedleIndex], name=names[NeedleIndex]) for NeedleIndex in range(NumberOfNeedles)]
+        lastRecord = self.stepLog.last
+        for lvControlPointsRAS,lvControlPointsIJK in self.runDetectionJobs(jobs):
+            ControlPointsPackage.append(lvControlPointsRAS)
+            ControlPointsPackageIJK.append(lvControlPointsIJK)
+        detector.merge(forks)
+        self.printStepRecords(lastRecord)
+        for warning in detector.warnings: vprint(1, warning)
+        # the feedback calls below use the last tip, as after the sequential loop
+        NeedleIndex = NumberOfNeedles-1
         ijkA = tips[NeedleIndex]
         strManualName = names[NeedleIndex]
-        colorVar=NeedleIndex
-
-        #call single needle detection >>>>>>>AM>>>>>>>>>
-        if widget.algoVersParameter.value == 1:
-          lvControlPointsRAS,lvControlPointsIJK=self.needleDetectionThread13_1(ijkA, imgData, colorVar, fvSpacing, bScript, imgLabelData, strManualName, bDrawNeedle=False)
-        elif widget.algoVersParameter.value == 3:
-          lvControlPointsRAS,lvControlPointsIJK=self.needleDetectionThread15_1( ijkA, imgData, imgLabelData, lrasTempPoints,0, fvSpacing, bUp=False, bScript=False, strManualName=strManualName, tipOnly=False, bDrawNeedle=False)
-        else:
-          msgbox ("/!\ single needleDetectionThread %d not defined"%widget.algoVersParameter.value)
-        # end call single needle detection <<<<<<AM<<<<<<<<<
+    else:
+        for NeedleIndex in range(NumberOfNeedles):
+            vprint(2, "The ",NeedleIndex+1," Needle")
+            ijkA = tips[NeedleIndex]
+            strManualName = names[NeedleIndex]
+            colorVar=NeedleIndex
+
+            #call single needle detection >>>>>>>AM>>>>>>>>>
+            if widget.algoVersParameter.value == 1:
+              lvControlPointsRAS,lvControlPointsIJK=self.needleDetectionThread13_1(ijkA, imgData, colorVar, fvSpacing, bScript, imgLabelData, strManualName, bDrawNeedle=False)
+            elif widget.algoVersParameter.value == 3:
+              lvControlPointsRAS,lvControlPointsIJK=self.needleDetectionThread15_1( ijkA, imgData, imgLabelData, lrasTempPoints,0, fvSpacing, bUp=False, bScript=False, strManualName=strManualName, tipOnly=False, bDrawNeedle=False)
+            else:
+              msgbox ("/!\ single needleDetectionThread %d not defined"%widget.algoVersParameter.value)
+            # end call single needle detection <<<<<<AM<<<<<<<<<
 
-        ControlPointsPackage.append(lvControlPointsRAS)
-        ControlPointsPackageIJK.append(lvControlPointsIJK)
-        print "The", NeedleIndex+1,"needle finished"
+            ControlPointsPackage.append(lvControlPointsRAS)
+            ControlPointsPackageIJK.append(lvControlPointsIJK)
+            vprint(2, "The", NeedleIndex+1,"needle finished")
     OriginalControlPointsPackage = []
     OriginalControlPointsPackageIJK = []
     for i in range(len(ControlPointsPackage)):
@@ -3226,7 +3581,7 @@ class NeedleFinderLogic:
                             Counting[k]=1
                     WrongPositionsToSend.append(wrongpositiontosend)
             NumberOfWrongPositionsToSend = len(WrongPositionsToSend)
-            print "The",feedbackindex+1," Loop"
+            vprint(2, "The",feedbackindex+1," Loop")
             for i in range(NumberOfWrongPositionsToSend):
                 Punish = 0.85
 
@@ -3243,14 +3598,16 @@ class NeedleFinderLogic:
                 #CorrectedControlPoints, CorrectedControlPointsIJK = self.needleDetectionThread15_RM_Feedback(ControlPointsPackage, ControlPointsPackageIJK, WrongPositionsToSend[i], imgData, fvSpacing, imgLabelData, GlobalDirection, Punish,bScript,bUp)
                 ControlPointsPackage[WrongPositionsToSend[i][0]] = CorrectedControlPoints
                 ControlPointsPackageIJK[WrongPositionsToSend[i][0]] = CorrectedControlPointsIJK
-                print "The ",WrongPositionsToSend[i],"(+1 each) Needle corrected"
+                self.stepLog.record('RM', names[WrongPositionsToSend[i][0]], None, feedback=feedbackindex,
+                                    related=WrongPositionsToSend[i][1:], punish=Punish, controlPoints=CorrectedControlPointsIJK)
+                vprint(1, "The ",WrongPositionsToSend[i],"(+1 each) Needle corrected")
             LastWrongPositionsToSend = WrongPositionsToSend
             OriginalWrongPositions = WrongPositionsToSend
         else:
             WrongPosition,WrongReason,GlobalDirection = self.needleRationalityCheck(ControlPointsPackageIJK, ControlPointsPackage, imgData, fvSpacing)
             NumberOfWrongNeedles = len(WrongPosition)
             if NumberOfWrongNeedles == 0:
-                print "Cannot detect wrong needles"
+                vprint(2, "Cannot detect wrong needles")
             else:
                 NumberOfLastWrongNeedles = len(LastWrongPositionsToSend)
 
@@ -3286,31 +3643,28 @@ class NeedleFinderLogic:
                                         Punish = feedbackindex+1
                         WrongPositionsToSend.append(wrongpositiontosend)
                 NumberOfWrongPositionsToSend = len(WrongPositionsToSend)
-                print "The",feedbackindex+1," Loop"
+                vprint(2, "The",feedbackindex+1," Loop")
                 for i in range(NumberOfWrongPositionsToSend):
                     CorrectedControlPoints, CorrectedControlPointsIJK = self.needleDetectionThread15_1( ijkA, imgData, imgLabelData, lrasTempPoints,0, fvSpacing, bUp=False, bScript=False, strManualName=strManualName, tipOnly=False, bDrawNeedle=False,whetherfeedback=True,ControlPointsPackage=ControlPointsPackage,ControlPointsPackageIJK=ControlPointsPackageIJK,WrongPosition=WrongPositionsToSend[i],GlobalDirection=GlobalDirection,Punish=Punish)
                     #CorrectedControlPoints, CorrectedControlPointsIJK = self.needleDetectionThread15_RM_Feedback(ControlPointsPackage, ControlPointsPackageIJK, WrongPositionsToSend[i], imgData, fvSpacing, imgLabelData, GlobalDirection,Punish,bScript,bUp)
                     ControlPointsPackage[WrongPositionsToSend[i][0]] = CorrectedControlPoints
                     ControlPointsPackageIJK[WrongPositionsToSend[i][0]] = CorrectedControlPointsIJK
-                    print "The ",WrongPositionsToSend[i],"(+1 each) Needle corrected"
+                    self.stepLog.record('RM', names[WrongPositionsToSend[i][0]], None, feedback=feedbackindex,
+                                        related=WrongPositionsToSend[i][1:], punish=Punish, controlPoints=CorrectedControlPointsIJK)
+                    vprint(1, "The ",WrongPositionsToSend[i],"(+1 each) Needle corrected")
                 LastWrongPositionsToSend = WrongPositionsToSend
 
     FinalControlPointsPackage, FinalControlPointsPackageIJK = self.needleRationalityProtect(OriginalControlPointsPackage, OriginalControlPointsPackageIJK, ControlPointsPackage, ControlPointsPackageIJK, OriginalWrongPositions,imgData,fvSpacing)
    # FinalControlPointsPackage = ControlPointsPackage
 
-    for i in range(NumberOfNeedles):
-        colorVar = i
-        strManualName = names[i]
-        if not bAutoStopTip:
-          self.addNeedleToScene(FinalControlPointsPackage[i], (205)% MAXCOL, 'Detection', bScript,0, manualName=strManualName)
-        if bAutoStopTip and bUp:
-          self.addNeedleToScene(FinalControlPointsPackage[i], (205)% MAXCOL, 'Detection', bScript,0, manualName=strManualName)
-    print "The Time of 15_RM:_________________________",time.clock()-t0
+    if not bAutoStopTip or bUp:
+        self.addNeedlesToScene(FinalControlPointsPackage[:NumberOfNeedles], (205)% MAXCOL, 'Detection', bScript, 0, manualNames=[names[i] for i in range(NumberOfNeedles)])
+    vprint(1, "The Time of 15_RM:_________________________",time.clock()-t0)
 
 
   def needleRationalityProtect(self, OriginalControlPointsPackage, OriginalControlPointsPackageIJK, ControlPointsPackage, ControlPointsPackageIJK, OriginalWrongPositions, imageData, spacing):
     '''Ruibin: comment... '''
-    print "Protection Start"
+    vprint(2, "Protection Start")
     flag_slope = False
     flag_combine = False
     WrongPosition = []
@@ -3335,16 +3689,16 @@ class NeedleFinderLogic:
         l = (direction[0]**2+direction[1]**2+direction[2]**2)**0.5
         direction = [direction[0]/l,direction[1]/l,direction[2]/l]
         SingleDirection.append(direction)
-        print "The ",i+1," direction:[",direction[0],",",direction[1],",",direction[2],"]"
+        vprint(2, "The ",i+1," direction:[",direction[0],",",direction[1],",",direction[2],"]")
         GlobalDirection[0] += direction[0]
         GlobalDirection[1] += direction[1]
         GlobalDirection[2] += direction[2]
     GlobalDirection = [GlobalDirection[0]/NumberOfNeedles,GlobalDirection[1]/NumberOfNeedles,GlobalDirection[2]/NumberOfNeedles]
     for i in range(NumberOfNeedles):
         tempmetric1 = 1-(SingleDirection[i][0]*GlobalDirection[0]+SingleDirection[i][1]*GlobalDirection[1]+SingleDirection[i][2]*GlobalDirection[2])
-        print "The ",i+1," slope_metric_1:",tempmetric1
+        vprint(2, "The ",i+1," slope_metric_1:",tempmetric1)
         SlopeMetric_1.append(tempmetric1)
-    print "The global direction is:[",GlobalDirection[0],",",GlobalDirection[1],",",GlobalDirection[2],"]"
+    vprint(2, "The global direction is:[",GlobalDirection[0],",",GlobalDirection[1],",",GlobalDirection[2],"]")
     # The check of curvature
     CurvatureMetric = []
     for i in range(NumberOfNeedles):
@@ -3365,7 +3719,7 @@ class NeedleFinderLogic:
                     direction2 = [direction2[0]/l2,direction2[1]/l2,direction2[2]/l2]
                     temp = 1-(direction1[0]*direction2[0]+direction1[1]*direction2[1]+direction1[2]*direction2[2])
                     tempmetric2 += temp
-        print "The ",i+1," curvature_metric_2:",tempmetric2
+        vprint(2, "The ",i+1," curvature_metric_2:",tempmetric2)
         CurvatureMetric.append(tempmetric2)
 
     #distance metric
@@ -3410,14 +3764,14 @@ class NeedleFinderLogic:
     OverlapCounter = [([0]*NumberOfNeedles) for k in range(NumberOfNeedles)]
     NearestPoint = [([0]*NumberOfNeedles) for k in range(NumberOfNeedles)]
     NearestCoordinate = [([([0]*3) for k in range(NumberOfNeedles)]) for n in range(NumberOfNeedles)]
-    print "DistanceMetric"
-    print "Distance Between Each Other:"
+    vprint(2, "DistanceMetric")
+    vprint(2, "Distance Between Each Other:")
     for i in range(NumberOfNeedles):
         NumberOfPointsOnThisNeedle = len(ControlPointsPackage[i])
         if i<9:
-            print "Needle  ",i+1,":",
+            line = "Needle   %d :" % (i+1)
         else:
-            print "Needle ",i+1,":",
+            line = "Needle  %d :" % (i+1)
         for j in range(NumberOfNeedles):
             if i!=j:
                 distancebetween = 9999
@@ -3490,19 +3844,19 @@ class NeedleFinderLogic:
                 DistanceThreshold += judge
                 if distance<DistanceThreshold:
                     OverlapCounter[i][j] += 1
-            print " (%d"%NearestPoint[i][j],")%.2f"%DistanceBetweenEachOther[i][j],
-        print " "
-    print "The Overlap Counter"
+            line += "  (%d )%.2f" % (NearestPoint[i][j], DistanceBetweenEachOther[i][j])
+        vprint(2, line)
+    vprint(2, "The Overlap Counter")
     for i in range(NumberOfNeedles):
         if i<9:
-            print "Needle  ",i+1,":",
+            line = "Needle   %d :" % (i+1)
         else:
-            print "Needle ",i+1,":",
+            line = "Needle  %d :" % (i+1)
         for j in range(NumberOfNeedles):
-            print " %d"%OverlapCounter[i][j],
-        print " "
-    print "Check End"
-    print "Diagnosis Start"
+            line += "  %d" % OverlapCounter[i][j]
+        vprint(2, line)
+    vprint(2, "Check End")
+    vprint(2, "Diagnosis Start")
     InteractPairs = []
     InteractReasons = []
     for i in range(NumberOfNeedles):
@@ -3566,19 +3920,19 @@ class NeedleFinderLogic:
                 InteractReasons.append(interactreason)
     WrongPosition = InteractPairs
     WrongReason   = InteractReasons
-    print "Wrong Positions __ Interact Pairs (Interact Reason):"
+    vprint(2, "Wrong Positions __ Interact Pairs (Interact Reason):")
     NumberOfInteractPairs = len(InteractPairs)
     for i in range(NumberOfInteractPairs):
         pairtoshow = [InteractPairs[i][0]+1,InteractPairs[i][1]+1]
-        print pairtoshow,"(%d"%InteractReasons[i],")"
-    print "Diagnosis end"
+        vprint(2, pairtoshow,"(%d"%InteractReasons[i],")")
+    vprint(2, "Diagnosis end")
 
 
 
     NumberOfOriginalWrongPositions = len(OriginalWrongPositions)
     for i in range(NumberOfOriginalWrongPositions):
         if CurvatureMetric[OriginalWrongPositions[i][0]]>0.4 or SlopeMetric_1[OriginalWrongPositions[i][0]]>0.03:
-            print "The ",OriginalWrongPositions[i][0]+1,"needle is protected"
+            vprint(1, "The ",OriginalWrongPositions[i][0]+1,"needle is protected")
             FinalControlPointsPackage[OriginalWrongPositions[i][0]] = OriginalControlPointsPackage[OriginalWrongPositions[i][0]]
             FinalControlPointsPackageIJK[OriginalWrongPositions[i][0]] = OriginalControlPointsPackageIJK[OriginalWrongPositions[i][0]]
         #else:
@@ -3600,7 +3954,7 @@ class NeedleFinderLogic:
         2. The reason why they are wrong, in flags like [true, false] or [true, true]...
 
     """
-    print "Check Start"
+    vprint(2, "Check Start")
     flag_slope = False
     flag_combine = False
     WrongPosition = []
@@ -3623,16 +3977,16 @@ class NeedleFinderLogic:
         l = (direction[0]**2+direction[1]**2+direction[2]**2)**0.5
         direction = [direction[0]/l,direction[1]/l,direction[2]/l]
         SingleDirection.append(direction)
-        print "The ",i+1," direction:[",direction[0],",",direction[1],",",direction[2],"]"
+        vprint(2, "The ",i+1," direction:[",direction[0],",",direction[1],",",direction[2],"]")
         GlobalDirection[0] += direction[0]
         GlobalDirection[1] += direction[1]
         GlobalDirection[2] += direction[2]
     GlobalDirection = [GlobalDirection[0]/NumberOfNeedles,GlobalDirection[1]/NumberOfNeedles,GlobalDirection[2]/NumberOfNeedles]
     for i in range(NumberOfNeedles):
         tempmetric1 = 1-(SingleDirection[i][0]*GlobalDirection[0]+SingleDirection[i][1]*GlobalDirection[1]+SingleDirection[i][2]*GlobalDirection[2])
-        print "The ",i+1," slope_metric_1:",tempmetric1
+        vprint(2, "The ",i+1," slope_metric_1:",tempmetric1)
         SlopeMetric_1.append(tempmetric1)
-    print "The global direction is:[",GlobalDirection[0],",",GlobalDirection[1],",",GlobalDirection[2],"]"
+    vprint(2, "The global direction is:[",GlobalDirection[0],",",GlobalDirection[1],",",GlobalDirection[2],"]")
     # The check of curvature
     CurvatureMetric = []
     for i in range(NumberOfNeedles):
@@ -3653,7 +4007,7 @@ class NeedleFinderLogic:
                     direction2 = [direction2[0]/l2,direction2[1]/l2,direction2[2]/l2]
                     temp = 1-(direction1[0]*direction2[0]+direction1[1]*direction2[1]+direction1[2]*direction2[2])
                     tempmetric2 += temp
-        print "The ",i+1," curvature_metric_2:",tempmetric2
+        vprint(2, "The ",i+1," curvature_metric_2:",tempmetric2)
         CurvatureMetric.append(tempmetric2)
     # The check of Variation
     """
@@ -3766,14 +4120,14 @@ class NeedleFinderLogic:
     OverlapCounter = [([0]*NumberOfNeedles) for k in range(NumberOfNeedles)]
     NearestPoint = [([0]*NumberOfNeedles) for k in range(NumberOfNeedles)]
     NearestCoordinate = [([([0]*3) for k in range(NumberOfNeedles)]) for n in range(NumberOfNeedles)]
-    print "DistanceMetric"
-    print "Distance Between Each Other:"
+    vprint(2, "DistanceMetric")
+    vprint(2, "Distance Between Each Other:")
     for i in range(NumberOfNeedles):
         NumberOfPointsOnThisNeedle = len(ControlPointsPackage[i])
         if i<9:
-            print "Needle  ",i+1,":",
+            line = "Needle   %d :" % (i+1)
         else:
-            print "Needle ",i+1,":",
+            line = "Needle  %d :" % (i+1)
         for j in range(NumberOfNeedles):
             if i!=j:
                 distancebetween = 9999
@@ -3846,19 +4200,19 @@ class NeedleFinderLogic:
                 DistanceThreshold += judge
                 if distance<DistanceThreshold:
                     OverlapCounter[i][j] += 1
-            print " (%d"%NearestPoint[i][j],")%.2f"%DistanceBetweenEachOther[i][j],
-        print " "
-    print "The Overlap Counter"
+            line += "  (%d )%.2f" % (NearestPoint[i][j], DistanceBetweenEachOther[i][j])
+        vprint(2, line)
+    vprint(2, "The Overlap Counter")
     for i in range(NumberOfNeedles):
         if i<9:
-            print "Needle  ",i+1,":",
+            line = "Needle   %d :" % (i+1)
         else:
-            print "Needle ",i+1,":",
+            line = "Needle  %d :" % (i+1)
         for j in range(NumberOfNeedles):
-            print " %d"%OverlapCounter[i][j],
-        print " "
-    print "Check End"
-    print "Diagnosis Start"
+            line += "  %d" % OverlapCounter[i][j]
+        vprint(2, line)
+    vprint(2, "Check End")
+    vprint(2, "Diagnosis Start")
     InteractPairs = []
     InteractReasons = []
     for i in range(NumberOfNeedles):
@@ -3922,16 +4276,20 @@ class NeedleFinderLogic:
                 InteractReasons.append(interactreason)
     WrongPosition = InteractPairs
     WrongReason   = InteractReasons
-    print "Wrong Positions __ Interact Pairs (Interact Reason):"
+    vprint(2, "Wrong Positions __ Interact Pairs (Interact Reason):")
     NumberOfInteractPairs = len(InteractPairs)
     for i in range(NumberOfInteractPairs):
         pairtoshow = [InteractPairs[i][0]+1,InteractPairs[i][1]+1]
-        print pairtoshow,"(%d"%InteractReasons[i],")"
-    print "Diagnosis End"
+        vprint(2, pairtoshow,"(%d"%InteractReasons[i],")")
+    vprint(2, "Diagnosis End")
+    for i in range(NumberOfNeedles):
+      self.stepLog.record('RM check', i, None, direction=SingleDirection[i], slope=SlopeMetric_1[i],
+                          curvature=CurvatureMetric[i],
+                          interactions=[pair[1] for pair in InteractPairs if pair[0] == i])
 
     return WrongPosition, WrongReason, GlobalDirection
 
-  def needleDetectionThreadCurrentDev(self, A, imageData, colorVar, spacing, script=False, imgLabelData=None, manualName=""):
+  def needleDetectionThreadCurrentDev(self, A, imageData, colorVar, spacing, script=False, imgLabelData=None, manualName="", tipCorrected=False):
     """
     From the needle tip, the algorithm looks for a direction maximizing the "needle likelihood" of a small segment in a conic region.
     The second extremity of this segment is saved as a control point (in controlPoints), used later.
@@ -3939,872 +4297,154 @@ class NeedleFinderLogic:
     The height of the new conic region (stepsize) is increased as well as its base diameter (rMax) and its normal is collinear to the previous computed segment. (cf. C0)
     NbStepsNeedle iterations give NbStepsNeedle-1 control points, the last one being used as an extremity as well as the needle tip.
     From these NbStepsNeedle-1 control points and 2 extremities a Bezier curve is computed, approximating the needle path.
-    Is this a threaded function? No it is not yet unfortunately, but the idea was to do it!
+    The tracking is version 0 of NeedleFinderLib.NeedleDetector (trackCurrentDev), cf. trackNeedle.
 
     :param A: RAS coordinates of the needle tip
     :param imageData: volumeNode.GetImageData()
     :param colorVar: color of the needle
     :param spacing: volumneNode.GetSpacing()
+    :param tipCorrected: A was already refined by findTips (autoCorrectTip)
     :return: a needle in 3D!!
     """
     # research
     profprint()
+    self.controlPoints, controlPointsIJK = self.trackNeedle(0, A, imageData, colorVar, spacing, script, imgLabelData, manualName, True, tipCorrected=tipCorrected)
+
+  def trackNeedle(self, version, A, imageData, colorVar, spacing, script, imgLabelData, name, bDrawNeedle, feedback=None, detector=None, up=False, tipCorrected=False):
+    """
+    Track the needle from tip A [ijk] with the detection version on the headless NeedleFinderLib.NeedleDetector, show the
+    cones and control points as fiducials if asked to, mark the search cones in the label map (conesColor, versions 0-2)
+    and add the needle to the scene.
+    detector is an optional detector shared by the needles of a run (e.g. a NeedleFinderLib.ROIDetector).
+    :return: control points [RAS], control points [IJK]
+    """
+    # productive
+    profprint()
     global conesColor
+    widget = slicer.modules.NeedleFinderWidget
+    if detector == None:
+      autoCorrectTip = widget.autoCorrectTip.isChecked() and not tipCorrected
+      detector = self.needleDetector(imageData, imgLabelData, spacing,
+                                     self.detectionParameters(algoVersParameter=version, autoCorrectTip=autoCorrectTip))
+    parameters = detector.parameters
     if conesColor: conesColor=(conesColor+1)%308;
     if conesColor==0: conesColor=300
-    # ## initialisation of the parameters
-    ijk = [0, 0, 0]
-    bestPoint = [0, 0, 0]
-    mode = "circle"
+    marked = False
+    if conesColor and imgLabelData and version in (0, 1, 2) and isinstance(detector, NeedleFinderLib.NeedleDetector):
+      # mark the search cones in the label volume
+      labelArray = detector.label.writableArray()
+      color = conesColor
+      def marker(ijk):
+        labelArray[ijk[:, 0], ijk[:, 1], ijk[:, 2]] = color
+      detector.sampleMarker = marker
+      marked = True
+    onStep = None
+    if widget.drawFiducialPoints.isChecked():
+      oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
+      oFiducial.Initialize(slicer.mrmlScene)
+      oFiducial.SetName('.c0_'+str(colorVar))
+      oFiducial.SetFiducialCoordinates(detector.ijk2ras(A))
+      oFiducial.GetDisplayNode().SetColor(0,0,1)
+      if not script:
+        def onStep(step, C0, A):
+          oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
+          oFiducial.Initialize(slicer.mrmlScene)
+          oFiducial.SetName('.b'+str(step+1)+'_'+str(colorVar))
+          oFiducial.SetFiducialCoordinates(detector.ijk2ras(C0))
+          oFiducial.GetDisplayNode().SetColor(0,0,1)
+          fiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
+          fiducial.Initialize(slicer.mrmlScene)
+          fiducial.SetName('.c_'+str(colorVar))
+          fiducial.SetFiducialCoordinates(detector.ijk2ras(A))
+
+    lastRecord = self.stepLog.last
+    with NeedleFinderLib.tracer.span('needle', needle=name or colorVar):
+      controlPoints, controlPointsIJK = detector.track(A, feedback, onStep, name, up)
+    if marked:
+      imgLabelData.Modified()
+    if version == 0:
+      self.estimatorReference = detector.estimatorReference
+    elif version == 3:
+      self.printStepRecords(lastRecord)
+      for warning in detector.warnings:
+        breakbox(warning)
+      del detector.warnings[:]
+    elif version == 6:
+      search = detector.coarseToFine
+      print "coarse-to-fine: %d of %d cones searched exhaustively (%d too small for the coarse search), %d samples" % (
+        search.direct + search.fallbacks, search.steps, search.direct, detector.samples)
+
+    if not parameters.autoStopTip:
+      if bDrawNeedle: self.addNeedleToScene(controlPoints, colorVar, 'Detection', script, 0, manualName=name)
+
+    return controlPoints, controlPointsIJK
 
-    # ## load parameters from GUI
+  def needleDetectionThread13_1(self, Aori, imageData, colorVar, spacing, script=False, imgLabelData=None,manName="",bDrawNeedle=False,whetherfeedback=False,ControlPointsPackage=None,ControlPointsPackageIJK=None,WrongPosition=None,GlobalDirection=None, Punish=None):
+    '''MICCAI2013 suspect version, 3/11/13
+    iGyne_old b16872c19a3bc6be1f4a9722e5daf16a603393f6
+    https://github.com/gpernelle/iGyne_old/commit/b16872c19a3bc6be1f4a9722e5daf16a603393f6#diff-8ab0fe8b431d2af8b1aff51977e85ca2
 
+    From the needle tip, the algorithm looks for a direction maximizing the "needle likelihood" of a small segment in a conic region.
+    The second extremity of this segment is saved as a control point (in controlPoints), used later.
+    Then, this step is iterated, replacing the needle tip by the latest control point.
+    The height of the new conic region (stepsize) is increased as well as its base diameter (rMax) and its normal is collinear to the previous computed segment. (cf. C0)
+    NbStepsNeedle iterations give NbStepsNeedle-1 control points, the last one being used as an extremity as well as the needle tip.
+    From these NbStepsNeedle-1 control points and 2 extremities a Bezier curve is computed, approximating the needle path.
+    The tracking is version 1 of NeedleFinderLib.NeedleDetector (trackCones13), cf. trackNeedle.
+    '''
+    # productive #probablyMiccai13
+    profprint()
     widget = slicer.modules.NeedleFinderWidget
-
-    distanceMax = widget.radiusMax.value
-    gradientPonderation = widget.gradientPonderation.value
-    sigmaValue = widget.sigmaValue.value
-    # stepsize                    = widget.stepsize.value
-    gaussianAttenuationChecked = widget.gaussianAttenuationButton.isChecked()
-    gradient = widget.gradient.isChecked()
-    numberOfPointsPerNeedle = max(1, widget.numberOfPointsPerNeedle.value - 1)
-    nbRotatingIterations = widget.nbRotatingIterations.value
-    radiusNeedleParameter = widget.radiusNeedleParameter.value
-    axialSegmentationLimit = widget.axialSegmentationLimit
-    lenghtNeedleParameter = widget.lenghtNeedleParameter.value / (spacing[2])
-    autoCorrectTip = widget.autoCorrectTip.isChecked()
-    exponent = widget.exponent.value
-    drawFiducialPoints = widget.drawFiducialPoints.isChecked()
-    autoStopTip = widget.autoStopTip.isChecked()
-
-    # ## length needle = distance Aijk[2]*0.9
-    # lenghtNeedle = abs(self.ijk2ras(A)[2]*0.9)
-    A = [int(A[0]), int(A[1]), int(A[2])]
-    if axialSegmentationLimit != None:
-      lenghtNeedle = abs(A[2] - axialSegmentationLimit) * 1.15 * spacing[2]
-    elif axialSegmentationLimit == None and widget.maxLength.isChecked():
-      axialSegmentationLimit = 0
-      lenghtNeedle = abs(A[2] - axialSegmentationLimit) * 1.15 * spacing[2]
+    # >>>>>> Ruibins feedback >>>>>>>>>>
+    feedback = None
+    if(whetherfeedback):
+        WrongIndex = WrongPosition[0]
+        RelatedIndex = WrongPosition[1:]
+        A = ControlPointsPackageIJK[WrongIndex][0]
+        radiusNeedleParameter = widget.radiusNeedleParameter.value
+        feedback = lambda M: self.Feedback(ControlPointsPackage, Punish, radiusNeedleParameter, len(RelatedIndex), len, RelatedIndex, range, M)
     else:
-      lenghtNeedle = lenghtNeedleParameter
+        A = Aori
+    #<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+    return self.trackNeedle(1, A, imageData, colorVar, spacing, script, imgLabelData, manName, bDrawNeedle, feedback)
 
-    rMax = distanceMax / float(spacing[0])
-    NbStepsNeedle = numberOfPointsPerNeedle - 1
-    nbRotatingStep = nbRotatingIterations
+  def needleDetectionThread13_2(self, A, imageData, colorVar, spacing, script=False, imgLabelData=None,manualName="",bDrawNeedle=True):
+    '''MICCAI2013 suspect version, 3/11/13
+    iGyne_old b16872c19a3bc6be1f4a9722e5daf16a603393f6
+    https://github.com/gpernelle/iGyne_old/commit/b16872c19a3bc6be1f4a9722e5daf16a603393f6#diff-8ab0fe8b431d2af8b1aff51977e85ca2
 
-    dims = [0, 0, 0]
-    imageData.GetDimensions(dims)
-    pixelValue = numpy.zeros(shape=(dims[0], dims[1], dims[2]))
+    >>> same as 13_1, with bugfixes (e.g. concerning down stepSize or L "/spacing[2]") <<<
 
-    A0 = A
-    # print A0
+    The tracking is version 2 of NeedleFinderLib.NeedleDetector (trackCones13), cf. trackNeedle and needleDetectionThread13_1.
+    '''
+    #productive #probablyMiccai13 #smallChanges
+    profprint()
+    return self.trackNeedle(2, A, imageData, colorVar, spacing, script, imgLabelData, manualName, bDrawNeedle)
 
-    self.controlPoints = []
-    controlPointsIJK = []
-    bestControlPoints = []
+  def addPlaneToScene(self, foot, x, y):
+    """
+    Add a plane to the scene.
+    :param foot: base point
+    :param x: vector
+    :param y: vector
+    :return: visible plane in scene
+    """
+    #research
+    profprint()
+    scene = slicer.mrmlScene
+    # Create model node
+    model = slicer.vtkMRMLModelNode()
+    model.SetScene(scene)
+    model.SetName(scene.GenerateUniqueName(".ObturatorPlane"))
 
-    radiusNeedle = int(round(radiusNeedleParameter / float(spacing[0])))
-    radiusNeedleCorner = int(round((radiusNeedleParameter / float(spacing[0]) / 1.414)))
-
-    #---------------------------------------------------------------------------------
-    # look for the best tip in the neighboorhood of the mouse click
-    coeff = 1  # to look every 0.2mm
-    radiusSphere = 5
-    X = coeff * radiusSphere / float(spacing[0])
-    Y = coeff * radiusSphere / float(spacing[1])
-    Z = 5 / float(spacing[2])
-    # print "X,Y,Z",X,Y,Z
-    #---------------------------------------------------------------------------------
-    # find the tip in a circle
-    if autoCorrectTip:
-      A = self.findTip(A, imageData, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y, Z)
-    # keep the first control point as A0
-    A0 = A
-    #---------------------------------------------------------------------------------
-    # Add points to the control point list
-
-    self.controlPoints.append(self.ijk2ras(A))
-    controlPointsIJK.append(A)
-    bestControlPoints.append(self.ijk2ras(A))
-    #---------------------------------------------------------------------------------
-    # Draw fiducial points initial tip and found tip
-    if drawFiducialPoints:
-      oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-      oFiducial.Initialize(slicer.mrmlScene)
-      oFiducial.SetName('.c0_'+str(colorVar))
-      oFiducial.SetFiducialCoordinates(self.ijk2ras(A))
-      oFiducial.GetDisplayNode().SetColor(0,0,1)
-      """
-      fiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-      fiducial.Initialize(slicer.mrmlScene)
-      fiducial.SetName('Best tip')
-      fiducial.SetFiducialCoordinates(self.ijk2ras(A))
-
-      fiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-      fiducial.Initialize(slicer.mrmlScene)
-      fiducial.SetName('A init')
-      fiducial.SetFiducialCoordinates(self.ijk2ras(AInit))
-      """
-
-    for step in range(0, NbStepsNeedle + 1):
-
-      # step 0
-      #------------------------------------------------------------------------------
-      if step == 0:
-
-        stepSize = self.stepSize(step, NbStepsNeedle) * lenghtNeedle
-
-        Vx = 0
-        Vy = 0
-        Vz = -stepSize
-
-        rMax = distanceMax / float(spacing[0])
-        rIter = int(round(rMax))
-        tIter = max(1, int(round(stepSize)))  # ## ??? stepSize can be smaller 1 and it is in mm not int index coordinates
-
-        # print "stepsize 0:",stepSize
-
-        tot = stepSize
-
-      else:
-
-        """
-          step 1,2,...
-          ------------------------------------------------------------------------------
-                 [   vector V   ]
-                 *--------------*---------------------X   -> direction of tracking
-                tip0            A                    C0
-
-                then, for the following step:
-                                              tip0<-A, A<-C, C0 = A + K.V
-        """
-        """
-        stepSize = self.stepSize(step+1,NbStepsNeedle+1)*lenghtNeedle
-        #print '\nstepsize',step, ':',stepSize
-
-
-        C0      = [ 2*A[0]-tip0[0],
-                    2*A[1]-tip0[1],
-                    A[2]-stepSize   ]
-        """
-
-
-        stepSize = self.stepSize(step + 1, NbStepsNeedle + 1) * lenghtNeedle
-        rMax = max(stepSize, distanceMax / float(spacing[0])) # ??? why is stepSize not divided by spacing[0]
-        rIter = max(15, min(20, int(rMax / float(spacing[0])))) # ??? why divide rMax again by spacing[0]
-        tIter = max(1, int(round(stepSize)))  # ## ??? stepSize can be smaller 1 and it is in mm not int index coordinates
-
-        # Vector V
-        Vx = A[0] - tip0[0]
-        Vy = A[1] - tip0[1]
-        Vz = A[2] - tip0[2]
-
-      coeffSize = abs(stepSize) / spacing[2]
-      if Vz != 0 :
-        K = coeffSize / float(abs(Vz))
-      else:
-        break
-
-      P0 = A
-      C0 = [ P0[0] + K * Vx,
-                    P0[1] + K * Vy,
-                    P0[2] + K * Vz ]
-
-      if drawFiducialPoints and 1: # show cone base markers b
-        oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-        oFiducial.Initialize(slicer.mrmlScene)
-        oFiducial.SetName('.b'+str(step+1)+'_'+str(colorVar))
-        oFiducial.SetFiducialCoordinates(self.ijk2ras(C0))
-        oFiducial.GetDisplayNode().SetColor(0,0,1)
-
-      estimator = 0
-      minEstimator = 0
-
-      # radius variation
-      for R in range(rIter + 1):
-
-        r = R * (rMax / float(rIter))
-
-        # ## angle variation from 0 to 360
-        for thetaStep in xrange(nbRotatingStep):
-
-          angleInDegree = (thetaStep * 360) / float(nbRotatingStep)
-          theta = math.radians(angleInDegree)
-
-          C = [ C0[0] + r * (math.cos(theta)),
-                            C0[1] + r * (math.sin(theta)),
-                            C0[2]]
-
-          total = 0
-          M = [[0, 0, 0] for i in xrange(int(tIter) + 1)]
-
-
-          # calculates tIter = number of points per segment
-          # print tIter
-          for t in xrange(tIter + 1):
-
-            tt = t / float(tIter)
-
-            # x,y,z coordinates
-            for i in range(3):
-
-              M[t][i] = (1 - tt) * A[i] + tt * C[i]
-              ijk[i] = int(round(M[t][i]))
-
-            # first, test if points are in the image space
-            if ijk[0] < dims[0] and ijk[0] > 0 and  ijk[1] < dims[1] and ijk[1] > 0 and ijk[2] < dims[2] and ijk[2] > 0:
-
-              center = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1], ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0] + 1, ijk[1], ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0] - 1, ijk[1], ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + 1, ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - 1, ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0] + 1, ijk[1] + 1, ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0] + 1, ijk[1] - 1, ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0] - 1, ijk[1] + 1, ijk[2], 0)
-              center += imageData.GetScalarComponentAsDouble(ijk[0] - 1, ijk[1] - 1, ijk[2], 0)
-
-              total += center ** exponent
-              if gradient == 1 and mode == "circle" :
-
-                g1 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedle, ijk[1], ijk[2], 0)
-                g2 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedle, ijk[1], ijk[2], 0)
-                g3 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + radiusNeedle, ijk[2], 0)
-                g4 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - radiusNeedle, ijk[2], 0)
-                g5 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                g6 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-                g7 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                g8 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-
-                # total += (center - ((g1+g2+g3+g4+g5+g6+g7+g8)/float(8))*gradientPonderation)/float(tIter)
-                total += ((center - g1) ** gradientPonderation) / float(tIter)
-                total += ((center - g2) ** gradientPonderation) / float(tIter)
-                total += ((center - g3) ** gradientPonderation) / float(tIter)
-                total += ((center - g4) ** gradientPonderation) / float(tIter)
-                total += ((center - g5) ** gradientPonderation) / float(tIter)
-                total += ((center - g6) ** gradientPonderation) / float(tIter)
-                total += ((center - g7) ** gradientPonderation) / float(tIter)
-                total += ((center - g8) ** gradientPonderation) / float(tIter)
-
-                # total = self.objectiveFunctionLOG(imageData, ijk, radiusNeedleParameter, spacing, 1)
-
-              if gradient == 1 and mode == "square" :
-
-                g1 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedle, ijk[1], ijk[2], 0)
-                g2 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedle, ijk[1], ijk[2], 0)
-                g3 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + radiusNeedle, ijk[2], 0)
-                g4 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - radiusNeedle, ijk[2], 0)
-
-                total += (8 * center - ((g1 + g2 + g3 + g4) / float(4)) * gradientPonderation) / float(tIter)
-
-                # total = self.objectiveFunctionLOG(imageData, ijk, radiusNeedleParameter, spacing, 1)
-              # >>>>>>>>>>>>>>>>>>>>>> exp.02
-              if imgLabelData:
-                fLabel = imgLabelData.GetScalarComponentAsFloat(ijk[0], ijk[1], ijk[2], 0)
-                if fLabel and fLabel < 300:
-                  #print "# force high influence of found label: ",fLabel
-                  total -= 10000
-                if conesColor: imgLabelData.SetScalarComponentFromFloat(ijk[0], ijk[1], ijk[2], 0, conesColor) #mark the search cones in fLabel volume
-              # <<<<<<<<<<<<<<<<<<<<
-          if R == 0:
-
-            initialIntensity = total
-            estimator = total
-
-          if gaussianAttenuationChecked == 1 and step >= 2 :
-            if step == NbStepsNeedle:
-                sigmaValue = 100
-
-            if Vz != 0:
-              """
-              stepSize    =(A[2] - C0[2])
-              K           =stepSize/float(tip0[2]-A[2])
-
-              X           = [ A[0] + K * (A[0]-tip0[0]),
-                              A[1] + K * (A[1]-tip0[1]),
-                              A[2] + K * (A[2]-tip0[2]) ]
-              """
-
-              rgauss = ((C[0] - C0[0]) ** 2
-                              + (C[1] - C0[1]) ** 2
-                              + (C[2] - C0[2]) ** 2) ** 0.5
-
-              gaussianAttenuation = math.exp(-(rgauss / float(rMax)) ** 2 / float((2 * (sigmaValue / float(10)) ** 2)))  # 1 for x=0, 0.2 for x=5
-              estimator = (total) * gaussianAttenuation # ??? this doesn't work as intended for negative values (they get larger!)
-            else:
-              estimator = total
-
-
-          else:
-            estimator = (total)
-
-          if estimator < initialIntensity:
-
-            if estimator < minEstimator or minEstimator == 0:
-              minEstimator = estimator
-              if minEstimator != 0:
-                bestPoint = C
-
-
-      tip0 = A
-      if bestPoint == [0, 0, 0]:
-        A = C0
-      elif bestPoint != tip0:
-        A = bestPoint
-
-      # save the value of the objective function for the initial step.
-      # will be used as reference for the initial step of the ascending tracking
-      if step == 1:
-        self.estimatorReference = minEstimator
-
-
-      if A[2] < axialSegmentationLimit and A != A0:
-
-        asl = axialSegmentationLimit
-        l = (A[2] - asl) / float(tip0[2] - A[2])
-
-        A = [  A[0] - l * (tip0[0] - A[0]),
-                A[1] - l * (tip0[1] - A[1]),
-                A[2] - l * (tip0[2] - A[2])]
-
-      self.controlPoints.append(self.ijk2ras(A))
-      controlPointsIJK.append(A)
-      # print('step:',step,':',minEstimator )
-      if drawFiducialPoints:
-        fiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-        fiducial.Initialize(slicer.mrmlScene)
-        fiducial.SetName('.c' +str(step)+'_'+ str(colorVar))
-        fiducial.SetFiducialCoordinates(self.controlPoints[step + 1])
-
-      if A[2] <= axialSegmentationLimit and A != A0:
-        break
-
-    if not autoStopTip:
-      self.addNeedleToScene(self.controlPoints, colorVar, 'Detection', script,0, manualName=manualName)
-
-  def needleDetectionThread13_1(self, Aori, imageData, colorVar, spacing, script=False, imgLabelData=None,manName="",bDrawNeedle=False,whetherfeedback=False,ControlPointsPackage=None,ControlPointsPackageIJK=None,WrongPosition=None,GlobalDirection=None, Punish=None):
-    '''MICCAI2013 suspect version, 3/11/13
-    iGyne_old b16872c19a3bc6be1f4a9722e5daf16a603393f6
-    https://github.com/gpernelle/iGyne_old/commit/b16872c19a3bc6be1f4a9722e5daf16a603393f6#diff-8ab0fe8b431d2af8b1aff51977e85ca2
-
-    From the needle tip, the algorithm looks for a direction maximizing the "needle likelihood" of a small segment in a conic region.
-    The second extremity of this segment is saved as a control point (in controlPoints), used later.
-    Then, this step is iterated, replacing the needle tip by the latest control point.
-    The height of the new conic region (stepsize) is increased as well as its base diameter (rMax) and its normal is collinear to the previous computed segment. (cf. C0)
-    NbStepsNeedle iterations give NbStepsNeedle-1 control points, the last one being used as an extremity as well as the needle tip.
-    From these NbStepsNeedle-1 control points and 2 extremities a Bezier curve is computed, approximating the needle path.
-    '''
-    # productive #probablyMiccai13
-    profprint()
-    global conesColor
-    if conesColor: conesColor=(conesColor+1)%308;
-    if conesColor==0: conesColor=300
-    # ## initialisation of the parameters
-    ijk = [0, 0, 0]
-    bestPoint = [0, 0, 0]
-    widget = slicer.modules.NeedleFinderWidget
-
-    # ## load parameters from GUI
-    distanceMax = widget.radiusMax.value
-    gradientPonderation = widget.gradientPonderation.value
-    sigmaValue = widget.sigmaValue.value
-    stepsize = widget.stepsize.value
-    gaussianAttenuationChecked = widget.gaussianAttenuationButton.isChecked()
-    gradient = widget.gradient.isChecked()
-    numberOfPointsPerNeedle = widget.numberOfPointsPerNeedle.value
-    nbRotatingIterations = widget.nbRotatingIterations.value
-    radiusNeedleParameter = widget.radiusNeedleParameter.value
-    axialSegmentationLimit = widget.axialSegmentationLimit
-    autoStopTip = widget.autoStopTip.isChecked()
-
-    # >>>>>> Ruibins feedback >>>>>>>>>>
-    if(whetherfeedback):
-        WrongIndex = WrongPosition[0]
-        NumberOfRelatedIndexs = len(WrongPosition) - 1
-        RelatedIndex = []
-        for k in range(NumberOfRelatedIndexs):
-            RelatedIndex.append(WrongPosition[k+1])
-        A = ControlPointsPackageIJK[WrongIndex][0]
-        NeighbourAttenuation = 0
-    else:
-        A = Aori
-    #<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-
-    # ## length needle = distance Aijk[2]*0.9
-    # lenghtNeedle = abs(self.ijk2ras(A)[2]*0.9)
-
-    if axialSegmentationLimit != None:
-      lenghtNeedle = abs(A[2] - axialSegmentationLimit) * 1.15 * spacing[2]
-    else:
-      lenghtNeedle = A[2] * 0.9 * spacing[2]
-
-    rMax = distanceMax / float(spacing[0])
-    NbStepsNeedle = numberOfPointsPerNeedle - 1
-    nbRotatingStep = nbRotatingIterations
-
-    dims = [0, 0, 0]
-    imageData.GetDimensions(dims)
-    pixelValue = numpy.zeros(shape=(dims[0], dims[1], dims[2]))
-
-    A0 = A
-    print A0
-    if widget.drawFiducialPoints.isChecked():
-      oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-      oFiducial.Initialize(slicer.mrmlScene)
-      oFiducial.SetName('.c0_'+str(colorVar))
-      oFiducial.SetFiducialCoordinates(self.ijk2ras(A))
-      oFiducial.GetDisplayNode().SetColor(0,0,1)
-
-    controlPoints = []
-    controlPointsIJK = []
-    bestControlPoints = []
-
-    controlPoints.append(self.ijk2ras(A))
-    controlPointsIJK.append(A)
-    bestControlPoints.append(self.ijk2ras(A))
-
-    for step in range(0, NbStepsNeedle + 2):
-      print "length", lenghtNeedle
-      # step 0
-      #------------------------------------------------------------------------------
-      if step == 0:
-
-        L = self.stepSize13(step + 1, NbStepsNeedle + 1) * lenghtNeedle
-        C0 = [A[0], A[1], A[2] - L]
-        rMax = distanceMax / float(spacing[0])
-        rIter = rMax
-        tIter = int(round(L))  # ??? L can be smaller 1 and it is in mm not int index coordinates
-
-      # step 1,2,...
-      #------------------------------------------------------------------------------
-      else:
-
-        stepSize = self.stepSize13(step + 1, NbStepsNeedle + 1) * lenghtNeedle
-        print stepSize
-
-        C0 = [ 2 * A[0] - tip0[0],
-                    2 * A[1] - tip0[1],
-                    A[2] - stepSize   ]  # ??? this is buggy vector calculus, now its a feature ;-)
-
-        rMax = max(stepSize, distanceMax / float(spacing[0]))
-        rIter = max(15, min(20, int(rMax / float(spacing[0])))) # ??? why divide again by spacing[0]
-        tIter = stepSize  # ## ??? stepSize can be smaller 1 and it is in mm not int index coordinates
-
-      if not script and widget.drawFiducialPoints.isChecked(): # show cone base markers b
-        oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-        oFiducial.Initialize(slicer.mrmlScene)
-        oFiducial.SetName('.b'+str(step+1)+'_'+str(colorVar))
-        oFiducial.SetFiducialCoordinates(self.ijk2ras(C0))
-        oFiducial.GetDisplayNode().SetColor(0,0,1)
-
-      estimator = 0
-      minEstimator = 0
-
-      # radius variation
-      for R in range(int(rIter) + 1):
-
-        r = R * (rMax / float(rIter))
-
-        # ## angle variation from 0 to 360
-        for thetaStep in xrange(int(nbRotatingStep)):
-
-          angleInDegree = (thetaStep * 360) / float(nbRotatingStep)
-          theta = math.radians(angleInDegree)
-
-          C = [ C0[0] + r * (math.cos(theta)),
-                            C0[1] + r * (math.sin(theta)),
-                            C0[2]]
-
-          total = 0
-          M = [[0, 0, 0] for i in xrange(int(tIter) + 1)]
-
-
-          # calculates tIter = number of points per segment
-          for t in xrange(int(tIter) + 1):
-
-            tt = t / float(tIter)
-
-            # x,y,z coordinates
-            for i in range(3):
-
-              M[t][i] = (1 - tt) * A[i] + tt * C[i]
-              ijk[i] = int(round(M[t][i]))
-
-            # first, test if points are in the image space
-            if ijk[0] < dims[0] and ijk[0] > 0 and  ijk[1] < dims[1] and ijk[1] > 0 and ijk[2] < dims[2] and ijk[2] > 0:
-
-              center = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1], ijk[2], 0)
-              total += center
-
-              #>>>>>>>>>>>>>>> Ruibins feedback >>>>>>>>>>>>>>>>>
-              if(whetherfeedback):
-                  NeighbourAttenuation = self.Feedback(ControlPointsPackage, Punish, radiusNeedleParameter, NumberOfRelatedIndexs, len, RelatedIndex, range, M[t])
-                  total +=NeighbourAttenuation
-              #<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-
-              if gradient == 1 :
-
-                radiusNeedle = int(round(radiusNeedleParameter / float(spacing[0])))
-                radiusNeedleCorner = int(round((radiusNeedleParameter / float(spacing[0]) / 1.414)))
-
-                g1 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedle, ijk[1], ijk[2], 0)
-                g2 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedle, ijk[1], ijk[2], 0)
-                g3 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + radiusNeedle, ijk[2], 0)
-                g4 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - radiusNeedle, ijk[2], 0)
-                g5 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                g6 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-                g7 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                g8 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-
-                total += 8 * center - ((g1 + g2 + g3 + g4 + g5 + g6 + g7 + g8) / 8) * gradientPonderation
-              # >>>>>>>>>>>>>>>>>>>>>> exp.02
-              if imgLabelData:
-                fLabel = imgLabelData.GetScalarComponentAsFloat(ijk[0], ijk[1], ijk[2], 0)
-                if fLabel and fLabel < 300:
-                  #print "# force high influence of found label: ",fLabel
-                  total -= 10000
-                if conesColor: imgLabelData.SetScalarComponentFromFloat(ijk[0], ijk[1], ijk[2], 0, conesColor) #mark the search cones in fLabel volume
-              # <<<<<<<<<<<<<<<<<<<<
-          if R == 0:
-
-            initialIntensity = total
-            estimator = total
-
-          if gaussianAttenuationChecked == 1 and step >= 2 :
-
-            if tip0[2] - A[2] != 0:
-
-                stepSize = (A[2] - C0[2])
-                K = stepSize / float(tip0[2] - A[2])
-
-                X = [ A[0] + K * (A[0] - tip0[0]),
-                                A[1] + K * (A[1] - tip0[1]),
-                                A[2] + K * (A[2] - tip0[2]) ]
-
-                rgauss = ((C[0] - X[0]) ** 2
-                                + (C[1] - X[1]) ** 2
-                                + (C[2] - X[2]) ** 2) ** 0.5
-
-                gaussianAttenuation = math.exp(-(rgauss / float(rMax)) ** 2 / float((2 * (sigmaValue / float(10)) ** 2)))  # 1 for x=0, 0.2 for x=5
-                estimator = (total) * gaussianAttenuation # ??? this doesn't work as intended for negative values (they get larger!)
-            else:
-                estimator = total
-
-
-          else:
-            estimator = (total)
-
-          if estimator < initialIntensity:
-
-            if estimator < minEstimator or minEstimator == 0:
-              minEstimator = estimator
-              if minEstimator != 0:
-                bestPoint = C
-
-
-      tip0 = A
-      if bestPoint == [0, 0, 0]:
-        A = C0
-      elif bestPoint != tip0:
-        A = bestPoint
-
-
-      if A[2] < axialSegmentationLimit and A != A0:
-
-        asl = axialSegmentationLimit
-        l = (A[2] - asl) / float(tip0[2] - A[2])
-
-        A = [  A[0] - l * (tip0[0] - A[0]),
-                A[1] - l * (tip0[1] - A[1]),
-                A[2] - l * (tip0[2] - A[2])]
-
-      controlPoints.append(self.ijk2ras(A))
-      controlPointsIJK.append(A)
-
-      if not script and widget.drawFiducialPoints.isChecked():
-        fiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-        fiducial.Initialize(slicer.mrmlScene)
-        fiducial.SetName('.c_'+str(colorVar))
-        fiducial.SetFiducialCoordinates(controlPoints[step + 1])
-
-      if A[2] <= axialSegmentationLimit and A != A0:
-        break
-
-    # self.addNeedleToScene(controlPoints,colorVar)
-    if not autoStopTip:
-      if bDrawNeedle: self.addNeedleToScene(controlPoints, colorVar, 'Detection', script,0,manualName=manName)
-
-    return controlPoints,controlPointsIJK # <<< Ruibin
-
-  def needleDetectionThread13_2(self, A, imageData, colorVar, spacing, script=False, imgLabelData=None,manualName=""):
-    '''MICCAI2013 suspect version, 3/11/13
-    iGyne_old b16872c19a3bc6be1f4a9722e5daf16a603393f6
-    https://github.com/gpernelle/iGyne_old/commit/b16872c19a3bc6be1f4a9722e5daf16a603393f6#diff-8ab0fe8b431d2af8b1aff51977e85ca2
-
-    >>> same as 13_1, with bugfixes (e.g. concerning down stepSize or L "/spacing[2]") <<<
-
-    From the needle tip, the algorithm looks for a direction maximizing the "needle likelihood" of a small segment in a conic region.
-    The second extremity of this segment is saved as a control point (in controlPoints), used later.
-    Then, this step is iterated, replacing the needle tip by the latest control point.
-    The height of the new conic region (stepsize) is increased as well as its base diameter (rMax) and its normal is collinear to the previous computed segment. (cf. C0)
-    NbStepsNeedle iterations give NbStepsNeedle-1 control points, the last one being used as an extremity as well as the needle tip.
-    From these NbStepsNeedle-1 control points and 2 extremities a Bezier curve is computed, approximating the needle path.
-    '''
-    #productive #probablyMiccai13 #smallChanges
-    profprint()
-    t0 = time.clock()
-    global conesColor
-    if conesColor: conesColor=(conesColor+1)%308;
-    if conesColor==0: conesColor=300
-    # ## initialisation of the parameters
-    ijk = [0, 0, 0]
-    bestPoint = [0, 0, 0]
-    widget = slicer.modules.NeedleFinderWidget
-
-    # ## load parameters from GUI
-    distanceMax = widget.radiusMax.value
-    gradientPonderation = widget.gradientPonderation.value
-    sigmaValue = widget.sigmaValue.value
-    stepsize = widget.stepsize.value
-    gaussianAttenuationChecked = widget.gaussianAttenuationButton.isChecked()
-    gradient = widget.gradient.isChecked()
-    numberOfPointsPerNeedle = widget.numberOfPointsPerNeedle.value
-    nbRotatingIterations = widget.nbRotatingIterations.value
-    radiusNeedleParameter = widget.radiusNeedleParameter.value
-    axialSegmentationLimit = widget.axialSegmentationLimit
-    autoStopTip = widget.autoStopTip.isChecked()
-
-    # ## length needle = distance Aijk[2]*0.9
-    # lenghtNeedle = abs(self.ijk2ras(A)[2]*0.9)
-
-    if axialSegmentationLimit != None:
-      lenghtNeedle = abs(A[2] - axialSegmentationLimit) * 1.15 * spacing[2]
-    else:
-      lenghtNeedle = A[2] * 0.9 * spacing[2]
-
-    rMax = distanceMax / float(spacing[0])
-    NbStepsNeedle = numberOfPointsPerNeedle - 1
-    nbRotatingStep = nbRotatingIterations
-
-    dims = [0, 0, 0]
-    imageData.GetDimensions(dims)
-    pixelValue = numpy.zeros(shape=(dims[0], dims[1], dims[2]))
-
-    A0 = A
-    print A0
-    if widget.drawFiducialPoints.isChecked():
-      oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-      oFiducial.Initialize(slicer.mrmlScene)
-      oFiducial.SetName('.c0_'+str(colorVar))
-      oFiducial.SetFiducialCoordinates(self.ijk2ras(A))
-      oFiducial.GetDisplayNode().SetColor(0,0,1)
-
-    controlPoints = []
-    controlPointsIJK = []
-    bestControlPoints = []
-
-    controlPoints.append(self.ijk2ras(A))
-    controlPointsIJK.append(A)
-    bestControlPoints.append(self.ijk2ras(A))
-
-    for step in range(0, NbStepsNeedle + 2):
-      print "length", lenghtNeedle
-      # step 0
-      #------------------------------------------------------------------------------
-      if step == 0:
-
-        L = self.stepSize13(step + 1, NbStepsNeedle + 1) * lenghtNeedle
-        #L = self.stepSizeAndre(step + 1, NbStepsNeedle + 2) * lenghtNeedle #<<< not better
-        #L=lenghtNeedle/NbStepsNeedle #<o><< equal step size: better!
-        C0 = [A[0], A[1], A[2] - L /spacing[2]] #<<< /spacing[2] bugfix
-        rMax = distanceMax / float(spacing[0])
-        rIter = rMax
-        tIter = int(round(L))  ## /spacing[2] worse at beginnng! more steps??? L can be smaller 1 and it is in mm not int index coordinates
-
-      # step 1,2,...
-      #------------------------------------------------------------------------------
-      else:
-
-        stepSize = self.stepSize13(step + 1, NbStepsNeedle + 1) * lenghtNeedle
-        #stepSize = self.stepSizeAndre(step + 1, NbStepsNeedle + 2) * lenghtNeedle #<<< not better
-        #stepSize=lenghtNeedle/NbStepsNeedle #<o><< equal step size: better!
-        print stepSize
-
-        C0 = [ 2 * A[0] - tip0[0],
-                    2 * A[1] - tip0[1],
-                    A[2] - stepSize /spacing[2]   ]  #<<< /spacing[2] bugfix # ??? this is buggy vector calculus, now its a feature ;-)
-        #C0 = [A[0], A[1], A[2]+int(round(stepSize/spacing[2])) ] #<<< TODO test simply going down along z-axis
-        rMax = max(stepSize, distanceMax / float(spacing[0]))
-        rIter = max(15, min(20, int(rMax / float(spacing[0])))) # ??? why divide again by spacing[0]
-        tIter = stepSize     # /spacing[2]  #more steps, slightly better! ??? stepSize can be smaller 1 and it is in mm not int index coordinates
-
-      if not script and widget.drawFiducialPoints.isChecked(): # show cone base markers b
-        oFiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-        oFiducial.Initialize(slicer.mrmlScene)
-        oFiducial.SetName('.b'+str(step+1)+'_'+str(colorVar))
-        oFiducial.SetFiducialCoordinates(self.ijk2ras(C0))
-        oFiducial.GetDisplayNode().SetColor(0,0,1)
-
-      estimator = 0
-      minEstimator = 0
-
-      # radius variation
-      for R in range(int(rIter) + 1):
-
-        r = R * (rMax / float(rIter))
-
-        # ## angle variation from 0 to 360
-        for thetaStep in xrange(int(nbRotatingStep)):
-
-          angleInDegree = (thetaStep * 360) / float(nbRotatingStep)
-          theta = math.radians(angleInDegree)
-
-          C = [ C0[0] + r * (math.cos(theta)),
-                            C0[1] + r * (math.sin(theta)),
-                            C0[2]]
-
-          total = 0
-          M = [[0, 0, 0] for i in xrange(int(tIter) + 1)]
-
-
-          # calculates tIter = number of points per segment
-          for t in xrange(int(tIter) + 1):
-
-            tt = t / float(tIter)
-
-            # x,y,z coordinates
-            for i in range(3):
-
-              M[t][i] = (1 - tt) * A[i] + tt * C[i]
-              ijk[i] = int(round(M[t][i]))
-
-            # first, test if points are in the image space
-            if ijk[0] < dims[0] and ijk[0] > 0 and  ijk[1] < dims[1] and ijk[1] > 0 and ijk[2] < dims[2] and ijk[2] > 0:
-
-              center = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1], ijk[2], 0)
-              total += center
-              if gradient == 1 :
-
-                radiusNeedle = int(round(radiusNeedleParameter / float(spacing[0])))
-                radiusNeedleCorner = int(round((radiusNeedleParameter / float(spacing[0]) / 1.414)))
-
-                g1 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedle, ijk[1], ijk[2], 0)
-                g2 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedle, ijk[1], ijk[2], 0)
-                g3 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + radiusNeedle, ijk[2], 0)
-                g4 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - radiusNeedle, ijk[2], 0)
-                g5 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                g6 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-                g7 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                g8 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-
-                total += 8 * center - ((g1 + g2 + g3 + g4 + g5 + g6 + g7 + g8) / 8) * gradientPonderation
-              # >>>>>>>>>>>>>>>>>>>>>> exp.02
-              if imgLabelData:
-                fLabel = imgLabelData.GetScalarComponentAsFloat(ijk[0], ijk[1], ijk[2], 0)
-                if fLabel and fLabel < 300:
-                  #print "# force high influence of found label: ",fLabel
-                  total -= 10000
-                if conesColor: imgLabelData.SetScalarComponentFromFloat(ijk[0], ijk[1], ijk[2], 0, conesColor) #mark the search cones in fLabel volume
-              # <<<<<<<<<<<<<<<<<<<<
-          if R == 0:
-
-            initialIntensity = total
-            estimator = total
-
-          if gaussianAttenuationChecked == 1 and step >= 2 :
-
-            if tip0[2] - A[2] != 0:
-
-                stepSize = (A[2] - C0[2])
-                K = stepSize / float(tip0[2] - A[2])
-
-                X = [ A[0] + K * (A[0] - tip0[0]),
-                                A[1] + K * (A[1] - tip0[1]),
-                                A[2] + K * (A[2] - tip0[2]) ]
-
-                rgauss = ((C[0] - X[0]) ** 2
-                                + (C[1] - X[1]) ** 2
-                                + (C[2] - X[2]) ** 2) ** 0.5
-
-                gaussianAttenuation = math.exp(-(rgauss / float(rMax)) ** 2 / float((2 * (sigmaValue / float(10)) ** 2)))  # 1 for x=0, 0.2 for x=5
-                estimator = (total) * gaussianAttenuation # ??? this might not work as intended for negative values (they get larger!)
-                # >>> bugfix ? makes it even worse on average: bugfixbug ;-)
-                #estimator=total
-                #estimatorAtt = total * gaussianAttenuation
-                #estimator-=np.abs(estimator-estimatorAtt)
-                # <<< xifgub
-            else:
-                estimator = total
-
-
-          else:
-            estimator = (total)
-
-          if estimator < initialIntensity:
-
-            if estimator < minEstimator or minEstimator == 0:
-              minEstimator = estimator
-              if minEstimator != 0:
-                bestPoint = C
-
-
-      tip0 = A
-      if bestPoint == [0, 0, 0]:
-        A = C0
-      elif bestPoint != tip0:
-        A = bestPoint
-
-
-      if A[2] < axialSegmentationLimit and A != A0:
-
-        asl = axialSegmentationLimit
-        l = (A[2] - asl) / float(tip0[2] - A[2])
-
-        A = [  A[0] - l * (tip0[0] - A[0]),
-                A[1] - l * (tip0[1] - A[1]),
-                A[2] - l * (tip0[2] - A[2])]
-
-      controlPoints.append(self.ijk2ras(A))
-      controlPointsIJK.append(A)
-
-      if not script and widget.drawFiducialPoints.isChecked():
-        fiducial = slicer.mrmlScene.CreateNodeByClass('vtkMRMLAnnotationFiducialNode')
-        fiducial.Initialize(slicer.mrmlScene)
-        fiducial.SetName('.c_'+str(colorVar))
-        fiducial.SetFiducialCoordinates(controlPoints[step + 1])
-
-      if A[2] <= axialSegmentationLimit and A != A0:
-        break
-
-    # self.addNeedleToScene(controlPoints,colorVar)
-    if not autoStopTip:
-      self.addNeedleToScene(controlPoints, colorVar, 'Detection', script, manualName=manualName)
-    print time.clock() - t0, "seconds process time"
-
-  def addPlaneToScene(self, foot, x, y):
-    """
-    Add a plane to the scene.
-    :param foot: base point
-    :param x: vector
-    :param y: vector
-    :return: visible plane in scene
-    """
-    #research
-    profprint()
-    scene = slicer.mrmlScene
-    # Create model node
-    model = slicer.vtkMRMLModelNode()
-    model.SetScene(scene)
-    model.SetName(scene.GenerateUniqueName(".ObturatorPlane"))
-
-    planeSource = vtk.vtkPlaneSource()
-    foot-=25*(x+y)
-    #planeSource.SetOrigin(np.array(foot))
-    planeSource.SetOrigin(list(foot))
-    planeSource.SetPoint1(np.array(foot)+50*x)
-    planeSource.SetPoint2(np.array(foot)+50*y)
-    planeSource.Update()
-    model.SetAndObservePolyData(planeSource.GetOutput())
+    planeSource = vtk.vtkPlaneSource()
+    foot-=25*(x+y)
+    #planeSource.SetOrigin(np.array(foot))
+    planeSource.SetOrigin(list(foot))
+    planeSource.SetPoint1(np.array(foot)+50*x)
+    planeSource.SetPoint2(np.array(foot)+50*y)
+    planeSource.Update()
+    model.SetAndObservePolyData(planeSource.GetOutput())
 
     # Create display node
     modelDisplay = slicer.vtkMRMLModelDisplayNode()
@@ -4849,448 +4489,50 @@ class NeedleFinderLogic:
     https://github.com/gpernelle/iGyne_old/commit/b16872c19a3bc6be1f4a9722e5daf16a603393f6#diff-8ab0fe8b431d2af8b1aff51977e85ca2
 
     >>> Developers version: Andre's bug fixes & experiments here: e.g. use additional user information to fix outliers.
-    >>> \!/ This site is under heavy construction. /!\
     From the needle tip, the algorithm looks for a direction maximizing the "needle likelihood" of a small segment in a conic region.
     The second extremity of this segment is saved as a control point (in lvControlPointsRAS), used later.
     Then, this iStep is iterated, replacing the needle tip by the latest control point.
     The height of the new conic region (stepsize) is increased as well as its base diameter (iRMax) and its normal is collinear to the previous computed segment. (cf. ijkB)
     nStepsNeedle iterations give nStepsNeedle-1 control points, the last one being used as an extremity as well as the needle tip.
     From these nStepsNeedle-1 control points and 2 extremities a Bezier curve is computed, approximating the needle path.
+    The tracking is version 3 of NeedleFinderLib.NeedleDetector (trackCones15), cf. trackNeedle.
     '''
     #research
     profprint()
     t0 = time.clock()
-    bDraw=True
-    #msgbox("Detour: \!/ This site is under heavy construction. /!\ ")
     widget = slicer.modules.NeedleFinderWidget
-    print "\n"*10 #<<< fast forward in console to create visual break
-    # ## load parameters from GUI
-    iRadiusMax_mm = widget.radiusMax.value
-    iGradientPonderation = widget.gradientPonderation.value
-    iSigmaValue = widget.sigmaValue.value
-    bGaussianAttenuation = widget.gaussianAttenuationButton.isChecked()
-    bGradient = widget.gradient.isChecked()
-    nPointsPerNeedle = widget.numberOfPointsPerNeedle.value
-    nRotatingIts = widget.nbRotatingIterations.value
-    iRadiusNeedle_mm = widget.radiusNeedleParameter.value
-    iAxialSegmentationLimit = widget.axialSegmentationLimit
-    bAutoStopTip = widget.autoStopTip.isChecked()
-    global conesColor
-    if conesColor: conesColor=(conesColor+1)%308;
-    if conesColor==0: conesColor=300
-    print "conesColor= ", conesColor
-    ### initialisation of some parameters
-    fModelNeedleLength_mm=187
-    fModelSegmentLength_mm=fModelNeedleLength_mm/20.
-    fK=2*np.pi*2050/(1000.) # 18 gauge brachy needle
-
+    vprint(2, "\n"*10) #<<< fast forward in console to create visual break
     #>>>>>>>>>>>>>>>>> Ruibins feedback >>>>>>>>>>>>>>>>>>
+    feedback = None
     if(whetherfeedback):
         WrongIndex = WrongPosition[0]
-        NumberOfRelatedIndexs = len(WrongPosition) - 1
-        RelatedIndex = []
-        for k in range(NumberOfRelatedIndexs):
-            RelatedIndex.append(WrongPosition[k+1])
+        RelatedIndex = WrongPosition[1:]
         ijkA = ControlPointsPackageIJK[WrongIndex][0]
-        NeighbourAttenuation = 0
+        iRadiusNeedle_mm = widget.radiusNeedleParameter.value
+        feedback = lambda M: self.Feedback(ControlPointsPackage, Punish, iRadiusNeedle_mm, len(RelatedIndex), len, RelatedIndex, range, M)
     else:
         ijkA = ijkAori
     #<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-
-    # refactored local functions:
-    def norm(fv):
-        return np.sqrt(np.dot(fv,fv))
-    def normalized(fv):
-        fLen=np.sqrt(np.dot(fv,fv))
-        return fv/fLen, fLen
-    def defLocalNeedleCooSys(fvX, fvY, fvZ, iStep, rasA, rasDeflectionDirection, rasNeedlePlaneNormal,bDraw=False):
-        rasSegmentVector=rasA-rasAPrev
-        fLenSV=norm(rasSegmentVector)
-        rasSegmentVector1=rasSegmentVector/fLenSV
-        fAngleZvSeg_rad=np.arccos(np.dot(fvZ,rasSegmentVector1))
-        if not rasNeedlePlaneNormal.any(): rasNeedlePlaneNormal = np.cross(rasSegmentVector1,fvZ)
-        if np.arccos(np.dot(rasNeedlePlaneNormal,fvX))>np.pi/2: rasNeedlePlaneNormal*=-1 # check vector direction and turn if not in rhs normal X direction
-        if not sum(rasNeedlePlaneNormal):
-          rasNeedlePlaneNormal=np.cross(fvY,fvZ)
-        fLenNPN = norm(rasNeedlePlaneNormal)
-        rasNeedlePlaneNormal1=rasNeedlePlaneNormal/fLenNPN
-        if not rasDeflectionDirection.any(): rasDeflectionDirection=  \
-          +   np.cross(fvZ,rasNeedlePlaneNormal1) #TODO / CAVE: mind the sign
-        if np.arccos(np.dot(rasDeflectionDirection,fvY))>np.pi/2: rasDeflectionDirection*=-1 # check vector direction and turn for RHS
-        fLenDD=norm(rasDeflectionDirection)
-        rasDeflectionDirection1=rasDeflectionDirection/fLenDD
-        #re-estimate reference needle direction  #TODO/CAVE: mind the sign
-        if 1:
-          fvZ=    +     np.cross(rasNeedlePlaneNormal1,rasDeflectionDirection1)
-          fvZ/=norm(fvZ)
-        return rasDeflectionDirection1, rasNeedlePlaneNormal1, fvZ
-    def initNeedleModel(fAngleRefNeedle_rad, fEstNeedleLength_mm, fvZ, rasA, bDraw=False):
-        rasAPrev2A=rasA-rasAPrev; rasAPrev2A/=norm(rasAPrev2A)
-        fAngleLongSegVZ_rad=np.arccos(np.dot(fvZ,rasAPrev2A))
-        fEstDeflection_mm=fEstNeedleLength_mm*1/np.cos(fAngleRefNeedle_rad)*np.sin(fAngleLongSegVZ_rad) # estimate deflection as from z-axis
-        # look up the needle length model matrices and find best matches
-        faArcLen_mm=zip(*matArcLen_mm)[0] #transpose
-        ixArcLenColMin=find_nearest(faArcLen_mm,fEstNeedleLength_mm)[0]
-        # estimator using est. deflection
-        faYDefl_mm=matYDefl_mm[ixArcLenColMin] #zip(*matYDefl_mm)[ixArcLenColMin] #transpose
-        ixYDeflRowMin=find_nearest(faYDefl_mm,fEstDeflection_mm)[0]
-        fEstF0_mmN=matFs_mN[ixArcLenColMin][ixYDeflRowMin]/1000
-        fEstEndSegAngle_rad=matEndSegAngles_rad[ixArcLenColMin][ixYDeflRowMin]
-        fSumAngle_rad=fEstEndSegAngle_rad
-        fF_mmN=fEstF0_mmN #*np.cos(fSumAngle_rad)/(np.pi) #estimate
-        return fF_mmN, fSumAngle_rad
-    def runNeedleModel(fStepAngle_rad, fF_mmN, fStepSize_mm, fvZ, iModelIt, rasDeflectionDirection1, fSumAngle_rad, rasB, bDraw=False):
-        rasModelStepVector=rasDeflectionDirection1*np.sin(fSumAngle_rad)+fvZ*np.cos(fSumAngle_rad)
-        rasEstStepVector1=rasModelStepVector/norm(rasModelStepVector)
-        rasBDef=rasB
-        rasB=rasA  +   rasEstStepVector1*fStepSize_mm # TODO check sign, and if this still makes sense
-        fDistBDef2BMod=norm(rasBDef-rasB)
-        fMaxDistBDef2BMod_mm=0 #.25 # CONST
-        fSumAngle_deg = 0
-        if 1 and fDistBDef2BMod>fMaxDistBDef2BMod_mm:
-          #compromise between model and heuristic based default vector
-          rasBDef2BMod=rasB-rasBDef; rasBDef2BMod1, fDistBDef2BMod_mm=normalized(rasBDef2BMod)
-          rasB=rasBDef+rasBDef2BMod1*min(fMaxDistBDef2BMod_mm,fDistBDef2BMod_mm/2.)
-        fAngleMultiSegments_rad=0
-        if fStepSize_mm/fModelSegmentLength_mm < 1: iFineStep=5; print "# fine steps "
-        else: iFineStep=1; print "normal steps"
-        for j in range(0, int(round(fStepSize_mm/(fModelSegmentLength_mm/iFineStep)))):
-          fF_mmN=fF_mmN/np.cos(fSumAngle_rad)
-          fStepAngle_rad=fF_mmN/(fK*iFineStep); angle_deg=np.degrees(fStepAngle_rad)
-          fSumAngle_rad-=fStepAngle_rad; fSumAngle_deg=np.degrees(fSumAngle_rad)
-          if fSumAngle_rad<0: fStepAngle_rad=fSumAngle_rad=0;# TODO check this
-          fAngleMultiSegments_rad+=fStepAngle_rad
-          iModelIt+=1
-        fAngleMultiSegments_deg=np.degrees(fAngleMultiSegments_rad)
-        return fF_mmN, fAngleMultiSegments_deg, rasEstStepVector1, fSumAngle_deg, rasB
-    def find_nearest(t,x):
-      from bisect import bisect_left
-      i = bisect_left(t, x)
-      if i==len(t): i-=1
-      if t[i] - x > 0.5:
-        i-=1
-      return i,t[i]
-    ijkAPrev=rasCBestPrev=ijkCBest=ijkCBestPrev=None
-    rasA2CBestInit=[]
-    rasA2CBest=rasCBestPrev2CBest=rasCBestPrev2CBestPrev1=np.array([])
-    ijk = [0, 0, 0]
-    fLabel = None
     if not bScript: widget.createAddOrSelectLabelMapNode(bScript) #<<< always have label map to draw search cones
-    #widget.clearLabelMap()
-
-    if iAxialSegmentationLimit != None:
-      fEstNeedleLength_mm = abs(ijkA[2] - iAxialSegmentationLimit) #* 1.15 * fvSpacing[2] #<<< CONST was 1.15
-    else:
-      fEstNeedleLength_mm = ijkA[2] * 0.9 * fvSpacing[2] # CONST
-    #load external needle model matrices (variable = file name)
-    sourceDir=slicer.util.modulePath('NeedleFinder').rstrip('NeedleFinder.py')
-    execfile(sourceDir+"matFs_mN.py") in locals()
-    execfile(sourceDir+"matArcLen_mm.py") in locals()
-    execfile(sourceDir+"matYDefl_mm.py") in locals()
-    execfile(sourceDir+"matEndSegAngles_rad.py") in locals()
-    fAngleRefNeedle_rad=np.deg2rad(22.5)# <<< to rotate z-axis down 22.5 degrees around x
-    fvX=np.array([1,0,0]); fvY=-np.array([0,np.cos(fAngleRefNeedle_rad),np.sin(fAngleRefNeedle_rad)])
-    fvZ=np.array([0,np.sin(fAngleRefNeedle_rad),  -   np.cos(fAngleRefNeedle_rad)])
-    fSumAngle_rad=fStepAngle_rad=fAngleA2CBestVZ_rad=None
-    rasA=np.array(self.ijk2ras(ijkA))#<<<
-    rasA0=rasA
-    ijkA0 = ijkA
-    nStepsNeedle = nPointsPerNeedle - 1 # one point (mouse click on tip) is already there
-    if bUp:
-      iZDirectionSign = 1
-    else:
-      iZDirectionSign = -1
-
-    ivDims = [0, 0, 0]
-    imgData.GetDimensions(ivDims)
+    lvControlPointsRAS, lvControlPointsIJK = self.trackNeedle(3, ijkA, imgData, (205)% MAXCOL, fvSpacing, bScript, imgLabelData, strManualName, False, feedback, up=bUp)
 
     if not bUp:
       self.controlPoints = [] # in up mode, more interpol. points will be added to this array
-    lvControlPointsRAS = []
-    lvControlPointsIJK = []
-    lvBestControlPoints = []
-    rasNeedlePlaneNormal=rasDeflectionDirection=np.zeros(3)
-
-    lvControlPointsRAS.append(self.ijk2ras(ijkA))
-    lvControlPointsIJK.append(ijkA)
-    lvBestControlPoints.append(self.ijk2ras(ijkA))
-    print "#-----------------------------------------------------------"
-    fStepsSum_mm=0
-    iModelIt=0
-    iStart=-1 # <<<o> use init its. or not
-    for iAbsStep, iStep in enumerate(range(iStart, nStepsNeedle)):
-      print "#--------------------------------- %s: iStart: %d / iStep: %d / b,c%d----------------"%(strManualName, iStart,iStep,iStep+1)
-      fStepSize_mm = self.stepSize13(iStep+1,nStepsNeedle+1)*fEstNeedleLength_mm
-      #fStepSize_mm = (1.-self.stepSizeAndre(iStep+1,nStepsNeedle+1))*fEstNeedleLength_mm
-      fStepSize_mm = fEstNeedleLength_mm / (nStepsNeedle) # <<< equal step size
-      if iStep>-1: fStepsSum_mm+=fStepSize_mm
-      print "fStepSize_mm, fStepsSum_mm, fEstNeedleLength_mm= %f, %f, %f"%(fStepSize_mm, fStepsSum_mm, fEstNeedleLength_mm)
-
-      # init. iSteps for model est.
-      #------------------------------------------------------------------------------
-      if iStep < 0:
-
-        fFac=1./((((2)))*abs(iStart))*(iAbsStep+1) #<o> CONST how much of the nedle used for init. (1=full, 2=half)
-        fStepSizeInit_mm = fFac * fEstNeedleLength_mm
-        rasEstStepVector1=np.array([fvZ[0],fvZ[1], fvZ[2]])
-        rasB= rasA+rasEstStepVector1*fStepSizeInit_mm #<<< first step along reference needle axis
-        ijkB=self.ras2ijk(rasB)
-        iRMax = max(fStepSizeInit_mm, iRadiusMax_mm / float(fvSpacing[0])) # / nStepsNeedle
-        nRIter = max(15, min(20, int(iRMax/fvSpacing[0])))
-        nTIter=fStepSizeInit_mm #???
-        print "iRMax, nRIter, nTIter= %d, %d, %d"%(iRMax,nRIter,nTIter)
-
-      # iStep 0
-      #------------------------------------------------------------------------------
-      elif iStep==0: # and iStart == 0:
-
-        ijkB = [ijkA[0], ijkA[1], ijkA[2]+iZDirectionSign*fStepSize_mm/fvSpacing[2] ] #<<< going down along z-axis performs better on average on MICCAI13 cases
-        rasB=self.ijk2ras(ijkB)
-        ijkEstStepVector=np.array([0,0,iZDirectionSign * fStepSize_mm/fvSpacing[2]])
-
-        if len(rasA2CBestInit)==0: rasA2CBestInit.append(fvZ)
-        rasInitStepVector=sum(rasA2CBestInit)/len(rasA2CBestInit)
-        rasInitStepVector1, dum=normalized(rasInitStepVector) #TODO try
-        print "rasInitStepVector1= ",rasInitStepVector1
-        rasB=rasA+rasInitStepVector1*fStepSize_mm #<o>
-        ijkB=self.ras2ijk(rasB)
-        rasEstStepVector=self.ijk2ras(ijkEstStepVector)
-        rasEstStepVector1, dum=normalized(rasEstStepVector)
-        print "ijkB= ",ijkB,"# line: ",lineno()
-        iRMax = iRadiusMax_mm / fvSpacing[0] # / nStepsNeedle
-        nRIter = iRMax
-        nTIter=int(round(fStepSize_mm))
-        print "iRMax, nRIter, nTIter= %d, %d, %d"%(iRMax,nRIter,nTIter)
-        if iStart<0 and iStep==0:
-          fF_mmN, fSumAngle_rad = initNeedleModel(fAngleRefNeedle_rad, fEstNeedleLength_mm, fvZ, rasA)
-
-      # iStep other
-      #------------------------------------------------------------------------------
-      else:
-
-        ijkB = [ 2 * ijkA[0] - ijkAPrev[0],  # ??? why do you go double iStep in xy-plane
-                  2 * ijkA[1] - ijkAPrev[1],
-                  ijkA[2] + iZDirectionSign * fStepSize_mm /fvSpacing[2]   ]  # ??? this was buggy vector calculus, now its a feature ;-)
-
-        rasB=self.ijk2ras(ijkB)
-        print "default_ijkB= ", ijkB
-        iRMax = max(fStepSize_mm,iRadiusMax_mm / fvSpacing[0])
-        nRIter =max(15,min(20,int(iRMax/ fvSpacing[0])))
-        nTIter = fStepSize_mm # ??? coarse step size from MICCAI13 TODO check this
-        print "iRMax, nRIter, nTIter= %d, %d, %d"%(iRMax,nRIter,nTIter)
-
-        #>>>>>> exp.04
-        # define local needle coordinate system
-        rasDeflectionDirection1, rasNeedlePlaneNormal1, fvZ = defLocalNeedleCooSys(fvX, fvY, fvZ, iStep, rasA, rasDeflectionDirection, rasNeedlePlaneNormal,bDraw=True)
-        # initialise needle model
-        if (iStart==0 and iStep==1):
-          fF_mmN, fSumAngle_rad = initNeedleModel(fAngleRefNeedle_rad, fEstNeedleLength_mm, fvZ, rasA, bDraw=True)
-        # run needle model
-        if (iStart==0 and iStep>=1) or (iStart<0 and iStep>=0):
-          fF_mmN, fAngleMultiSegments_deg, rasEstStepVector1, fSumAngle_deg,    rasB   = runNeedleModel(fStepAngle_rad, fF_mmN, fStepSize_mm, fvZ, iModelIt, rasDeflectionDirection1, fSumAngle_rad, rasB, bDraw=True)
-        ijkB=self.ras2ijk(rasB)
-        #<<<<<< exp.04
-
-      ##############
-      # cone search: radius, fStepAngle_rad and line length variation
-      if ijkCBest: ijkCBestPrev = ijkCBest
-      ijkCBest = [np.nan, np.nan, np.nan]
-      print "# searching cone:"
-      fMinTotal = np.inf
-      for iR in range(int(nRIter) + 1):
-
-        fR = iR * (iRMax / float(nRIter))
-
-        # ## fStepAngle_rad variation from 0 to 360
-        for iThetaStep in xrange(int(nRotatingIts)):
-
-          fAngle_deg = (iThetaStep * 360.) / float(nRotatingIts)
-          fThetaStep_rad = math.radians(fAngle_deg)
-
-          ijkC = [ ijkB[0] + fR * (math.cos(fThetaStep_rad)),
-                            ijkB[1] + fR * (math.sin(fThetaStep_rad)),
-                            ijkB[2]]
-
-          fTotal = 0
-          lijkM = [[0, 0, 0] for i in xrange(int(nTIter) + 1)]
-
-          fLabel =  0
-          # calculates nTIter = number of points per segment
-          for iTStep in xrange(int(nTIter) + 1):
-
-            fTStep = iTStep / float(nTIter)
-
-            # x,y,z coordinates
-            for i in range(3):
-
-              lijkM[iTStep][i] = (1 - fTStep) * ijkA[i] + fTStep * ijkC[i]
-              ijk[i] = int(round(lijkM[iTStep][i]))
-
-            # first, test if points are in the image space
-            iRadiusNeedle = int(round(iRadiusNeedle_mm / float(fvSpacing[0])))
-            iRadiusNeedleCorner = int(round((iRadiusNeedle_mm / float(fvSpacing[0]) / 1.414)))
-            lim = max(iRadiusNeedle, iRadiusNeedleCorner) + 1
-
-            if ijk[0] < ivDims[0] - lim and ijk[0] > lim and  ijk[1] < ivDims[1] - lim and ijk[1] > lim and ijk[2] < ivDims[2] and ijk[2] > 0:
-
-              dCenter = imgData.GetScalarComponentAsDouble(ijk[0], ijk[1], ijk[2], 0)
-              fTotal += dCenter
-
-              # >>>>>>>>>>>>>>> Ruibins feedback >>>>>>>>>>>>>>
-              if(whetherfeedback):
-                  NeighbourAttenuation = self.Feedback(ControlPointsPackage, Punish, iRadiusNeedle_mm, NumberOfRelatedIndexs, len, RelatedIndex, range, lijkM[iTStep])
-                  fTotal +=NeighbourAttenuation
-              #<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-
-              if 1 and bGradient == 1 : #<<< feature on/off
-
-                iRadiusNeedle = int(round(iRadiusNeedle_mm / float(fvSpacing[0])))
-                iRadiusNeedleCorner = int(round((iRadiusNeedle_mm / float(fvSpacing[0]) / 1.414)))
-
-                g1 = imgData.GetScalarComponentAsDouble(ijk[0] + iRadiusNeedle, ijk[1], ijk[2], 0)
-                g2 = imgData.GetScalarComponentAsDouble(ijk[0] - iRadiusNeedle, ijk[1], ijk[2], 0)
-                g3 = imgData.GetScalarComponentAsDouble(ijk[0], ijk[1] + iRadiusNeedle, ijk[2], 0)
-                g4 = imgData.GetScalarComponentAsDouble(ijk[0], ijk[1] - iRadiusNeedle, ijk[2], 0)
-                g5 = imgData.GetScalarComponentAsDouble(ijk[0] + iRadiusNeedleCorner, ijk[1] + iRadiusNeedleCorner, ijk[2], 0)
-                g6 = imgData.GetScalarComponentAsDouble(ijk[0] - iRadiusNeedleCorner, ijk[1] - iRadiusNeedleCorner, ijk[2], 0)
-                g7 = imgData.GetScalarComponentAsDouble(ijk[0] - iRadiusNeedleCorner, ijk[1] + iRadiusNeedleCorner, ijk[2], 0)
-                g8 = imgData.GetScalarComponentAsDouble(ijk[0] + iRadiusNeedleCorner, ijk[1] - iRadiusNeedleCorner, ijk[2], 0)
-
-                fTotal += 8 * dCenter - ((g1 + g2 + g3 + g4 + g5 + g6 + g7 + g8) / 8) * iGradientPonderation
-              #fi gradient
-              # >>>>>>>>>>>>>>>>>>>>>> exp.02
-              # if imgLabelData:
-              #   fLabel = imgLabelData.GetScalarComponentAsFloat(ijk[0], ijk[1], ijk[2], 0)
-              #   if fLabel and fLabel < 300:
-              #     fTotal -= 10000
-              #   if conesColor: imgLabelData.SetScalarComponentFromFloat(ijk[0], ijk[1], ijk[2], 0, conesColor) #mark the search cones in fLabel volume
-              # <<<<<<<<<<<<<<<<<<<<
-            #fi points in image space
-          #rof iTStep
-
-          if 1 and bGaussianAttenuation == 1 and iStep >= 2 : #<<< feature on/off
-
-            if ijkAPrev[2] - ijkA[2] != 0:
-
-                fK = (ijkA[2] - ijkB[2]) / float(ijkAPrev[2] - ijkA[2])
-
-                ijkX = [ ijkA[0] + fK * (ijkA[0] - ijkAPrev[0]),
-                                ijkA[1] + fK * (ijkA[1] - ijkAPrev[1]),
-                                ijkA[2] + fK * (ijkA[2] - ijkAPrev[2]) ]
-
-                fRgauss = ((ijkC[0] - ijkX[0]) ** 2
-                                + (ijkC[1] - ijkX[1]) ** 2
-                                + (ijkC[2] - ijkX[2]) ** 2) ** 0.5
-
-                fGaussianAttenuation = math.exp(-(fRgauss / float(iRMax)) ** 2 / float((2 * (iSigmaValue / float(10)) ** 2)))  # 1 for x=0, 0.2 for x=5
-                if fGaussianAttenuation<0 or fGaussianAttenuation>1:
-                  print "fGaussianAttenuation= ",fGaussianAttenuation," # /!\ "
-                fTotal = fTotal * fGaussianAttenuation
-          #fi gauss
-
-          if fTotal < fMinTotal:
-            fMinTotal = fTotal
-            ijkCBest = ijkC; rasCBest=self.ijk2ras(ijkCBest)
-        #rof iThetaStep
-      #rof iR
-      if ijkCBest==[np.nan,np.nan,np.nan]:
-        breakbox("/!!\ no ijkCBest found")
-
-      ijkAPrev = ijkA; rasAPrev=np.array(self.ijk2ras(ijkAPrev))
-
-      #>>> constraints: compare distances
-      if 1: # <o>
-        #fAngleA2CBestVStepVector_rad=0
-        print "ijkCBest= ", ijkCBest,'# line: ', lineno()
-        rasB2CBest=rasCBest-np.array(rasB)
-        fDistB2CBest_mm=norm(rasB2CBest)
-        print "fDistB2CBest_mm= ",fDistB2CBest_mm
-        if ijkCBestPrev:
-          rasCBestPrev=np.array(self.ijk2ras(ijkCBestPrev))
-          if rasCBestPrev2CBest.any(): rasCBestPrev2CBestPrev=rasCBestPrev2CBest; rasCBestPrev2CBestPrev1=rasCBestPrev2CBestPrev/norm(rasCBestPrev2CBestPrev)
-          rasCBestPrev2CBest=rasCBest-rasCBestPrev; rasCBestPrev2CBest1=rasCBestPrev2CBest/norm(rasCBestPrev2CBest)
-        rasA=np.array(self.ijk2ras(ijkA))
-        if rasA2CBest.any(): rasA2CBestPrev=rasA2CBest; rasA2CBestPrev1=rasA2CBestPrev/norm(rasA2CBestPrev)
-        rasA2CBest=rasCBest-rasA; rasA2CBest1=rasA2CBest/norm(rasA2CBest)
-        # in first initializing iterations, model not estimated yet, accept ijkCBest anyway
-        if (iStart<0 and iStep<0) or (iStart==0 and iStep==0):
-          fDistB2CBest_mm=-np.inf
-          fLimitCrit4=fMaxDistB2CBest_mm=np.inf #CONST
-        if ((iStart==0 and iStep>=1) or (iStart<0 and iStep>=0)) and ijkCBest != [np.nan, np.nan, np.nan]: # <<< feature off/on
-          fMaxDistB2CBest_mm=(((1))) #<o> CONST mm
-          fLimitCrit4=fMaxDistB2CBest_mm #CONST
-        bReject=not fDistB2CBest_mm<fLimitCrit4
-        bUseB=False
-        bRejected=False
-        ########################
-        if bReject:print "#^^^^^^^^^^^^^ crit. rejects best cone point"
-        ########################
-        if ijkCBest == [np.nan, np.nan, np.nan] or bReject: #<<<o> use criteria, when we dont use const. behaves as 13_2
-          if 1: #<o> TODO try, compromise between model and image feature based vector
-            if rasB2CBest.any():
-              rasB2CBest1, dum=normalized(rasB2CBest)
-            else: rasB2CBest1=np.array([0,0,0])
-            rasA=rasB+rasB2CBest1*min(fMaxDistB2CBest_mm,fDistB2CBest_mm/2.)
-            ijkA=self.ras2ijk(rasA)
-            print '#middle vector, but within constraint: rasA= ',rasA
-            #<<<
-          bUseB=True
-          print "using_point_near_ijkB= ", ijkA
-          if iStep==0-abs(iStart): breakbox("/!!\ not using CBest in first it.??") #<<<
-        elif ijkCBest != ijkAPrev:
-          if iStep<=-1: #prepare init. of model
-            print "# iStep -1"
-            if iStep==-1:
-              rasA2CBestInit.append(rasA2CBest) #2nd init. seg.
-              rasAPrev=rasA0-rasA2CBest #trick to restart from user tip click
-              ijkAPrev=self.ras2ijk(rasAPrev)
-              ijkA=ijkA0; rasA=self.ijk2ras(ijkA)
-            elif iStep<=-2: rasA2CBestInit.append(rasA2CBest) #1st init segment
-            continue #rof iStep, skip rest of loop using this helper segments
-          ijkA = ijkCBest; rasA=self.ijk2ras(ijkA)
-          rasNeedlePlaneNormal=rasDeflectionDirection=np.zeros(3) #<o>force recalc. of deflection direction
-          print "using_ijkC= ",ijkCBest
-          print "best_fEstimator_value= ",fTotal
-        else: breakbox("/!!| uncaught ijkCBest==ijkAPrev")
-        #file ijkCBest != ijkAPrev
-      #fi constraints <<<
-
-      #################
-      # drag back a too far low control point to the axial limit plane
-      if ijkA[2] < iAxialSegmentationLimit and ijkA != ijkA0:
-
-        asl = iAxialSegmentationLimit
-        l = (ijkA[2] - asl) / float(ijkAPrev[2] - ijkA[2])
-
-        ijkA = [  ijkA[0] - l * (ijkAPrev[0] - ijkA[0]),
-                ijkA[1] - l * (ijkAPrev[1] - ijkA[1]),
-                ijkA[2] - l * (ijkAPrev[2] - ijkA[2])]
-
-      if iStep>=0:
-        lvControlPointsRAS.append(self.ijk2ras(ijkA))
-        lvControlPointsIJK.append(ijkA)
-
-        if ijkA[2] <= iAxialSegmentationLimit and ijkA != ijkA0:
-          print "# /!\ needle too long, break"
-          break
-    #rof iStep
     for i in range(len(lvControlPointsRAS)): self.controlPoints.append(lvControlPointsRAS[i])
-    if not bAutoStopTip:
+    if not widget.autoStopTip.isChecked():
       if bDrawNeedle: self.addNeedleToScene(lvControlPointsRAS, (205)% MAXCOL, 'Detection', bScript,0, manualName=strManualName)
       self.controlPoints = []
-    if bAutoStopTip and bUp:
+    elif bUp:
       if bDrawNeedle: self.addNeedleToScene(self.controlPoints, (205)% MAXCOL, 'Detection', bScript,0, manualName=strManualName)
       self.controlPoints = []
-    print time.clock() - t0, "seconds process time"
-    #self.deleteTempModels() # otw. too much clutter on view
+    vprint(1, time.clock() - t0, "seconds process time")
     if bUp: return lvControlPointsIJK[-1] #return last control point as tip estimate
 
     return lvControlPointsRAS,lvControlPointsIJK # <<< Ruibin
 
   def Feedback(self, ControlPointsPackage, Punish, iRadiusNeedle_mm, NumberOfRelatedIndexs, len, RelatedIndex, range, ijk):
       ''' Ruibin: comment... '''
-      ras = [0,0,0]
-      ras = self.ijk2ras(ijk)
+      ras = self.volumeTransform().ijk2ras(ijk)
       NeighbourAttenuation = 0
       for w in range(NumberOfRelatedIndexs):
           distance = 9999
@@ -5372,6 +4614,7 @@ class NeedleFinderLogic:
     """
     # research
     profprint()
+    volume = self.getVolumeAccessor(imageData)
     widget = slicer.modules.NeedleFinderWidget
 
     # ## initialisation of the parameters
@@ -5409,7 +4652,6 @@ class NeedleFinderLogic:
 
     dims = [0, 0, 0]
     imageData.GetDimensions(dims)
-    pixelValue = numpy.zeros(shape=(dims[0], dims[1], dims[2]))
 
     A0 = A
     # print A0
@@ -5426,6 +4668,7 @@ class NeedleFinderLogic:
 
     radiusNeedle = int(round(radiusNeedleParameter / float(spacing[0])))
     radiusNeedleCorner = int(round((radiusNeedleParameter / float(spacing[0]) / 1.414)))
+    features = self.getNeedleFeatures(volume, radiusNeedle, radiusNeedleCorner) if lookNeighborhood == 1 else None
     """
     #---------------------------------------------------------------------------------
     # look for the best tip in the neighboorhood of the mouse click
@@ -5439,15 +4682,15 @@ class NeedleFinderLogic:
       for j in range(-3,3):
           for k in range(-3,3):
             for l in range (-3,1):
-                v0 = 8 * imageData.GetScalarComponentAsDouble(ijk[0]+i, ijk[1]+j, ijk[2]+k+l, 0)
-                v1 = imageData.GetScalarComponentAsDouble(ijk[0]+radiusNeedle+i, ijk[1]+j, ijk[2]+k+l, 0)
-                v2 = imageData.GetScalarComponentAsDouble(ijk[0]-radiusNeedle+i, ijk[1]+j, ijk[2]+k+l, 0)
-                v3 = imageData.GetScalarComponentAsDouble(ijk[0]+i, ijk[1]+radiusNeedle+j, ijk[2]+k+l, 0)
-                v4 = imageData.GetScalarComponentAsDouble(ijk[0]+i, ijk[1]-radiusNeedle+j, ijk[2]+k+l, 0)
-                v5 = imageData.GetScalarComponentAsDouble(ijk[0]+radiusNeedleCorner+i, ijk[1]+radiusNeedleCorner+j, ijk[2]+k+l, 0)
-                v6 = imageData.GetScalarComponentAsDouble(ijk[0]-radiusNeedleCorner+i, ijk[1]-radiusNeedleCorner+j, ijk[2]+k+l, 0)
-                v7 = imageData.GetScalarComponentAsDouble(ijk[0]-radiusNeedleCorner+i, ijk[1]+radiusNeedleCorner+j, ijk[2]+k+l, 0)
-                v8 = imageData.GetScalarComponentAsDouble(ijk[0]+radiusNeedleCorner+i, ijk[1]-radiusNeedleCorner+j, ijk[2]+k+l, 0)
+                v0 = 8 * volume.value(ijk[0]+i, ijk[1]+j, ijk[2]+k+l)
+                v1 = volume.value(ijk[0]+radiusNeedle+i, ijk[1]+j, ijk[2]+k+l)
+                v2 = volume.value(ijk[0]-radiusNeedle+i, ijk[1]+j, ijk[2]+k+l)
+                v3 = volume.value(ijk[0]+i, ijk[1]+radiusNeedle+j, ijk[2]+k+l)
+                v4 = volume.value(ijk[0]+i, ijk[1]-radiusNeedle+j, ijk[2]+k+l)
+                v5 = volume.value(ijk[0]+radiusNeedleCorner+i, ijk[1]+radiusNeedleCorner+j, ijk[2]+k+l)
+                v6 = volume.value(ijk[0]-radiusNeedleCorner+i, ijk[1]-radiusNeedleCorner+j, ijk[2]+k+l)
+                v7 = volume.value(ijk[0]-radiusNeedleCorner+i, ijk[1]+radiusNeedleCorner+j, ijk[2]+k+l)
+                v8 = volume.value(ijk[0]+radiusNeedleCorner+i, ijk[1]-radiusNeedleCorner+j, ijk[2]+k+l)
             totalTip = v0-(v1+v2+v3+v4+v5+v6+v7+v8/float(8))*gradientPonderation
             if totalTip<minTotalTip or minTotalTip==0:
               minTotalTip = totalTip
@@ -5591,18 +4834,20 @@ class NeedleFinderLogic:
               # first, test if points are in the image space
               if ijk[0] < dims[0] and ijk[0] > 0 and  ijk[1] < dims[1] and ijk[1] > 0 and ijk[2] < dims[2] and ijk[2] > 0:
 
-                center = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1], ijk[2], 0)
+                center = volume.value(ijk[0], ijk[1], ijk[2])
                 total += center / float(tIter)
-                if lookNeighborhood == 1 :
-
-                  g1 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedle, ijk[1], ijk[2], 0)
-                  g2 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedle, ijk[1], ijk[2], 0)
-                  g3 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] + radiusNeedle, ijk[2], 0)
-                  g4 = imageData.GetScalarComponentAsDouble(ijk[0], ijk[1] - radiusNeedle, ijk[2], 0)
-                  g5 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                  g6 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
-                  g7 = imageData.GetScalarComponentAsDouble(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2], 0)
-                  g8 = imageData.GetScalarComponentAsDouble(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2], 0)
+                if lookNeighborhood == 1 and features:
+                  total += features.gradientTerm(ijk[0], ijk[1], ijk[2], gradientPonderation) / float(tIter)
+                elif lookNeighborhood == 1 :
+
+                  g1 = volume.value(ijk[0] + radiusNeedle, ijk[1], ijk[2])
+                  g2 = volume.value(ijk[0] - radiusNeedle, ijk[1], ijk[2])
+                  g3 = volume.value(ijk[0], ijk[1] + radiusNeedle, ijk[2])
+                  g4 = volume.value(ijk[0], ijk[1] - radiusNeedle, ijk[2])
+                  g5 = volume.value(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2])
+                  g6 = volume.value(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2])
+                  g7 = volume.value(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2])
+                  g8 = volume.value(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2])
 
                   total += (8 * center - ((g1 + g2 + g3 + g4 + g5 + g6 + g7 + g8) / float(8)) * gradientPonderation) / float(tIter)
 
@@ -5761,12 +5006,13 @@ class NeedleFinderLogic:
         widget.obtuNeedlePt[i][0] = [E[0], E[1], E[2]]
             # print needleNumber,needleStep,coord
 
-    for i in range(len(widget.obtuNeedlePt)):
-      if widget.obtuNeedlePt[i][0][0] != 999:
-          controlPointsUnsorted = [val for val in widget.obtuNeedlePt[i] if val != [999, 999, 999]]
-          controlPoints = controlPointsUnsorted
-          if ((i == 0 and len(controlPoints) >= 1) or i >= 1) :
-            self.addNeedleToScene(controlPoints, i, 'Obturator')
+    with self.sceneBatch():
+      for i in range(len(widget.obtuNeedlePt)):
+        if widget.obtuNeedlePt[i][0][0] != 999:
+            controlPointsUnsorted = [val for val in widget.obtuNeedlePt[i] if val != [999, 999, 999]]
+            controlPoints = controlPointsUnsorted
+            if ((i == 0 and len(controlPoints) >= 1) or i >= 1) :
+              self.addNeedleToScene(controlPoints, i, 'Obturator')
 
   def drawValidationNeedles(self, nb=None):
     """This function takes the values inside the table tableValueCtrPt and add attributes such as color, name ,.. for every
@@ -5811,19 +5057,20 @@ class NeedleFinderLogic:
             print needleNumber, needleStep, coord
             # print self.tableValueCtrPt[needleNumber][needleStep]
 
-    for i in range(len(tableValueCtrPt)):
-      if not all(e == [999, 999, 999] for e in tableValueCtrPt[i]):
-      # if self.tableValueCtrPt[i][1] != [999, 999, 999]:
-        colorVar = random.randrange(50, 100, 1)  # ??? /(100.)
-        controlPointsUnsorted = [val for val in tableValueCtrPt[i] if val != [999, 999, 999]]
-        controlPoints = self.sortTable(controlPointsUnsorted, (2, 1, 0))
-        # print "Control points unsorted", controlPointsUnsorted
-        print "Control points", controlPoints
-        self.addNeedleToScene(controlPoints, i, 'Validation')
-        self.observeManualNeedles()
-      else:
-        # print i
-        pass
+    with self.sceneBatch():
+      for i in range(len(tableValueCtrPt)):
+        if not all(e == [999, 999, 999] for e in tableValueCtrPt[i]):
+        # if self.tableValueCtrPt[i][1] != [999, 999, 999]:
+          colorVar = random.randrange(50, 100, 1)  # ??? /(100.)
+          controlPointsUnsorted = [val for val in tableValueCtrPt[i] if val != [999, 999, 999]]
+          controlPoints = self.sortTable(controlPointsUnsorted, (2, 1, 0))
+          # print "Control points unsorted", controlPointsUnsorted
+          print "Control points", controlPoints
+          self.addNeedleToScene(controlPoints, i, 'Validation')
+          self.observeManualNeedles()
+        else:
+          # print i
+          pass
     self.findAxialSegmentationLimitFromMarker(bForceFallback=True) #AM force the presence of the limit marker
 
   def addCSplineToScene(self, controlPoint, colorVar, needleType='Detection', endMarker=False, name="^", script=False, manualName=""):
@@ -5879,7 +5126,6 @@ class NeedleFinderLogic:
       inputPoints.InsertPoint(i, x, y, z)
     # Generate the polyline for the spline.
     points = vtk.vtkPoints()
-    profileData = vtk.vtkPolyData()
     # Number of points on the spline
     numberOfOutputPoints = 50
     # Interpolate x, y and z by using the three spline filters and
@@ -5887,24 +5133,14 @@ class NeedleFinderLogic:
     for i in range(0, numberOfOutputPoints):
       t = (numberOfInputPoints-1.0)/(numberOfOutputPoints-1.0)*i
       points.InsertPoint(i, aSplineX.Evaluate(t), aSplineY.Evaluate(t), aSplineZ.Evaluate(t))
-    # Create the polyline.
-    lines = vtk.vtkCellArray()
-    lines.InsertNextCell(numberOfOutputPoints)
-    for i in range(0, numberOfOutputPoints): lines.InsertCellPoint(i)
-    profileData.SetPoints(points)
-    profileData.SetLines(lines)
     # Add thickness to the resulting line.
-    profileTubes = vtk.vtkTubeFilter()
-    profileTubes.SetNumberOfSides(8)
-    profileTubes.SetInputData(profileData)
-    profileTubes.SetRadius(1)
-    profileTubes.SetNumberOfSides(50)
-    profileTubes.Update()
+    curvePoints = [points.GetPoint(i) for i in range(numberOfOutputPoints)]
+    profileTubes = self.needleTube(curvePoints, controlPoints=controlPointListSorted)
 
     # ## Create model node
     model = slicer.vtkMRMLModelNode()
     model.SetScene(scene)
-    model.SetAndObservePolyData(profileTubes.GetOutput())
+    model.SetAndObservePolyData(profileTubes)
     # ## Create display node
     modelDisplay = slicer.vtkMRMLModelDisplayNode()
 
@@ -6019,14 +5255,7 @@ class NeedleFinderLogic:
     modelDisplay.SetInputPolyDataConnection(model.GetPolyDataConnection())
     scene.AddNode(model)
     # ##Create Tube around the line
-    tube = vtk.vtkTubeFilter()
-    polyData = model.GetPolyData()
-    tube.SetInputData(polyData)
-    tube.SetRadius(radius)
-    tube.SetNumberOfSides(50)
-    tube.Update()
-
-    model.SetAndObservePolyData(tube.GetOutput())
+    model.SetAndObservePolyData(self.needleTube(controlPointListSorted, radius, controlPoints=controlPointListSorted))
     model.GetDisplayNode().SliceIntersectionVisibilityOn()
     model.GetDisplayNode().SetOpacity(1-trans)
     if needleType == 'Validation':
@@ -6071,24 +5300,16 @@ class NeedleFinderLogic:
     a = a[order]
     diff = np.diff(a, axis=0)
     ui = np.ones(len(a), 'bool')
-    ui[1:] = (diff != 0).any(axis=1)
-    return a[ui]
-
-
-  def addNeedleToScene(self, controlPoint, colorVar, needleType='Detection', script=False, trans=0, manualName="", bPause=False):
-    """Computes the Bezier's curve and adds visual representation of a needle to the scene
-
-    :param controlPoint: array of RAS coordinates of points of a needle (used as control point for the Bezier's curve
-    :param colorVar: color of the needle
-    :param needleType: 'validation' for a manually segmentated needle, 'detection' for an automatically segmented needle,
-    'obturator' for an obturator needle
-    :return: visually, needle added to the scene
-    """
-    # productive
-    profprint()
+    ui[1:] = (diff != 0).any(axis=1)
+    return a[ui]
+
+
+  def needleControlPoints(self, controlPoint):
     """
-    Create a model of the needle from its equation (Beziers curve fitting the control points)
+    Control points of the Bezier curve of a needle: duplicates removed, sorted from the tip down and
+    extended to the real needle length if asked.
     """
+    # productive
     widget = slicer.modules.NeedleFinderWidget
 
     realNeedleLength = widget.realNeedleLength.value
@@ -6114,9 +5335,18 @@ class NeedleFinderLogic:
     if lenghtTotal < realNeedleLength and extendNeedle:
       lastPoint = [controlPointListSorted[-1][0], controlPointListSorted[-1][1], controlPointListSorted[-1][2] - (realNeedleLength - lenghtTotal)]
       controlPointListSorted.append(lastPoint)
+    return controlPointListSorted
 
-    label = None
-    scene = slicer.mrmlScene
+  def needleTube(self, curvePoints, radius=1, sides=None, controlPoints=None):
+    """
+    Tube polydata around the polyline of the curve samples [RAS], with sides sides (the interactive level of detail
+    of the widget by default). The curve samples, the control points and the radius are stored as field data of the
+    tube, so that the measurements on the needle don't depend on its tessellation (cf. needleCenterline) and the tube
+    can be rebuilt at another level of detail (cf. rebuildNeedleTubes).
+    """
+    # productive
+    if sides == None:
+      sides = slicer.modules.NeedleFinderWidget.tubeSides.value
     points = vtk.vtkPoints()
     polyData = vtk.vtkPolyData()
     polyData.SetPoints(points)
@@ -6130,23 +5360,121 @@ class NeedleFinderLogic:
     idArray = polygons.GetData()
     idArray.Reset()
     idArray.InsertNextTuple1(0)
-    nbEvaluationPoints = 50
-    n = len(controlPointListSorted) - 1
-    Q = [[0, 0, 0] for t in range(nbEvaluationPoints + 1)]
-    # start calculation
-    for t in range(nbEvaluationPoints+1): #+1):  #<<< lil bug    <<< we need +1, it's not a bug! otherwise needle is too short!
-      tt = float(t) / (1 * nbEvaluationPoints)
-      for j in range(3):
-        for i in range(n + 1):
-          Q[t][j] += self.binomial(n, i) * (1 - tt) ** (n - i) * tt ** i * controlPointListSorted[i][j]
-      pointIndex = points.InsertNextPoint(*Q[t])
+    for Q in curvePoints:
+      pointIndex = points.InsertNextPoint(*Q)
       linesIDArray.InsertNextTuple1(pointIndex)
       linesIDArray.SetTuple1(0, linesIDArray.GetNumberOfTuples() - 1)
       lines.SetNumberOfCells(1)
+    # ##Create Tube around the line
+    tube = vtk.vtkTubeFilter()
+    tube.SetInputData(polyData)
+    tube.SetRadius(radius)
+    tube.SetNumberOfSides(sides)
+    tube.Update()
+    tubePolyData = vtk.vtkPolyData()
+    tubePolyData.ShallowCopy(tube.GetOutput())
+    fieldData = tubePolyData.GetFieldData()
+    centerline = vtk.util.numpy_support.numpy_to_vtk(np.array(curvePoints, dtype=np.float64).reshape(-1, 3), deep=1)
+    centerline.SetName(centerlineArrayName)
+    fieldData.AddArray(centerline)
+    if controlPoints is not None and len(controlPoints):
+      controlPointArray = vtk.util.numpy_support.numpy_to_vtk(np.array(controlPoints, dtype=np.float64).reshape(-1, 3), deep=1)
+      controlPointArray.SetName(controlPointsArrayName)
+      fieldData.AddArray(controlPointArray)
+    radiusArray = vtk.vtkDoubleArray()
+    radiusArray.SetName(tubeRadiusArrayName)
+    radiusArray.InsertNextValue(radius)
+    fieldData.AddArray(radiusArray)
+    return tubePolyData
+
+  def needleFieldData(self, polydata):
+    """
+    Centerline [RAS], control points [RAS] (None if not stored) and radius stored with a needle tube by needleTube,
+    None for other polydata.
+    """
+    # productive
+    if not polydata:
+      return None
+    fieldData = polydata.GetFieldData()
+    centerline = fieldData.GetArray(centerlineArrayName)
+    if centerline is None:
+      return None
+    controlPoints = fieldData.GetArray(controlPointsArrayName)
+    if controlPoints is not None:
+      controlPoints = vtk.util.numpy_support.vtk_to_numpy(controlPoints).reshape(-1, 3).copy()
+    radius = fieldData.GetArray(tubeRadiusArrayName)
+    radius = radius.GetValue(0) if radius is not None else 1.
+    return vtk.util.numpy_support.vtk_to_numpy(centerline).reshape(-1, 3).copy(), controlPoints, radius
+
+  def needleCenterline(self, polydata):
+    """
+    Centerline samples [RAS] of a needle tube, from the tip down: the field data of the tube or, for the 50 sided tubes
+    of older scenes, the centers of the rings of the tube.
+
+    :return: N x 3 array, None if polydata is not a needle tube
+    """
+    # productive
+    geometry = self.needleGeometry(polydata)
+    return geometry.points if geometry else None
+
+  def needleGeometry(self, polydata):
+    """
+    NeedleCenterline (tip, base, direction, length...) of a needle tube, cf. needleCenterline. Use needleIndex for the
+    needles of the scene, which caches it per model node.
+
+    :return: NeedleCenterline, None if polydata is not a needle tube
+    """
+    # productive
+    data = self.needleFieldData(polydata)
+    if data:
+      return NeedleFinderLib.NeedleCenterline(data[0], data[2])
+    if not polydata:
+      return None
+    n = polydata.GetNumberOfPoints()
+    if n <= 100 or n % 50:
+      return None
+    rings = vtk.util.numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()).reshape(-1, 50, 3)
+    radius = np.linalg.norm(rings[0, 0] - rings[0, 25]) / 2.
+    return NeedleFinderLib.NeedleCenterline((rings[:, 0] + rings[:, 25]) / 2., radius)
+
+  def tubeSurfacePoint(self, geometry, index, offset):
+    """
+    Point of the surface of a needle tube at the centerline sample index, at the angle 2 pi offset/50 around the
+    needle (offset is the index of the point in a ring of the former 50 sided tubes, cf. parSearch).
+    """
+    # productive
+    return geometry.surfacePoint(index, 2 * math.pi * (offset % 50) / 50.)
+
+  def rebuildNeedleTubes(self, sides=None):
+    """
+    Rebuild the tubes of the needles of the scene from their stored centerline with sides sides (the interactive level
+    of detail of the widget by default), e.g. at export quality for screenshots and saved models.
+    """
+    # productive
+    profprint()
+    modelNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLModelNode')
+    models = [modelNodes.GetItemAsObject(i) for i in range(modelNodes.GetNumberOfItems())]
+    with self.sceneBatch():
+      for model in models:
+        data = self.needleFieldData(model.GetPolyData())
+        if data is None:
+          continue
+        centerline, controlPoints, radius = data
+        model.SetAndObservePolyData(self.needleTube(centerline, radius, sides, controlPoints))
+
+  def addNeedleModel(self, tubePolyData, colorVar, needleType='Detection', trans=0, manualName=""):
+    """
+    Add the model and display nodes of a needle tube to the scene, named and colored according to the needle type.
+
+    :return: the model node
+    """
+    # productive
+    widget = slicer.modules.NeedleFinderWidget
+    scene = slicer.mrmlScene
     # ## Create model node
     model = slicer.vtkMRMLModelNode()
     model.SetScene(scene)
-    model.SetAndObservePolyData(polyData)
+    model.SetAndObservePolyData(tubePolyData)
     # ## Create display node
     modelDisplay = slicer.vtkMRMLModelDisplayNode()
 
@@ -6156,15 +5484,8 @@ class NeedleFinderLogic:
     # ## Add to scene
     modelDisplay.SetInputPolyDataConnection(model.GetPolyDataConnection())
     scene.AddNode(model)
-    # ##Create Tube around the line
-    tube = vtk.vtkTubeFilter()
-    polyData = model.GetPolyData()
-    tube.SetInputData(polyData)
-    tube.SetRadius(1)
-    tube.SetNumberOfSides(50)
-    tube.Update()
+    NeedleFinderLib.tracer.count('scene nodes added', 2)
 
-    model.SetAndObservePolyData(tube.GetOutput())
     model.GetDisplayNode().SliceIntersectionVisibilityOn()
     model.GetDisplayNode().SetOpacity(1-trans)
     if needleType == 'Validation':
@@ -6177,10 +5498,6 @@ class NeedleFinderLogic:
 
     self.lastNeedleNames.append(model.GetName())
 
-    # evaluate and print the processing time
-    processingTime = time.clock() - self.t0
-    # print processingTime
-
     if needleType == 'Validation':
       nth = int(colorVar) % MAXCOL
       modelDisplay.SetColor(self.color[int(nth)][0], self.color[int(nth)][1], self.color[int(nth)][2])
@@ -6191,14 +5508,85 @@ class NeedleFinderLogic:
       else: nth = int(colorVar) % MAXCOL
       modelDisplay.SetColor(self.color[int(nth)][0], self.color[int(nth)][1], self.color[int(nth)][2])
       model.SetAttribute("nth", str(nth))
+    return model
 
-    if needleType == 'Validation':
-      1
-      # self.addNeedleToTable(int(colorVar),label,'Validation') ### ??? why ID=color here
-      # self.addNeedleToTable(int(model.GetID().strip('vtkMRMLModelNode')),label,'Validation')
+  @NeedleFinderLib.traced()
+  def addNeedleToScene(self, controlPoint, colorVar, needleType='Detection', script=False, trans=0, manualName="", bPause=False):
+    """Computes the Bezier's curve and adds visual representation of a needle to the scene
+
+    :param controlPoint: array of RAS coordinates of points of a needle (used as control point for the Bezier's curve
+    :param colorVar: color of the needle
+    :param needleType: 'validation' for a manually segmentated needle, 'detection' for an automatically segmented needle,
+    'obturator' for an obturator needle
+    :return: visually, needle added to the scene; the model node
+    """
+    # productive
+    profprint()
+    """
+    Create a model of the needle from its equation (Beziers curve fitting the control points)
+    """
+    controlPointListSorted = self.needleControlPoints(controlPoint)
+    nbEvaluationPoints = 50
+    # nbEvaluationPoints+1 samples (t = 0 .. 1), otherwise the needle is too short
+    Q = NeedleFinderLib.BezierCurve(controlPointListSorted).evaluate(nbEvaluationPoints)
+    model = self.addNeedleModel(self.needleTube(Q, controlPoints=controlPointListSorted), colorVar, needleType, trans,
+                                manualName)
+
+    # evaluate and print the processing time
+    processingTime = time.clock() - self.t0
+    # print processingTime
+
+    if needleType != 'Validation' and not script:
+      self.addNeedleToTable(int(model.GetID().strip('vtkMRMLModelNode')))
+    return model
+
+  def addNeedlesToScene(self, controlPoints, colorVars, needleType='Detection', script=False, trans=0, manualNames=None):
+    """
+    addNeedleToScene for many needles: all Bezier curves are evaluated at once and all tubes built before the nodes are
+    added to the scene in one batch, with one update of the report table at the end (cf. sceneBatch).
 
-    elif not script:
-      self.addNeedleToTable(int(model.GetID().strip('vtkMRMLModelNode')), label)
+    :param controlPoints: list of the control points [RAS] of each needle
+    :param colorVars: color of each needle, or one color for all of them
+    :param manualNames: name suffix of each needle
+    :return: the model nodes, in the order of controlPoints
+    """
+    # productive
+    profprint()
+    if not isinstance(colorVars, (list, tuple)):
+      colorVars = [colorVars] * len(controlPoints)
+    if manualNames == None:
+      manualNames = [""] * len(controlPoints)
+    nbEvaluationPoints = 50
+    controlPointSets = [self.needleControlPoints(c) for c in controlPoints]
+    curves = NeedleFinderLib.evaluateBezier(controlPointSets, nbEvaluationPoints)
+    tubes = [self.needleTube(Q, controlPoints=P) for Q, P in zip(curves, controlPointSets)]
+    models = []
+    with self.sceneBatch():
+      for tube, colorVar, manualName in zip(tubes, colorVars, manualNames):
+        model = self.addNeedleModel(tube, colorVar, needleType, trans, manualName)
+        if needleType != 'Validation' and not script:
+          self.addNeedleToTable(int(model.GetID().strip('vtkMRMLModelNode')))
+        models.append(model)
+    return models
+
+  @contextlib.contextmanager
+  def sceneBatch(self):
+    """
+    Context for adding many needles (addNeedleToScene, addPolyLineToScene, addCSplineToScene...): the scene is in
+    batch processing state, so that views and observers update once at its end, and the rows of the report table
+    are added at its end, with one table refresh. Nested batches end with the outermost one.
+    """
+    # productive
+    scene = slicer.mrmlScene
+    self.sceneBatchDepth += 1
+    scene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      yield
+    finally:
+      scene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+      self.sceneBatchDepth -= 1
+      if not self.sceneBatchDepth:
+        self.flushNeedleTable()
 
   def deleteTempModels(self):
     """
@@ -6641,7 +6029,7 @@ class NeedleFinderLogic:
     w = slicer.modules.NeedleFinderWidget
     l = w.logic
     if not variant:
-      l.exportEvaluation(['user','case','maxTipHD','maxHD', 'avgHD', 'stdHD', 'medHD',
+      l.resultsSink(fileName).writeHeader(['user','case','maxTipHD','maxHD', 'avgHD', 'stdHD', 'medHD',
                         'nNeedles','nOutliers','outliers',
                         'radiusNeedle',
                         'lenghtNeedle',
@@ -6656,9 +6044,9 @@ class NeedleFinderLogic:
                         'algoV',
                         'case',
                         t.strftime("%d/%m/%Y"), t.strftime("%H:%M:%S")
-                        ], fileName)
+                        ])
     else:
-      l.exportEvaluation(['user','case','tipHD','HD', 'man.-seg_', 'ID1', 'ID2',
+      l.resultsSink(fileName).writeHeader(['user','case','tipHD','HD', 'man.-seg_', 'ID1', 'ID2',
                         'outlier?',
                         'radiusNeedle',
                         'lenghtNeedle',
@@ -6673,11 +6061,15 @@ class NeedleFinderLogic:
                         'algoV',
                         #'case',
                         t.strftime("%d/%m/%Y"), t.strftime("%H:%M:%S")
-                        ], fileName)
+                        ])
 
   def parSearch(self, mode=False):
     """
     Parameter evaluation/optimization using no, grid brute-force or random-search algo.
+    Mode 3 converts the cases to case bundles (NeedleFinderLib.CaseBundle, scenes converted before and unchanged
+    since are skipped) for the headless search of NeedleFinderLib.ParameterSearch, which runs the random
+    search of mode 2 over a process pool, outside of Slicer, or successive halving/hyperband searches that evaluate
+    most configurations on a few needles only.
     """
     # research
     profprint()
@@ -6756,18 +6148,13 @@ class NeedleFinderLogic:
               result[0:0]=[user,id]
             l.exportEvaluation(results, dir+'/User-'+str(user)+'_AP-' + str(id) + '.csv')
             #slicer.util.saveScene(dir+'/AP-' + str(id) + '.mrb') # may use lots of disk space
-            # stats
-            HD = np.array(results)
-            # HD.shape = (int(len(results)/float(3)),3)
-            maxTipHD = HD[:, 2].max()
-            maxHD = HD[:, 3].max()
-            avgHD = HD[:, 3].mean()
-            stdHD = HD[:, 3].std()
-            sl = np.sort(HD[:, 3])
-            medHD = sl[sl.size / 2]
-            resultsEval = [user,id,maxTipHD, maxHD, avgHD, stdHD, medHD]+[len(results)]+[len(outliers)] +[str(outliers)]+ l.valuesExperience + [id]
+            # stats: maxTipHD, maxHD, avgHD, stdHD, medHD, nNeedles, nOutliers
+            summary = NeedleFinderLib.RunningSummary(outlierThresh_mm)
+            summary.addRows(results, 2, 3, 4)
+            resultsEval = [user,id] + summary.row() +[str(summary.outliers)]+ l.valuesExperience + [id]
             l.exportEvaluation(resultsEval, dir+'/AP-All_stats.csv')
             #pause()
+      l.closeResults()
       msgbox("parSearch mode 0 done, results in "+dir)
     elif mode == 1:
       id = 'Current'
@@ -6782,19 +6169,16 @@ class NeedleFinderLogic:
         for result in results:
           result[0:0]=[user,id]
         l.exportEvaluation(results, dir+'/BF-' + str(id) + '.csv')
-        slicer.util.saveScene(dir+'/BF-' + str(id) + '.mrb') # may use lots of disk space
-        # stats
-        HD = np.array(results)
-        # HD.shape = (int(len(results)/float(3)),3)
-        maxTipHD = HD[:, 2].max()
-        maxHD = HD[:, 3].max()
-        avgHD = HD[:, 3].mean()
-        stdHD = HD[:, 3].std()
-        sl = np.sort(HD[:, 3])
-        medHD = sl[sl.size / 2]
-        resultsEval = [user,id,maxTipHD,maxHD, avgHD, stdHD, medHD] +[len(results)]+[len(outliers)] +[str(outliers)]+ l.valuesExperience + [id]
+        # stats: maxTipHD, maxHD, avgHD, stdHD, medHD, nNeedles, nOutliers
+        summary = NeedleFinderLib.RunningSummary(outlierThresh_mm)
+        summary.addRows(results, 2, 3, 4)
+        resultsEval = [user,id] + summary.row() +[str(summary.outliers)]+ l.valuesExperience + [id]
         l.exportEvaluation(resultsEval, dir+'/BF-' + str(id) + '_stats.csv')
+        # the needles of the run, instead of the whole scene (cf. loadDetectionArtifact)
+        l.saveDetectionArtifact(dir+'/BF-' + str(id) + '.needles.jsonl', i, [result[2:] for result in results],
+                                dict(zip(summary.columns, summary.row())))
         #pause()
+      l.closeResults()
       msgbox("parSearch mode 1 done, results in "+dir)
     elif mode == 2:
       # code piece from Guillaumes (bruteForce.py) multi patient mode search
@@ -6819,26 +6203,63 @@ class NeedleFinderLogic:
             for result in results:
               result[0:0]=[user,id]
             l.exportEvaluation(results, dir+'/RS-' + str(id) + '.csv')
-            slicer.util.saveScene(dir+'/RS-' + str(id) + '.mrb') # may use lots of disk space
-            # stats
-            HD = np.array(results)
-            maxTipHD = HD[:, 2].max()
-            maxHD = HD[:, 3].max()
-            avgHD = HD[:, 3].mean()
-            stdHD = HD[:, 3].std()
-            sl = np.sort(HD[:, 3])
-            medHD = sl[sl.size / 2]
-            resultsEval = [user,id,maxTipHD,maxHD, avgHD, stdHD, medHD] +[len(results)]+[len(outliers)] +[str(outliers)]+ l.valuesExperience + [id]
+            # stats: maxTipHD, maxHD, avgHD, stdHD, medHD, nNeedles, nOutliers
+            summary = NeedleFinderLib.RunningSummary(outlierThresh_mm)
+            summary.addRows(results, 2, 3, 4)
+            resultsEval = [user,id] + summary.row() +[str(summary.outliers)]+ l.valuesExperience + [id]
             l.exportEvaluation(resultsEval, dir+'/RS-' + str(id) + '_stats.csv')
+            # the needles of the run, instead of the whole scene (cf. loadDetectionArtifact)
+            l.saveDetectionArtifact(dir+'/RS-' + str(id) + '.needles.jsonl', i, [result[2:] for result in results],
+                                    dict(zip(summary.columns, summary.row())), case=id)
             # end = time.time()
             # print 'processing time: ', end-start
             # start = time.time()
             #pause()
+        l.closeResults()
         msgbox("parSearch mode 2 done, results in "+dir)
       #rof id
     #file mode 2
+    elif mode == 3:
+      cases = []
+      for id in range(100):
+        if path[id]:
+          cases.append(dir+'/case-' + str(id))
+          if NeedleFinderLib.CaseBundle.isUpToDate(cases[-1], path[id]):
+            print "up to date: ", cases[-1]
+            continue
+          print "converting ", path[id]
+          slicer.mrmlScene.Clear(0)
+          slicer.util.loadScene(path[id])
+          self.exportSearchCase(cases[-1], source=path[id])
+      print "python NeedleFinderLib/ParameterSearch.py -o " + dir + "/search.jsonl --cases " + ' '.join(cases)
+      msgbox("parSearch mode 3 done, cases in "+dir)
+    l.closeResults()
     slicer.mrmlScene.Clear(0) #clean up to save memory
 
+  def exportSearchCase(self, directory, type="Validation", source=None):
+    """
+    Save the detection volume, the axial limit, the centerlines (tip first) and the tips of the needles of a type as
+    a NeedleFinderLib.CaseBundle, a case of the headless validation and parameter search
+    (NeedleFinderLib.ParameterSearch).
+    :param source: the scene of the case, recorded to skip the conversion while it is unchanged
+    """
+    # research
+    profprint()
+    widget = slicer.modules.NeedleFinderWidget
+    transform = self.volumeTransform()
+    centerlines = []
+    names = []
+    for node in self.needleIndex.nodes(slicer.mrmlScene, type):
+      geometry = self.needleIndex.geometry(node)
+      points = geometry.points if geometry.tipIndex == 0 else geometry.points[::-1]
+      centerlines.append(transform.ras2ijkArray(points))
+      names.append(node.GetName())
+    tips, tipNames = self.returnTipsFromNeedleModels(type, center=True)
+    case = NeedleFinderLib.CaseBundle.write(directory, self.getVolumeAccessor(self.detectionVolume()).array,
+                                            transform.ijkToRAS, centerlines, widget.axialSegmentationLimit, names,
+                                            tips, source)
+    print "converted %d needles to %s (%s)" % (len(centerlines), directory, case.hash)
+
   #----------------------------------------------------------------------------------------------
   """ Needle segmentation report"""
   #----------------------------------------------------------------------------------------------
@@ -6850,9 +6271,20 @@ class NeedleFinderLogic:
     """
     # productive
     profprint()
+    if self.sceneBatchDepth:
+      # added at the end of the batch, cf. sceneBatch
+      self.pendingTableRows.append((ID, label, needleType))
+      return
     widget = slicer.modules.NeedleFinderWidget
     widget.initTableViewControlPoints()
     widget.initTableView()
+    self.addNeedleRow(widget, ID, label, needleType)
+
+  def addNeedleRow(self, widget, ID, label=None, needleType=None):
+    """
+    Append the row of a needle to the report table (initialized by the caller, cf. addNeedleToTable)
+    """
+    # productive
     if label != None:
       ref = int(label[0]) % MAXNEEDLES
       needleLabel = self.option[ref]
@@ -6917,6 +6349,24 @@ class NeedleFinderLogic:
 
     widget.row += 1
 
+  def flushNeedleTable(self):
+    """
+    Add the rows of the report table deferred by sceneBatch, with the table view updated once.
+    """
+    # productive
+    rows, self.pendingTableRows = self.pendingTableRows, []
+    if not rows:
+      return
+    widget = slicer.modules.NeedleFinderWidget
+    widget.initTableViewControlPoints()
+    widget.initTableView()
+    widget.view.setUpdatesEnabled(False)
+    try:
+      for ID, label, needleType in rows:
+        self.addNeedleRow(widget, ID, label, needleType)
+    finally:
+      widget.view.setUpdatesEnabled(True)
+
   def deleteNeedleFromTable(self, ID):
     """
     Delete last needle from model
@@ -7697,35 +7147,21 @@ class NeedleFinderLogic:
     widget = slicer.modules.NeedleFinderWidget
     returnTips = []
     names = []
-    modelNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLModelNode')
-    nbNode = modelNodes.GetNumberOfItems()
-    for nthNode in range(nbNode):
-        # print nthNode
-        node = slicer.mrmlScene.GetNthNodeByClass(nthNode, 'vtkMRMLModelNode')
-        if node.GetAttribute('type') == type:
-            polydata = node.GetPolyData()
-            p, pOpp, pbis = [0, 0, 0], [0, 0, 0], [0, 0, 0]
-            #if not polydata: breakbox("/!!!\ needle tube not found as polydata in scene/vtk file missing: "+widget.caseNr+" "+node.GetName())
-            if polydata and polydata.GetNumberOfPoints() > 100:  # ??? this is risky when u have other models in the scene (not only neeedles(
-                if not widget.autoStopTip.isChecked():
-                  polydata.GetPoint(0+offset, p)
-                  if center:
-                    polydata.GetPoint(0+offset+25, pOpp)
-                    p = (np.array(p) + np.array(pOpp))/2
-                  polydata.GetPoint(int(polydata.GetNumberOfPoints() - 1 - offset), pbis)
-                  if center:
-                    polydata.GetPoint(0+offset+25, pOpp)
-                    pbis = (np.array(pbis) + np.array(pOpp))/2
-                  if pbis[2] > p[2]:
-                      p = pbis
-                else:
-                  # get a point from the middle (low=/4, high=/4*3) of the needle shaft polygon model
-                  polydata.GetPoint(int(polydata.GetNumberOfPoints() / 2)+ offset, p) #CONST
-                  if center:
-                    polydata.GetPoint(int(polydata.GetNumberOfPoints() / 2)+offset+25, pOpp)
-                    p = (np.array(p) + np.array(pOpp))/2
-                returnTips.append(self.ras2ijk(p))
-                names.append(node.GetName())
+    for node in self.needleIndex.nodes(slicer.mrmlScene, type):
+        geometry = self.needleIndex.geometry(node)
+        if not widget.autoStopTip.isChecked():
+          index = geometry.tipIndex
+        else:
+          # get a point from the middle of the needle shaft
+          index = len(geometry.points) // 2 #CONST
+        if center:
+          p = geometry.points[index]
+        else:
+          p = self.tubeSurfacePoint(geometry, index, offset)
+        returnTips.append(list(p))
+        names.append(node.GetName())
+    if returnTips:
+      returnTips = self.ras2ijkArray(returnTips).tolist()
     return returnTips, names
 
   def returnBasesFromNeedleModels(self, type="Validation", offset=0):
@@ -7737,23 +7173,15 @@ class NeedleFinderLogic:
     widget = slicer.modules.NeedleFinderWidget
     returnBases = []
     names = []
-    modelNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLModelNode')
-    nbNode = modelNodes.GetNumberOfItems()
-    for nthNode in range(nbNode):
-        # print nthNode
-        node = slicer.mrmlScene.GetNthNodeByClass(nthNode, 'vtkMRMLModelNode')
-        if node.GetAttribute('type') == type:
-            polydata = node.GetPolyData()
-            p, pbis = [0, 0, 0], [0, 0, 0]
-            #if not polydata: breakbox("/!!!\ needle tube not found as polydata in scene: "+widget.caseNr+" "+node.GetName())
-            if polydata and polydata.GetNumberOfPoints() > 100:  # ??? this is risky when u have other models in the scene (not only neeedles(
-                if not widget.autoStopTip.isChecked():
-                  polydata.GetPoint(0+offset, p)
-                  polydata.GetPoint(int(polydata.GetNumberOfPoints() - 1 - offset), pbis)
-                  if pbis[2] < p[2]:
-                      p = pbis
-                returnBases.append(self.ras2ijk(p))
-                names.append(node.GetName())
+    for node in self.needleIndex.nodes(slicer.mrmlScene, type):
+        geometry = self.needleIndex.geometry(node)
+        p = [0, 0, 0]
+        if not widget.autoStopTip.isChecked():
+          p = list(self.tubeSurfacePoint(geometry, geometry.baseIndex, offset))
+        returnBases.append(p)
+        names.append(node.GetName())
+    if returnBases:
+      returnBases = self.ras2ijkArray(returnBases).tolist()
     return returnBases, names
 
   def returnMidsFromNeedleModels(self, type="Validation", offset=0):
@@ -7765,21 +7193,16 @@ class NeedleFinderLogic:
     widget = slicer.modules.NeedleFinderWidget
     returnTips = []
     names = []
-    modelNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLModelNode')
-    nbNode = modelNodes.GetNumberOfItems()
-    for nthNode in range(nbNode):
-        # print nthNode
-        node = slicer.mrmlScene.GetNthNodeByClass(nthNode, 'vtkMRMLModelNode')
-        if node.GetAttribute('type') == type:
-            polydata = node.GetPolyData()
-            pmid=[0, 0, 0]
-            #if not polydata: breakbox("/!!!\ needle tube not found as polydata in scene/vtk file missing: "+widget.caseNr+" "+node.GetName())
-            if polydata and polydata.GetNumberOfPoints() > 100:  # ??? this is risky when u have other models in the scene (not only neeedles(
-              polydata.GetPoint(int((polydata.GetNumberOfPoints() - 1)/2)+offset, pmid)
-              returnTips.append(self.ras2ijk(pmid))
-              names.append(node.GetName())
+    for node in self.needleIndex.nodes(slicer.mrmlScene, type):
+        geometry = self.needleIndex.geometry(node)
+        pmid = self.tubeSurfacePoint(geometry, geometry.midIndex, offset)
+        returnTips.append(list(pmid))
+        names.append(node.GetName())
+    if returnTips:
+      returnTips = self.ras2ijkArray(returnTips).tolist()
     return returnTips, names
 
+  @NeedleFinderLib.traced()
   def startValidation(self, script=False, offset=0, needleNr=None):
     """Start the evaluation process:
     * Calls returnTipsFromNeedleModels() to build an array of the tip of manually segmented needles
@@ -7806,9 +7229,7 @@ class NeedleFinderLogic:
     # delete old needles as they will be recalculated
     self.deleteAllAutoNeedlesFromScene()
     # select the image node from the Red slice viewer
-    m = vtk.vtkMatrix4x4()
     volumeNode = slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetBackgroundLayer().GetVolumeNode()
-    volumeNode.GetIJKToRASMatrix(m)
     imageData = volumeNode.GetImageData()
     spacing = volumeNode.GetSpacing()
     # chrono starts
@@ -7879,32 +7300,149 @@ class NeedleFinderLogic:
     crosshairNode.SetCrosshairMode(slicer.vtkMRMLCrosshairNode().ShowIntersection)
 
   def exportEvaluation(self, results, url):
-    """ Export evaluation results to a CSV file (e.g. when doing parameter optimizations)
+    """ Export evaluation results to a CSV file (e.g. when doing parameter optimizations).
+    The rows are buffered by the results sink of the file (cf. resultsSink), call closeResults at the end of the run.
 
-    :param results: array containing the results of the evaluation
+    :param results: a row or a list of rows of results of the evaluation
     :param url: url for saving the file
     """
     # research
     profprint()
-    if not os.path.exists(url):
-      print "creating new results file: ",url
-      open(url, 'w').close()
-    myfile = open(url, 'a')
-
-    wr = csv.writer(myfile)
-    r = numpy.array(results)
-    if len(r.shape) == 1:
-      wr.writerow(results)
-    else:
-      wr.writerows(results)
+    self.resultsSink(url).write(results)
+
+  def resultsSink(self, url):
+    """
+    NeedleFinderLib.ResultsSink of a results file, opened once per run: buffered CSV rows and an .npz archive of the
+    columns next to it, written by closeResults.
+    """
+    # research
+    sink = self.resultSinks.get(url)
+    if sink is None:
+      sink = NeedleFinderLib.ResultsSink(url)
+      if sink.created:
+        print "creating new results file: ",url
+      self.resultSinks[url] = sink
+    return sink
+
+  def removeSceneObservers(self):
+    """
+    Remove the scene observers of the needle index (cf. sceneObserverTags), when the logic is not used anymore.
+    """
+    # productive
+    for tag in self.sceneObserverTags:
+      slicer.mrmlScene.RemoveObserver(tag)
+    self.sceneObserverTags = []
+
+  def closeResults(self):
+    """
+    Flush and close the results files of exportEvaluation and the detection artifact files of saveDetectionArtifact.
+    """
+    # research
+    for sink in self.resultSinks.values():
+      sink.close()
+    self.resultSinks = {}
+    for writer in self.artifactWriters.values():
+      writer.close()
+    self.artifactWriters = {}
+
+  def saveDetectionArtifact(self, fileName, run, results=None, scores=None, **info):
+    """
+    Append the segmented needles of the scene (control points, centerline, radius and their scores) and the detection
+    parameters to a NeedleFinderLib detection artifact file, instead of saving the whole scene.
+
+    :param run: name or number of the run
+    :param results: rows of evaluate (script mode) for the scores of the needles
+    :param scores: scores of the run, e.g. its statistics
+    """
+    # research
+    profprint()
+    needleScores = {}
+    for row in results or []:
+      # tip distance, HD, manual needle number, manual and auto model ID numbers, cf. evaluate
+      needleScores[int(row[4])] = dict(tipDistance=float(row[0]), hausdorff=float(row[1]), manual=int(row[2]))
+    needles = []
+    for node in self.needleIndex.nodes(slicer.mrmlScene, 'Detection'):
+      data = self.needleFieldData(node.GetPolyData())
+      if data is None:
+        continue
+      centerline, controlPoints, radius = data
+      needles.append(dict(name=node.GetName(), nth=node.GetAttribute('nth'), centerline=centerline,
+                          controlPointsRAS=controlPoints, radius=radius,
+                          controlPointsIJK=self.ras2ijkArray(controlPoints) if controlPoints is not None else None,
+                          scores=needleScores.get(int(node.GetID().strip('vtkMRMLModelNode')))))
+    writer = self.artifactWriters.get(fileName)
+    if writer is None:
+      writer = NeedleFinderLib.DetectionArtifactWriter(fileName)
+      self.artifactWriters[fileName] = writer
+    writer.write(run, self.detectionParameters().asDict(), needles, scores, **info)
+
+  def loadDetectionArtifact(self, fileName, run=None):
+    """
+    Recreate the needle models of a run of a detection artifact file (the last one if run is None), replacing the
+    segmented needles of the current set.
+
+    :return: the model nodes
+    """
+    # research
+    profprint()
+    runs = NeedleFinderLib.readDetectionArtifacts(fileName, run)
+    if not runs:
+      print "no run %s in %s" % ('' if run is None else run, fileName)
+      return []
+    self.deleteAllAutoNeedlesFromScene()
+    models = []
+    with self.sceneBatch():
+      for needle in runs[-1]['needles']:
+        # auto-seg_<round>-ID-<model ID>-<manual name>, cf. addNeedleModel
+        manualName = needle['name'].split('-ID-')[-1].split('-', 1)[-1] if '-ID-' in needle['name'] else ''
+        tube = self.needleTube(needle['centerline'], needle['radius'], controlPoints=needle['controlPointsRAS'])
+        models.append(self.addNeedleModel(tube, int(needle['nth'] or 0), 'Detection', manualName=manualName))
+    print "%d needles of run %s loaded from %s" % (len(models), runs[-1]['run'], fileName)
+    return models
+
+  def dumpStepLog(self, fileName, needle=None):
+    """
+    Save the buffered step records of the detectors (of a needle) to a JSON lines file.
+    """
+    # research
+    profprint()
+    n = self.stepLog.dump(fileName, needle=needle)
+    print "%d step records saved to %s (%d older ones dropped)" % (n, fileName, self.stepLog.dropped)
+
+  def printStepRecords(self, after, detector='15_1'):
+    """
+    Print the step records of the detector made after record number after, at verbosity 2.
+    """
+    # productive
+    if verbosity >= 2:
+      for record in self.stepLog.select(detector, after=after):
+        vprint(2, NeedleFinderLib.StepLog.text(record))
+
+  def exportTrace(self, fileName, reset=True):
+    """
+    Print the statistics of NeedleFinderLib.tracer (spans, profprint calls, counters, per needle) and save its events
+    as a Chrome trace.
+
+    :param reset: start a new trace
+    """
+    # research
+    profprint()
+    tracer = NeedleFinderLib.tracer
+    for line in tracer.summary():
+      print line
+    tracer.exportChromeTrace(fileName)
+    print "trace of %d events saved to %s" % (len(tracer.events), fileName)
+    if reset:
+      tracer.reset()
 
   def hausdorffDistance(self, id1, id2):
     """
     Calculates the Hausdorff's distance [HD]_ of two needles. Both needles are truncated to start and end at the same slices.
+    The centerlines of the needles are compared, cf. evaluateNeedlePairs.
 
     :param id1: vtkMRMLModelNodeID of Needle 1
     :param id2: vtkMRMLModelNodeID of Needle 2
-    :return: Hausdorff's distance in millimeters
+    :return: Hausdorff's distance in millimeters, None if the needles have no axial range in common
 
     .. math::  d_{\mathrm H}(X,Y) = \max\{\,\sup_{x \in X} \inf_{y \in Y} d(x,y),\, \sup_{y \in Y} \inf_{x \in X} d(x,y)\,\}
 
@@ -7918,74 +7456,32 @@ class NeedleFinderLogic:
     .. [HD] http://en.wikipedia.org/wiki/Hausdorff_distance
     """
     # productive #math
-    if isinstance(id1, int):
-      id1 = 'vtkMRMLModelNode%d' % id1
-    if isinstance(id2, int):
-      id2 = 'vtkMRMLModelNode%d' % id2
     if frequent: profprint()
-    node1 = slicer.mrmlScene.GetNodeByID(id1)
-    polydata1 = node1.GetPolyData()
-    node2 = slicer.mrmlScene.GetNodeByID(id2)
-    polydata2 = node2.GetPolyData()
-    nb1 = polydata1.GetNumberOfPoints()
-    nb2 = polydata2.GetNumberOfPoints()
+    r = self.evaluateNeedlePairs([(id1, id2)])[0]
+    if r['valid']:
+      return float(r['hausdorff'])
 
-    pt1 = [0, 0, 0]
-    pt2 = [0, 0, 0]
-    polydata1.GetPoint(1, pt1)
-    polydata1.GetPoint(nb1 - 1, pt2)
-    minVal1 = min(pt1[2], pt2[2])
-    maxVal1 = max(pt1[2], pt2[2])
-    pt1 = [0, 0, 0]
-    pt2 = [0, 0, 0]
-    polydata2.GetPoint(1, pt1)
-    polydata2.GetPoint(nb2 - 1, pt2)
-    minVal2 = min(pt1[2], pt2[2])
-    maxVal2 = max(pt1[2], pt2[2])
-    valueBase = max(minVal1, minVal2)
+  def evaluateNeedlePairs(self, pairs):
+    """
+    Hausdorff distances, tip and mean errors of pairs of needles, all at once on their centerlines
+    (cf. NeedleFinderLib.evaluateNeedles, with the truncation of the former hausdorffDistance).
 
-    if polydata1.GetNumberOfPoints() > 100 and polydata2.GetNumberOfPoints() > 100:
-      # truncate polydatas
-      truncatedPolydata1 = self.clipPolyData(node1, valueBase)
-      truncatedPolydata2 = self.clipPolyData(node2, valueBase)
-
-      if truncatedPolydata1.GetNumberOfPoints()>100 and truncatedPolydata2.GetNumberOfPoints()>100:
-
-        cellId = vtk.mutable(1)
-        subid = vtk.mutable(1)
-        dist = vtk.mutable(1)
-        cl2 = vtk.vtkCellLocator()
-        cl2.SetDataSet(truncatedPolydata2)
-        cl2.BuildLocator()
-        # Hausforff 1 -> 2
-        minima = []
-        for i in range(int(nb1 / float(10))):
-          pt = [0, 0, 0]
-          polydata1.GetPoint(10 * i, pt)
-          closest = [0, 0, 0]
-          cl2.FindClosestPoint(pt, closest, cellId, subid, dist)
-          if abs(closest[2] - pt[2]) <= 1:
-            minima.append(self.distance(pt, closest))
-          else:
-              minima.append(0)
-        hausdorff12 = max(minima)
-
-        # Hausforff 2 -> 1
-        minima = []
-        cl1 = vtk.vtkCellLocator()
-        cl1.SetDataSet(truncatedPolydata1)
-        cl1.BuildLocator()
-        for i in range(int(nb2 / float(10))):
-          pt = [0, 0, 0]
-          polydata2.GetPoint(10 * i, pt)
-          closest = [0, 0, 0]
-          cl1.FindClosestPoint(pt, closest, cellId, subid, dist)
-          if abs(closest[2] - pt[2]) <= 1:
-            minima.append(self.distance(pt, closest))
-          else:
-              minima.append(0)
-        hausdorff21 = max(minima)
-        return max(hausdorff12, hausdorff21)
+    :param pairs: list of (id1, id2), vtkMRMLModelNode IDs or their numbers
+    :return: structured array of NeedleFinderLib.EVALUATION_DTYPE, in the order of pairs
+    """
+    # productive #math
+    if frequent: profprint()
+    scene = slicer.mrmlScene
+    centerlines1, centerlines2 = [], []
+    for id1, id2 in pairs:
+      if isinstance(id1, int):
+        id1 = 'vtkMRMLModelNode%d' % id1
+      if isinstance(id2, int):
+        id2 = 'vtkMRMLModelNode%d' % id2
+      for nodeID, centerlines in ((id1, centerlines1), (id2, centerlines2)):
+        geometry = self.needleIndex.geometryByID(scene, nodeID)
+        centerlines.append(geometry.points if geometry else np.zeros((0, 3)))
+    return NeedleFinderLib.evaluateNeedles(centerlines1, centerlines2, truncate='slice')
 
   def hausdorffDistance13(self, id1, id2):
     """MICCAI13 Version
@@ -8107,6 +7603,7 @@ class NeedleFinderLogic:
           pass
 
 
+  @NeedleFinderLib.traced()
   def evaluate(self, script=False, needleNr=None):
     """
     This function first invokes needleMatching() with, for each automatically segmented needle in the vtkMRMLScene,
@@ -8133,11 +7630,12 @@ class NeedleFinderLogic:
                             widget.sigmaValue.value,
                             widget.algoVersParameter.value]
 
+    evaluation = self.evaluateNeedlePairs([(match[1], match[2]) for match in result])
     for i in range(len(result)):
       # if widget.algoVersParameter.value <= 0:
       #   val = self.hausdorffDistance(result[i][1], result[i][2])
       # else:
-      val = self.hausdorffDistance(result[i][1], result[i][2])
+      val = evaluation['hausdorff'][i] if evaluation['valid'][i] else float('inf')
       try: needleNrFromFilename=int(result[i][3].strip('manual-seg_'))
       except: needleNrFromFilename=-1
       if needleNr!=None and needleNr!=needleNrFromFilename:
@@ -8162,25 +7660,10 @@ class NeedleFinderLogic:
     """
     # productive #math
     if frequent: profprint()
-    node = slicer.mrmlScene.GetNodeByID('vtkMRMLModelNode' + str(id1))
-    polydata = node.GetPolyData()
-    node2 = slicer.mrmlScene.GetNodeByID('vtkMRMLModelNode' + str(id2))
-    polydata2 = node2.GetPolyData()
-    p, pbis = [0, 0, 0], [0, 0, 0]
-    p2 = [0, 0, 0]
-    p2bis = [0, 0, 0]
-    tipDistance = []
-    for i in range(100):
-        polydata.GetPoint(i, p)
-        polydata.GetPoint(polydata.GetNumberOfPoints()-1 - i, pbis)
-        if pbis[2] > p[2]:
-          p = pbis
-        polydata2.GetPoint(i, p2)
-        polydata2.GetPoint(polydata2.GetNumberOfPoints()-1 - i, p2bis)
-        if p2bis[2] > p2[2]:
-          p2 = p2bis
-        tipDistance.append(((p2[0] - p[0]) ** 2 + (p2[1] - p[1]) ** 2 + (p2[2] - p[2]) ** 2) ** 0.5)
-    return min(tipDistance)
+    scene = slicer.mrmlScene
+    geometry = self.needleIndex.geometryByID(scene, 'vtkMRMLModelNode' + str(id1))
+    geometry2 = self.needleIndex.geometryByID(scene, 'vtkMRMLModelNode' + str(id2))
+    return float(np.linalg.norm(geometry2.tip - geometry.tip))
 
   def distBase(self, id1, id2):
     """ Returns the distance between the base of two needles
@@ -8191,62 +7674,42 @@ class NeedleFinderLogic:
     """
     # productive #math
     if frequent: profprint()
-    node = slicer.mrmlScene.GetNodeByID('vtkMRMLModelNode' + str(id1))
-    polydata = node.GetPolyData()
-    node2 = slicer.mrmlScene.GetNodeByID('vtkMRMLModelNode' + str(id2))
-    polydata2 = node2.GetPolyData()
-    p, pbis = [0, 0, 0], [0, 0, 0]
-    p2 = [0, 0, 0]
-    p2bis = [0, 0, 0]
-    baseDistance = []
-    for i in range(100):
-        polydata.GetPoint(i, p)
-        polydata.GetPoint(polydata.GetNumberOfPoints()-1 - i, pbis)
-        if pbis[2] > p[2]:
-          pbis = p
-        polydata2.GetPoint(i, p2)
-        polydata2.GetPoint(polydata2.GetNumberOfPoints()-1 - i, p2bis)
-        if p2bis[2] > p2[2]:
-          p2bis = p2
-        baseDistance.append(((p2bis[0] - pbis[0]) ** 2 + (p2bis[1] - pbis[1]) ** 2 + (p2bis[2] - pbis[2]) ** 2) ** 0.5)
-    return min(baseDistance)
-
-  def needleMatching(self):
+    scene = slicer.mrmlScene
+    geometry = self.needleIndex.geometryByID(scene, 'vtkMRMLModelNode' + str(id1))
+    geometry2 = self.needleIndex.geometryByID(scene, 'vtkMRMLModelNode' + str(id2))
+    return float(np.linalg.norm(geometry2.base - geometry.base))
+
+  def needleMatching(self, baseWeight=0., maxDistance=None):
     """This functions associates manually segmented needles to their automatically segmented version. To do so,
-    each manually segmented needle has a 'type' attribute named 'validation'. For each manually segmented needle, an axial
-    distance between the tip of this needle, and the tip of every auto segmented needle is computed. The auto needle that
-    offers the minimal tip axial distance is considered as corresponding needle
+    each manually segmented needle has a 'type' attribute named 'validation'. The distances between the tips of all
+    the auto and manual segmented needles are computed at once, and the one to one assignment of minimal total
+    distance is chosen (cf. NeedleFinderLib.matchNeedles), so that no manual needle is matched twice.
 
-    :return: array of tuple of corresponding needles
+    :param baseWeight: weight of the distance of the bases in the cost of a pair
+    :param maxDistance: auto needles farther than this from their assigned manual needle are not matched,
+                        matchingThresh_mm if None
+    :return: array of [tip distance, manual needle ID, auto needle ID, manual needle name], in the order of the auto
+             needles in the scene
     """
     # productive
     profprint()
     print('NeedleMatching started')
-    modelNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLModelNode')
-    nbNode = modelNodes.GetNumberOfItems()
+    if maxDistance == None:
+      maxDistance = matchingThresh_mm
+    needles = self.needleIndex.nodes(slicer.mrmlScene)
+    autoNodes = [node for node in needles if 'auto-seg' in node.GetName()]
+    manualNodes = [node for node in needles if 'manual-seg' in node.GetName()]
+    autoGeometry = [self.needleIndex.geometry(node) for node in autoNodes]
+    manualGeometry = [self.needleIndex.geometry(node) for node in manualNodes]
+    matches = NeedleFinderLib.matchNeedles([g.tip for g in autoGeometry], [g.tip for g in manualGeometry],
+                                           [g.base for g in autoGeometry], [g.base for g in manualGeometry],
+                                           baseWeight, maxDistance)
     result = []
-    found = []
-    # print nbNode
-    for nthNode in range(nbNode):
-      node = slicer.mrmlScene.GetNthNodeByClass(nthNode, 'vtkMRMLModelNode')
-      if 'auto-seg' in node.GetName():
-        dist = []
-        polydata = node.GetPolyData()
-        if polydata is not None and polydata.GetNumberOfPoints() > 100:
-          for nthNode2 in range(nbNode):
-            node2 = slicer.mrmlScene.GetNthNodeByClass(nthNode2, 'vtkMRMLModelNode')
-            if 'manual-seg' in node2.GetName():
-              polydata2 = node2.GetPolyData()
-              if polydata2 is not None and polydata2.GetNumberOfPoints() > 100:
-                tipDistance = self.distTip(int(node.GetID().strip('vtkMRMLModelNode')) , int(node2.GetID().strip('vtkMRMLModelNode')))
-                dist.append([tipDistance, node2.GetID(), node2.GetName()])
-                # print tipDistance
-          if dist != []:
-            match = [min(dist)[0], min(dist)[1], node.GetID(), min(dist)[2]]
-            result.append(match)
-            found.append(min(dist)[1])
-            found.append(node.GetID())
-            node.GetDisplayNode().SetSliceIntersectionVisibility(1)
+    for autoIndex, manualIndex, tipDistance in matches:
+      node, node2 = autoNodes[autoIndex], manualNodes[manualIndex]
+      result.append([tipDistance, node2.GetID(), node.GetID(), node2.GetName()])
+      node.GetDisplayNode().SetSliceIntersectionVisibility(1)
+    print('%d auto needles, %d manual needles, %d matched' % (len(autoNodes), len(manualNodes), len(result)))
     # print result
     print('NeedleMatching finished')
 
@@ -8849,6 +8312,9 @@ class NeedleFinderLogic:
     config.set('BooleanSection', 'extendNeedle', widget.extendNeedle.isChecked())
     config.set('BooleanSection', 'maxLength', widget.maxLength.isChecked())
     config.set('BooleanSection', 'gaussianAttenuationButton', widget.gaussianAttenuationButton.isChecked())
+    config.set('BooleanSection', 'featureVolumes', widget.featureVolumes.isChecked())
+    config.set('BooleanSection', 'vectorizedConeSearch', widget.vectorizedConeSearch.isChecked())
+    config.set('BooleanSection', 'roiDetection', widget.roiDetection.isChecked())
 
     config.set('IntegerSection', 'realNeedleLength', widget.realNeedleLength.value)
     config.set('IntegerSection', 'sigmaValue', widget.sigmaValue.value)
@@ -8860,6 +8326,12 @@ class NeedleFinderLogic:
     config.set('IntegerSection', 'lenghtNeedleParameter', widget.lenghtNeedleParameter.value)
     config.set('IntegerSection', 'radiusNeedleParameter', widget.radiusNeedleParameter.value)
     config.set('IntegerSection', 'algoVersParameter', widget.algoVersParameter.value)
+    config.set('IntegerSection', 'detectionThreads', widget.detectionThreads.value)
+    config.set('IntegerSection', 'coarseTopK', widget.coarseTopK.value)
+    config.set('IntegerSection', 'coarseBudget', widget.coarseBudget.value)
+    config.set('IntegerSection', 'memoryBudget', widget.memoryBudget.value)
+    config.set('IntegerSection', 'tubeSides', widget.tubeSides.value)
+    config.set('IntegerSection', 'exportTubeSides', widget.exportTubeSides.value)
 
     # Writing our configuration file to 'example.cfg'
     with open(filePath, 'wb') as configfile:
@@ -8884,6 +8356,18 @@ class NeedleFinderLogic:
     extendNeedle = config.getboolean('BooleanSection', 'extendNeedle')
     maxLength = config.getboolean('BooleanSection', 'maxLength')
     gaussianAttenuationButton = config.getboolean('BooleanSection', 'gaussianAttenuationButton')
+    try:
+      featureVolumes = config.getboolean('BooleanSection', 'featureVolumes')
+    except:
+      featureVolumes = True # old parameter files
+    try:
+      vectorizedConeSearch = config.getboolean('BooleanSection', 'vectorizedConeSearch')
+    except:
+      vectorizedConeSearch = True # old parameter files
+    try:
+      roiDetection = config.getboolean('BooleanSection', 'roiDetection')
+    except:
+      roiDetection = False # old parameter files
 
     realNeedleLength = config.getint('IntegerSection', 'realNeedleLength')
     sigmaValue = config.getint('IntegerSection', 'sigmaValue')
@@ -8898,6 +8382,24 @@ class NeedleFinderLogic:
     lenghtNeedleParameter = config.getint('IntegerSection', 'lenghtNeedleParameter')
     radiusNeedleParameter = config.getint('IntegerSection', 'radiusNeedleParameter')
     algoVersParameter = config.getint('IntegerSection', 'algoVersParameter')
+    try:
+      detectionThreads = config.getint('IntegerSection', 'detectionThreads')
+    except:
+      detectionThreads = 1 # old parameter files
+    try:
+      coarseTopK = config.getint('IntegerSection', 'coarseTopK')
+      coarseBudget = config.getint('IntegerSection', 'coarseBudget')
+    except:
+      coarseTopK, coarseBudget = 4, 35 # old parameter files
+    try:
+      memoryBudget = config.getint('IntegerSection', 'memoryBudget')
+    except:
+      memoryBudget = 0 # old parameter files
+    try:
+      tubeSides = config.getint('IntegerSection', 'tubeSides')
+      exportTubeSides = config.getint('IntegerSection', 'exportTubeSides')
+    except:
+      tubeSides, exportTubeSides = 12, 50 # old parameter files
 
     widget.autoCorrectTip.checked = autoCorrectTip
     widget.invertedContrast.checked = invertedContrast
@@ -8908,6 +8410,9 @@ class NeedleFinderLogic:
     widget.extendNeedle.checked = extendNeedle
     widget.maxLength.checked = maxLength
     widget.gaussianAttenuationButton.checked = gaussianAttenuationButton
+    widget.featureVolumes.checked = featureVolumes
+    widget.vectorizedConeSearch.checked = vectorizedConeSearch
+    widget.roiDetection.checked = roiDetection
 
     widget.realNeedleLength.value = realNeedleLength
     widget.sigmaValue.value = sigmaValue
@@ -8919,6 +8424,12 @@ class NeedleFinderLogic:
     widget.lenghtNeedleParameter.value = lenghtNeedleParameter
     widget.radiusNeedleParameter.value = radiusNeedleParameter
     widget.algoVersParameter.value = algoVersParameter
+    widget.detectionThreads.value = detectionThreads
+    widget.coarseTopK.value = coarseTopK
+    widget.coarseBudget.value = coarseBudget
+    widget.memoryBudget.value = memoryBudget
+    widget.tubeSides.value = tubeSides
+    widget.exportTubeSides.value = exportTubeSides
     print "#############"
     print "algoVers: ", algoVersParameter
     print "Parameters successfully loaded!"
@@ -8933,8 +8444,6 @@ class NeedleFinderLogic:
     imageData = red_logic.GetBackgroundLayer().GetVolumeNode()
     dn = imageData.GetScalarVolumeDisplayNode()
     imageDimensions = imageData.GetImageData().GetDimensions()
-    m = vtk.vtkMatrix4x4()
-    volumeNode.GetIJKToRASMatrix(m)
     #####################################################################################
     # We load the template scene, with the fiducial lists 'moving' and 'fixed'
     #####################################################################################
@@ -8954,7 +8463,7 @@ class NeedleFinderLogic:
     slicer.mrmlScene.AddNode(roi)
     roi.SetROIAnnotationVisibility(1)
     roi.SetRadiusXYZ(100,100,imageDimensions[2]/c)
-    roi.SetXYZ(0,0,m.GetElement(2,3)+imageDimensions[2]/c)
+    roi.SetXYZ(0,0,self.volumeTransform(volumeNode).ijkToRAS[2, 3]+imageDimensions[2]/c)
     roi.SetLocked(1)
     print 'roi set'
     #####################################################################################
@@ -9302,7 +8811,7 @@ class NeedleFinderLogic:
             slicer.mrmlScene.RemoveNode(previousPt)
 
           ctrlPts = []
-          centerline = self.getCenterLine(polyData)
+          centerline = self.getCenterLine(node)
 
           for i in range(N):
               # p = polyData.GetPoint(int(i*2500/(N-1)))
@@ -9312,16 +8821,16 @@ class NeedleFinderLogic:
 
   def getCenterLine(self, polydata):
       '''
-      :param polydata: vtkPolydata
-      :return: list of 50 points at the center of the needle
+      :param polydata: model node of a needle (cached, cf. needleIndex) or vtkPolydata of a needle tube
+      :return: list of the points of the centerline of the needle, cf. needleCenterline
       '''
-      centerline = []
-      for i in range(50):
-          p1 = polydata.GetPoint(i*50)
-          p2 = polydata.GetPoint(i*50 + 25)
-          p = (np.array(p1) + np.array(p2))/2
-          centerline.append(p)
-      return centerline
+      if isinstance(polydata, slicer.vtkMRMLModelNode):
+          geometry = self.needleIndex.geometry(polydata)
+      else:
+          geometry = self.needleGeometry(polydata)
+      if geometry is None:
+          return []
+      return list(geometry.points)
 
   def cleanScene(self, path = None):
     '''
@@ -9549,8 +9058,7 @@ class NeedleFinderLogic:
           name = node.GetName()
           nb = int(name.split('_')[1]) # get needle number
           if nb in validNeedles and name not in filterOutNeedles:
-              p = node.GetPolyData()
-              x = self.getCenterLine(p)
+              x = self.getCenterLine(node)
               dists = []
               for q in x:
                   dists.append(self.distance(q,pt))
@@ -9711,6 +9219,12 @@ class NeedleFinderTest(unittest.TestCase):
 
     self.setUp()
     self.test_NeedleFinder1()
+    self.setUp()
+    self.test_NeedleFinderDetectors()
+    self.setUp()
+    self.test_NeedleFinderConeSearchBackends()
+    self.test_NeedleFinderDistanceFields()
+    self.test_NeedleFinderBenchmark()
 
   def test_NeedleFinder1(self):
     """
@@ -9752,4 +9266,170 @@ class NeedleFinderTest(unittest.TestCase):
     volumeNode = slicer.util.getNode(pattern="FA")
     logic = NeedleFinderLogic()
     self.assertTrue(logic.hasImageData(volumeNode))
+    logic.removeSceneObservers()
+    self.delayDisplay('Test passed!')
+
+  def catheterPhantom(self):
+    """
+    Synthetic volume shown in the red slice: noise and a dark, slightly oblique catheter, IJK = RAS
+    """
+    # test
+    dims = [60, 60, 40]
+    numpy.random.seed(0)
+    a = (500 + 50 * numpy.random.randn(dims[2], dims[1], dims[0])).astype(numpy.int16)
+    for k in range(dims[2]):
+      i0 = 30 + int(round(0.2 * (dims[2] - 1 - k)))
+      a[k, 28:33, i0 - 2:i0 + 3] = 50
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(dims)
+    imageData.GetPointData().SetScalars(vtk.util.numpy_support.numpy_to_vtk(a.ravel(), deep=1, array_type=vtk.VTK_SHORT))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName('ConeSearchPhantom')
+    volumeNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volumeNode)
+    selectionNode = slicer.app.applicationLogic().GetSelectionNode()
+    selectionNode.SetReferenceActiveVolumeID(volumeNode.GetID())
+    slicer.app.applicationLogic().PropagateVolumeSelection(0)
+    return imageData
+
+  def setDetectionParameters(self, widget):
+    """
+    Detection parameters of the recorded control points (those of Config/default.cfg) and the axial limit 2
+    """
+    # test
+    widget.radiusMax.value = 10
+    widget.gradientPonderation.value = 5
+    widget.sigmaValue.value = 4
+    widget.exponent.value = 1
+    widget.numberOfPointsPerNeedle.value = 8
+    widget.nbRotatingIterations.value = 35
+    widget.radiusNeedleParameter.value = 2
+    widget.lenghtNeedleParameter.value = 35
+    widget.gradient.checked = True
+    widget.gaussianAttenuationButton.checked = True
+    widget.autoCorrectTip.checked = False
+    widget.maxLength.checked = False
+    widget.autoStopTip.checked = False
+    widget.drawFiducialPoints.checked = False
+    widget.roiDetection.checked = False
+    widget.axialSegmentationLimit = 2
+
+  def trackNeedle(self, logic, version, tip, imageData):
+    """
+    Control points [RAS] of the single needle detector of the version
+    """
+    # test
+    if version == 0:
+      logic.needleDetectionThreadCurrentDev(tip, imageData, 0, [1, 1, 1], script=True)
+      return logic.controlPoints
+    elif version == 1:
+      return logic.needleDetectionThread13_1(tip, imageData, 0, [1, 1, 1], script=True)[0]
+    elif version == 2:
+      return logic.needleDetectionThread13_2(tip, imageData, 0, [1, 1, 1], script=True, bDrawNeedle=False)[0]
+    return logic.needleDetectionThread15_1(tip, imageData, None, [], 0, [1, 1, 1], bScript=True)[0]
+
+  def test_NeedleFinderDetectors(self):
+    """
+    The detectors of the module have to give the control points of the voxel by voxel loops of the first version of
+    the module (recorded on the same phantom)
+    """
+    # test
+    profprint()
+    global needleModelInterpolation
+    self.delayDisplay("Starting the detector test")
+    imageData = self.catheterPhantom()
+    widget = slicer.modules.NeedleFinderWidget
+    logic = widget.logic
+    self.setDetectionParameters(widget)
+    # 13_1 and 13_2 only differ for an axial spacing other than 1 mm
+    cones13 = [[30.000000, 30.000000, 38.000000], [27.572949, 28.236644, 36.833803], [33.673288, 28.020782, 34.501408],
+               [32.469815, 28.462274, 30.419718], [30.187653, 28.120052, 23.422535], [35.680139, 27.777831, 11.760563],
+               [39.348177, 28.131207, 2.000000]]
+    expected = {
+      0: [[30.000000, 30.000000, 38.000000], [29.449103, 30.834573, 36.745455], [29.607104, 30.812165, 35.212121],
+          [32.354344, 28.585424, 32.912121], [30.943868, 31.138411, 29.078788], [33.675024, 28.968539, 22.945455],
+          [34.440507, 31.006317, 12.978788], [36.584351, 30.834066, 2.000000]],
+      1: cones13,
+      2: cones13,
+      3: [[30.000000, 30.000000, 38.000000], [29.557864, 31.067312, 33.061555], [29.771682, 32.253661, 28.061555],
+          [30.843948, 32.927111, 23.061555], [32.390082, 32.719966, 18.061555], [33.475509, 32.030958, 13.061555],
+          [34.100227, 31.823812, 8.061555], [35.391611, 31.616667, 3.061555]]}
+    interpolation = needleModelInterpolation
+    needleModelInterpolation = False # the first 15_1 took the nearest entry of the needle model
+    try:
+      for version in (0, 1, 2, 3):
+        result = self.trackNeedle(logic, version, [30, 30, 38], imageData)
+        self.assertEqual(len(result), len(expected[version]))
+        for point, expectedPoint in zip(result, expected[version]):
+          for x, y in zip(point, expectedPoint):
+            self.assertAlmostEqual(x, y, places=5)
+    finally:
+      needleModelInterpolation = interpolation
+    self.delayDisplay('Test passed!')
+
+  def test_NeedleFinderConeSearchBackends(self):
+    """
+    The vectorized cone search has to give exactly the same control points as the VTK loop
+    """
+    # test
+    profprint()
+    self.delayDisplay("Starting the cone search backend test")
+    imageData = self.catheterPhantom()
+    widget = slicer.modules.NeedleFinderWidget
+    logic = widget.logic
+    self.setDetectionParameters(widget)
+    vectorized = widget.vectorizedConeSearch.isChecked()
+    try:
+      for version in (0, 1, 3):
+        results = []
+        for backend in (False, True):
+          widget.vectorizedConeSearch.checked = backend
+          results.append(self.trackNeedle(logic, version, [30, 30, 38], imageData))
+        self.assertEqual(results[0], results[1])
+    finally:
+      widget.vectorizedConeSearch.checked = vectorized
+    self.delayDisplay('Test passed!')
+
+  def test_NeedleFinderDistanceFields(self):
+    """
+    The outer isosurface of the needle distance field has to lie at the isovalue from the needle tube
+    """
+    # test
+    profprint()
+    self.delayDisplay("Starting the distance field test")
+    compositor = NeedleFinderLib.DistanceFieldCompositor(1.5, 10.)
+    centerline = numpy.array([[0.3, 0.2, -20.], [0.3, 0.2, 20.]])
+    radius = 1.
+    lattice, field = compositor.update({'needle': (0, centerline, radius)}, ['needle'])
+    image = vtk.vtkImageData()
+    image.SetDimensions(*lattice.dims)
+    image.SetOrigin(*lattice.origin)
+    image.SetSpacing(lattice.spacing, lattice.spacing, lattice.spacing)
+    image.GetPointData().SetScalars(vtk.util.numpy_support.numpy_to_vtk(field.ravel(order='F'), deep=1, array_type=vtk.VTK_FLOAT))
+    contourFilter = vtk.vtkContourFilter()
+    contourFilter.SetInputData(image)
+    contourFilter.SetValue(0, 10.)
+    contourFilter.Update()
+    points = vtk.util.numpy_support.vtk_to_numpy(contourFilter.GetOutput().GetPoints().GetData())
+    distance = NeedleFinderLib.polylineDistance(points, centerline) - radius
+    self.assertLess(numpy.abs(distance - 10.).max(), 0.1)
+    self.delayDisplay('Test passed!')
+
+  def test_NeedleFinderBenchmark(self):
+    """
+    Offline benchmark of the headless detection versions on a synthetic phantom, cf. NeedleFinderLib.Benchmark
+    """
+    # test
+    profprint()
+    self.delayDisplay("Starting the detection benchmark")
+    phantom = NeedleFinderLib.NeedlePhantom.generate(dims=(120, 120, 40), nNeedles=4, seed=1)
+    records = NeedleFinderLib.runBenchmark([phantom], NeedleFinderLib.NeedleDetector.versions)
+    fileName = slicer.app.temporaryPath + '/NeedleFinderBenchmark.jsonl'
+    NeedleFinderLib.writeResults(records, fileName)
+    for s in NeedleFinderLib.summarize(records):
+      print(s['text'])
+    print('Benchmark results written to %s' % fileName)
+    for r in records:
+      self.assertEqual(r['status'], 'ok')
+      self.assertLess(r['hausdorff'], 2)
     self.delayDisplay('Test passed!')
@@ -0,0 +1,95 @@
+"""
+Detection artifacts.
+
+parSearch saved the whole scene (volume and all models) to an .mrb after every run, to keep the detected needles.
+A detection artifact file keeps only what is needed to look at a run again: one JSON line per run, appended, with
+the detection parameters, the scores of the run and per needle its name, color index, control points [RAS and
+IJK], sampled centerline [RAS], radius and scores. The coordinates are rounded to 1e-3 mm. The module recreates
+the needle models of a run from it (loadDetectionArtifact).
+"""
+
+import json
+import os
+import time
+import numpy
+
+__all__ = ['DetectionArtifactWriter', 'readDetectionArtifacts']
+
+FORMAT = 1
+
+
+def roundedPoints(points):
+  if points is None:
+    return None
+  return numpy.round(numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3), 3).tolist()
+
+
+class DetectionArtifactWriter(object):
+  """
+  Appends the runs to a detection artifact file, cf. module doc.
+  """
+
+  def __init__(self, fileName):
+    self.fileName = fileName
+    cut = False
+    if os.path.exists(fileName) and os.path.getsize(fileName):
+      with open(fileName, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        cut = f.read(1) != b'\n'
+    self.file = open(fileName, 'a')
+    if cut:
+      self.file.write('\n') # after a run cut by an interruption
+    self.runs = 0
+
+  def write(self, run, parameters, needles, scores=None, **info):
+    """
+    Append a run and flush it.
+
+    :param run: name or number of the run
+    :param parameters: dict of the detection parameters
+    :param needles: list of dicts with name, centerline [RAS] and optionally nth (color index), controlPointsRAS,
+                    controlPointsIJK, radius and scores (dict)
+    :param scores: optional scores of the run (e.g. its statistics), JSON serializable
+    :param info: other JSON serializable values of the run, e.g. case
+    """
+    record = dict(info, format=FORMAT, run=run, time=time.time(), parameters=parameters, scores=scores, needles=[])
+    for needle in needles:
+      record['needles'].append(dict(name=needle['name'], nth=needle.get('nth'),
+                                    centerline=roundedPoints(needle['centerline']),
+                                    controlPointsRAS=roundedPoints(needle.get('controlPointsRAS')),
+                                    controlPointsIJK=roundedPoints(needle.get('controlPointsIJK')),
+                                    radius=float(needle.get('radius', 1.)), scores=needle.get('scores')))
+    self.file.write(json.dumps(record, sort_keys=True) + '\n')
+    self.file.flush()
+    self.runs += 1
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+
+def readDetectionArtifacts(fileName, run=None):
+  """
+  Runs of a detection artifact file, the points as N x 3 arrays; a line cut by an interruption is skipped.
+
+  :param run: only the runs of this name or number if not None
+  :return: list of run dicts, in the order they were written
+  """
+  runs = []
+  if not os.path.exists(fileName):
+    return runs
+  with open(fileName) as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      if run is not None and record.get('run') != run:
+        continue
+      for needle in record['needles']:
+        for key in ('centerline', 'controlPointsRAS', 'controlPointsIJK'):
+          if needle.get(key) is not None:
+            needle[key] = numpy.array(needle[key], dtype=numpy.float64).reshape(-1, 3)
+      runs.append(record)
+  return runs
@@ -0,0 +1,237 @@
+"""
+Offline detection benchmark.
+
+Tracks the needles of synthetic phantoms (cf. Phantom) with each detection version through the headless
+NeedleDetector and records, per needle, the wall time, the number of line samples scored, the peak
+resident memory of the tracking and the Hausdorff distance of the needle curve (the Bezier curve of the
+control points, as rendered by the module) to the ground truth centerline.
+The records are written as JSON lines (or CSV) so that runs can be compared for speed and accuracy
+regressions.
+
+Run it outside of Slicer from the module directory:
+  python NeedleFinderLib/Benchmark.py -o benchmark.jsonl --phantoms 3 --needles 8
+The versions are those of NeedleDetector (0-3 and 6); 4 and 5 are the post-processing of the module over
+versions 1 and 3, whose tracking is benchmarked as such, and are recorded as 'unsupported' if asked for. With
+--trace, the spans and counters of the detection (cf. Tracing) are exported as a Chrome trace, one needle per
+phantom, needle and version.
+"""
+
+import ast
+import csv
+import json
+import time
+import numpy
+
+from Detector import DetectionParameters, NeedleDetector
+from DetectionROI import ROIDetector
+from Curves import BezierCurve
+from Evaluation import hausdorffDistance
+from Phantom import NeedlePhantom
+from Tracing import tracer
+
+__all__ = ['PeakMemory', 'runBenchmark', 'summarize', 'writeResults']
+
+COLUMNS = ['run', 'phantom', 'seed', 'version', 'needle', 'status', 'time', 'setupTime', 'samples',
+           'peakMemory', 'hausdorff', 'controlPoints', 'message']
+
+
+class PeakMemory(object):
+  """
+  Peak resident memory of the process above the resident memory at start(), from /proc/self/status.
+  The high-water mark is reset through /proc/self/clear_refs (Linux); elsewhere peak() returns None.
+  """
+
+  def __init__(self):
+    self.baseline = None
+
+  @staticmethod
+  def status(name):
+    try:
+      with open('/proc/self/status') as f:
+        for line in f:
+          if line.startswith(name + ':'):
+            return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+      pass
+    return None
+
+  def start(self):
+    try:
+      with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+      self.baseline = self.status('VmRSS')
+    except (IOError, OSError):
+      self.baseline = None
+
+  def peak(self):
+    """
+    Bytes, None if not measurable.
+    """
+    if self.baseline is None:
+      return None
+    high = self.status('VmHWM')
+    return None if high is None else max(0, high - self.baseline)
+
+
+def warmUp(detector):
+  """
+  Compute the feature volumes, the coarse volume and the needle model the tracking reads, so that they are not
+  timed with the first needle.
+  """
+  p = detector.parameters
+  features = detector.features()
+  if features is not None:
+    features.center, features.ringMean
+  if p.algoVersParameter == 0 and p.featureVolumes:
+    radiusNeedle, radiusNeedleCorner = detector.needleRadius()
+    detector.featureCache.get(detector.volume, radiusNeedle, radiusNeedleCorner).box
+  elif p.algoVersParameter == 3:
+    detector.needleModel
+  elif p.algoVersParameter == 6:
+    detector.volume.downsampled()
+
+
+def runBenchmark(phantoms, versions=NeedleDetector.versions, parameters=None, run=None, log=None):
+  """
+  Track the needles of each phantom with each version, cf. module doc.
+
+  :param phantoms: NeedlePhantom list
+  :param parameters: DetectionParameters (defaults if None), algoVersParameter and axialSegmentationLimit
+                     are set per version and phantom
+  :param run: name of the run in the records, the start time if None
+  :param log: optional function(string) for progress messages
+  :return: list of record dicts with the keys COLUMNS, times in s, memory in bytes, distances in mm;
+           setupTime is the time to prepare the detector of a version and phantom (crop, feature volumes)
+  """
+  parameters = parameters or DetectionParameters()
+  run = run or time.strftime('%Y-%m-%dT%H:%M:%S')
+  memory = PeakMemory()
+  records = []
+  for phantomIndex, phantom in enumerate(phantoms):
+    truth = phantom.centerlinesRAS()
+    for version in versions:
+      base = dict(run=run, phantom=phantomIndex, seed=phantom.seed, version=version)
+      if version not in NeedleDetector.versions:
+        for needle in range(len(phantom.tips)):
+          records.append(dict(base, needle=needle, status='unsupported',
+                              message="needle detection version %d has no headless implementation" % version))
+        continue
+      p = parameters.copy(algoVersParameter=version, axialSegmentationLimit=phantom.axialSegmentationLimit)
+      start = time.time()
+      detector = NeedleDetector(phantom.array, phantom.transform, p, spacing=phantom.spacing)
+      tips = phantom.tips
+      if p.roiDetection and version in ROIDetector.versions:
+        detector = ROIDetector(detector, tips)
+        warmUp(detector.localDetector())
+      else:
+        warmUp(detector)
+      setupTime = time.time() - start
+      for needle, tip in enumerate(tips):
+        record = dict(base, needle=needle, setupTime=setupTime)
+        samples = detector.samples
+        memory.start()
+        start = time.time()
+        try:
+          with tracer.span('needle', needle='%d/%d/%d' % (phantomIndex, needle, version)):
+            controlPoints, controlPointsIJK = detector.track(tip)
+        except Exception as e:
+          record.update(status='error', message='%s: %s' % (type(e).__name__, e))
+        else:
+          record.update(status='ok', time=time.time() - start, samples=detector.samples - samples,
+                        peakMemory=memory.peak(), controlPoints=len(controlPoints),
+                        hausdorff=hausdorffDistance(BezierCurve.fromNeedle(controlPoints).evaluate(), truth[needle]))
+        records.append(record)
+      if log:
+        log('phantom %d, %s' % (phantomIndex, summarize([r for r in records if r['phantom'] == phantomIndex
+                                                        and r['version'] == version])[0]['text']))
+  return records
+
+
+def summarize(records):
+  """
+  Per version statistics of the records (needles, failures, time, samples, memory, Hausdorff distance).
+
+  :return: list of dicts, one per version, with a 'text' line for the log
+  """
+  summary = []
+  for version in sorted(set(r['version'] for r in records)):
+    rs = [r for r in records if r['version'] == version]
+    ok = [r for r in rs if r['status'] == 'ok']
+    s = dict(version=version, needles=len(rs), failed=len(rs) - len(ok))
+    if ok:
+      times = [r['time'] for r in ok]
+      distances = [r['hausdorff'] for r in ok if r['hausdorff'] is not None]
+      memory = [r['peakMemory'] for r in ok if r['peakMemory'] is not None]
+      s.update(meanTime=numpy.mean(times), maxTime=max(times), samples=sum(r['samples'] for r in ok),
+               peakMemory=max(memory) if memory else None,
+               meanHausdorff=numpy.mean(distances) if distances else None,
+               maxHausdorff=max(distances) if distances else None)
+      s['text'] = ("version %d: %d needles, %.3f s/needle (max %.3f), %d samples, peak %s, HD mean %s max %s mm"
+                   % (version, len(rs), s['meanTime'], s['maxTime'], s['samples'],
+                      '%.1f MB' % (s['peakMemory'] / 2. ** 20) if s['peakMemory'] is not None else 'n/a',
+                      '%.2f' % s['meanHausdorff'] if distances else 'n/a',
+                      '%.2f' % s['maxHausdorff'] if distances else 'n/a'))
+    else:
+      s['text'] = "version %d: %d needles, %s" % (version, len(rs), rs[0]['status'] if rs else 'no records')
+    summary.append(s)
+  return summary
+
+
+def writeResults(records, fileName):
+  """
+  Write the records as CSV if fileName ends with .csv, as JSON lines otherwise.
+  """
+  if fileName.lower().endswith('.csv'):
+    with open(fileName, 'wb') as f:
+      writer = csv.DictWriter(f, COLUMNS)
+      writer.writeheader()
+      for r in records:
+        writer.writerow(dict((key, r.get(key)) for key in COLUMNS))
+  else:
+    with open(fileName, 'w') as f:
+      for r in records:
+        f.write(json.dumps(dict((key, r.get(key)) for key in COLUMNS), sort_keys=True) + '\n')
+
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description="Benchmark the needle detection on synthetic phantoms.")
+  parser.add_argument('-o', '--output', default='benchmark.jsonl', help="results, .jsonl or .csv")
+  parser.add_argument('--phantoms', type=int, default=2, help="number of phantoms")
+  parser.add_argument('--needles', type=int, default=8, help="needles per phantom")
+  parser.add_argument('--seed', type=int, default=0, help="seed of the first phantom")
+  parser.add_argument('--dims', type=int, nargs=3, default=[160, 160, 60])
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.5, 0.5, 2.0], help="voxel size [mm]")
+  parser.add_argument('--noise', type=float, default=20.)
+  parser.add_argument('--bending', type=float, default=6., help="largest deviation of the needles [mm]")
+  parser.add_argument('--versions', type=int, nargs='+', default=list(NeedleDetector.versions),
+                      choices=NeedleDetector.versions)
+  parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                      help="detection parameter, e.g. --set radiusMax=12 --set roiDetection=True")
+  parser.add_argument('--trace', default=None, help="Chrome trace (.json) of the detection")
+  args = parser.parse_args(argv)
+
+  parameters = DetectionParameters()
+  for assignment in args.set:
+    name, value = assignment.split('=', 1)
+    parameters.update(**{name: ast.literal_eval(value)})
+  phantoms = [NeedlePhantom.generate(args.dims, args.spacing, args.needles, noise=args.noise, bending=args.bending,
+                                     seed=args.seed + n) for n in range(args.phantoms)]
+
+  def log(text):
+    print(text)
+  tracer.enable(args.trace is not None)
+  records = runBenchmark(phantoms, args.versions, parameters, log=log)
+  for s in summarize(records):
+    print(s['text'])
+  writeResults(records, args.output)
+  print("%d records written to %s" % (len(records), args.output))
+  if args.trace:
+    for line in tracer.summary():
+      print(line)
+    tracer.exportChromeTrace(args.trace)
+    print("trace written to %s" % args.trace)
+
+
+if __name__ == '__main__':
+  main()
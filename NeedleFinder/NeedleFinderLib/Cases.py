@@ -0,0 +1,151 @@
+"""
+Preprocessed validation cases.
+
+Loading a case scene (MRML XML, the NRRD volume and every validation model) takes seconds, only for the volume and
+the tips and centerlines of the validation needles. A case bundle keeps these once converted (cf. parSearch mode 3
+of the module), as a directory of:
+  case.json        format, shape and dtype of the volume, IJK to RAS matrix, axial limit, needle names, tips [ijk],
+                   centerline lengths, content hash, source scene and its modification time
+  volume.npy       voxels [i, j, k], memory-mapped when opened
+  centerlines.npy  centerlines [ijk] of the needles, tip first, concatenated
+so that opening a case reads a small JSON file and maps the volume, in milliseconds. The content hash (SHA-1 of the
+voxels, the matrix, the axial limit and the centerlines) identifies the data of a case whatever its path.
+
+A CaseBundle is a NeedlePhantom, so that it can be tracked and evaluated headless (cf. Benchmark, ParameterSearch).
+"""
+
+import hashlib
+import json
+import os
+import numpy
+
+from Phantom import NeedlePhantom
+
+__all__ = ['CaseBundle', 'isCaseBundle']
+
+FORMAT = 1
+
+
+def isCaseBundle(path):
+  return os.path.isfile(os.path.join(path, 'case.json'))
+
+
+def contentHash(array, ijkToRAS, centerlines, axialSegmentationLimit, chunk=1 << 24):
+  """
+  SHA-1 (hex) of the voxels (read in chunks of a memory-mapped array), the matrix, the axial limit and the centerlines.
+  """
+  h = hashlib.sha1()
+  h.update(('%s %s ' % (array.dtype.str, array.shape)).encode('ascii'))
+  flat = array.T.reshape(-1) # i fastest, as the scalars of a vtkImageData (no copy for the arrays of the module)
+  for n in range(0, flat.size, chunk):
+    h.update(numpy.ascontiguousarray(flat[n:n + chunk]).tobytes())
+  h.update(numpy.asarray(ijkToRAS, dtype=numpy.float64).tobytes())
+  h.update(('%r' % axialSegmentationLimit).encode('ascii'))
+  for c in centerlines:
+    h.update(numpy.asarray(c, dtype=numpy.float64).tobytes())
+  return h.hexdigest()
+
+
+class CaseBundle(NeedlePhantom):
+  """
+  Case read from a bundle directory, cf. module doc; the voxel array is a read-only memory map.
+  """
+
+  def __init__(self, directory, verify=False):
+    """
+    :param verify: check the content hash (reads all the voxels)
+    """
+    with open(os.path.join(directory, 'case.json')) as f:
+      meta = json.load(f)
+    if meta.get('format') != FORMAT:
+      raise ValueError("%s: unsupported case bundle format %r" % (directory, meta.get('format')))
+    array = numpy.load(os.path.join(directory, 'volume.npy'), mmap_mode='r')
+    points = numpy.load(os.path.join(directory, 'centerlines.npy'))
+    offsets = numpy.concatenate([[0], numpy.cumsum(meta['lengths'])]).astype(int)
+    centerlines = [points[offsets[n]:offsets[n + 1]] for n in range(len(meta['lengths']))]
+    NeedlePhantom.__init__(self, array, numpy.array(meta['ijkToRAS']), centerlines, meta['axialSegmentationLimit'])
+    self.directory = directory
+    self.names = meta['names']
+    self.bundleTips = meta['tips']
+    self.hash = meta['hash']
+    self.source = meta.get('source')
+    self.sourceTime = meta.get('sourceTime')
+    if verify and self.contentHash() != self.hash:
+      raise ValueError("%s: the content doesn't match the hash of the bundle" % directory)
+
+  @property
+  def tips(self):
+    """
+    Tips [ijk] of the validation needles as the module takes them from the models.
+    """
+    return self.bundleTips
+
+  def contentHash(self):
+    return contentHash(self.array, self.transform.ijkToRAS, self.centerlines, self.axialSegmentationLimit)
+
+  @staticmethod
+  def needleCount(directory):
+    with open(os.path.join(directory, 'case.json')) as f:
+      return len(json.load(f)['lengths'])
+
+  @staticmethod
+  def contentHashOf(directory):
+    """
+    Content hash recorded in a bundle, without opening it.
+    """
+    with open(os.path.join(directory, 'case.json')) as f:
+      return json.load(f)['hash']
+
+  @staticmethod
+  def isUpToDate(directory, source):
+    """
+    True if the bundle exists and was made from the source file as it is now.
+    """
+    if not isCaseBundle(directory):
+      return False
+    with open(os.path.join(directory, 'case.json')) as f:
+      meta = json.load(f)
+    return (meta.get('format') == FORMAT and meta.get('source') == os.path.abspath(source)
+            and meta.get('sourceTime') == os.path.getmtime(source))
+
+  @classmethod
+  def write(cls, directory, array, ijkToRAS, centerlines, axialSegmentationLimit=None, names=None, tips=None,
+            source=None):
+    """
+    Write a bundle (the files are written next to their final name and renamed, so that an interrupted conversion
+    leaves no bundle that looks complete).
+
+    :param array: voxel array [i, j, k]
+    :param ijkToRAS: 4x4 matrix
+    :param centerlines: one N x 3 array [ijk] per needle, from the tip down
+    :param names: names of the needles (their numbers if None)
+    :param tips: tips [ijk] the detection starts from (the first centerline points if None)
+    :param source: file the case was converted from (e.g. the MRML scene)
+    :return: the CaseBundle
+    """
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    elif isCaseBundle(directory):
+      os.remove(os.path.join(directory, 'case.json'))
+    centerlines = [numpy.asarray(c, dtype=numpy.float64).reshape(-1, 3) for c in centerlines]
+    array = numpy.asarray(array)
+    ijkToRAS = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+    limit = None if axialSegmentationLimit is None else int(axialSegmentationLimit)
+    meta = dict(format=FORMAT, shape=list(array.shape), dtype=array.dtype.str, ijkToRAS=ijkToRAS.tolist(),
+                axialSegmentationLimit=limit,
+                names=[str(n) for n in (names if names is not None else range(len(centerlines)))],
+                tips=[[float(x) for x in t] for t in (tips if tips is not None else [c[0] for c in centerlines])],
+                lengths=[len(c) for c in centerlines], hash=contentHash(array, ijkToRAS, centerlines, limit),
+                source=os.path.abspath(source) if source else None,
+                sourceTime=os.path.getmtime(source) if source and os.path.exists(source) else None)
+    for name, data in (('volume.npy', array),
+                       ('centerlines.npy', numpy.concatenate(centerlines) if centerlines else numpy.zeros((0, 3)))):
+      temporary = os.path.join(directory, name + '.tmp')
+      with open(temporary, 'wb') as f:
+        numpy.save(f, data)
+      os.rename(temporary, os.path.join(directory, name))
+    temporary = os.path.join(directory, 'case.json.tmp')
+    with open(temporary, 'w') as f:
+      json.dump(meta, f, indent=1, sort_keys=True)
+    os.rename(temporary, os.path.join(directory, 'case.json'))
+    return cls(directory)
@@ -0,0 +1,221 @@
+"""
+Coarse-to-fine cone search.
+
+The exhaustive search scores all (rIter+1) x nbRotatingIterations rays of a cone at full resolution,
+most of them pointing far away from the needle. The coarse-to-fine search
+  1. scores every radiusStride-th radius and angleStride-th angle on the 2x downsampled volume,
+  2. scores at full resolution only the rays around the topK best coarse rays (and the cone axis),
+  3. makes sure the selected ray is a local optimum of the full resolution rays, scoring its missing
+     neighbours once if needed.
+The budget is a fraction of the cost of the exhaustive search, a coarse ray costing coarseCost full resolution
+rays (half the samples). Cones too small for the coarse rays and the refinement of one of them to fit in the
+budget are searched exhaustively right away. The search falls back to scoring the remaining rays of the cone
+when the coarse ranking is ambiguous (the k-th and (k+1)-th coarse estimators are within `ambiguity` of each
+other), when the full resolution rays would exceed the budget, when the coarse and the full resolution search
+disagree on whether any ray beats the cone axis, or when the selected ray is still not a local optimum after the
+extra refinement; the rays already scored at full resolution are not scored again.
+
+Rays are identified by their index in the cone, in the order of coneRays: R * nTheta + thetaStep.
+"""
+
+import numpy
+
+from VolumeAccess import roundHalfAway
+from ConeSearch import coneSamples
+
+__all__ = ['coarseConeScores', 'CoarseToFineSearch']
+
+
+def coarseConeScores(volume, A, Cs, tIter, gradient=False, radiusNeedle=0, radiusNeedleCorner=0,
+                     gradientPonderation=0, label=None):
+  """
+  Approximate scoreConeRays on volume.downsampled(): half the samples per ray and half the needle radius.
+  The label penalty is read at full resolution. The scores are rescaled to the number of full resolution samples.
+
+  :return: array of float scores, one per ray
+  """
+  coarse = volume.downsampled()
+  nT = max(1, int(tIter) // 2)
+  A = (numpy.asarray(A, dtype=numpy.float64) - 0.5) / 2
+  Cs = (numpy.asarray(Cs, dtype=numpy.float64).reshape(-1, 3) - 0.5) / 2
+  M, ijk = coneSamples(A, Cs, nT)
+  i, j, k = ijk[:, :, 0], ijk[:, :, 1], ijk[:, :, 2]
+  dims = coarse.dims
+  inside = (i >= 0) & (i < dims[0]) & (j >= 0) & (j < dims[1]) & (k >= 0) & (k < dims[2])
+  center = coarse.gather(i, j, k)
+  total = center.copy()
+  if gradient:
+    r = max(1, int(round(radiusNeedle / 2.)))
+    rc = int(round(radiusNeedleCorner / 2.))
+    g = numpy.zeros(center.shape)
+    for di, dj in ((r, 0), (-r, 0), (0, r), (0, -r), (rc, rc), (-rc, -rc), (-rc, rc), (rc, -rc)):
+      g += coarse.gather(i + di, j + dj, k)
+    total += 8 * center - (g / 8) * gradientPonderation
+  if label is not None:
+    fLabel = label.gatherPoints(M * 2 + 0.5).reshape(center.shape)
+    total -= 10000 * ((fLabel != 0) & (fLabel < 300))
+  total[~inside] = 0
+  return total.sum(axis=1) * ((int(tIter) + 1) / float(nT + 1))
+
+
+class CoarseToFineSearch(object):
+  """
+  Choice of the rays of a cone step to score at full resolution, cf. module doc.
+  Keeps counts of the steps, the cones searched exhaustively right away (direct) or after the coarse search
+  (fallbacks) and the scored rays, for benchmarks.
+  """
+
+  def __init__(self, topK=4, budget=0.35, ambiguity=0.02, radiusStride=2, angleStride=3, coarseCost=0.5):
+    """
+    :param topK: number of coarse rays refined
+    :param budget: maximal cost of the coarse and full resolution rays, as a fraction of the rays of the cone
+    :param ambiguity: relative difference of the k-th and (k+1)-th coarse estimators below which the
+                      coarse ranking is not trusted
+    :param coarseCost: cost of a coarse ray, in full resolution rays
+    """
+    if topK < 1 or budget <= 0 or ambiguity < 0:
+      raise ValueError("invalid coarse-to-fine search topK=%r budget=%r ambiguity=%r" % (topK, budget, ambiguity))
+    self.topK = topK
+    self.budget = budget
+    self.ambiguity = ambiguity
+    self.radiusStride = radiusStride
+    self.angleStride = angleStride
+    self.coarseCost = coarseCost
+    self.steps = 0
+    self.direct = 0
+    self.fallbacks = 0
+    self.coarseScoredRays = 0
+    self.refinedRays = 0
+    self.exhaustiveRays = 0
+
+  counters = ('steps', 'direct', 'fallbacks', 'coarseScoredRays', 'refinedRays', 'exhaustiveRays')
+
+  def merge(self, search):
+    """
+    Add the counts of another search, e.g. that of a detector of a worker thread.
+    """
+    for name in self.counters:
+      setattr(self, name, getattr(self, name) + getattr(search, name))
+
+  def coarseRays(self, nR, nTheta):
+    """
+    Rays scored on the coarse volume: the cone axis, every radiusStride-th radius (and the outermost one)
+    and every angleStride-th angle.
+    """
+    radii = range(self.radiusStride, nR, self.radiusStride)
+    if nR > 1 and (not radii or radii[-1] != nR - 1):
+      radii.append(nR - 1)
+    return [0] + [R * nTheta + a for R in radii for a in range(0, nTheta, self.angleStride)]
+
+  def refinement(self, coarse, estimators, nR, nTheta):
+    """
+    Rays to score at full resolution around the topK coarse rays, in cone order,
+    None if the coarse ranking is ambiguous or the budget is exceeded.
+
+    :param coarse: cone indices of the coarse rays
+    :param estimators: their coarse estimators (the lower the better)
+    """
+    order = sorted(range(len(coarse)), key=lambda n: estimators[n])
+    if len(order) > self.topK:
+      e0, e1 = estimators[order[self.topK - 1]], estimators[order[self.topK]]
+      if abs(e1 - e0) <= self.ambiguity * max(abs(e0), abs(e1)):
+        return None
+    refined = set([0])
+    for n in order[:self.topK]:
+      R, a = divmod(coarse[n], nTheta)
+      if R == 0:
+        continue
+      for R1 in range(R - self.radiusStride + 1, R + self.radiusStride):
+        if 0 < R1 < nR:
+          for da in range(-self.angleStride + 1, self.angleStride):
+            refined.add(R1 * nTheta + (a + da) % nTheta)
+    if not self.withinBudget(refined, coarse, nR, nTheta):
+      return None
+    return sorted(refined)
+
+  def withinBudget(self, refined, coarse, nR, nTheta):
+    return len(coarse) * self.coarseCost + len(refined) <= self.budget * nR * nTheta
+
+  def fitsBudget(self, coarse, nR, nTheta):
+    """
+    False if the coarse rays and the refinement around one of them already exceed the budget (small cones).
+    """
+    neighbourhood = 1 + (2 * self.radiusStride - 1) * (2 * self.angleStride - 1)
+    return self.withinBudget(range(min(neighbourhood, nR * nTheta)), coarse, nR, nTheta)
+
+  def missingNeighbours(self, winner, refined, nR, nTheta):
+    """
+    Radial and angular neighbours of ray winner not scored at full resolution yet.
+    """
+    R, a = divmod(winner, nTheta)
+    if R == 0:
+      return []
+    missing = []
+    for dR, da in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+      R1 = R + dR
+      if R1 == 0:
+        n = 0
+      elif R1 < nR:
+        n = R1 * nTheta + (a + da) % nTheta
+      else:
+        continue
+      if n not in refined:
+        missing.append(n)
+    return missing
+
+  def exhaustive(self, totals, nR, nTheta, score, select):
+    """
+    Selection among all the rays of the cone, scoring those that are not in totals yet.
+
+    :param totals: full resolution totals of the rays scored so far, by cone index
+    """
+    missing = [n for n in range(nR * nTheta) if n not in totals]
+    self.exhaustiveRays += len(missing)
+    if missing:
+      totals.update(zip(missing, score(missing)))
+    indices = range(nR * nTheta)
+    return select(indices, [totals[n] for n in indices])[0]
+
+  def fallback(self, totals, nR, nTheta, score, select):
+    self.fallbacks += 1
+    return self.exhaustive(totals, nR, nTheta, score, select)
+
+  def search(self, nR, nTheta, coarseEstimator, score, select):
+    """
+    Coarse-to-fine selection of one cone step, the same as the exhaustive one if it had to fall back.
+
+    :param coarseEstimator: function(indices) returning the coarse estimators and the coarse total of the axis
+    :param score: function(indices) returning the full resolution totals of the rays
+    :param select: function(indices, totals) returning (bestPoint, winner), winner being the cone index of the
+                   selected ray or None if no ray beats the axis (cf. NeedleDetector.selectRay)
+    :return: bestPoint
+    """
+    self.steps += 1
+    coarse = self.coarseRays(nR, nTheta)
+    if not self.fitsBudget(coarse, nR, nTheta):
+      self.direct += 1
+      return self.exhaustive({}, nR, nTheta, score, select)
+    estimators, axis = coarseEstimator(coarse)
+    self.coarseScoredRays += len(coarse)
+    coarseBeatsAxis = any(e < axis for e in estimators[1:])
+    refined = self.refinement(coarse, estimators, nR, nTheta)
+    if refined is None:
+      return self.fallback({}, nR, nTheta, score, select)
+    totals = dict(zip(refined, score(refined)))
+    for attempt in range(2):
+      indices = sorted(totals)
+      bestPoint, winner = select(indices, [totals[n] for n in indices])
+      if winner is None:
+        if coarseBeatsAxis:
+          break
+        self.refinedRays += len(totals)
+        return bestPoint
+      missing = self.missingNeighbours(winner, totals, nR, nTheta)
+      if not missing:
+        self.refinedRays += len(totals)
+        return bestPoint
+      if attempt or not self.withinBudget(set(totals).union(missing), coarse, nR, nTheta):
+        break
+      totals.update(zip(missing, score(missing)))
+    self.refinedRays += len(totals)
+    return self.fallback(totals, nR, nTheta, score, select)
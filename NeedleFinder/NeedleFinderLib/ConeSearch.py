@@ -0,0 +1,242 @@
+"""
+Vectorized cone search kernel.
+
+The legacy detectors score every ray of a search cone sample by sample with
+imageData.GetScalarComponentAsDouble. The functions below build all (R, theta, t)
+samples of one cone step as a single coordinate array and score all rays at once
+with NumPy fancy indexing on a VolumeAccessor.
+
+The arithmetic is done in the same order as in the legacy loops (per sample, in t order)
+so the scores and therefore the control points are bit-identical to those of the loops.
+The loops themselves are kept as reference (scoreConeRaysLoop, scoreConeRaysCurrentDevLoop).
+"""
+
+import math
+import numpy
+
+from VolumeAccess import roundHalfAway
+
+__all__ = ['coneRays', 'coneSamples', 'insideSamples', 'scoreConeRays', 'scoreConeRaysCurrentDev',
+           'scoreConeRaysLoop', 'scoreConeRaysCurrentDevLoop']
+
+# 3x3 in-plane neighbourhood of the center of needleDetectionThreadCurrentDev, in its summation order
+BOX = [(0, 0), (1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+
+def coneRays(C0, rMax, rIter, nbRotatingStep):
+  """
+  Enumerate the cone base points C in the order of the legacy (R, thetaStep) loops.
+
+  :param C0: center of the cone base [ijk]
+  :param rMax: radius of the cone base [voxels]
+  :param rIter: number of radius iterations (R runs from 0 to int(rIter))
+  :param nbRotatingStep: number of angles per radius
+  :return: list of (R, C) with C a list [x, y, z]
+  """
+  rays = []
+  for R in range(int(rIter) + 1):
+    r = R * (rMax / float(rIter))
+    for thetaStep in range(int(nbRotatingStep)):
+      angleInDegree = (thetaStep * 360) / float(nbRotatingStep)
+      theta = math.radians(angleInDegree)
+      C = [ C0[0] + r * (math.cos(theta)),
+            C0[1] + r * (math.sin(theta)),
+            C0[2]]
+      rays.append((R, C))
+  return rays
+
+
+def coneSamples(A, Cs, tIter):
+  """
+  Sample points of the segments [A, C] for all cone base points Cs.
+
+  :return: M (nRays x (int(tIter)+1) x 3) float coordinates and ijk, the rounded integer indices
+  """
+  tt = numpy.array([t / float(tIter) for t in range(int(tIter) + 1)], dtype=numpy.float64)
+  A = numpy.asarray(A, dtype=numpy.float64)
+  Cs = numpy.asarray(Cs, dtype=numpy.float64).reshape(-1, 3)
+  M = (1 - tt)[None, :, None] * A[None, None, :] + tt[None, :, None] * Cs[:, None, :]
+  ijk = roundHalfAway(M).astype(numpy.int64)
+  return M, ijk
+
+
+def insideSamples(ijk, dims, margin=0):
+  """
+  Mask of the samples the legacy loops score: strictly inside of the extent, and at more than margin voxels
+  from the i and j borders (needleDetectionThread15_1 keeps the ring of the gradient term in the image).
+  """
+  return ((ijk[..., 0] < dims[0] - margin) & (ijk[..., 0] > margin) &
+          (ijk[..., 1] < dims[1] - margin) & (ijk[..., 1] > margin) &
+          (ijk[..., 2] < dims[2]) & (ijk[..., 2] > 0))
+
+
+def scoreConeRays(volume, A, Cs, tIter, gradient=False, radiusNeedle=0, radiusNeedleCorner=0,
+                  gradientPonderation=0, label=None, sampleCallback=None, features=None, margin=0):
+  """
+  Score all rays [A, C] of one cone step, as needleDetectionThread13_1 does:
+  sum over the in-image samples of center (+ 8*center - mean(ring)*gradientPonderation),
+  -10000 for samples on a label < 300.
+
+  :param volume: VolumeAccessor of the image
+  :param A: start point of the rays (current tip) [ijk]
+  :param Cs: list of cone base points [ijk]
+  :param tIter: number of sample intervals per ray
+  :param label: optional VolumeAccessor of the label map
+  :param sampleCallback: optional function(M) returning an additional term per in-image sample
+                         (e.g. the neighbour feedback), called in the legacy (ray, t) order
+  :param features: optional NeedleFeatures for the same radii, read instead of the ring voxels
+  :param margin: border of the samples in i and j [voxels], cf. insideSamples
+  :return: list of float scores, one per ray
+  """
+  M, ijk = coneSamples(A, Cs, tIter)
+  nRays, nT = ijk.shape[0], ijk.shape[1]
+  inside = insideSamples(ijk, volume.dims, margin)
+  totals = numpy.zeros(nRays, dtype=numpy.float64)
+  # accumulate column by column to keep the floating point order of the legacy loop
+  for t in range(nT):
+    m = inside[:, t]
+    if not m.any():
+      continue
+    i = ijk[m, t, 0]
+    j = ijk[m, t, 1]
+    k = ijk[m, t, 2]
+    center = volume.array[i, j, k].astype(numpy.float64)
+    total = totals[m] + center
+    if sampleCallback:
+      rows = numpy.nonzero(m)[0]
+      for n in range(len(rows)):
+        total[n] += sampleCallback(list(M[rows[n], t]))
+    if gradient and features is not None:
+      total = total + features.gradientTerms(i, j, k, gradientPonderation)
+    elif gradient:
+      g = volume.gather(i + radiusNeedle, j, k)
+      g = g + volume.gather(i - radiusNeedle, j, k)
+      g = g + volume.gather(i, j + radiusNeedle, k)
+      g = g + volume.gather(i, j - radiusNeedle, k)
+      g = g + volume.gather(i + radiusNeedleCorner, j + radiusNeedleCorner, k)
+      g = g + volume.gather(i - radiusNeedleCorner, j - radiusNeedleCorner, k)
+      g = g + volume.gather(i - radiusNeedleCorner, j + radiusNeedleCorner, k)
+      g = g + volume.gather(i + radiusNeedleCorner, j - radiusNeedleCorner, k)
+      total = total + (8 * center - (g / 8) * gradientPonderation)
+    if label is not None:
+      fLabel = label.gather(i, j, k).astype(numpy.float32)
+      total = total - 10000 * ((fLabel != 0) & (fLabel < 300))
+    totals[m] = total
+  return totals.tolist()
+
+
+def scoreConeRaysCurrentDev(volume, A, Cs, tIter, exponent=1, gradient=False, radiusNeedle=0, radiusNeedleCorner=0,
+                            gradientPonderation=0, label=None, features=None):
+  """
+  Score all rays [A, C] of one cone step, as needleDetectionThreadCurrentDev does:
+  sum over the in-image samples of box**exponent + sum((box - g)**gradientPonderation / tIter) over the 8 ring
+  voxels g, box being the 3x3 in-plane sum of the sample, -10000 for samples on a label < 300.
+
+  :param features: optional NeedleFeatures, whose box volume is read instead of the 9 voxels
+  :return: list of float scores, one per ray
+  """
+  M, ijk = coneSamples(A, Cs, tIter)
+  nRays, nT = ijk.shape[0], ijk.shape[1]
+  inside = insideSamples(ijk, volume.dims)
+  ring = [(radiusNeedle, 0), (-radiusNeedle, 0), (0, radiusNeedle), (0, -radiusNeedle),
+          (radiusNeedleCorner, radiusNeedleCorner), (-radiusNeedleCorner, -radiusNeedleCorner),
+          (-radiusNeedleCorner, radiusNeedleCorner), (radiusNeedleCorner, -radiusNeedleCorner)]
+  totals = numpy.zeros(nRays, dtype=numpy.float64)
+  for t in range(nT):
+    m = inside[:, t]
+    if not m.any():
+      continue
+    i = ijk[m, t, 0]
+    j = ijk[m, t, 1]
+    k = ijk[m, t, 2]
+    if features is not None:
+      center = features.box[i, j, k].astype(numpy.float64)
+    else:
+      center = volume.gather(i, j, k)
+      for di, dj in BOX[1:]:
+        center = center + volume.gather(i + di, j + dj, k)
+    total = totals[m] + center ** exponent
+    if gradient:
+      for di, dj in ring:
+        total = total + ((center - volume.gather(i + di, j + dj, k)) ** gradientPonderation) / float(tIter)
+    if label is not None:
+      fLabel = label.gather(i, j, k).astype(numpy.float32)
+      total = total - 10000 * ((fLabel != 0) & (fLabel < 300))
+    totals[m] = total
+  return totals.tolist()
+
+
+def scoreConeRaysLoop(volume, A, Cs, tIter, gradient=False, radiusNeedle=0, radiusNeedleCorner=0,
+                      gradientPonderation=0, label=None, sampleCallback=None, margin=0):
+  """
+  Voxel by voxel reference of scoreConeRays: the loop of needleDetectionThread13_1, reading every sample with
+  volume.value(i, j, k) (a VolumeAccessor or the vtkImageData itself, cf. ImageDataVoxels).
+  """
+  dims = volume.dims
+  ijk = [0, 0, 0]
+  totals = []
+  for C in Cs:
+    total = 0
+    M = [[0, 0, 0] for i in range(int(tIter) + 1)]
+    for t in range(int(tIter) + 1):
+      tt = t / float(tIter)
+      for i in range(3):
+        M[t][i] = (1 - tt) * A[i] + tt * C[i]
+        ijk[i] = int(round(M[t][i]))
+      if (ijk[0] < dims[0] - margin and ijk[0] > margin and ijk[1] < dims[1] - margin and ijk[1] > margin and
+          ijk[2] < dims[2] and ijk[2] > 0):
+        center = volume.value(ijk[0], ijk[1], ijk[2])
+        total += center
+        if sampleCallback:
+          total += sampleCallback(M[t])
+        if gradient:
+          g1 = volume.value(ijk[0] + radiusNeedle, ijk[1], ijk[2])
+          g2 = volume.value(ijk[0] - radiusNeedle, ijk[1], ijk[2])
+          g3 = volume.value(ijk[0], ijk[1] + radiusNeedle, ijk[2])
+          g4 = volume.value(ijk[0], ijk[1] - radiusNeedle, ijk[2])
+          g5 = volume.value(ijk[0] + radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2])
+          g6 = volume.value(ijk[0] - radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2])
+          g7 = volume.value(ijk[0] - radiusNeedleCorner, ijk[1] + radiusNeedleCorner, ijk[2])
+          g8 = volume.value(ijk[0] + radiusNeedleCorner, ijk[1] - radiusNeedleCorner, ijk[2])
+          total += 8 * center - ((g1 + g2 + g3 + g4 + g5 + g6 + g7 + g8) / 8) * gradientPonderation
+        if label is not None:
+          fLabel = label.value(ijk[0], ijk[1], ijk[2])
+          if fLabel and fLabel < 300:
+            total -= 10000
+    totals.append(float(total))
+  return totals
+
+
+def scoreConeRaysCurrentDevLoop(volume, A, Cs, tIter, exponent=1, gradient=False, radiusNeedle=0,
+                                radiusNeedleCorner=0, gradientPonderation=0, label=None):
+  """
+  Voxel by voxel reference of scoreConeRaysCurrentDev: the loop of needleDetectionThreadCurrentDev.
+  """
+  dims = volume.dims
+  ring = [(radiusNeedle, 0), (-radiusNeedle, 0), (0, radiusNeedle), (0, -radiusNeedle),
+          (radiusNeedleCorner, radiusNeedleCorner), (-radiusNeedleCorner, -radiusNeedleCorner),
+          (-radiusNeedleCorner, radiusNeedleCorner), (radiusNeedleCorner, -radiusNeedleCorner)]
+  ijk = [0, 0, 0]
+  totals = []
+  for C in Cs:
+    total = 0
+    M = [[0, 0, 0] for i in range(int(tIter) + 1)]
+    for t in range(int(tIter) + 1):
+      tt = t / float(tIter)
+      for i in range(3):
+        M[t][i] = (1 - tt) * A[i] + tt * C[i]
+        ijk[i] = int(round(M[t][i]))
+      if ijk[0] < dims[0] and ijk[0] > 0 and ijk[1] < dims[1] and ijk[1] > 0 and ijk[2] < dims[2] and ijk[2] > 0:
+        center = volume.value(ijk[0], ijk[1], ijk[2])
+        for di, dj in BOX[1:]:
+          center += volume.value(ijk[0] + di, ijk[1] + dj, ijk[2])
+        total += center ** exponent
+        if gradient:
+          for di, dj in ring:
+            total += ((center - volume.value(ijk[0] + di, ijk[1] + dj, ijk[2])) ** gradientPonderation) / float(tIter)
+        if label is not None:
+          fLabel = label.value(ijk[0], ijk[1], ijk[2])
+          if fLabel and fLabel < 300:
+            total -= 10000
+    totals.append(float(total))
+  return totals
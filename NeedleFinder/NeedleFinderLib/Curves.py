@@ -0,0 +1,271 @@
+"""
+Bezier needle curves.
+
+A needle is rendered and evaluated as the Bezier curve of its control points, sorted from the tip down
+(cf. NeedleFinderLogic.addNeedleToScene):
+  Q(t) = sum_i binomial(n, i) (1-t)^(n-i) t^i P_i,  t in [0, 1]
+The former code evaluated it with a loop over samples, axes and control points, recomputing the binomial
+coefficients each time. Here the Bernstein basis of the nbEvaluationPoints+1 uniform samples is computed
+once per (degree, sample count) and a curve, or a set of curves, is one matrix product.
+
+NeedleCenterline holds the geometry of a needle model read from its centerline samples (tip, base, direction,
+length); NeedleGeometryIndex caches it per model node, so that the validation queries of the module don't
+read the tube polydata again.
+"""
+
+import math
+import threading
+import numpy
+
+__all__ = ['bernsteinBasis', 'evaluateBezier', 'BezierCurve', 'NeedleCenterline', 'NeedleGeometryIndex']
+
+_basisCache = {}
+_basisLock = threading.Lock()
+
+
+def binomialCoefficients(n):
+  return numpy.array([math.factorial(n) // (math.factorial(i) * math.factorial(n - i)) for i in range(n + 1)],
+                     dtype=numpy.float64)
+
+
+def bernsteinMatrix(n, t):
+  """
+  Bernstein polynomials of degree n at parameters t: len(t) x (n+1) array.
+  """
+  t = numpy.asarray(t, dtype=numpy.float64).reshape(-1, 1)
+  i = numpy.arange(n + 1)
+  return binomialCoefficients(n) * (1 - t) ** (n - i) * t ** i
+
+
+def bernsteinBasis(n, nbEvaluationPoints=50):
+  """
+  Bernstein polynomials of degree n at t = 0, 1/nbEvaluationPoints, ..., 1: read-only
+  (nbEvaluationPoints+1) x (n+1) array, computed once per process.
+  """
+  key = (n, nbEvaluationPoints)
+  with _basisLock:
+    basis = _basisCache.get(key)
+    if basis is None:
+      basis = bernsteinMatrix(n, numpy.arange(nbEvaluationPoints + 1) / float(nbEvaluationPoints))
+      basis.flags.writeable = False
+      _basisCache[key] = basis
+  return basis
+
+
+def evaluateBezier(controlPointSets, nbEvaluationPoints=50):
+  """
+  Uniform samples of the Bezier curves of several control point sets, one matrix product per degree.
+
+  :param controlPointSets: list of (n+1) x 3 control points, n may differ between the sets
+  :return: list of (nbEvaluationPoints+1) x 3 arrays, in the order of the sets
+  """
+  sets = [numpy.asarray(P, dtype=numpy.float64).reshape(-1, 3) for P in controlPointSets]
+  curves = [None] * len(sets)
+  degrees = {}
+  for index, P in enumerate(sets):
+    degrees.setdefault(len(P) - 1, []).append(index)
+  for n, indices in degrees.items():
+    # (n+1) x (3 * number of curves) right-hand side
+    stacked = numpy.hstack([sets[index] for index in indices])
+    Q = numpy.dot(bernsteinBasis(n, nbEvaluationPoints), stacked)
+    for m, index in enumerate(indices):
+      curves[index] = Q[:, 3 * m:3 * m + 3]
+  return curves
+
+
+class BezierCurve(object):
+  """
+  Bezier curve of a needle: uniform samples, points at any parameter, de Casteljau subdivision,
+  length and arc length resampling.
+  """
+
+  def __init__(self, controlPoints):
+    """
+    :param controlPoints: (n+1) x 3 control points [RAS], from the tip down
+    """
+    self.controlPoints = numpy.array(controlPoints, dtype=numpy.float64).reshape(-1, 3)
+    if not len(self.controlPoints):
+      raise ValueError("a Bezier curve needs at least one control point")
+
+  @classmethod
+  def fromNeedle(cls, controlPoints):
+    """
+    Curve of the control points of a detected needle as in addNeedleToScene: duplicates removed,
+    sorted from the tip down (decreasing S, then A, then R).
+    """
+    P = numpy.array(controlPoints, dtype=numpy.float64).reshape(-1, 3)
+    P = P[numpy.lexsort((-P[:, 0], -P[:, 1], -P[:, 2]))]
+    keep = numpy.ones(len(P), dtype=bool)
+    keep[1:] = (numpy.diff(P, axis=0) != 0).any(axis=1)
+    return cls(P[keep])
+
+  @property
+  def degree(self):
+    return len(self.controlPoints) - 1
+
+  @property
+  def tip(self):
+    return self.controlPoints[0]
+
+  @property
+  def base(self):
+    return self.controlPoints[-1]
+
+  def evaluate(self, nbEvaluationPoints=50):
+    """
+    Points at t = 0, 1/nbEvaluationPoints, ..., 1: (nbEvaluationPoints+1) x 3 array.
+    """
+    return numpy.dot(bernsteinBasis(self.degree, nbEvaluationPoints), self.controlPoints)
+
+  def pointsAt(self, t):
+    """
+    Points at the parameters t (array in [0, 1]): len(t) x 3 array.
+    """
+    return numpy.dot(bernsteinMatrix(self.degree, t), self.controlPoints)
+
+  def subdivide(self, t=0.5):
+    """
+    de Casteljau subdivision at parameter t.
+
+    :return: the BezierCurves of [0, t] and [t, 1], of the same degree
+    """
+    P = self.controlPoints.copy()
+    first, second = [P[0].copy()], [P[-1].copy()]
+    for r in range(self.degree):
+      P = (1 - t) * P[:-1] + t * P[1:]
+      first.append(P[0].copy())
+      second.append(P[-1].copy())
+    return BezierCurve(first), BezierCurve(second[::-1])
+
+  def length(self, nbEvaluationPoints=200):
+    """
+    Arc length of the curve, as the length of the polyline of nbEvaluationPoints+1 samples.
+    """
+    Q = self.evaluate(nbEvaluationPoints)
+    return float(numpy.sqrt((numpy.diff(Q, axis=0) ** 2).sum(axis=1)).sum())
+
+  def resample(self, step, nbEvaluationPoints=200):
+    """
+    Points of the curve every step mm of arc length from the tip, and its end point.
+    The arc length is approximated by the polyline of nbEvaluationPoints+1 samples.
+    """
+    Q = self.evaluate(nbEvaluationPoints)
+    s = numpy.concatenate([[0], numpy.cumsum(numpy.sqrt((numpy.diff(Q, axis=0) ** 2).sum(axis=1)))])
+    if s[-1] == 0:
+      return Q[:1]
+    arcLength = numpy.append(numpy.arange(0, s[-1], step), s[-1])
+    return self.pointsAt(numpy.interp(arcLength, s, numpy.linspace(0, 1, nbEvaluationPoints + 1)))
+
+
+class NeedleCenterline(object):
+  """
+  Geometry of a needle from its centerline samples [RAS]: the tip is the higher end (largest S), the base the lower one.
+  """
+
+  def __init__(self, points, radius=1.):
+    self.points = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+    if not len(self.points):
+      raise ValueError("a needle centerline needs at least one point")
+    self.points.flags.writeable = False
+    self.radius = radius
+    if self.points[0][2] >= self.points[-1][2]:
+      self.tipIndex, self.baseIndex = 0, len(self.points) - 1
+    else:
+      self.tipIndex, self.baseIndex = len(self.points) - 1, 0
+    self.midIndex = (len(self.points) - 1) // 2
+    self.length = float(numpy.sqrt((numpy.diff(self.points, axis=0) ** 2).sum(axis=1)).sum())
+    axis = self.tip - self.base
+    norm = numpy.linalg.norm(axis)
+    self.direction = axis / norm if norm else numpy.array([0., 0., 1.])
+
+  @property
+  def tip(self):
+    return self.points[self.tipIndex]
+
+  @property
+  def base(self):
+    return self.points[self.baseIndex]
+
+  @property
+  def mid(self):
+    return self.points[self.midIndex]
+
+  def surfacePoint(self, index, angle):
+    """
+    Point of the tube of the needle at the centerline sample index, at angle [rad] around the needle.
+    """
+    P = self.points
+    tangent = P[min(index + 1, len(P) - 1)] - P[max(index - 1, 0)]
+    norm = numpy.linalg.norm(tangent)
+    tangent = tangent / norm if norm else numpy.array([0., 0., 1.])
+    u = numpy.cross(tangent, [0., 0., 1.])
+    if numpy.linalg.norm(u) < 1e-6:
+      u = numpy.cross(tangent, [1., 0., 0.])
+    u = u / numpy.linalg.norm(u)
+    v = numpy.cross(tangent, u)
+    return P[index] + self.radius * (math.cos(angle) * u + math.sin(angle) * v)
+
+
+class NeedleGeometryIndex(object):
+  """
+  NeedleCenterline of the model nodes (vtkMRMLModelNode) of a scene, read by reader(polydata) and rebuilt when the
+  polydata of a node was replaced or modified since. The list of the model nodes of the scene is kept until
+  invalidate(), called by the module when nodes are added to or removed from the scene.
+  """
+
+  def __init__(self, reader):
+    """
+    :param reader: function(polydata) returning the NeedleCenterline of a needle tube, None for other polydata
+    """
+    self.reader = reader
+    self.entries = {}
+    self.modelNodes = None
+    self.lock = threading.Lock()
+
+  def geometry(self, node):
+    """
+    NeedleCenterline of a model node, None if it is not a needle.
+    """
+    polydata = node.GetPolyData() if node is not None else None
+    if not polydata:
+      return None
+    mtime = polydata.GetMTime()
+    with self.lock:
+      entry = self.entries.get(node)
+      if entry is None or entry[0] is not polydata or entry[1] != mtime:
+        entry = (polydata, mtime, self.reader(polydata))
+        self.entries[node] = entry
+    return entry[2]
+
+  def geometryByID(self, scene, nodeID):
+    return self.geometry(scene.GetNodeByID(nodeID))
+
+  def nodes(self, scene, type=None):
+    """
+    Model nodes of the scene with a needle geometry, of the attribute 'type' if not None, in scene order.
+    """
+    with self.lock:
+      modelNodes = self.modelNodes
+    if modelNodes is None:
+      collection = scene.GetNodesByClass('vtkMRMLModelNode')
+      modelNodes = [collection.GetItemAsObject(i) for i in range(collection.GetNumberOfItems())]
+      with self.lock:
+        self.modelNodes = modelNodes
+        # forget the removed nodes
+        for node in list(self.entries):
+          if node not in modelNodes:
+            del self.entries[node]
+    return [node for node in modelNodes
+            if (type is None or node.GetAttribute('type') == type) and self.geometry(node) is not None]
+
+  def invalidate(self, *args):
+    """
+    Read the model nodes of the scene again at the next query (usable as scene observer).
+    """
+    with self.lock:
+      self.modelNodes = None
+
+  def clear(self):
+    with self.lock:
+      self.modelNodes = None
+      self.entries.clear()
@@ -0,0 +1,279 @@
+"""
+ROI-bounded needle detection.
+
+The needles of a case live between their tips and the axial segmentation limit, a small part of a
+high-resolution MR volume. ROIDetector crops the image (and label map) once to the bounding box of the
+tips, extended by the axial reach of the cones and a lateral margin of a few cone radii, and tracks the
+needles on that sub-volume, so that the copies and feature volumes of the detection stay small.
+
+The ROI is a heuristic bound: the rays actually scored are recorded, and a needle whose rays got too
+close to a border of the ROI (where the crop would read zeros instead of the image) is tracked again on
+the whole volume, so the control points are those of the whole volume detection.
+
+The memory of the detection is estimated beforehand and kept within a budget by dropping, in turn,
+the feature volumes and the copy of the ROI; MemoryError is raised if that is not enough.
+"""
+
+import threading
+import numpy
+
+from VolumeAccess import VolumeAccessor
+from FeatureVolumes import FeatureCache, SLAB
+from Transforms import AffineTransform
+from CoarseSearch import CoarseToFineSearch
+from Detector import NeedleDetector, stepSize13
+from Tracing import tracer
+
+__all__ = ['coneReach', 'detectionROI', 'estimateMemory', 'ROIDetector']
+
+
+def coneReach(parameters, spacing, tip):
+  """
+  Largest cone base radius and axial reach [voxels] of a MICCAI13 track from tip [ijk] (cf. trackCones13),
+  which stops at the axial segmentation limit.
+  """
+  p = parameters
+  NbStepsNeedle = p.numberOfPointsPerNeedle - 1
+  if p.axialSegmentationLimit != None:
+    lenghtNeedle = abs(tip[2] - p.axialSegmentationLimit) * 1.15 * spacing[2]
+  else:
+    lenghtNeedle = tip[2] * 0.9 * spacing[2]
+  axialScale = 1 / float(spacing[2]) if p.algoVersParameter == 2 else 1
+  radius = p.radiusMax / float(spacing[0])
+  descent = 0
+  for step in range(0, NbStepsNeedle + 2):
+    stepSize = stepSize13(step + 1, NbStepsNeedle + 1) * lenghtNeedle
+    radius = max(radius, stepSize)
+    descent += stepSize * axialScale
+    if p.axialSegmentationLimit != None and tip[2] - descent <= p.axialSegmentationLimit:
+      break
+  return radius, descent
+
+
+def detectionROI(tips, dims, parameters, spacing, guard=(0, 0, 0), margin=1.5):
+  """
+  Bounding ROI of the tracks of the tips.
+
+  :param dims: volume dimensions
+  :param guard: additional border along i, j, k [voxels]
+  :param margin: lateral margin around the tips, in largest cone radii
+  :return: lower (inclusive, even) and upper (exclusive) index of the ROI
+  """
+  lower = [dims[0], dims[1], dims[2]]
+  upper = [0, 0, 0]
+  for tip in tips:
+    radius, descent = coneReach(parameters, spacing, tip)
+    lateral = margin * radius
+    lower = [min(lower[0], tip[0] - lateral - guard[0]), min(lower[1], tip[1] - lateral - guard[1]),
+             min(lower[2], tip[2] - descent - 1 - guard[2])]
+    upper = [max(upper[0], tip[0] + lateral + guard[0]), max(upper[1], tip[1] + lateral + guard[1]),
+             max(upper[2], tip[2] + 1 + guard[2])]
+  # even lower bounds keep the 2x2x2 blocks of the coarse search aligned with the whole volume
+  lower = [max(0, int(numpy.floor(l)) // 2 * 2) for l in lower]
+  upper = [min(n, int(numpy.ceil(u)) + 1) for u, n in zip(upper, dims)]
+  return lower, [max(u, l + 1) for l, u in zip(lower, upper)]
+
+
+def estimateMemory(shape, itemsize, labelItemsize, parameters, copy=True):
+  """
+  Estimated memory [bytes] of a detection on a volume of the given shape, by item.
+
+  :param itemsize, labelItemsize: bytes per voxel of the image and of the label map (0 without label map)
+  :param copy: True if the image and label map are copied
+  """
+  n = int(numpy.prod(shape))
+  memory = {}
+  memory['image'] = n * itemsize if copy else 0
+  memory['label'] = n * labelItemsize if copy else 0
+  if parameters.gradient and parameters.featureVolumes:
+    # center and ring mean (float32), float64 slab of shiftedSum
+    memory['features'] = 8 * n + shape[0] * shape[1] * min(SLAB, shape[2]) * 8
+  if parameters.algoVersParameter == 6:
+    # block means and counts (float32)
+    memory['coarse'] = 8 * (n + 7) // 8
+  return memory
+
+
+class ROIDetector(object):
+  """
+  NeedleDetector on the bounding ROI of the needles to track, cf. module doc.
+  Has the interface of NeedleDetector used by the module (track, detect, fork, merge, ijk2ras, parameters, samples).
+  Its tracks can run in several threads at once: each one has its own detector, merged back under the lock.
+  The ROI is estimated for the MICCAI13 tracks of versions, the other versions are tracked on the whole volume.
+  """
+
+  versions = (1, 2, 6)
+
+  def __init__(self, detector, tips, memoryBudget=None, margin=1.5):
+    """
+    :param detector: NeedleDetector on the whole volume
+    :param tips: tips [ijk] of the needles to track
+    :param memoryBudget: MB, 0 for no limit, parameters.memoryBudget if None
+    :param margin: lateral margin of the ROI around the tips, in largest cone radii
+    """
+    p = detector.parameters
+    if memoryBudget is None:
+      memoryBudget = p.memoryBudget
+    self.budget = memoryBudget * 2 ** 20
+    dims = detector.volume.dims
+    self.guard = self.borderGuard(detector)
+    self.lower, self.upper = detectionROI(tips, dims, p, detector.spacing, self.guard, margin)
+    shape = [u - l for l, u in zip(self.lower, self.upper)]
+    itemsize = detector.volume.array.itemsize
+    labelItemsize = detector.label.array.itemsize if detector.label is not None else 0
+
+    # within the budget, drop the feature volumes, then the copies
+    parameters, copy = p, True
+    self.memory = estimateMemory(shape, itemsize, labelItemsize, parameters, copy)
+    if self.overBudget(self.memory):
+      parameters = p.copy(featureVolumes=False)
+      self.memory = estimateMemory(shape, itemsize, labelItemsize, parameters, copy)
+    if self.overBudget(self.memory):
+      copy = False
+      self.memory = estimateMemory(shape, itemsize, labelItemsize, parameters, copy)
+    if self.overBudget(self.memory):
+      raise MemoryError("needle detection needs %.1f MB in an ROI of %s voxels, over the budget of %g MB"
+                        % (sum(self.memory.values()) / 2. ** 20, shape, memoryBudget))
+    self.copy = copy
+    # the whole volume detection of the needles leaving the ROI must fit as well
+    if self.overBudget(estimateMemory(dims, itemsize, labelItemsize, p, False)):
+      detector = NeedleDetector(detector.volume, detector.transform, p.copy(featureVolumes=False), detector.label,
+                                detector.spacing, FeatureCache(1))
+    self.detector = detector
+
+    ROI = tuple(slice(l, u) for l, u in zip(self.lower, self.upper))
+    with tracer.span('roi crop', copy=copy):
+      self.volume = self.crop(detector.volume, ROI)
+      self.label = self.crop(detector.label, ROI) if detector.label is not None else None
+    offset = numpy.identity(4)
+    offset[:3, 3] = self.lower
+    self.transform = AffineTransform(numpy.dot(detector.transform.ijkToRAS, offset))
+    if parameters.axialSegmentationLimit != None:
+      parameters = parameters.copy(axialSegmentationLimit=parameters.axialSegmentationLimit - self.lower[2])
+    self.localParameters = parameters
+    self.featureCache = FeatureCache(1)
+    self.fallbacks = 0
+    self.localSamples = 0
+    self.coarseToFine = CoarseToFineSearch(p.coarseTopK, p.coarseBudget / 100., p.coarseAmbiguity / 100.)
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def borderGuard(detector):
+    """
+    Distance [voxels] the scored rays must keep from the borders of the ROI: the ring of the gradient term
+    in plane and, for the coarse search, the half resolution ring and block.
+    """
+    radiusNeedle, radiusNeedleCorner = detector.needleRadius()
+    guard = [max(radiusNeedle, radiusNeedleCorner) + 1, 0]
+    if detector.parameters.algoVersParameter == 6:
+      guard[0] += 2 * max(1, int(round(radiusNeedle / 2.))) + 2
+      guard[1] = 2
+    return guard[0], guard[0], guard[1]
+
+  def overBudget(self, memory):
+    return self.budget > 0 and sum(memory.values()) > self.budget
+
+  def crop(self, volume, ROI):
+    array = volume.array[ROI]
+    if self.copy:
+      array = numpy.ascontiguousarray(array)
+    return VolumeAccessor(array)
+
+  @property
+  def parameters(self):
+    return self.detector.parameters
+
+  @property
+  def samples(self):
+    return self.localSamples + self.detector.samples
+
+  def ijk2ras(self, ijk):
+    return self.detector.ijk2ras(ijk)
+
+  def ras2ijk(self, ras):
+    return self.detector.ras2ijk(ras)
+
+  def report(self):
+    """
+    ROI, memory and fallbacks as a string, for the log.
+    """
+    dims = self.detector.volume.dims
+    shape = [u - l for l, u in zip(self.lower, self.upper)]
+    fraction = float(numpy.prod(shape)) / numpy.prod(dims)
+    memory = ', '.join('%s %.1f MB' % (name, size / 2. ** 20) for name, size in sorted(self.memory.items()) if size)
+    return ("ROI %s-%s (%.0f%% of the volume), %s, %s, %d needle(s) tracked on the whole volume"
+            % (self.lower, self.upper, 100 * fraction, memory or 'no extra memory', 'copied' if self.copy else 'not copied',
+               self.fallbacks))
+
+  def toGlobal(self, ijk):
+    return [ijk[0] + self.lower[0], ijk[1] + self.lower[1], ijk[2] + self.lower[2]]
+
+  def toLocal(self, ijk):
+    return [ijk[0] - self.lower[0], ijk[1] - self.lower[1], ijk[2] - self.lower[2]]
+
+  def inside(self, reach):
+    """
+    True if the bounding box of the scored rays keeps the guard distance from the ROI borders that are not
+    borders of the volume.
+    """
+    if reach is None:
+      return True
+    dims = self.detector.volume.dims
+    shape = self.volume.dims
+    low, high = numpy.floor(reach[0]), numpy.ceil(reach[1])
+    for d in range(3):
+      if self.lower[d] > 0 and low[d] - self.guard[d] < 1:
+        return False
+      if self.upper[d] < dims[d] and high[d] + self.guard[d] > shape[d] - 1:
+        return False
+    return True
+
+  def localDetector(self):
+    """
+    NeedleDetector in ROI index coordinates, sharing the feature volumes of the ROI.
+    """
+    return NeedleDetector(self.volume, self.transform, self.localParameters, self.label, self.detector.spacing,
+                          self.featureCache)
+
+  def fork(self):
+    """
+    The ROI detector itself, its tracks don't share any state but the counters kept under the lock.
+    """
+    return self
+
+  def merge(self, forks):
+    pass
+
+  def track(self, tip, feedback=None, onStep=None, name=None, up=False):
+    """
+    Track one needle from its tip [ijk] in the ROI, or on the whole volume if it leaves the ROI, cf. NeedleDetector.track.
+    """
+    local = self.localDetector()
+    localFeedback = None
+    if feedback:
+      localFeedback = lambda M: feedback(self.toGlobal(M))
+    steps = []
+    localOnStep = None
+    if onStep:
+      localOnStep = lambda step, C0, A: steps.append((step, self.toGlobal(C0), self.toGlobal(A)))
+    controlPoints, controlPointsIJK = local.track(self.toLocal(tip), localFeedback, localOnStep, name, up)
+    with self.lock:
+      self.localSamples += local.samples
+      self.coarseToFine.merge(local.coarseToFine)
+    if not self.inside(local.reach):
+      with self.lock:
+        self.fallbacks += 1
+      tracer.count('roi fallbacks')
+      fallback = self.detector.fork()
+      result = fallback.track(tip, feedback, onStep, name, up)
+      with self.lock:
+        self.detector.merge([fallback])
+      return result
+    for step in steps:
+      onStep(*step)
+    controlPointsIJK = [self.toGlobal(a) for a in controlPointsIJK]
+    controlPointsIJK[0] = tip
+    return [self.ijk2ras(a) for a in controlPointsIJK], controlPointsIJK
+
+  def detect(self, tips):
+    return [self.track(tip) for tip in tips]
@@ -0,0 +1,862 @@
+"""
+Headless needle detection.
+
+NeedleDetector tracks needles from their tips on a plain voxel array with an IJK to RAS affine
+and a DetectionParameters object, without Slicer widgets or MRML nodes, so that the detection
+can be scripted, run in worker threads or batch jobs, and profiled.
+The NeedleFinder module uses it as its detection backend (cf. NeedleFinderLogic.needleDetector):
+its single needle detectors needleDetectionThreadCurrentDev, 13_1, 13_2 and 15_1 only draw the results.
+"""
+
+import math
+import os
+import numpy
+
+from VolumeAccess import VolumeAccessor
+from ConeSearch import (coneRays, coneSamples, insideSamples, scoreConeRays, scoreConeRaysCurrentDev, scoreConeRaysLoop,
+                        scoreConeRaysCurrentDevLoop)
+from FeatureVolumes import FeatureCache
+from CoarseSearch import coarseConeScores, CoarseToFineSearch
+from TipSearch import findTips
+from NeedleModel import NeedleModel
+from Transforms import AffineTransform
+from Tracing import tracer
+
+__all__ = ['DetectionParameters', 'NeedleDetector', 'stepSize13', 'stepSizeCurrentDev']
+
+# needle model of 15_1: length [mm] of the modelled needle and of its segments
+MODEL_NEEDLE_LENGTH = 187
+MODEL_SEGMENT_LENGTH = MODEL_NEEDLE_LENGTH / 20.
+# bending stiffness of an 18 gauge brachy needle
+NEEDLE_STIFFNESS = 2 * numpy.pi * 2050 / (1000.)
+# reference needle direction of 15_1: the z axis rotated down by 22.5 degrees around x
+REFERENCE_ANGLE = numpy.deg2rad(22.5)
+
+
+def fibonacci(n):
+  F = [0, 1]
+  for i in range(1, n + 1):
+    F.append(F[i - 1] + F[i])
+  return F
+
+
+def stepSize13(k, l):
+  """
+  MICCAI13 step size, cf. NeedleFinderLogic.stepSize13:
+  fraction of the needle length covered by step k of l
+  """
+  F = fibonacci(l + 1)
+  return (sum(fibonacci(k + 1), -1) + F[k + 1]) / float(sum(fibonacci(l + 1), -1))
+
+
+def stepSizeCurrentDev(k, l):
+  """
+  Step size of needleDetectionThreadCurrentDev, cf. NeedleFinderLogic.stepSize:
+  fraction of the needle length covered by step k of l
+  """
+  F = fibonacci(l)
+  return F[k + 1] / float(sum(F))
+
+
+def norm(v):
+  return numpy.sqrt(numpy.dot(v, v))
+
+
+def localNeedleFrame(fvX, fvY, fvZ, rasA, rasAPrev):
+  """
+  Deflection direction, needle plane normal and needle direction (unit vectors) of the last segment
+  [APrev, A] [RAS] of a 15_1 track, the signs being chosen along fvY and fvX.
+  """
+  segment = rasA - rasAPrev
+  segment1 = segment / norm(segment)
+  normal = numpy.cross(segment1, fvZ)
+  if numpy.arccos(numpy.dot(normal, fvX)) > numpy.pi / 2:
+    normal *= -1
+  if not sum(normal):
+    normal = numpy.cross(fvY, fvZ)
+  normal1 = normal / norm(normal)
+  deflection = numpy.cross(fvZ, normal1)
+  if numpy.arccos(numpy.dot(deflection, fvY)) > numpy.pi / 2:
+    deflection *= -1
+  deflection1 = deflection / norm(deflection)
+  fvZ = numpy.cross(normal1, deflection1)
+  fvZ /= norm(fvZ)
+  return deflection1, normal1, fvZ
+
+
+class DetectionParameters(object):
+  """
+  Parameters of the needle detection, named as the controls of the NeedleFinder parameter frame.
+  Lengths are in mm, axialSegmentationLimit is an axial (k) index or None.
+  exponent, maxLength and autoCorrectTip are only used by version 0, needleModelInterpolation by version 3.
+  coarseBudget and coarseAmbiguity are percentages, cf. CoarseToFineSearch.
+  With roiDetection, detect() works on the bounding ROI of the tips within memoryBudget MB (0: no limit),
+  cf. ROIDetector.
+  Without vectorizedConeSearch the rays are scored voxel by voxel as in the former loops of the module (same control
+  points, slower), for comparison.
+  """
+
+  defaults = [
+    ('algoVersParameter', 1),
+    ('radiusMax', 10),
+    ('gradientPonderation', 5),
+    ('sigmaValue', 4),
+    ('exponent', 1),
+    ('gradient', True),
+    ('gaussianAttenuation', True),
+    ('numberOfPointsPerNeedle', 8),
+    ('nbRotatingIterations', 35),
+    ('radiusNeedleParameter', 2),
+    ('lenghtNeedleParameter', 35),
+    ('axialSegmentationLimit', None),
+    ('maxLength', False),
+    ('autoCorrectTip', False),
+    ('autoStopTip', False),
+    ('needleModelInterpolation', True),
+    ('featureVolumes', True),
+    ('vectorizedConeSearch', True),
+    ('coarseTopK', 4),
+    ('coarseBudget', 35),
+    ('coarseAmbiguity', 2),
+    ('roiDetection', False),
+    ('memoryBudget', 0),
+  ]
+
+  def __init__(self, **kwargs):
+    for name, value in self.defaults:
+      setattr(self, name, value)
+    self.update(**kwargs)
+
+  def update(self, **kwargs):
+    names = [name for name, value in self.defaults]
+    for name, value in kwargs.items():
+      if name not in names:
+        raise ValueError("unknown detection parameter '%s'" % name)
+      setattr(self, name, value)
+    return self
+
+  def copy(self, **kwargs):
+    """
+    Copy of the parameters, with the given values changed.
+    """
+    return DetectionParameters(**self.asDict()).update(**kwargs)
+
+  def asDict(self):
+    return dict((name, getattr(self, name)) for name, value in self.defaults)
+
+  def inert(self):
+    """
+    Names of the parameters that have no effect on the control points with the other values, e.g. exponent outside
+    of version 0 or gradientPonderation without the gradient term.
+    """
+    version = self.algoVersParameter
+    tipSearch = version == 0 and self.autoCorrectTip # findTips reads the radius, sigma and ponderation
+    inert = set(['vectorizedConeSearch']) # both backends give the same control points
+    if version != 0:
+      inert.update(['exponent', 'maxLength', 'autoCorrectTip', 'lenghtNeedleParameter'])
+    if version != 3:
+      inert.add('needleModelInterpolation')
+    if version != 6:
+      inert.update(['coarseTopK', 'coarseBudget', 'coarseAmbiguity'])
+    if not self.gradient and not tipSearch:
+      inert.add('gradientPonderation')
+      if version != 3: # 15_1 keeps the samples at the needle radius from the border
+        inert.add('radiusNeedleParameter')
+    if not self.gaussianAttenuation and not tipSearch:
+      inert.add('sigmaValue')
+    return inert
+
+  def __repr__(self):
+    return 'DetectionParameters(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name, value in self.defaults)
+
+
+class NeedleDetector(object):
+  """
+  Needle tracking on a voxel array.
+
+  Implemented versions (algoVersParameter): 0 (needleDetectionThreadCurrentDev), 1 (MICCAI13,
+  needleDetectionThread13_1), 2 (13_2, with the /spacing[2] bugfixes), 3 (MICCAI15, needleDetectionThread15_1)
+  and 6 (version 1 with the coarse-to-fine cone search). Versions 4 and 5 are the post-processing of the module
+  (needleDetectionThread_RM) over versions 1 and 3.
+  The control points are those of the former voxel by voxel loops of the module.
+  """
+
+  versions = (0, 1, 2, 3, 6)
+
+  def __init__(self, volume, ijkToRAS, parameters=None, label=None, spacing=None, featureCache=None):
+    """
+    :param volume: voxel array indexed [i, j, k] or a VolumeAccessor
+    :param ijkToRAS: 4x4 IJK to RAS matrix or an AffineTransform
+    :param parameters: DetectionParameters (defaults if None)
+    :param label: optional label array [i, j, k] or VolumeAccessor; samples on labels < 300 are penalized
+    :param spacing: voxel size [mm], taken from the matrix if None
+    :param featureCache: FeatureCache to share the feature volumes with other detectors
+    """
+    self.volume = volume if isinstance(volume, VolumeAccessor) else VolumeAccessor(numpy.asarray(volume))
+    if label is not None and not isinstance(label, VolumeAccessor):
+      label = VolumeAccessor(numpy.asarray(label))
+    self.label = label
+    self.transform = ijkToRAS if isinstance(ijkToRAS, AffineTransform) else AffineTransform(ijkToRAS)
+    self.spacing = list(spacing) if spacing is not None else self.transform.spacing()
+    self.parameters = parameters or DetectionParameters()
+    self.featureCache = featureCache or FeatureCache(1)
+    self.samples = 0 # number of line samples scored, for benchmarks
+    self.reach = None # bounding box [ijk] of the rays scored since resetReach
+    self.stepLog = None # optional StepLog for the step records of version 3
+    self.sampleMarker = None # optional function(ijk) called with the N x 3 in-image samples of each scored cone
+    self.warnings = [] # unexpected states of version 3 (the module showed them in a dialog)
+    self.estimatorReference = 0 # lowest estimator of step 1 of the last version 0 track
+    self.imageVoxels = None # optional image reader of the voxel by voxel cone search, cf. ImageDataVoxels
+    self.labelVoxels = None # the same for the label map
+    self._needleModel = None
+    p = self.parameters
+    self.coarseToFine = CoarseToFineSearch(p.coarseTopK, p.coarseBudget / 100., p.coarseAmbiguity / 100.)
+
+  def ijk2ras(self, ijk):
+    return self.transform.ijk2ras(ijk)
+
+  def ras2ijk(self, ras):
+    return self.transform.ras2ijk(ras)
+
+  def needleRadius(self):
+    """
+    Radii of the ring of the gradient term in voxels (axis aligned, diagonal).
+    """
+    radiusNeedleParameter = self.parameters.radiusNeedleParameter
+    radiusNeedle = int(round(radiusNeedleParameter / float(self.spacing[0])))
+    radiusNeedleCorner = int(round((radiusNeedleParameter / float(self.spacing[0]) / 1.414)))
+    return radiusNeedle, radiusNeedleCorner
+
+  def features(self):
+    """
+    Cached feature volumes for the gradient term, None if not used.
+    """
+    p = self.parameters
+    if not (p.gradient and p.featureVolumes and p.vectorizedConeSearch):
+      return None
+    radiusNeedle, radiusNeedleCorner = self.needleRadius()
+    return self.featureCache.get(self.volume, radiusNeedle, radiusNeedleCorner)
+
+  @property
+  def needleModel(self):
+    """
+    NeedleModel of version 3, by default the one of the module directory.
+    """
+    if self._needleModel is None:
+      self._needleModel = NeedleModel.load(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return self._needleModel
+
+  @needleModel.setter
+  def needleModel(self, model):
+    self._needleModel = model
+
+  def track(self, tip, feedback=None, onStep=None, name=None, up=False):
+    """
+    Track one needle from its tip.
+
+    :param tip: needle tip [ijk]
+    :param feedback: optional function(M) returning an additional score for each sample M [ijk]
+                     (Ruibin's feedback of the post-processing; not used by version 0)
+    :param onStep: optional function(step, C0, A) called after each step with the center of the
+                   cone base and the new control point [ijk], e.g. to display them
+    :param name: name of the needle in the step records
+    :param up: track upwards (version 3 only)
+    :return: control points [RAS], control points [IJK], the tip being the first one
+    """
+    version = self.parameters.algoVersParameter
+    if version not in self.versions:
+      raise ValueError("needle detection version %d has no headless implementation" % version)
+    with tracer.span('track', version=version):
+      if version == 0:
+        return self.trackCurrentDev(tip, onStep)
+      if version == 3:
+        return self.trackCones15(tip, feedback, onStep, name, up)
+      return self.trackCones13(tip, version == 2, feedback, onStep, coarseToFine=version == 6)
+
+  def detect(self, tips):
+    """
+    Track the needles of all tips, cf. track.
+    """
+    p = self.parameters
+    if p.roiDetection:
+      from DetectionROI import ROIDetector
+      if p.algoVersParameter in ROIDetector.versions:
+        return ROIDetector(self, tips).detect(tips)
+    if p.algoVersParameter == 0 and p.autoCorrectTip:
+      # all tips refined in one call
+      results = []
+      for tip in self.correctTips(tips):
+        with tracer.span('track', version=0):
+          results.append(self.trackCurrentDev(tip, tipCorrected=True))
+      return results
+    return [self.track(tip) for tip in tips]
+
+  def correctTips(self, tips):
+    """
+    Tips [ijk] moved to the best tip response within 5 mm, as autoCorrectTip of version 0 (cf. TipSearch).
+    """
+    p = self.parameters
+    coeff, radiusSphere = 1, 5
+    radiusNeedle, radiusNeedleCorner = self.needleRadius()
+    return findTips(self.volume.array, tips, radiusNeedle, coeff, p.sigmaValue, p.gradientPonderation,
+                    coeff * radiusSphere / float(self.spacing[0]), coeff * radiusSphere / float(self.spacing[1]))
+
+  def fork(self):
+    """
+    Detector for one tracking job of a worker thread: it shares the volumes, parameters, feature volumes, needle
+    model and step log of this one and has its own samples, reach, warnings, estimator reference and coarse-to-fine
+    counts, merged back by the calling thread after the join (cf. merge).
+    """
+    p = self.parameters
+    fork = NeedleDetector(self.volume, self.transform, p, self.label, self.spacing, self.featureCache)
+    fork.stepLog = self.stepLog
+    fork.sampleMarker = self.sampleMarker
+    fork.imageVoxels = self.imageVoxels
+    fork.labelVoxels = self.labelVoxels
+    if p.algoVersParameter == 3:
+      # loaded once, on the calling thread
+      fork.needleModel = self.needleModel
+    fork.coarseToFine = CoarseToFineSearch(p.coarseTopK, p.coarseBudget / 100., p.coarseAmbiguity / 100.)
+    return fork
+
+  def merge(self, forks):
+    """
+    Merge the state of the forks of finished jobs, in the order of the jobs, as if they had been tracked by this
+    detector one after the other.
+    """
+    for fork in forks:
+      self.samples += fork.samples
+      if fork.reach is not None:
+        self.extendReach(fork.reach[0], fork.reach[1])
+      self.warnings.extend(fork.warnings)
+      self.estimatorReference = fork.estimatorReference
+      self.coarseToFine.merge(fork.coarseToFine)
+
+  def resetReach(self):
+    self.reach = None
+
+  def extendReach(self, A, Cs):
+    """
+    Extend the bounding box of the scored rays by the rays [A, C] for C in Cs.
+    """
+    points = numpy.vstack([numpy.asarray(A, dtype=numpy.float64).reshape(1, 3),
+                           numpy.asarray(Cs, dtype=numpy.float64).reshape(-1, 3)])
+    lower, upper = points.min(axis=0), points.max(axis=0)
+    if self.reach is not None:
+      lower = numpy.minimum(lower, self.reach[0])
+      upper = numpy.maximum(upper, self.reach[1])
+    self.reach = (lower, upper)
+
+  def attenuation(self, step, A, tip0, C0, rMax, C):
+    """
+    Gaussian attenuation of the estimator of the ray ending at C around the extrapolated needle direction,
+    None if not applied.
+    """
+    if not (self.parameters.gaussianAttenuation and step >= 2) or tip0[2] - A[2] == 0:
+      return None
+    stepSize = (A[2] - C0[2])
+    K = stepSize / float(tip0[2] - A[2])
+    X = [A[0] + K * (A[0] - tip0[0]),
+         A[1] + K * (A[1] - tip0[1]),
+         A[2] + K * (A[2] - tip0[2])]
+    rgauss = ((C[0] - X[0]) ** 2 + (C[1] - X[1]) ** 2 + (C[2] - X[2]) ** 2) ** 0.5
+    return math.exp(-(rgauss / float(rMax)) ** 2 / float((2 * (self.parameters.sigmaValue / float(10)) ** 2)))
+
+  def attenuationCurrentDev(self, step, C0, rMax, C):
+    """
+    Gaussian attenuation of needleDetectionThreadCurrentDev around the cone axis, with sigma 100 in the last
+    step; None if not applied.
+    """
+    p = self.parameters
+    if not (p.gaussianAttenuation and step >= 2):
+      return None
+    sigmaValue = p.sigmaValue
+    if step == max(1, p.numberOfPointsPerNeedle - 1) - 1:
+      sigmaValue = 100
+    rgauss = ((C[0] - C0[0]) ** 2 + (C[1] - C0[1]) ** 2 + (C[2] - C0[2]) ** 2) ** 0.5
+    return math.exp(-(rgauss / float(rMax)) ** 2 / float((2 * (sigmaValue / float(10)) ** 2)))
+
+  def selectRay(self, rays, totals, step, A, tip0, C0, rMax, bestPoint):
+    """
+    Selection of needleDetectionThread13_1 among scored rays (in cone order, starting with the cone axis):
+    the end of the ray with the lowest estimator below the total of the axis.
+
+    :return: the selected end point (bestPoint if no ray beats the axis), index of the selected ray or None
+    """
+    estimators = []
+    for n, (R, C) in enumerate(rays):
+      factor = self.attenuation(step, A, tip0, C0, rMax, C)
+      estimators.append(totals[n] if factor is None else totals[n] * factor)
+    bestPoint, winner, minEstimator = self.selectEstimator(rays, totals, estimators, bestPoint)
+    return bestPoint, winner
+
+  @staticmethod
+  def selectEstimator(rays, totals, estimators, bestPoint):
+    """
+    The end of the ray with the lowest estimator below the total of the cone axis, cf. selectRay.
+
+    :return: the selected end point (bestPoint if none), index of the selected ray or None, lowest estimator
+    """
+    minEstimator = 0
+    winner = None
+    for n, (R, C) in enumerate(rays):
+      if R == 0:
+        initialIntensity = totals[n]
+      estimator = estimators[n]
+      if estimator < initialIntensity:
+        if estimator < minEstimator or minEstimator == 0:
+          minEstimator = estimator
+          if minEstimator != 0:
+            bestPoint = C
+            winner = n
+    return bestPoint, winner, minEstimator
+
+  def trackCones13(self, tip, bugfix13_2=False, feedback=None, onStep=None, coarseToFine=False):
+    """
+    From the needle tip, look for the direction maximizing the "needle likelihood" of a segment in a conic region,
+    save the other end of the segment as control point and iterate from it (MICCAI13).
+    With bugfix13_2 the axial steps are converted to voxels (needleDetectionThread13_2).
+    With coarseToFine the rays are chosen with the CoarseToFineSearch instead of scoring them all.
+    """
+    p = self.parameters
+    spacing = self.spacing
+    axialSegmentationLimit = p.axialSegmentationLimit
+    distanceMax = p.radiusMax
+    NbStepsNeedle = p.numberOfPointsPerNeedle - 1
+    radiusNeedle, radiusNeedleCorner = self.needleRadius()
+    features = self.features()
+
+    A = tip
+    if axialSegmentationLimit != None:
+      lenghtNeedle = abs(A[2] - axialSegmentationLimit) * 1.15 * spacing[2]
+    else:
+      lenghtNeedle = A[2] * 0.9 * spacing[2]
+
+    A0 = A
+    tip0 = None
+    bestPoint = [0, 0, 0]
+    controlPointsIJK = [A]
+
+    for step in range(0, NbStepsNeedle + 2):
+      if step == 0:
+        L = stepSize13(step + 1, NbStepsNeedle + 1) * lenghtNeedle
+        if bugfix13_2:
+          C0 = [A[0], A[1], A[2] - L / spacing[2]]
+        else:
+          C0 = [A[0], A[1], A[2] - L]
+        rMax = distanceMax / float(spacing[0])
+        rIter = rMax
+        tIter = int(round(L))
+      else:
+        stepSize = stepSize13(step + 1, NbStepsNeedle + 1) * lenghtNeedle
+        if bugfix13_2:
+          C0 = [2 * A[0] - tip0[0], 2 * A[1] - tip0[1], A[2] - stepSize / spacing[2]]
+        else:
+          C0 = [2 * A[0] - tip0[0], 2 * A[1] - tip0[1], A[2] - stepSize]
+        rMax = max(stepSize, distanceMax / float(spacing[0]))
+        rIter = max(15, min(20, int(rMax / float(spacing[0]))))
+        tIter = stepSize
+
+      rays = coneRays(C0, rMax, rIter, p.nbRotatingIterations)
+      tracer.count('cones')
+      if coarseToFine:
+        bestPoint = self.searchCoarseToFine(rays, int(rIter) + 1, int(p.nbRotatingIterations), step, A, tip0, C0, rMax,
+                                            tIter, bestPoint, feedback, features)
+      else:
+        totals = self.scoreRays(rays, A, tIter, feedback, features)
+        bestPoint, winner = self.selectRay(rays, totals, step, A, tip0, C0, rMax, bestPoint)
+
+      # bestPoint is kept from the previous steps if no ray is better than the cone axis, as in 13_1
+      tip0 = A
+      if bestPoint == [0, 0, 0]:
+        A = C0
+      elif bestPoint != tip0:
+        A = bestPoint
+
+      if axialSegmentationLimit != None and A[2] < axialSegmentationLimit and A != A0:
+        asl = axialSegmentationLimit
+        l = (A[2] - asl) / float(tip0[2] - A[2])
+        A = [A[0] - l * (tip0[0] - A[0]),
+             A[1] - l * (tip0[1] - A[1]),
+             A[2] - l * (tip0[2] - A[2])]
+
+      controlPointsIJK.append(A)
+      if onStep:
+        onStep(step, C0, A)
+
+      if axialSegmentationLimit != None and A[2] <= axialSegmentationLimit and A != A0:
+        break
+
+    return [self.ijk2ras(a) for a in controlPointsIJK], controlPointsIJK
+
+  def trackCurrentDev(self, tip, onStep=None, tipCorrected=False):
+    """
+    needleDetectionThreadCurrentDev: the cone steps of MICCAI13 along the direction of the last segment, with
+    Fibonacci step sizes, the 3x3 sum of the samples to the power exponent and the gradient term
+    sum((box - g)**gradientPonderation) of the 8 ring voxels (cf. scoreConeRaysCurrentDev).
+    With autoCorrectTip the tip is refined first, unless tipCorrected.
+    """
+    p = self.parameters
+    spacing = self.spacing
+    distanceMax = p.radiusMax
+    NbStepsNeedle = max(1, p.numberOfPointsPerNeedle - 1) - 1
+    radiusNeedle, radiusNeedleCorner = self.needleRadius()
+    # the 3x3 center is used with or without gradient
+    features = None
+    if p.featureVolumes and p.vectorizedConeSearch:
+      features = self.featureCache.get(self.volume, radiusNeedle, radiusNeedleCorner)
+
+    A = [int(tip[0]), int(tip[1]), int(tip[2])]
+    axialSegmentationLimit = p.axialSegmentationLimit
+    if axialSegmentationLimit == None and p.maxLength:
+      axialSegmentationLimit = 0
+    if axialSegmentationLimit != None:
+      lenghtNeedle = abs(A[2] - axialSegmentationLimit) * 1.15 * spacing[2]
+    else:
+      lenghtNeedle = p.lenghtNeedleParameter / float(spacing[2])
+    if p.autoCorrectTip and not tipCorrected:
+      A = self.correctTips([A])[0]
+
+    A0 = A
+    tip0 = None
+    bestPoint = [0, 0, 0]
+    controlPointsIJK = [A]
+    self.estimatorReference = 0
+
+    for step in range(0, NbStepsNeedle + 1):
+      if step == 0:
+        stepSize = stepSizeCurrentDev(step, NbStepsNeedle) * lenghtNeedle
+        V = [0, 0, -stepSize]
+        rMax = distanceMax / float(spacing[0])
+        rIter = int(round(rMax))
+      else:
+        stepSize = stepSizeCurrentDev(step + 1, NbStepsNeedle + 1) * lenghtNeedle
+        rMax = max(stepSize, distanceMax / float(spacing[0]))
+        rIter = max(15, min(20, int(rMax / float(spacing[0]))))
+        V = [A[0] - tip0[0], A[1] - tip0[1], A[2] - tip0[2]]
+      tIter = max(1, int(round(stepSize)))
+      if V[2] == 0:
+        break
+      K = abs(stepSize) / spacing[2] / float(abs(V[2]))
+      C0 = [A[0] + K * V[0], A[1] + K * V[1], A[2] + K * V[2]]
+
+      rays = coneRays(C0, rMax, rIter, p.nbRotatingIterations)
+      tracer.count('cones')
+      Cs = [C for R, C in rays]
+      self.countSamples(A, Cs, tIter)
+      if p.vectorizedConeSearch:
+        totals = scoreConeRaysCurrentDev(self.volume, A, Cs, tIter, p.exponent, p.gradient, radiusNeedle,
+                                         radiusNeedleCorner, p.gradientPonderation, self.label, features)
+      else:
+        volume, label = self.voxels()
+        totals = scoreConeRaysCurrentDevLoop(volume, A, Cs, tIter, p.exponent, p.gradient, radiusNeedle,
+                                             radiusNeedleCorner, p.gradientPonderation, label)
+      self.markSamples(A, Cs, tIter)
+      estimators = []
+      for n, C in enumerate(Cs):
+        factor = self.attenuationCurrentDev(step, C0, rMax, C)
+        estimators.append(totals[n] if factor is None else totals[n] * factor)
+      bestPoint, winner, minEstimator = self.selectEstimator(rays, totals, estimators, bestPoint)
+
+      tip0 = A
+      if bestPoint == [0, 0, 0]:
+        A = C0
+      elif bestPoint != tip0:
+        A = bestPoint
+      # reference of the first step of the upward tracking
+      if step == 1:
+        self.estimatorReference = minEstimator
+
+      if axialSegmentationLimit != None and A[2] < axialSegmentationLimit and A != A0:
+        asl = axialSegmentationLimit
+        l = (A[2] - asl) / float(tip0[2] - A[2])
+        A = [A[0] - l * (tip0[0] - A[0]),
+             A[1] - l * (tip0[1] - A[1]),
+             A[2] - l * (tip0[2] - A[2])]
+
+      controlPointsIJK.append(A)
+      if onStep:
+        onStep(step, C0, A)
+
+      if axialSegmentationLimit != None and A[2] <= axialSegmentationLimit and A != A0:
+        break
+
+    return [self.ijk2ras(a) for a in controlPointsIJK], controlPointsIJK
+
+  def trackCones15(self, tip, feedback=None, onStep=None, name=None, up=False):
+    """
+    MICCAI15 tracking (needleDetectionThread15_1): equal steps from a first segment along the reference needle
+    direction; the cone of each step is centered on the straight extrapolation of the last segment, the best ray
+    end C is the plain minimum of the scores (no label term, samples kept at the ring radius from the i and j
+    borders) and is only taken if it lies within 1 mm of the cone center B, the next point being moved from B
+    towards C by at most 1 mm otherwise.
+    The needle model estimates the needle bending along the track; as in 15_1 it does not move B.
+    """
+    p = self.parameters
+    spacing = self.spacing
+    transform = self.transform
+    radiusNeedle, radiusNeedleCorner = self.needleRadius()
+    features = self.features()
+    margin = max(radiusNeedle, radiusNeedleCorner) + 1
+    stiffness = NEEDLE_STIFFNESS
+    fvX = numpy.array([1, 0, 0])
+    fvY = -numpy.array([0, numpy.cos(REFERENCE_ANGLE), numpy.sin(REFERENCE_ANGLE)])
+    fvZ = numpy.array([0, numpy.sin(REFERENCE_ANGLE), -numpy.cos(REFERENCE_ANGLE)])
+    zSign = 1 if up else -1
+    axialSegmentationLimit = p.axialSegmentationLimit
+
+    A = tip
+    if axialSegmentationLimit != None:
+      lenghtNeedle = abs(A[2] - axialSegmentationLimit)
+    else:
+      lenghtNeedle = A[2] * 0.9 * spacing[2]
+    nStepsNeedle = p.numberOfPointsPerNeedle - 1 # the tip is already there
+    stepSize = lenghtNeedle / (nStepsNeedle)
+
+    A0 = A
+    rasA = numpy.array(transform.ijk2ras(A))
+    rasA0 = rasA
+    APrev = rasAPrev = None
+    rasCBest = None
+    initVectors = []
+    force = sumAngle = None
+    maxDistance = limit = numpy.inf
+    controlPointsIJK = [A]
+    start = -1 # number of initialization steps (negative)
+
+    for absStep, step in enumerate(range(start, nStepsNeedle)):
+      if step < 0:
+        # first segment along the reference direction, over half the needle
+        stepSizeInit = 1. / (2 * abs(start)) * (absStep + 1) * lenghtNeedle
+        rasB = rasA + fvZ * stepSizeInit
+        B = transform.ras2ijk(rasB)
+        rMax = max(stepSizeInit, p.radiusMax / float(spacing[0]))
+        rIter = max(15, min(20, int(rMax / float(spacing[0]))))
+        tIter = stepSizeInit
+      elif step == 0:
+        # restart from the tip along the direction of the initialization segments
+        if not initVectors:
+          initVectors.append(fvZ)
+        initVector = sum(initVectors) / len(initVectors)
+        rasB = rasA + initVector / norm(initVector) * stepSize
+        B = transform.ras2ijk(rasB)
+        rMax = p.radiusMax / float(spacing[0])
+        rIter = rMax
+        tIter = int(round(stepSize))
+        if start < 0:
+          force, sumAngle = self.initNeedleModel(lenghtNeedle, fvZ, rasA, rasAPrev)
+      else:
+        B = [2 * A[0] - APrev[0],
+             2 * A[1] - APrev[1],
+             A[2] + zSign * stepSize / float(spacing[2])]
+        rasB = transform.ijk2ras(B)
+        rMax = max(stepSize, p.radiusMax / float(spacing[0]))
+        rIter = max(15, min(20, int(rMax / float(spacing[0]))))
+        tIter = stepSize
+        deflection1, normal1, fvZ = localNeedleFrame(fvX, fvY, fvZ, rasA, rasAPrev)
+        force, rasB = self.runNeedleModel(force, stepSize, fvZ, deflection1, sumAngle, rasA, rasB, stiffness)
+        B = transform.ras2ijk(rasB)
+
+      rays = coneRays(B, rMax, rIter, p.nbRotatingIterations)
+      tracer.count('cones')
+      totals = self.scoreRays(rays, A, tIter, feedback, features, useLabel=False, margin=margin)
+      CBest = None
+      minTotal = numpy.inf
+      for n, (R, C) in enumerate(rays):
+        total = totals[n]
+        factor = self.attenuation(step, A, APrev, B, rMax, C)
+        if factor is not None:
+          # 15_1 reused the stiffness variable here, the needle model runs with it from then on
+          stiffness = (A[2] - B[2]) / float(APrev[2] - A[2])
+          total = total * factor
+        if total < minTotal:
+          minTotal = total
+          CBest = C
+      if CBest is None:
+        self.warnings.append("/!!\ no ijkCBest found")
+        if rasCBest is None:
+          rasCBest = numpy.array(rasB)
+      else:
+        rasCBest = numpy.array(transform.ijk2ras(CBest))
+
+      APrev = A
+      rasAPrev = numpy.array(transform.ijk2ras(APrev))
+
+      # constraint: distance of the best ray end to the cone center
+      rasB2CBest = rasCBest - numpy.array(rasB)
+      distanceB2C = norm(rasB2CBest)
+      rasA = numpy.array(transform.ijk2ras(A))
+      rasA2CBest = rasCBest - rasA
+      if step < 0:
+        # the model is not estimated yet, the best ray end is taken anyway
+        distanceB2C = -numpy.inf
+        maxDistance = limit = numpy.inf
+      elif CBest is not None:
+        maxDistance = limit = 1 # mm
+      rejected = not distanceB2C < limit
+      useB = False
+      stepRecord = {}
+      if self.stepLog is not None:
+        stepRecord = self.stepLog.record('15_1', name, step, feedback=feedback is not None, B=B, C=CBest,
+                                         score=minTotal, distanceB2C=distanceB2C, rejected=rejected)
+      if CBest is None or rejected:
+        # towards the best ray end, within the constraint
+        if rasB2CBest.any():
+          direction = rasB2CBest / norm(rasB2CBest)
+        else:
+          direction = numpy.array([0, 0, 0])
+        rasA = numpy.array(rasB) + direction * min(maxDistance, distanceB2C / 2.)
+        A = transform.ras2ijk(rasA)
+        useB = True
+        if step == -abs(start):
+          self.warnings.append("/!!\ not using CBest in first it.??")
+      elif CBest != APrev:
+        if step < 0:
+          # the initialization segment gives the direction of step 0, which starts again from the tip
+          initVectors.append(rasA2CBest)
+          if step == -1:
+            rasAPrev = rasA0 - rasA2CBest
+            APrev = transform.ras2ijk(rasAPrev)
+            A = A0
+            rasA = numpy.array(transform.ijk2ras(A))
+          continue
+        A = CBest
+        rasA = numpy.array(transform.ijk2ras(A))
+      else:
+        self.warnings.append("/!!| uncaught ijkCBest==ijkAPrev")
+
+      # drag back a too far low control point to the axial limit plane
+      if axialSegmentationLimit != None and A[2] < axialSegmentationLimit and A != A0:
+        asl = axialSegmentationLimit
+        l = (A[2] - asl) / float(APrev[2] - A[2])
+        A = [A[0] - l * (APrev[0] - A[0]),
+             A[1] - l * (APrev[1] - A[1]),
+             A[2] - l * (APrev[2] - A[2])]
+
+      stepRecord['A'] = A
+      stepRecord['useB'] = useB
+      if step >= 0:
+        controlPointsIJK.append(A)
+        if onStep:
+          onStep(step, B, A)
+        if axialSegmentationLimit != None and A[2] <= axialSegmentationLimit and A != A0:
+          break
+
+    return [self.ijk2ras(a) for a in controlPointsIJK], controlPointsIJK
+
+  def initNeedleModel(self, lenghtNeedle, fvZ, rasA, rasAPrev):
+    """
+    Force [N] and end segment angle [rad] of the needle model for the deflection of the segment [APrev, A] from
+    the reference direction fvZ (15_1).
+    """
+    segment = rasA - rasAPrev
+    segment /= norm(segment)
+    angle = numpy.arccos(numpy.dot(fvZ, segment))
+    deflection = lenghtNeedle * 1 / numpy.cos(REFERENCE_ANGLE) * numpy.sin(angle)
+    if self.parameters.needleModelInterpolation:
+      force, endSegmentAngle = self.needleModel.interpolate(lenghtNeedle, deflection)
+    else:
+      force, endSegmentAngle = self.needleModel.nearest(lenghtNeedle, deflection)
+    force /= 1000
+    return force, endSegmentAngle
+
+  @staticmethod
+  def runNeedleModel(force, stepSize, fvZ, deflection1, sumAngle, rasA, rasB, stiffness):
+    """
+    Bend the needle model over one step of stepSize [mm] from A [RAS]: the model step ends at A along the end
+    segment angle sumAngle in the needle plane; B is moved towards it by at most 0 mm, i.e. kept (15_1).
+
+    :return: force of the model after the step, B [RAS]
+    """
+    modelStep = deflection1 * numpy.sin(sumAngle) + fvZ * numpy.cos(sumAngle)
+    modelStep1 = modelStep / norm(modelStep)
+    rasBDefault = rasB
+    rasB = rasA + modelStep1 * stepSize
+    distance = norm(rasBDefault - rasB)
+    maxDistance = 0
+    if distance > maxDistance:
+      # compromise between the model and the default step
+      direction = rasB - rasBDefault
+      rasB = rasBDefault + direction / norm(direction) * min(maxDistance, distance / 2.)
+    if stepSize / MODEL_SEGMENT_LENGTH < 1:
+      fineSteps = 5
+    else:
+      fineSteps = 1
+    for j in range(0, int(round(stepSize / (MODEL_SEGMENT_LENGTH / fineSteps)))):
+      force = force / numpy.cos(sumAngle)
+      stepAngle = force / (stiffness * fineSteps)
+      sumAngle -= stepAngle
+      if sumAngle < 0:
+        stepAngle = sumAngle = 0
+    return force, rasB
+
+  def countSamples(self, A, Cs, tIter):
+    """
+    Count the line samples of the rays [A, C] for C in Cs and extend the reach.
+    """
+    self.samples += len(Cs) * (int(tIter) + 1)
+    tracer.count('rays scored', len(Cs))
+    tracer.count('line samples', len(Cs) * (int(tIter) + 1))
+    self.extendReach(A, Cs)
+
+  def voxels(self):
+    """
+    Scalar readers of the image and of the label map (or None) for the voxel by voxel cone search.
+    """
+    label = self.labelVoxels if self.labelVoxels is not None else self.label
+    return (self.imageVoxels if self.imageVoxels is not None else self.volume), label
+
+  def markSamples(self, A, Cs, tIter, margin=0):
+    """
+    Pass the in-image samples (N x 3 [ijk]) of the scored rays [A, C] to the sampleMarker, if any. The loops of
+    the module marked each sample in the label map right after reading it; here a cone is marked once scored.
+    """
+    if self.sampleMarker:
+      M, ijk = coneSamples(A, Cs, tIter)
+      self.sampleMarker(ijk[insideSamples(ijk, self.volume.dims, margin)])
+
+  def scoreRays(self, rays, A, tIter, feedback=None, features=None, useLabel=True, margin=0):
+    """
+    Full resolution totals of the rays [A, C] (cf. scoreConeRays, scoreConeRaysLoop).
+    """
+    p = self.parameters
+    radiusNeedle, radiusNeedleCorner = self.needleRadius()
+    Cs = [C for R, C in rays]
+    self.countSamples(A, Cs, tIter)
+    if p.vectorizedConeSearch:
+      totals = scoreConeRays(self.volume, A, Cs, tIter, p.gradient, radiusNeedle, radiusNeedleCorner,
+                             p.gradientPonderation, self.label if useLabel else None, feedback, features, margin)
+    else:
+      volume, label = self.voxels()
+      totals = scoreConeRaysLoop(volume, A, Cs, tIter, p.gradient, radiusNeedle, radiusNeedleCorner,
+                                 p.gradientPonderation, label if useLabel else None, feedback, margin)
+    self.markSamples(A, Cs, tIter, margin)
+    return totals
+
+  def searchCoarseToFine(self, rays, nR, nTheta, step, A, tip0, C0, rMax, tIter, bestPoint, feedback, features):
+    """
+    Selected ray end of one cone step with the coarse-to-fine search (cf. CoarseToFineSearch).
+    """
+    p = self.parameters
+    radiusNeedle, radiusNeedleCorner = self.needleRadius()
+
+    def coarseEstimator(indices):
+      totals = coarseConeScores(self.volume, A, [rays[n][1] for n in indices], tIter, p.gradient,
+                                radiusNeedle, radiusNeedleCorner, p.gradientPonderation, self.label)
+      self.samples += len(indices) * (max(1, int(tIter) // 2) + 1)
+      tracer.count('coarse line samples', len(indices) * (max(1, int(tIter) // 2) + 1))
+      self.extendReach(A, [rays[n][1] for n in indices])
+      estimators = []
+      for n, total in zip(indices, totals):
+        factor = self.attenuation(step, A, tip0, C0, rMax, rays[n][1])
+        estimators.append(total if factor is None else total * factor)
+      return estimators, totals[0]
+
+    def score(indices):
+      return self.scoreRays([rays[n] for n in indices], A, tIter, feedback, features)
+
+    def select(indices, totals):
+      point, winner = self.selectRay([rays[n] for n in indices], totals, step, A, tip0, C0, rMax, bestPoint)
+      return point, (None if winner is None else indices[winner])
+
+    return self.coarseToFine.search(nR, nTheta, coarseEstimator, score, select)
@@ -0,0 +1,107 @@
+"""
+Step diagnostics of the detectors.
+
+needleDetectionThread15_1 and _RM printed their intermediate values at every cone step (default and best cone
+points, scores, rejections, the direction metrics of the rationality check), which slows the detection down in the
+Slicer Python console. They record them in a StepLog instead: a ring buffer of the last records, one dict per step
+(detector, needle, step and the values of the step), kept in memory and dumped to a JSON lines file on demand, e.g.
+after a bad detection. How much is still printed (cf. StepLog.text) is up to the verbosity of the module.
+"""
+
+import collections
+import itertools
+import json
+import numpy
+
+__all__ = ['StepLog']
+
+
+def jsonValue(value):
+  """
+  JSON value of the NumPy arrays and scalars of the records.
+  """
+  if isinstance(value, numpy.ndarray):
+    return value.tolist()
+  if isinstance(value, numpy.generic):
+    return value.item()
+  return str(value)
+
+
+class StepLog(object):
+  """
+  Ring buffer of the step records of the detectors, cf. module doc. Recording takes a number from a counter and
+  appends a dict to a deque, both atomic in CPython, so that detectors in worker threads record without a lock; the
+  conversion of the values to JSON is left to dump.
+  """
+
+  def __init__(self, capacity=100000):
+    self.records = collections.deque(maxlen=capacity)
+    self.sequence = itertools.count(1)
+
+  def record(self, detector, needle, step, **values):
+    """
+    Append a record; the oldest one is dropped once the buffer is full.
+
+    :param detector: name of the detector, e.g. '15_1'
+    :param needle: name or number of the needle
+    :param step: step number (None for the records of a whole needle or run)
+    :param values: values of the step, e.g. B, C, score, rejected
+    :return: the record, which can still be completed by the detector
+    """
+    values['seq'] = next(self.sequence)
+    values['detector'] = detector
+    values['needle'] = needle
+    values['step'] = step
+    self.records.append(values)
+    return values
+
+  def __len__(self):
+    return len(self.records)
+
+  @property
+  def last(self):
+    """
+    Number of the last buffered record (0 if there is none).
+    """
+    try:
+      return self.records[-1]['seq']
+    except IndexError:
+      return 0
+
+  @property
+  def dropped(self):
+    """
+    Number of records dropped from the full buffer (up to the last one).
+    """
+    return max(0, self.last - len(self.records))
+
+  def clear(self):
+    self.records.clear()
+
+  def select(self, detector=None, needle=None, after=0):
+    """
+    Buffered records of a detector and/or a needle numbered after after, oldest first.
+    """
+    return [r for r in list(self.records) if r['seq'] > after and
+            (detector is None or r['detector'] == detector) and (needle is None or r['needle'] == needle)]
+
+  @staticmethod
+  def text(record):
+    """
+    One line console text of a record.
+    """
+    values = ', '.join('%s=%s' % (name, record[name]) for name in sorted(record)
+                       if name not in ('seq', 'detector', 'needle', 'step'))
+    return '%s %s step %s: %s' % (record['detector'], record['needle'], record['step'], values)
+
+  def dump(self, fileName, detector=None, needle=None):
+    """
+    Write the buffered records (of a detector and/or a needle) to a JSON lines file.
+
+    :return: the number of records written
+    """
+    records = self.select(detector, needle)
+    with open(fileName, 'w') as f:
+      for record in records:
+        f.write(json.dumps(record, sort_keys=True, default=jsonValue) + '\n')
+    return len(records)
@@ -0,0 +1,176 @@
+"""
+Incremental distance fields of the needles for the radiation isosurfaces.
+
+The former isosurfaces ran vtkImplicitModeller on the appended tubes of all visible needles at 60^3 samples,
+for every change of the visible needles. Here each needle has its own signed distance grid [mm] to its tube
+(distance to the centerline minus the radius, negative inside), sampled on a block of a lattice shared by all
+needles: the block covers the needle and the largest isovalue around it. The field of the visible needles is
+the minimum of their blocks, clamped one lattice spacing beyond the largest isovalue (so that the contour of the
+largest isovalue is interpolated between true distances); only the needles whose centerline changed are sampled
+again.
+"""
+
+import threading
+import numpy
+
+__all__ = ['Lattice', 'polylineDistance', 'needleDistanceField', 'DistanceFieldCompositor']
+
+
+class Lattice(object):
+  """
+  Regular grid [RAS] of the isosurfaces: origin (center of voxel 0), isotropic spacing [mm], dims (i along R, j along A,
+  k along S).
+  """
+
+  def __init__(self, origin, spacing, dims):
+    self.origin = numpy.array(origin, dtype=numpy.float64)
+    self.spacing = float(spacing)
+    self.dims = tuple(int(n) for n in dims)
+
+  @classmethod
+  def fromBounds(cls, low, high, spacing, margin):
+    """
+    Lattice of the box low-high [RAS] extended by margin [mm].
+    """
+    low = numpy.asarray(low, dtype=numpy.float64) - margin
+    high = numpy.asarray(high, dtype=numpy.float64) + margin
+    dims = numpy.floor((high - low) / spacing).astype(int) + 2
+    return cls(low, spacing, dims)
+
+  def contains(self, low, high):
+    upper = self.origin + self.spacing * (numpy.array(self.dims) - 1)
+    return bool((numpy.asarray(low) >= self.origin).all() and (numpy.asarray(high) <= upper).all())
+
+  def block(self, low, high):
+    """
+    Index slices of the lattice voxels covering the box low-high [RAS].
+    """
+    lower = numpy.floor((numpy.asarray(low) - self.origin) / self.spacing).astype(int)
+    upper = numpy.ceil((numpy.asarray(high) - self.origin) / self.spacing).astype(int) + 1
+    lower = numpy.clip(lower, 0, self.dims)
+    upper = numpy.clip(upper, 0, self.dims)
+    return tuple(slice(l, max(l, u)) for l, u in zip(lower, upper))
+
+  def points(self, block):
+    """
+    RAS coordinates of the voxels of a block, array of the block shape x 3.
+    """
+    axes = [self.origin[d] + self.spacing * numpy.arange(block[d].start, block[d].stop) for d in range(3)]
+    return numpy.concatenate([x[..., None] for x in numpy.meshgrid(*axes, indexing='ij')], axis=-1)
+
+
+def polylineDistance(points, polyline, chunk=65536):
+  """
+  Distance of each point (N x 3) to the polyline (M x 3) [mm].
+  """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  polyline = numpy.asarray(polyline, dtype=numpy.float64).reshape(-1, 3)
+  if len(polyline) == 1:
+    return numpy.sqrt(((points - polyline[0]) ** 2).sum(axis=1))
+  A = polyline[:-1]
+  AB = polyline[1:] - A
+  length2 = (AB ** 2).sum(axis=1)
+  length2[length2 == 0] = 1
+  distance = numpy.empty(len(points))
+  for n in range(0, len(points), chunk):
+    P = points[n:n + chunk]
+    AP = P[:, None, :] - A[None, :, :]
+    t = numpy.clip((AP * AB[None, :, :]).sum(axis=2) / length2, 0, 1)
+    d2 = ((AP - t[:, :, None] * AB[None, :, :]) ** 2).sum(axis=2)
+    distance[n:n + chunk] = numpy.sqrt(d2.min(axis=1))
+  return distance
+
+
+def needleDistanceField(centerline, radius, lattice, maxDistance):
+  """
+  Signed distance [mm] to the tube of a needle on the block of the lattice within maxDistance + one lattice spacing
+  of the tube.
+
+  :return: block (index slices) and float32 array of the block shape, clamped at maxDistance + lattice.spacing
+  """
+  centerline = numpy.asarray(centerline, dtype=numpy.float64).reshape(-1, 3)
+  clamp = maxDistance + lattice.spacing
+  reach = radius + clamp
+  block = lattice.block(centerline.min(axis=0) - reach, centerline.max(axis=0) + reach)
+  shape = tuple(s.stop - s.start for s in block)
+  if not all(shape):
+    return block, numpy.zeros(shape, dtype=numpy.float32)
+  distance = polylineDistance(lattice.points(block).reshape(-1, 3), centerline) - radius
+  return block, numpy.minimum(distance, clamp).astype(numpy.float32).reshape(shape)
+
+
+class DistanceFieldCompositor(object):
+  """
+  Distance field of a set of needles on a shared lattice, updated incrementally, cf. module doc.
+  """
+
+  def __init__(self, spacing=1.5, maxDistance=10.):
+    """
+    :param spacing: voxel size of the lattice [mm]
+    :param maxDistance: largest distance of interest [mm] (the largest isovalue), the field is clamped one
+                        spacing beyond it
+    """
+    self.spacing = float(spacing)
+    self.maxDistance = float(maxDistance)
+    self.lattice = None
+    self.fields = {} # key -> (version, block, array)
+    self.field = None
+    self.composited = None # keys of the needles in field
+    self.computed = 0 # number of needle fields sampled, for the log
+    self.lock = threading.Lock()
+
+  def configure(self, spacing, maxDistance):
+    """
+    Change the resolution or the largest distance; the needle fields are sampled again at the next update.
+    """
+    if float(spacing) != self.spacing or float(maxDistance) != self.maxDistance:
+      with self.lock:
+        self.spacing, self.maxDistance = float(spacing), float(maxDistance)
+        self.lattice = None
+        self.fields.clear()
+        self.field = None
+
+  def update(self, needles, visible):
+    """
+    Field of the visible needles.
+
+    :param needles: dict key -> (version, centerline [RAS], radius) of all the needles of the scene (the lattice covers
+                    all of them, so that showing or hiding a needle doesn't change it); version changes when the
+                    centerline does, e.g. the modification time of the polydata
+    :param visible: keys of the needles of the field
+    :return: Lattice and float32 array of its dims (Fortran order, updated in place while the lattice is the same),
+             None if there is no needle
+    """
+    with self.lock:
+      if not needles:
+        return None, None
+      low = numpy.min([numpy.min(c, axis=0) - r for v, c, r in needles.values()], axis=0)
+      high = numpy.max([numpy.max(c, axis=0) + r for v, c, r in needles.values()], axis=0)
+      margin = self.maxDistance + self.spacing
+      if self.lattice is None or not self.lattice.contains(low - margin + self.spacing, high + margin - self.spacing):
+        self.lattice = Lattice.fromBounds(low, high, self.spacing, margin)
+        self.fields.clear()
+        self.field = None
+      for key in list(self.fields):
+        if key not in needles:
+          del self.fields[key]
+      changed = False
+      for key in visible:
+        version, centerline, radius = needles[key]
+        entry = self.fields.get(key)
+        if entry is None or entry[0] != version:
+          block, array = needleDistanceField(centerline, radius, self.lattice, self.maxDistance)
+          self.fields[key] = (version, block, array)
+          self.computed += 1
+          changed = True
+      visible = frozenset(visible)
+      if self.field is None or changed or visible != self.composited:
+        if self.field is None:
+          # i fastest, as the scalars of a vtkImageData, so that they can share this array
+          self.field = numpy.empty(self.lattice.dims, dtype=numpy.float32, order='F')
+        self.field.fill(self.maxDistance + self.spacing)
+        for key in visible:
+          version, block, array = self.fields[key]
+          numpy.minimum(self.field[block], array, out=self.field[block])
+        self.composited = visible
+      return self.lattice, self.field
@@ -0,0 +1,188 @@
+"""
+Vectorized evaluation of needle segmentations.
+
+The module evaluated each matched pair of needles by clipping both tubes, building two vtkCellLocators and
+probing every tenth tube point in Python. Here the needles are compared by their centerlines: the points of
+one centerline, resampled every step mm, against the segments of the other (exact point to segment
+distances), for all the pairs at once on padded arrays. Each pair gets the directed and symmetric Hausdorff
+distances, the tip error and the mean error.
+
+Truncation, as the needles are not segmented over the same axial range:
+  'slice'  as the former module evaluation: the other needle is cut at the higher of both bases and the points
+           whose closest point is more than sliceTolerance mm away axially (beyond the other needle) don't count
+  'range'  both needles are cut to their common axial (S) range (cf. Benchmark)
+  None     the whole centerlines
+"""
+
+import numpy
+
+__all__ = ['EVALUATION_DTYPE', 'clipAxial', 'resample', 'closestPoints', 'evaluateNeedles', 'hausdorffDistance']
+
+EVALUATION_DTYPE = numpy.dtype([('index1', 'i4'), ('index2', 'i4'), ('valid', '?'), ('hausdorff', 'f8'),
+                                ('hausdorff12', 'f8'), ('hausdorff21', 'f8'), ('tipError', 'f8'),
+                                ('meanError', 'f8')])
+
+
+def resample(points, step):
+  """
+  Points every step mm along the polyline (and its last point).
+  """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  lengths = numpy.sqrt((numpy.diff(points, axis=0) ** 2).sum(axis=1))
+  s = numpy.concatenate([[0], numpy.cumsum(lengths)])
+  if s[-1] == 0:
+    return points[:1]
+  t = numpy.append(numpy.arange(0, s[-1], step), s[-1])
+  return numpy.column_stack([numpy.interp(t, s, points[:, d]) for d in range(3)])
+
+
+def clipAxial(polyline, low=None, high=None):
+  """
+  Part of the polyline with low <= S <= high, cut by linear interpolation; empty if none.
+  """
+  P = numpy.asarray(polyline, dtype=numpy.float64).reshape(-1, 3)
+  for bound, keep in ((low, lambda z: z >= low), (high, lambda z: z <= high)):
+    if bound is None or not len(P):
+      continue
+    inside = keep(P[:, 2])
+    if inside.all():
+      continue
+    clipped = []
+    for n in range(len(P)):
+      if inside[n]:
+        clipped.append(P[n])
+      if n + 1 < len(P) and inside[n] != inside[n + 1]:
+        A, B = P[n], P[n + 1]
+        clipped.append(A + (bound - A[2]) / (B[2] - A[2]) * (B - A))
+    P = numpy.array(clipped).reshape(-1, 3)
+  return P
+
+
+def closestPoints(points, polylines, chunk=1 << 20):
+  """
+  Closest points of padded point sets on padded polylines, for many pairs at once.
+
+  :param points: K x N x 3
+  :param polylines: K x M x 3 (M >= 2, pad by repeating the last point)
+  :return: distances K x N and closest points K x N x 3
+  """
+  A = polylines[:, :-1]
+  AB = polylines[:, 1:] - A
+  length2 = (AB ** 2).sum(axis=2)
+  length2[length2 == 0] = 1
+  K, N = points.shape[:2]
+  distances = numpy.empty((K, N))
+  closest = numpy.empty((K, N, 3))
+  pairs = max(1, chunk // max(1, N * A.shape[1]))
+  for k in range(0, K, pairs):
+    sl = slice(k, k + pairs)
+    AP = points[sl, :, None, :] - A[sl, None, :, :]
+    t = numpy.clip((AP * AB[sl, None, :, :]).sum(axis=3) / length2[sl, None, :], 0, 1)
+    C = A[sl, None, :, :] + t[..., None] * AB[sl, None, :, :]
+    d2 = ((points[sl, :, None, :] - C) ** 2).sum(axis=3)
+    best = d2.argmin(axis=2)
+    rows, columns = numpy.ix_(numpy.arange(C.shape[0]), numpy.arange(N))
+    distances[sl] = numpy.sqrt(d2[rows, columns, best])
+    closest[sl] = C[rows, columns, best]
+  return distances, closest
+
+
+def pad(arrays, length):
+  """
+  K x length x 3 array of the point arrays, padded by repeating their last point, and the K x length mask of the
+  actual points.
+  """
+  padded = numpy.empty((len(arrays), length, 3))
+  mask = numpy.zeros((len(arrays), length), dtype=bool)
+  for k, P in enumerate(arrays):
+    padded[k, :len(P)] = P
+    padded[k, len(P):] = P[-1]
+    mask[k, :len(P)] = True
+  return padded, mask
+
+
+def tipOf(P):
+  return P[0] if P[0][2] >= P[-1][2] else P[-1]
+
+
+def evaluateNeedles(centerlines1, centerlines2, pairs=None, step=0.5, truncate='slice', sliceTolerance=1.):
+  """
+  Hausdorff distances, tip and mean errors of pairs of needles.
+
+  :param centerlines1, centerlines2: lists of centerlines [RAS] (N x 3 arrays), e.g. segmented and reference needles
+  :param pairs: list of (index1, index2), the pairs (n, n) if None
+  :param step: resampling of the probed points [mm]
+  :param truncate: 'slice', 'range' or None, cf. module doc
+  :param sliceTolerance: axial tolerance of 'slice' [mm]
+  :return: structured array of EVALUATION_DTYPE, one record per pair; valid is False (and the distances NaN) when the
+           needles have no axial range in common
+  """
+  if pairs is None:
+    pairs = [(n, n) for n in range(min(len(centerlines1), len(centerlines2)))]
+  result = numpy.zeros(len(pairs), dtype=EVALUATION_DTYPE)
+  for field in ('hausdorff', 'hausdorff12', 'hausdorff21', 'tipError', 'meanError'):
+    result[field] = numpy.nan
+  if not len(pairs):
+    return result
+  result['index1'] = [i for i, j in pairs]
+  result['index2'] = [j for i, j in pairs]
+
+  # both directions of every pair in one batch: probes of one needle against the segments of the other
+  probes, targets, valid = [], [], []
+  for i, j in pairs:
+    C1 = numpy.asarray(centerlines1[i], dtype=numpy.float64).reshape(-1, 3)
+    C2 = numpy.asarray(centerlines2[j], dtype=numpy.float64).reshape(-1, 3)
+    if not len(C1) or not len(C2):
+      valid.append(False)
+      probes += [numpy.zeros((1, 3))] * 2
+      targets += [numpy.zeros((2, 3))] * 2
+      continue
+    low = max(C1[:, 2].min(), C2[:, 2].min())
+    high = min(C1[:, 2].max(), C2[:, 2].max())
+    if truncate == 'range':
+      C1, C2 = clipAxial(C1, low, high), clipAxial(C2, low, high)
+      T1, T2 = C1, C2
+    elif truncate == 'slice':
+      T1, T2 = clipAxial(C1, low), clipAxial(C2, low)
+    else:
+      T1, T2 = C1, C2
+    ok = low <= high and len(C1) > 0 and len(C2) > 0 and len(T1) > 0 and len(T2) > 0
+    valid.append(ok)
+    if not ok:
+      C1 = C2 = T1 = T2 = numpy.zeros((1, 3))
+    probes += [resample(C1, step), resample(C2, step)]
+    targets += [T2 if len(T2) > 1 else numpy.repeat(T2, 2, axis=0), T1 if len(T1) > 1 else numpy.repeat(T1, 2, axis=0)]
+  P, mask = pad(probes, max(len(p) for p in probes))
+  T, _ = pad(targets, max(len(t) for t in targets))
+  distances, closest = closestPoints(P, T)
+  if truncate == 'slice':
+    mask &= numpy.abs(closest[..., 2] - P[..., 2]) <= sliceTolerance
+  counted = numpy.where(mask, distances, 0)
+  n = mask.sum(axis=1)
+  directed = counted.max(axis=1)
+  mean = counted.sum(axis=1) / numpy.maximum(n, 1)
+
+  valid = numpy.array(valid)
+  result['valid'] = valid & (n[0::2] > 0) & (n[1::2] > 0)
+  ok = result['valid']
+  result['hausdorff12'][ok] = directed[0::2][ok]
+  result['hausdorff21'][ok] = directed[1::2][ok]
+  result['hausdorff'][ok] = numpy.maximum(directed[0::2], directed[1::2])[ok]
+  result['meanError'][ok] = ((mean[0::2] * n[0::2] + mean[1::2] * n[1::2]) / numpy.maximum(n[0::2] + n[1::2], 1))[ok]
+  for k, (i, j) in enumerate(pairs):
+    if ok[k]:
+      result['tipError'][k] = numpy.linalg.norm(tipOf(numpy.asarray(centerlines1[i], dtype=numpy.float64).reshape(-1, 3)) -
+                                                tipOf(numpy.asarray(centerlines2[j], dtype=numpy.float64).reshape(-1, 3)))
+  return result
+
+
+def hausdorffDistance(curve1, curve2, step=0.25, truncate=True):
+  """
+  Hausdorff distance [mm] of two polylines [RAS], probed every step mm.
+  With truncate both are cut to their common axial (S) range, as the module truncates the needles
+  to start and end at the same slices.
+
+  :return: distance, None if the curves have no axial range in common
+  """
+  r = evaluateNeedles([curve1], [curve2], step=step, truncate='range' if truncate else None)[0]
+  return float(r['hausdorff']) if r['valid'] else None
@@ -0,0 +1,184 @@
+"""
+Precomputed needle likelihood features.
+
+With the gradient option the detectors score every line sample with
+8*center - mean(g1..g8)*gradientPonderation, g1..g8 being the ring of voxels at the needle
+radius around the sample in the axial plane. The same voxels are scored again and again by
+overlapping cones, neighbouring needles and feedback passes, so the centre term and the
+ring-mean term are computed once per (volume, needle radius) as float32 volumes with
+shifted sums (i.e. a convolution with the sparse ring kernel) and kept in a small LRU cache.
+The ponderation is only applied at lookup time, so changing it does not invalidate anything.
+
+For integer images (CT/MR scalars) the float32 terms are exact and the scores are the same
+as with the per-sample evaluation.
+"""
+
+import collections
+import threading
+import numpy
+
+from Tracing import tracer
+
+__all__ = ['shiftedSum', 'NeedleFeatures', 'FeatureCache']
+
+# number of axial slices processed at once, bounds the float64 scratch memory
+SLAB = 16
+
+
+def shiftedSum(array, offsets, out=None):
+  """
+  Sum of the in-plane translates array[i+di, j+dj, k] for (di, dj) in offsets, zero padded
+  like vtkImageData.GetScalarComponentAsDouble out of the extent.
+
+  :param array: [i, j, k] volume
+  :param offsets: list of (di, dj) integer offsets
+  :param out: optional float32 output of the same shape
+  :return: float32 volume (summation done in float64, in the order of the offsets)
+  """
+  dims = array.shape
+  if out is None:
+    out = numpy.empty(dims, dtype=numpy.float32)
+  for k0 in range(0, dims[2], SLAB):
+    k1 = min(k0 + SLAB, dims[2])
+    acc = numpy.zeros((dims[0], dims[1], k1 - k0), dtype=numpy.float64)
+    for di, dj in offsets:
+      # destination and source windows of the translate, empty if the offset exceeds the volume
+      di0, di1 = max(0, -di), min(dims[0], dims[0] - di)
+      dj0, dj1 = max(0, -dj), min(dims[1], dims[1] - dj)
+      if di0 >= di1 or dj0 >= dj1:
+        continue
+      acc[di0:di1, dj0:dj1] += array[di0 + di:di1 + di, dj0 + dj:dj1 + dj, k0:k1]
+    out[:, :, k0:k1] = acc
+  return out
+
+
+class NeedleFeatures(object):
+  """
+  Feature volumes of one image for one needle radius (in voxels).
+  Every term is computed on first use only.
+
+  center        - the voxel value (float32)
+  ringMean      - mean of the 8 ring voxels g1..g8 at radiusNeedle / radiusNeedleCorner
+  ringAxialMean - mean of the 4 axis-aligned ring voxels g1..g4 (square mode)
+  box           - sum of the 3x3 in-plane neighbourhood (center of needleDetectionThreadCurrentDev)
+  """
+
+  def __init__(self, volume, radiusNeedle, radiusNeedleCorner):
+    """
+    :param volume: VolumeAccessor of the image
+    """
+    self.volume = volume
+    self.radiusNeedle = int(radiusNeedle)
+    self.radiusNeedleCorner = int(radiusNeedleCorner)
+    self._center = None
+    self._ringMean = None
+    self._ringAxialMean = None
+    self._box = None
+    self._lock = threading.Lock()
+
+  def axialRing(self):
+    r = self.radiusNeedle
+    return [(r, 0), (-r, 0), (0, r), (0, -r)]
+
+  def cornerRing(self):
+    rc = self.radiusNeedleCorner
+    return [(rc, rc), (-rc, -rc), (-rc, rc), (rc, -rc)]
+
+  def _term(self, name, compute):
+    """
+    Cached term, computed once even if several detection threads ask for it at the same time.
+    """
+    term = getattr(self, name)
+    if term is None:
+      with self._lock:
+        term = getattr(self, name)
+        if term is None:
+          with tracer.span('feature volume', term=name[1:], radius=self.radiusNeedle):
+            term = compute()
+          setattr(self, name, term)
+    return term
+
+  @property
+  def center(self):
+    return self._term('_center', lambda: self.volume.array.astype(numpy.float32))
+
+  @property
+  def ringMean(self):
+    def compute():
+      ring = shiftedSum(self.volume.array, self.axialRing() + self.cornerRing())
+      ring /= 8
+      return ring
+    return self._term('_ringMean', compute)
+
+  @property
+  def ringAxialMean(self):
+    def compute():
+      ring = shiftedSum(self.volume.array, self.axialRing())
+      ring /= 4
+      return ring
+    return self._term('_ringAxialMean', compute)
+
+  @property
+  def box(self):
+    def compute():
+      # separable 3x3 box: sum along i, then along j
+      rows = shiftedSum(self.volume.array, [(0, 0), (1, 0), (-1, 0)])
+      return shiftedSum(rows, [(0, 0), (0, 1), (0, -1)])
+    return self._term('_box', compute)
+
+  def nbytes(self):
+    """
+    Memory held by the terms computed so far.
+    """
+    return sum(a.nbytes for a in (self._center, self._ringMean, self._ringAxialMean, self._box) if a is not None)
+
+  def gradientTerm(self, i, j, k, gradientPonderation):
+    """
+    8*center - mean(g1..g8)*gradientPonderation at integer index (i, j, k).
+    """
+    if self.volume.inside(i, j, k):
+      return 8 * float(self.center[i, j, k]) - float(self.ringMean[i, j, k]) * gradientPonderation
+    # outside of the extent the ring may still touch the image
+    g = 0.0
+    for di, dj in self.axialRing() + self.cornerRing():
+      g += self.volume.value(i + di, j + dj, k)
+    return - (g / 8) * gradientPonderation
+
+  def gradientTerms(self, i, j, k, gradientPonderation):
+    """
+    Vectorized gradientTerm for index arrays inside of the extent.
+    """
+    center = self.center[i, j, k].astype(numpy.float64)
+    return 8 * center - self.ringMean[i, j, k].astype(numpy.float64) * gradientPonderation
+
+
+class FeatureCache(object):
+  """
+  LRU cache of NeedleFeatures keyed by (volume, radiusNeedle, radiusNeedleCorner).
+  A VolumeAccessor is replaced when its image is modified, so stale entries are never hit
+  and simply age out.
+  """
+
+  def __init__(self, maxEntries=2):
+    self.maxEntries = maxEntries
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, volume, radiusNeedle, radiusNeedleCorner):
+    """
+    Features of volume for the given radii, computed if not cached.
+    """
+    # the entry keeps the accessor alive, so its id cannot be reused while cached
+    key = (id(volume), int(radiusNeedle), int(radiusNeedleCorner))
+    with self.lock:
+      features = self.entries.pop(key, None)
+      if features is None:
+        features = NeedleFeatures(volume, radiusNeedle, radiusNeedleCorner)
+        while len(self.entries) >= self.maxEntries:
+          self.entries.popitem(last=False)
+      self.entries[key] = features
+    return features
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
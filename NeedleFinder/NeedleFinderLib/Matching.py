@@ -0,0 +1,96 @@
+"""
+Optimal matching of segmented needles to reference needles.
+
+The module matched each segmented needle to the reference needle of the closest tip, one pair at a time, so
+that two segmented needles could claim the same reference needle. Here the cost matrix of all the pairs is
+built at once from the tip (and optionally base) coordinates and the assignment minimizing the total cost
+is solved with the Hungarian algorithm (shortest augmenting paths with potentials, O(n^3)). Pairs costlier
+than a threshold are left unmatched.
+"""
+
+import numpy
+
+__all__ = ['linearAssignment', 'matchNeedles']
+
+
+def linearAssignment(cost):
+  """
+  Minimum cost assignment of the rows to the columns of a rectangular cost matrix.
+
+  :return: row and column indices of the min(rows, columns) assigned pairs, rows increasing
+  """
+  cost = numpy.asarray(cost, dtype=numpy.float64)
+  transposed = cost.shape[0] > cost.shape[1]
+  if transposed:
+    cost = cost.T
+  n, m = cost.shape
+  if not n:
+    return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+  # 1-based potentials u (rows), v (columns) and column assignment p, column 0 is virtual
+  u = numpy.zeros(n + 1)
+  v = numpy.zeros(m + 1)
+  p = numpy.zeros(m + 1, dtype=int)
+  way = numpy.zeros(m + 1, dtype=int)
+  for i in range(1, n + 1):
+    p[0] = i
+    j0 = 0
+    minv = numpy.full(m + 1, numpy.inf)
+    used = numpy.zeros(m + 1, dtype=bool)
+    while True:
+      used[j0] = True
+      i0 = p[j0]
+      free = ~used[1:]
+      reduced = cost[i0 - 1] - u[i0] - v[1:]
+      better = free & (reduced < minv[1:])
+      minv[1:][better] = reduced[better]
+      way[1:][better] = j0
+      candidates = numpy.where(free, minv[1:], numpy.inf)
+      j1 = int(candidates.argmin()) + 1
+      delta = candidates[j1 - 1]
+      u[p[used]] += delta
+      v[used] -= delta
+      minv[1:][free] -= delta
+      j0 = j1
+      if p[j0] == 0:
+        break
+    while j0:
+      j1 = way[j0]
+      p[j0] = p[j1]
+      j0 = j1
+  columns = numpy.nonzero(p[1:])[0]
+  rows = p[1:][columns] - 1
+  if transposed:
+    rows, columns = columns, rows
+  order = numpy.argsort(rows)
+  return rows[order], columns[order]
+
+
+def matchNeedles(tips1, tips2, bases1=None, bases2=None, baseWeight=0., maxDistance=None):
+  """
+  Optimal one to one matching of needles 1 (e.g. segmented) to needles 2 (e.g. reference).
+
+  :param tips1, tips2: N1 x 3 and N2 x 3 tip coordinates [RAS]
+  :param bases1, bases2: base coordinates, used if baseWeight > 0
+  :param baseWeight: weight of the base distance in the cost (tip distance + baseWeight * base distance)
+  :param maxDistance: pairs of a larger cost are not matched (no threshold if None)
+  :return: list of (index1, index2, tip distance), index1 increasing; at most one pair per needle
+  """
+  tips1 = numpy.asarray(tips1, dtype=numpy.float64).reshape(-1, 3)
+  tips2 = numpy.asarray(tips2, dtype=numpy.float64).reshape(-1, 3)
+  if not len(tips1) or not len(tips2):
+    return []
+  tipDistance = numpy.sqrt(((tips1[:, None, :] - tips2[None, :, :]) ** 2).sum(axis=2))
+  cost = tipDistance.copy()
+  if baseWeight and bases1 is not None and bases2 is not None:
+    bases1 = numpy.asarray(bases1, dtype=numpy.float64).reshape(-1, 3)
+    bases2 = numpy.asarray(bases2, dtype=numpy.float64).reshape(-1, 3)
+    cost += baseWeight * numpy.sqrt(((bases1[:, None, :] - bases2[None, :, :]) ** 2).sum(axis=2))
+  if maxDistance is not None:
+    # over the threshold a pair costs more than any assignment within it, so that it is chosen last
+    cost = numpy.where(cost > maxDistance, maxDistance * (1 + cost.size) + cost, cost)
+  rows, columns = linearAssignment(cost)
+  matches = []
+  for i, j in zip(rows, columns):
+    if maxDistance is None or cost[i, j] <= maxDistance:
+      matches.append((int(i), int(j), float(tipDistance[i, j])))
+  return matches
@@ -0,0 +1,181 @@
+"""
+Needle mechanics model of the 15_1 detector.
+
+The model tables give, for a cantilever needle segment of a given arc length bent by a given
+force, its deflection and the angle of its end segment:
+  matArcLen_mm[a][f]        arc length of row a [mm]
+  matYDefl_mm[a][f]         deflection [mm]
+  matFs_mN[a][f]            force [mN]
+  matEndSegAngles_rad[a][f] end segment angle [rad]
+with one row per arc length and one column per force.
+
+They used to be execfile'd from matFs_mN.py etc. on every needle. NeedleModel loads them once per
+process (from Config/needleModel.npz, or from the .py tables if the archive is missing), checks them,
+and looks up force and end segment angle from (arc length, deflection) for arrays of queries,
+either interpolated or with the nearest-neighbour lookup of the former code.
+"""
+
+import ast
+import bisect
+import os
+import threading
+import numpy
+
+__all__ = ['NeedleModel']
+
+TABLES = ['matArcLen_mm', 'matYDefl_mm', 'matFs_mN', 'matEndSegAngles_rad']
+
+
+def findNearest(t, x):
+  """
+  Index of the table entry of t matching x, as find_nearest of needleDetectionThread15_1
+  (first entry >= x unless it exceeds x by more than 0.5, which gives -1 below the first entry).
+  """
+  i = bisect.bisect_left(t, x)
+  if i == len(t): i -= 1
+  if t[i] - x > 0.5:
+    i -= 1
+  return i
+
+
+class NeedleModel(object):
+  """
+  Force and end segment angle of the needle as a function of arc length and deflection.
+  """
+
+  _cache = {}
+  _lock = threading.Lock()
+
+  def __init__(self, arcLength, deflection, force, endSegmentAngle):
+    """
+    :param arcLength, deflection, force, endSegmentAngle: tables (arc lengths x forces), cf. module doc
+    """
+    tables = [numpy.array(t, dtype=numpy.float64) for t in (arcLength, deflection, force, endSegmentAngle)]
+    self.validate(*tables)
+    self.arcLengthTable, self.deflection, self.force, self.endSegmentAngle = tables
+    self.arcLength = self.arcLengthTable[:, 0].copy() # one arc length per row
+
+  @staticmethod
+  def validate(arcLength, deflection, force, endSegmentAngle):
+    """
+    Raise ValueError if the tables can't be a needle model.
+    """
+    shape = arcLength.shape
+    if len(shape) != 2 or shape[0] < 2 or shape[1] < 2:
+      raise ValueError("needle model tables must be 2D with at least 2 arc lengths and 2 forces, got %s" % (shape,))
+    for name, t in zip(TABLES, (arcLength, deflection, force, endSegmentAngle)):
+      if t.shape != shape:
+        raise ValueError("needle model table %s has shape %s instead of %s" % (name, t.shape, shape))
+      if not numpy.isfinite(t).all():
+        raise ValueError("needle model table %s has non finite values" % name)
+    if (arcLength != arcLength[:, :1]).any() or (numpy.diff(arcLength[:, 0]) <= 0).any():
+      raise ValueError("needle model arc lengths must be constant per row and increasing")
+    if (numpy.diff(deflection, axis=1) < 0).any():
+      raise ValueError("needle model deflections must not decrease with the force")
+
+  @classmethod
+  def fromTables(cls, directory):
+    """
+    Read the matArcLen_mm.py, matYDefl_mm.py, matFs_mN.py and matEndSegAngles_rad.py tables (literals only,
+    nothing is executed).
+    """
+    tables = []
+    for name in TABLES:
+      with open(os.path.join(directory, name + '.py')) as f:
+        source = f.read()
+      tables.append(ast.literal_eval(source[source.index('[') : source.rindex(']') + 1]))
+    return cls(*tables)
+
+  @classmethod
+  def fromFile(cls, fileName):
+    """
+    Read a model saved with save().
+    """
+    archive = numpy.load(fileName)
+    try:
+      return cls(*[archive[name] for name in TABLES])
+    finally:
+      archive.close()
+
+  def save(self, fileName):
+    numpy.savez(fileName, matArcLen_mm=self.arcLengthTable, matYDefl_mm=self.deflection,
+                matFs_mN=self.force, matEndSegAngles_rad=self.endSegmentAngle)
+
+  @classmethod
+  def load(cls, moduleDir):
+    """
+    The model of the module directory, read once per process: Config/needleModel.npz if present,
+    the .py tables otherwise.
+    """
+    moduleDir = os.path.abspath(moduleDir)
+    with cls._lock:
+      model = cls._cache.get(moduleDir)
+      if model is None:
+        fileName = os.path.join(moduleDir, 'Config', 'needleModel.npz')
+        if os.path.isfile(fileName):
+          model = cls.fromFile(fileName)
+        else:
+          model = cls.fromTables(moduleDir)
+        cls._cache[moduleDir] = model
+    return model
+
+  def nearest(self, arcLength, deflection):
+    """
+    Force [mN] and end segment angle [rad] of the table entry closest to (arc length, deflection), with the
+    lookup of the former initNeedleModel (scalars).
+    """
+    a = findNearest(self.arcLength.tolist(), arcLength)
+    f = findNearest(self.deflection[a].tolist(), deflection)
+    return float(self.force[a, f]), float(self.endSegmentAngle[a, f])
+
+  def interpolate(self, arcLength, deflection):
+    """
+    Force [mN] and end segment angle [rad] at (arc length, deflection), bilinear in the table:
+    linear in deflection within the two rows around the arc length, then linear between the rows.
+    Queries outside of the table are clamped to its border. At the entries of the table it gives the values of
+    nearest, also on rows with repeated deflections such as the zero arc length row.
+
+    :param arcLength, deflection: scalars or arrays of the same shape
+    :return: force, endSegmentAngle (floats for scalar queries, arrays otherwise)
+    """
+    scalar = numpy.ndim(arcLength) == 0 and numpy.ndim(deflection) == 0
+    arcLength, deflection = numpy.broadcast_arrays(numpy.asarray(arcLength, dtype=numpy.float64),
+                                                   numpy.asarray(deflection, dtype=numpy.float64))
+    shape = arcLength.shape
+    a = arcLength.ravel()
+    d = deflection.ravel()
+    nA = len(self.arcLength)
+    a = numpy.clip(a, self.arcLength[0], self.arcLength[-1])
+    row0 = numpy.clip(numpy.searchsorted(self.arcLength, a, side='right') - 1, 0, nA - 2)
+    wA = (a - self.arcLength[row0]) / (self.arcLength[row0 + 1] - self.arcLength[row0])
+    force = numpy.zeros(len(a))
+    angle = numpy.zeros(len(a))
+    for row, w in ((row0, 1 - wA), (row0 + 1, wA)):
+      f, e = self._interpolateRows(row, d)
+      force += w * f
+      angle += w * e
+    if scalar:
+      return float(force[0]), float(angle[0])
+    return force.reshape(shape), angle.reshape(shape)
+
+  def _interpolateRows(self, rows, d):
+    """
+    Force and angle by linear interpolation in deflection along the given rows.
+    """
+    deflection = self.deflection[rows]
+    nF = deflection.shape[1]
+    # interval ending at the first column whose deflection is >= d (rows are non-decreasing), so that a
+    # deflection of the table gets the force of its first column, as the nearest lookup (bisect_left)
+    col0 = numpy.clip((deflection < d[:, None]).sum(axis=1) - 1, 0, nF - 2)
+    n = numpy.arange(len(rows))
+    d0 = deflection[n, col0]
+    d1 = deflection[n, col0 + 1]
+    span = d1 - d0
+    # flat intervals are only left at the clamped ends of a row (e.g. the zero arc length row): the first column
+    # up to its deflection, the last one above
+    flat = span <= 0
+    w = numpy.where(flat, numpy.where(d <= d0, 0.0, 1.0),
+                    (numpy.clip(d, d0, d1) - d0) / numpy.where(flat, 1.0, span))
+    force = (1 - w) * self.force[rows, col0] + w * self.force[rows, col0 + 1]
+    angle = (1 - w) * self.endSegmentAngle[rows, col0] + w * self.endSegmentAngle[rows, col0 + 1]
+    return force, angle
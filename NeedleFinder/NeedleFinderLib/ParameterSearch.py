@@ -0,0 +1,592 @@
+"""
+Headless parameter search.
+
+parSearch mode 2 of the module tries random detection parameters on each case serially in the GUI, clearing and
+loading the scene of the case for every configuration and saving it to an .mrb. Here the cases are case bundles
+(cf. Cases; parSearch mode 3 of the module converts its scenes), NeedlePhantom archives (cf. NeedlePhantom.save)
+or synthetic phantoms ('phantom:SEED'), and the (case, configuration) jobs are distributed over a process pool.
+Each worker process loads a case once and keeps it, with the feature volumes of its detectors, for the following
+jobs of the case; the jobs are ordered by case so that a worker mostly stays on one.
+
+The needles of a case are tracked from the tips of its reference centerlines and evaluated against them (cf.
+Evaluation). Every completed job is appended to a JSON lines store as soon as it is done, keyed by a job id made
+of the case (and the phantom options of a synthetic one), a hash of the parameters that are not searched and the
+searched values, so that an interrupted search resumes with the jobs missing from the store, and a store of another
+setup doesn't pass for done. Searched values without effect with the other parameters (e.g. exponent outside of
+version 0, cf. DetectionParameters.inert) are left out of the configurations, which are run once per effective
+values. The throughput is logged in configurations (jobs) per minute.
+
+Most random configurations are clearly bad after a few needles. successiveHalving() evaluates its configurations
+on a small random sample of the needles of all the cases first, keeps the best 1/eta of them (lowest mean
+Hausdorff distance) and evaluates those on eta times more needles, until the survivors are evaluated on all the
+needles; the samples are nested, so a promoted configuration is only run on the needles it misses. hyperband()
+runs several such brackets, from many configurations on few needles to few configurations on all the needles,
+so that the result doesn't depend on a good choice of the first sample size. The jobs of these searches are
+(case, configuration, needles) and go to the same store.
+
+Run it outside of Slicer from the module directory:
+  python NeedleFinderLib/ParameterSearch.py -o search.jsonl --cases case-24 case-28 --configurations 1000
+  python NeedleFinderLib/ParameterSearch.py -o search.jsonl --cases case-24 case-28 --strategy hyperband
+"""
+
+import ast
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import time
+import numpy
+
+from Detector import DetectionParameters, NeedleDetector
+from DetectionROI import ROIDetector
+from FeatureVolumes import FeatureCache
+from Curves import BezierCurve
+from Evaluation import evaluateNeedles
+from Results import RunningSummary
+from Phantom import NeedlePhantom
+from Cases import CaseBundle, isCaseBundle
+
+__all__ = ['SEARCH_SPACE', 'randomConfigurations', 'effectiveValues', 'jobId', 'loadCase', 'countNeedles',
+           'SearchStore', 'SearchWorker', 'JobRunner', 'runSearch', 'successiveHalving', 'hyperband', 'summarizeSearch']
+
+# parameter, low, high (exclusive): the ranges of the random search of parSearch mode 2 (exponent only takes effect
+# in version 0, cf. effectiveValues)
+SEARCH_SPACE = [
+  ('radiusNeedleParameter', 1, 6),
+  ('sigmaValue', 1, 40),
+  ('gradientPonderation', 1, 20),
+  ('exponent', 1, 20),
+  ('numberOfPointsPerNeedle', 3, 11),
+]
+
+
+def randomConfigurations(count, space=SEARCH_SPACE, seed=0, parameters=None):
+  """
+  count random parameter sets (dicts), the same for the same seed so that a search can be resumed.
+  With the DetectionParameters of the parameters that are not searched, the sets are reduced to their effective
+  values (cf. effectiveValues) and distinct, fewer than count if the space doesn't have as many.
+  """
+  random = numpy.random.RandomState(seed)
+  draw = lambda: dict((name, int(random.randint(low, high))) for name, low, high in space)
+  if parameters is None:
+    return [draw() for n in range(count)]
+  configurations, keys = [], set()
+  for n in range(100 * count):
+    if len(configurations) == count:
+      break
+    values = effectiveValues(draw(), parameters)
+    key = json.dumps(values, sort_keys=True)
+    if key not in keys:
+      keys.add(key)
+      configurations.append(values)
+  return configurations
+
+
+def effectiveValues(values, parameters=None):
+  """
+  The searched values that take effect with the other parameters (defaults if None), cf. DetectionParameters.inert.
+  """
+  inert = (parameters or DetectionParameters()).copy(**values).inert()
+  return dict((name, value) for name, value in values.items() if name not in inert)
+
+
+def jobId(case, values, needles=None, parameters=None, phantomOptions=None):
+  """
+  Key of a job in the store: the case (its content hash for a case bundle, so that the bundle can be moved, the
+  phantom options for a synthetic phantom), a hash of the effective parameters that are not searched (defaults if
+  None), the sorted parameter values and the needles if not all.
+  """
+  if isCaseBundle(case):
+    case = 'sha1:' + CaseBundle.contentHashOf(case)
+  elif case.startswith('phantom:') and phantomOptions:
+    case += json.dumps(phantomOptions, sort_keys=True)
+  parameters = (parameters or DetectionParameters()).copy(**values)
+  inert = parameters.inert()
+  fixed = dict((name, value) for name, value in parameters.asDict().items() if name not in inert and name not in values)
+  id = '%s|%s|%s' % (case, hashlib.sha1(json.dumps(fixed, sort_keys=True).encode('utf-8')).hexdigest()[:12],
+                     ','.join('%s=%r' % (name, values[name]) for name in sorted(values)))
+  if needles is not None:
+    id += '|needles=' + ','.join(str(n) for n in needles)
+  return id
+
+
+def loadCase(name, phantomOptions=None):
+  """
+  NeedlePhantom of a case: 'phantom:SEED' generates a phantom (with the NeedlePhantom.generate keyword arguments
+  phantomOptions), a directory is a case bundle, any other name a NeedlePhantom archive.
+  """
+  if name.startswith('phantom:'):
+    return NeedlePhantom.generate(seed=int(name.split(':', 1)[1]), **(phantomOptions or {}))
+  if isCaseBundle(name):
+    return CaseBundle(name)
+  return NeedlePhantom.load(name)
+
+
+def countNeedles(name, phantomOptions=None):
+  """
+  Number of needles of a case, without loading its volume.
+  """
+  if name.startswith('phantom:'):
+    return (phantomOptions or {}).get('nNeedles', 8)
+  if isCaseBundle(name):
+    return CaseBundle.needleCount(name)
+  archive = numpy.load(name)
+  try:
+    return len(archive['lengths'])
+  finally:
+    archive.close()
+
+
+class SearchStore(object):
+  """
+  JSON lines file of the job records of a search, appended to and synced after every record.
+  """
+
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.records = self.read(fileName)
+    self.file = open(fileName, 'a')
+    if self.file.tell() and not self.endsWithNewline(fileName):
+      self.file.write('\n') # after a record cut by an interruption
+
+  @staticmethod
+  def read(fileName):
+    """
+    Records of the file; a line that is not valid JSON (the last one, cut by an interruption) is skipped.
+    """
+    records = []
+    if os.path.exists(fileName):
+      with open(fileName) as f:
+        for line in f:
+          try:
+            records.append(json.loads(line))
+          except ValueError:
+            pass
+    return records
+
+  @staticmethod
+  def endsWithNewline(fileName):
+    with open(fileName, 'rb') as f:
+      f.seek(-1, os.SEEK_END)
+      return f.read(1) == b'\n'
+
+  def completed(self):
+    """
+    Ids of the jobs in the store (failed ones included, the detection is deterministic).
+    """
+    return set(r['job'] for r in self.records if 'job' in r)
+
+  def append(self, record):
+    self.records.append(record)
+    self.file.write(json.dumps(record, sort_keys=True) + '\n')
+    self.file.flush()
+    os.fsync(self.file.fileno())
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+
+class SearchWorker(object):
+  """
+  Runs the jobs of a process, keeping the last caseCacheSize cases (volume, reference centerlines and feature volumes).
+  """
+
+  def __init__(self, parameters=None, phantomOptions=None, outlierThreshold=3., caseCacheSize=2):
+    """
+    :param parameters: DetectionParameters of the parameters that are not searched (defaults if None)
+    :param outlierThreshold: Hausdorff distance [mm] over which a needle is an outlier
+    """
+    self.parameters = parameters or DetectionParameters()
+    self.phantomOptions = phantomOptions
+    self.outlierThreshold = outlierThreshold
+    self.caseCacheSize = caseCacheSize
+    self.cases = [] # (name, phantom, reference centerlines [RAS], FeatureCache), most recent last
+
+  def case(self, name):
+    for entry in self.cases:
+      if entry[0] == name:
+        self.cases.remove(entry)
+        self.cases.append(entry)
+        return entry
+    if len(self.cases) >= self.caseCacheSize:
+      del self.cases[0]
+    phantom = loadCase(name, self.phantomOptions)
+    # the feature volumes depend on the needle radius only, keep those of the searched radii
+    entry = (name, phantom, phantom.centerlinesRAS(), FeatureCache(6))
+    self.cases.append(entry)
+    return entry
+
+  def run(self, job):
+    """
+    Track and evaluate the needles of a case with a parameter set.
+
+    :param job: (job id, case name, parameter values dict[, needle indices]), all the needles of the case by default
+    :return: record dict: job, case, parameters, status ('ok' or 'error'), time [s], per needle hausdorff and tipError
+             [mm] (infinite if the needle could not be evaluated), the statistics (RunningSummary.columns) and the
+             outlier needles; with needle indices also needles, the indices of the values
+    """
+    id, name, values = job[:3]
+    needles = job[3] if len(job) > 3 else None
+    record = dict(job=id, case=name, parameters=values, pid=os.getpid())
+    if needles is not None:
+      record['needles'] = list(needles)
+    start = time.time()
+    # a case that can't be loaded stops the search instead of failing all its jobs in the store
+    name, phantom, truth, featureCache = self.case(name)
+    try:
+      parameters = self.parameters.copy(axialSegmentationLimit=phantom.axialSegmentationLimit, **values)
+      detector = NeedleDetector(phantom.array, phantom.transform, parameters, spacing=phantom.spacing,
+                                featureCache=featureCache)
+      if needles is None:
+        needles = range(len(phantom.tips))
+      tips = [phantom.tips[n] for n in needles]
+      if parameters.roiDetection and parameters.algoVersParameter in ROIDetector.versions:
+        detector = ROIDetector(detector, tips)
+      curves = []
+      for tip in tips:
+        controlPoints, controlPointsIJK = detector.track(tip)
+        curves.append(BezierCurve.fromNeedle(controlPoints).evaluate())
+      evaluation = evaluateNeedles(curves, truth, pairs=list(enumerate(needles)))
+    except Exception as e:
+      record.update(status='error', time=time.time() - start, message='%s: %s' % (type(e).__name__, e))
+      return record
+    hausdorff = numpy.where(evaluation['valid'], evaluation['hausdorff'], numpy.inf)
+    tipError = numpy.where(evaluation['valid'], evaluation['tipError'], numpy.inf)
+    summary = RunningSummary(self.outlierThreshold)
+    for k, needle in enumerate(needles):
+      summary.add(tipError[k], hausdorff[k], needle)
+    record.update(status='ok', time=time.time() - start, hausdorff=hausdorff.tolist(), tipError=tipError.tolist(),
+                  outliers=summary.outliers)
+    record.update(zip(summary.columns, summary.row()))
+    return record
+
+
+worker = None # SearchWorker of a pool process
+
+
+def initializeWorker(parameters, phantomOptions, outlierThreshold):
+  global worker
+  worker = SearchWorker(DetectionParameters(**parameters), phantomOptions, outlierThreshold)
+
+
+def runJob(job):
+  return worker.run(job)
+
+
+class JobRunner(object):
+  """
+  Process pool (or this process) running jobs into a store, cf. runSearch.
+  """
+
+  def __init__(self, parameters=None, processes=None, phantomOptions=None, outlierThreshold=3.):
+    """
+    :param parameters: DetectionParameters of the parameters that are not searched (defaults if None)
+    :param processes: size of the pool (the number of CPUs if None), 1 runs the jobs in this process
+    """
+    self.parameters = parameters or DetectionParameters()
+    self.phantomOptions = phantomOptions
+    arguments = (self.parameters.asDict(), phantomOptions, outlierThreshold)
+    if processes == 1:
+      self.pool = None
+      initializeWorker(*arguments)
+    else:
+      self.pool = multiprocessing.Pool(processes, initializeWorker, arguments)
+    self.detections = 0 # needles tracked
+
+  def run(self, jobs, store, log=None, logInterval=30.):
+    """
+    Run the jobs that are not in the store yet and append their records.
+
+    :param log: optional function(string) for the progress and the throughput, every logInterval s
+    :return: number of jobs run
+    """
+    completed = store.completed()
+    pending = [job for job in jobs if job[0] not in completed]
+    if log:
+      log("%d jobs, %d in %s, %d to run" % (len(jobs), len(jobs) - len(pending), store.fileName, len(pending)))
+    if not pending:
+      return 0
+    if self.pool is None:
+      results = (runJob(job) for job in pending)
+    else:
+      results = self.pool.imap_unordered(runJob, pending)
+    start = lastLog = time.time()
+    done = failed = 0
+    for record in results:
+      store.append(record)
+      done += 1
+      failed += record['status'] != 'ok'
+      self.detections += len(record.get('hausdorff', ()))
+      now = time.time()
+      if log and (now - lastLog >= logInterval or done == len(pending)):
+        rate = done / max(now - start, 1e-6) * 60.
+        log("%d/%d jobs, %d failed, %.1f configurations/min, %.0f min left"
+            % (done, len(pending), failed, rate, (len(pending) - done) / rate))
+        lastLog = now
+    return done
+
+  def close(self, terminate=False):
+    if self.pool is not None:
+      if terminate:
+        self.pool.terminate()
+      else:
+        self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+
+def runSearch(cases, configurations, fileName, parameters=None, processes=None, phantomOptions=None,
+              outlierThreshold=3., log=None, logInterval=30.):
+  """
+  Evaluate each configuration on each case, cf. module doc.
+
+  :param cases: case names, cf. loadCase
+  :param configurations: dicts of parameter values, cf. randomConfigurations; those with the same effective values
+                         are run once
+  :param fileName: JSON lines store, the jobs it already has are skipped
+  :param parameters: DetectionParameters of the other parameters (defaults if None)
+  :param processes: size of the pool (the number of CPUs if None), 1 runs the jobs in this process
+  :param log: optional function(string) for the progress and the throughput, every logInterval s
+  :return: the records of the jobs in the store, those of former runs included
+  """
+  parameters = parameters or DetectionParameters()
+  configurations = [effectiveValues(values, parameters) for values in configurations]
+  jobs, ids, distinct = [], set(), set()
+  for case in cases:
+    for values in configurations:
+      id = jobId(case, values, parameters=parameters, phantomOptions=phantomOptions)
+      distinct.add(json.dumps(values, sort_keys=True))
+      if id not in ids:
+        ids.add(id)
+        jobs.append((id, case, values))
+  if log:
+    log("%d cases x %d configurations (%d with distinct effective values)"
+        % (len(cases), len(configurations), len(distinct)))
+  store = SearchStore(fileName)
+  runner = JobRunner(parameters, processes, phantomOptions, outlierThreshold)
+  try:
+    runner.run(jobs, store, log, logInterval)
+    runner.close()
+  except:
+    runner.close(terminate=True)
+    raise
+  finally:
+    store.close()
+  return [r for r in store.records if r.get('job') in ids]
+
+
+def needleResults(records):
+  """
+  Hausdorff distance of each evaluated needle: dict parameters key -> {(case, needle): HD}.
+  """
+  results = {}
+  for r in records:
+    if r.get('status') == 'ok':
+      needles = r.get('needles', range(len(r['hausdorff'])))
+      distances = results.setdefault(json.dumps(r['parameters'], sort_keys=True), {})
+      for needle, distance in zip(needles, r['hausdorff']):
+        distances[(r['case'], needle)] = distance
+  return results
+
+
+def halvingScore(distances, sample, penalty):
+  """
+  Mean Hausdorff distance of a configuration on a sample of (case, needle), the needles that could not be evaluated
+  (or whose job failed) counting as penalty mm.
+  """
+  return numpy.mean([min(distances.get(item, numpy.inf), penalty) for item in sample])
+
+
+def successiveHalving(cases, configurations, fileName, eta=3, minNeedles=None, parameters=None, processes=None,
+                      phantomOptions=None, outlierThreshold=3., penalty=20., seed=0, runner=None, log=None,
+                      logInterval=30.):
+  """
+  Successive halving of the configurations over samples of the needles of the cases, cf. module doc.
+
+  :param configurations: dicts of parameter values, reduced to their effective values and deduplicated
+  :param eta: a rung keeps 1/eta of the configurations and evaluates them on eta times more needles
+  :param minNeedles: needles of the first rung (all the needles divided by eta per rung down to one configuration
+                     if None)
+  :param penalty: Hausdorff distance [mm] of a needle that failed, and largest distance counted in the score
+  :param seed: seed of the order of the needles of the samples
+  :param runner: JobRunner to share (one made for this search with parameters, processes, ... if None)
+  :return: list of dicts, best first: parameters, needles (number evaluated), score (mean HD [mm] on them), rung, and
+           a 'text' line for the log; those evaluated on all the needles come first
+  """
+  needles = [(case, n) for case in cases for n in range(countNeedles(case, phantomOptions))]
+  order = [needles[n] for n in numpy.random.RandomState(seed).permutation(len(needles))]
+  configurations = [effectiveValues(c, runner.parameters if runner else parameters) for c in configurations]
+  keys = [json.dumps(c, sort_keys=True) for c in configurations]
+  configurations = [c for n, c in enumerate(configurations) if keys[n] not in keys[:n]]
+  if minNeedles is None:
+    rungs = int(math.ceil(math.log(len(configurations), eta) - 1e-9)) if len(configurations) > 1 else 0
+    rungs = min(rungs, int(math.floor(math.log(max(len(order), 1), eta) + 1e-9)))
+    minNeedles = len(order) / float(eta) ** rungs
+  budget = [] # needles of each rung
+  while not budget or budget[-1] < len(order):
+    size = min(len(order), max(1, int(math.ceil(minNeedles * eta ** len(budget) - 1e-9))))
+    budget.append(max(size, budget[-1] + 1) if budget else size)
+  store = SearchStore(fileName)
+  ownRunner = runner is None
+  if ownRunner:
+    runner = JobRunner(parameters, processes, phantomOptions, outlierThreshold)
+  ranking = {}
+  ids = set() # the store may hold the jobs of other setups
+  try:
+    alive = configurations
+    evaluated = 0
+    for rung, size in enumerate(budget):
+      if log:
+        log("rung %d: %d configurations on %d/%d needles" % (rung, len(alive), size, len(order)))
+      new = order[evaluated:size]
+      jobs = []
+      for case in cases:
+        caseNeedles = sorted(n for c, n in new if c == case)
+        if caseNeedles:
+          for values in alive:
+            jobs.append((jobId(case, values, caseNeedles, runner.parameters, runner.phantomOptions), case, values,
+                         caseNeedles))
+      runner.run(jobs, store, log, logInterval)
+      ids.update(job[0] for job in jobs)
+      evaluated = size
+      results = needleResults([r for r in store.records if r.get('job') in ids])
+      scores = []
+      for values in alive:
+        key = json.dumps(values, sort_keys=True)
+        scores.append((halvingScore(results.get(key, {}), order[:size], penalty), key, values))
+        ranking[key] = dict(parameters=values, needles=size, score=scores[-1][0], rung=rung)
+      scores.sort(key=lambda s: s[0])
+      if size == len(order):
+        break
+      alive = [values for score, key, values in scores[:max(1, len(scores) // eta)]]
+    if ownRunner:
+      runner.close()
+  except:
+    if ownRunner:
+      runner.close(terminate=True)
+    raise
+  finally:
+    store.close()
+  summary = sorted(ranking.values(), key=lambda s: (-s['needles'], s['score']))
+  for s in summary:
+    s['text'] = ("HD mean %.2f mm on %d needles (rung %d): %s"
+                 % (s['score'], s['needles'], s['rung'],
+                    ', '.join('%s=%s' % (name, s['parameters'][name]) for name in sorted(s['parameters']))))
+  return summary
+
+
+def hyperband(cases, fileName, eta=3, minNeedles=1, space=SEARCH_SPACE, parameters=None, processes=None,
+              phantomOptions=None, outlierThreshold=3., penalty=20., seed=0, log=None, logInterval=30.):
+  """
+  Hyperband: brackets of successive halving of random configurations, cf. module doc. Bracket s starts
+  ceil((sMax + 1) / (s + 1)) * eta^s configurations with distinct effective values on all the needles / eta^s, sMax
+  is the largest s with at least minNeedles needles.
+
+  :return: the summaries of the brackets merged, best first (cf. successiveHalving)
+  """
+  total = sum(countNeedles(case, phantomOptions) for case in cases)
+  sMax = int(math.floor(math.log(max(total / float(minNeedles), 1), eta) + 1e-9))
+  runner = JobRunner(parameters, processes, phantomOptions, outlierThreshold)
+  summary = []
+  drawn = 0 # configurations of all the brackets
+  try:
+    for s in range(sMax, -1, -1):
+      count = int(math.ceil((sMax + 1) / (s + 1.))) * eta ** s
+      configurations = randomConfigurations(count, space, seed + s, runner.parameters)
+      drawn += len(configurations)
+      if log:
+        log("bracket %d: %d configurations from %d needles"
+            % (s, len(configurations), int(math.ceil(total / float(eta) ** s))))
+      summary += successiveHalving(cases, configurations, fileName, eta, total / float(eta) ** s, penalty=penalty,
+                                   seed=seed, runner=runner, phantomOptions=phantomOptions, log=log,
+                                   logInterval=logInterval)
+    runner.close()
+  except:
+    runner.close(terminate=True)
+    raise
+  if log:
+    log("%d needles tracked (%d for all the configurations on all the needles)"
+        % (runner.detections, total * drawn))
+  return sorted(summary, key=lambda s: (-s['needles'], s['score']))
+
+
+def summarizeSearch(records):
+  """
+  Statistics of each configuration over the cases of its successful jobs on all the needles, best first (fewest
+  outliers, then lowest mean Hausdorff distance).
+
+  :return: list of dicts: parameters, cases, outliers, meanHD (mean of the avgHD of the cases), maxHD, and a 'text'
+           line for the log
+  """
+  groups = {}
+  for r in records:
+    if r.get('status') == 'ok' and 'needles' not in r:
+      groups.setdefault(json.dumps(r['parameters'], sort_keys=True), []).append(r)
+  summary = []
+  for key, rs in groups.items():
+    s = dict(parameters=rs[0]['parameters'], cases=len(rs), outliers=sum(r['nOutliers'] for r in rs),
+             meanHD=numpy.mean([r['avgHD'] for r in rs]), maxHD=max(r['maxHD'] for r in rs))
+    s['text'] = ("%d outliers, HD mean %.2f max %.2f mm on %d cases: %s"
+                 % (s['outliers'], s['meanHD'], s['maxHD'], s['cases'],
+                    ', '.join('%s=%s' % (name, s['parameters'][name]) for name in sorted(s['parameters']))))
+    summary.append(s)
+  summary.sort(key=lambda s: (s['outliers'], s['meanHD']))
+  return summary
+
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(
+    description="Random search of the detection parameters on exported cases or phantoms.")
+  parser.add_argument('-o', '--output', default='search.jsonl', help="results store (.jsonl), resumed if it exists")
+  parser.add_argument('--cases', nargs='+', default=['phantom:0'],
+                      help="case bundle directories, NeedlePhantom archives (.npz) or phantom:SEED")
+  parser.add_argument('--strategy', choices=['random', 'halving', 'hyperband'], default='random',
+                      help="random search on all the needles, successive halving or hyperband")
+  parser.add_argument('--configurations', type=int, default=100,
+                      help="number of random parameter sets (random and halving)")
+  parser.add_argument('--eta', type=int, default=3, help="reduction factor of halving and hyperband")
+  parser.add_argument('--min-needles', type=int, default=None,
+                      help="needles of the first rung of halving (default: down to one configuration), of the "
+                           "smallest bracket of hyperband (default: 1)")
+  parser.add_argument('--seed', type=int, default=0, help="seed of the parameter sets")
+  parser.add_argument('--processes', type=int, default=None, help="worker processes (default: number of CPUs)")
+  parser.add_argument('--outlier-threshold', type=float, default=3., help="Hausdorff distance of the outliers [mm]")
+  parser.add_argument('--dims', type=int, nargs=3, default=[160, 160, 60], help="phantom dimensions")
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.5, 0.5, 2.0], help="phantom voxel size [mm]")
+  parser.add_argument('--needles', type=int, default=8, help="needles per phantom")
+  parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                      help="detection parameter that is not searched, e.g. --set algoVersParameter=6")
+  parser.add_argument('--top', type=int, default=5, help="number of best configurations printed")
+  args = parser.parse_args(argv)
+
+  parameters = DetectionParameters()
+  for assignment in args.set:
+    name, value = assignment.split('=', 1)
+    parameters.update(**{name: ast.literal_eval(value)})
+  phantomOptions = dict(dims=args.dims, spacing=args.spacing, nNeedles=args.needles)
+
+  def log(text):
+    print(text)
+  if args.strategy != 'hyperband':
+    configurations = randomConfigurations(args.configurations, seed=args.seed, parameters=parameters)
+  if args.strategy == 'random':
+    records = runSearch(args.cases, configurations, args.output, parameters, args.processes, phantomOptions,
+                        args.outlier_threshold, log=log)
+    summary = summarizeSearch(records)
+  elif args.strategy == 'halving':
+    summary = successiveHalving(args.cases, configurations, args.output, args.eta, args.min_needles, parameters,
+                                args.processes, phantomOptions, args.outlier_threshold, seed=args.seed, log=log)
+  else:
+    summary = hyperband(args.cases, args.output, args.eta, args.min_needles or 1, parameters=parameters,
+                        processes=args.processes, phantomOptions=phantomOptions,
+                        outlierThreshold=args.outlier_threshold, seed=args.seed, log=log)
+  for s in summary[:args.top]:
+    print(s['text'])
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,162 @@
+"""
+Synthetic needle phantoms.
+
+NeedlePhantom makes an MR-like volume of a pelvis-sized body (smooth bias field, Rician noise) with dark,
+curved catheters inserted through a template grid, and keeps their centerlines as ground truth, so that
+the detection can be benchmarked offline (cf. Benchmark). A phantom is also the container of a case of the
+offline parameter search (cf. ParameterSearch): save() and load() keep it as a NumPy archive, which the module
+exports from the validation needles of a scene.
+
+The catheters go up from the template at the first slice to their tips (high k). Their centerline is one
+point per slice: a tilt and a parabolic bending of random directions as a function of the height above the
+template, so that the needles deviate most at the tip.
+"""
+
+import math
+import numpy
+
+from Transforms import AffineTransform
+
+__all__ = ['NeedlePhantom']
+
+
+class NeedlePhantom(object):
+  """
+  Voxel array [i, j, k], IJK to RAS transform and needle centerlines [ijk] of a synthetic (or exported) case.
+  """
+
+  def __init__(self, array, transform, centerlines, axialSegmentationLimit=None, seed=None):
+    """
+    :param array: voxel array indexed [i, j, k]
+    :param transform: AffineTransform or 4x4 IJK to RAS matrix
+    :param centerlines: one N x 3 array [ijk] per needle, from the tip down
+    :param axialSegmentationLimit: axial index below which the needles are not detected, or None
+    """
+    self.array = array
+    self.transform = transform if isinstance(transform, AffineTransform) else AffineTransform(transform)
+    self.centerlines = [numpy.asarray(c, dtype=numpy.float64) for c in centerlines]
+    self.axialSegmentationLimit = axialSegmentationLimit
+    self.seed = seed
+
+  @property
+  def spacing(self):
+    return self.transform.spacing()
+
+  @property
+  def tips(self):
+    """
+    Needle tips as clicked in the module: voxel [ijk] of the first centerline point.
+    """
+    return [[int(round(x)) for x in c[0]] for c in self.centerlines]
+
+  def centerlinesRAS(self):
+    return [self.transform.ijk2rasArray(c) for c in self.centerlines]
+
+  def save(self, fileName):
+    """
+    Save as a compressed NumPy archive (.npz); the centerlines are concatenated, with their lengths.
+    """
+    centerlines = self.centerlines or [numpy.zeros((0, 3))]
+    numpy.savez_compressed(fileName, array=self.array, ijkToRAS=self.transform.ijkToRAS,
+                           centerlines=numpy.concatenate(centerlines),
+                           lengths=numpy.array([len(c) for c in self.centerlines], dtype=numpy.int64),
+                           axialSegmentationLimit=-1 if self.axialSegmentationLimit is None else self.axialSegmentationLimit,
+                           seed=-1 if self.seed is None else self.seed)
+
+  @classmethod
+  def load(cls, fileName):
+    """
+    Phantom saved by save().
+    """
+    archive = numpy.load(fileName)
+    try:
+      points = archive['centerlines']
+      offsets = numpy.concatenate([[0], numpy.cumsum(archive['lengths'])])
+      centerlines = [points[offsets[n]:offsets[n + 1]] for n in range(len(offsets) - 1)]
+      limit, seed = int(archive['axialSegmentationLimit']), int(archive['seed'])
+      return cls(archive['array'], archive['ijkToRAS'], centerlines, None if limit < 0 else limit,
+                 None if seed < 0 else seed)
+    finally:
+      archive.close()
+
+  @classmethod
+  def generate(cls, dims=(160, 160, 60), spacing=(0.5, 0.5, 2.0), nNeedles=8, templateSpacing=10., bending=6.,
+               tilt=0.1, needleRadius=0.9, noise=20., tissue=500., needleSignal=40., biasField=0.2, seed=0):
+    """
+    Random phantom.
+
+    :param dims: volume dimensions
+    :param spacing: voxel size [mm], anisotropic as the axial MR acquisitions
+    :param nNeedles: number of catheters, on distinct holes of a template grid
+    :param templateSpacing: distance of the template holes [mm]
+    :param bending: largest lateral deviation due to the bending, at the tip [mm]
+    :param tilt: largest tilt of the needles [rad]
+    :param needleRadius: radius of the signal void [mm]
+    :param noise: standard deviation of the Gaussian noise of the real and imaginary channels
+    :param tissue, needleSignal: intensities of the tissue and the needles
+    :param biasField: relative amplitude of the smooth intensity variation
+    """
+    random = numpy.random.RandomState(seed)
+    dims = [int(n) for n in dims]
+    spacing = [float(s) for s in spacing]
+    size = [n * s for n, s in zip(dims, spacing)]
+
+    # template holes within the central third of the body
+    center = numpy.array(size[:2]) / 2.
+    half = int(size[0] / 6. / templateSpacing)
+    holes = [(a, b) for a in range(-half, half + 1) for b in range(-half, half + 1)]
+    if nNeedles > len(holes):
+      raise ValueError("%d needles don't fit on a template of %d holes, make the volume larger or the template denser"
+                       % (nNeedles, len(holes)))
+    chosen = random.permutation(len(holes))[:nNeedles]
+    kTipRange = (int(0.7 * dims[2]), max(int(0.7 * dims[2]) + 1, int(0.95 * dims[2])))
+    axialSegmentationLimit = int(0.1 * dims[2])
+
+    centerlines = []
+    for n in chosen:
+      entry = center + numpy.array(holes[n]) * templateSpacing
+      kTip = random.randint(*kTipRange)
+      k = numpy.arange(kTip, -1, -1)
+      h = k * spacing[2] # mm above the template
+      length = max(h[0], 1.)
+      tiltAngle, bendAngle = random.uniform(0, 2 * math.pi, 2)
+      t = random.uniform(0, tilt)
+      b = random.uniform(0.3, 1.) * bending
+      x = entry[0] + t * h * math.cos(tiltAngle) + b * (h / length) ** 2 * math.cos(bendAngle)
+      y = entry[1] + t * h * math.sin(tiltAngle) + b * (h / length) ** 2 * math.sin(bendAngle)
+      centerlines.append(numpy.column_stack([x / spacing[0], y / spacing[1], k]))
+
+    array = cls.render(dims, spacing, centerlines, needleRadius, noise, tissue, needleSignal, biasField, random)
+    ijkToRAS = numpy.diag([-spacing[0], -spacing[1], spacing[2], 1.])
+    ijkToRAS[:3, 3] = [size[0] / 2., size[1] / 2., -size[2] / 2.]
+    return cls(array, AffineTransform(ijkToRAS), centerlines, axialSegmentationLimit, seed)
+
+  @staticmethod
+  def render(dims, spacing, centerlines, needleRadius, noise, tissue, needleSignal, biasField, random):
+    """
+    int16 voxels: elliptic body of tissue with a bias field, signal voids of the needles with a one voxel
+    partial volume edge, Rician noise.
+    """
+    i = numpy.arange(dims[0]) * spacing[0]
+    j = numpy.arange(dims[1]) * spacing[1]
+    x, y = numpy.meshgrid(i, j, indexing='ij')
+    size = [n * s for n, s in zip(dims, spacing)]
+    body = ((x - size[0] / 2.) / (0.45 * size[0])) ** 2 + ((y - size[1] / 2.) / (0.4 * size[1])) ** 2 <= 1
+    edge = min(spacing[0], spacing[1])
+    array = numpy.empty(dims, dtype=numpy.int16)
+    for k in range(dims[2]):
+      z = k * spacing[2]
+      bias = 1 + biasField * numpy.sin(x / size[0] * math.pi + 0.5) * numpy.cos(y / size[1] * math.pi - 0.3 + z / size[2])
+      signal = numpy.where(body, tissue * bias, 0.)
+      for c in centerlines:
+        kTip = int(c[0][2])
+        if k > kTip:
+          continue
+        ci, cj = c[kTip - k][0] * spacing[0], c[kTip - k][1] * spacing[1]
+        d = numpy.sqrt((x - ci) ** 2 + (y - cj) ** 2)
+        void = numpy.clip((needleRadius + edge / 2. - d) / edge, 0, 1)
+        signal = signal * (1 - void) + needleSignal * void
+      real = signal + random.normal(0, noise, signal.shape)
+      imaginary = random.normal(0, noise, signal.shape)
+      array[:, :, k] = numpy.clip(numpy.sqrt(real ** 2 + imaginary ** 2), 0, 32767)
+    return array
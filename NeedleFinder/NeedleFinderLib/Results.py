@@ -0,0 +1,207 @@
+"""
+Buffered evaluation results.
+
+ResultsSink replaces the CSV appends of the module's exportEvaluation, which opened the file for every row
+(and never closed it): the CSV is opened once per run, rows are buffered and flushed every flushRows rows or
+flushInterval seconds, and the rows are also kept by column and saved as a compressed NumPy archive (.npz,
+one array per column) next to the CSV when the sink is closed, for loading the results of a parameter search
+without parsing text. The archive of an existing CSV is read back when the sink is opened, so that it keeps
+the rows of the former runs.
+
+RunningSummary keeps the statistics of the evaluation of a case (max/mean/std/median of the Hausdorff
+distances, outliers) as the rows come, instead of rebuilding an array of all the results.
+"""
+
+import bisect
+import csv
+import math
+import numbers
+import os
+import time
+import numpy
+
+__all__ = ['ResultsSink', 'RunningSummary']
+
+
+class RunningSummary(object):
+  """
+  Statistics of the Hausdorff distances (HD) and tip distances of evaluated needles, updated per needle.
+  """
+
+  columns = ['maxTipHD', 'maxHD', 'avgHD', 'stdHD', 'medHD', 'nNeedles', 'nOutliers'] # of row()
+
+  def __init__(self, outlierThreshold=None):
+    """
+    :param outlierThreshold: HD [mm] over which a needle is an outlier
+    """
+    self.outlierThreshold = outlierThreshold
+    self.count = 0
+    self.mean = 0.
+    self.m2 = 0. # sum of the squared deviations from the mean (Welford)
+    self.maxHD = None
+    self.maxTipHD = None
+    self.sorted = []
+    self.outliers = []
+
+  def add(self, tipHD, HD, needle=None):
+    """
+    :param needle: name or number of the needle, kept for the outliers
+    """
+    HD, tipHD = float(HD), float(tipHD)
+    self.count += 1
+    delta = HD - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (HD - self.mean)
+    self.maxHD = HD if self.maxHD is None else max(self.maxHD, HD)
+    self.maxTipHD = tipHD if self.maxTipHD is None else max(self.maxTipHD, tipHD)
+    bisect.insort(self.sorted, HD)
+    if self.outlierThreshold is not None and HD > self.outlierThreshold:
+      self.outliers.append(needle)
+
+  def addRows(self, rows, tipColumn, hdColumn, needleColumn=None):
+    for row in rows:
+      self.add(row[tipColumn], row[hdColumn], row[needleColumn] if needleColumn is not None else None)
+
+  @property
+  def std(self):
+    return math.sqrt(self.m2 / self.count) if self.count else None
+
+  @property
+  def median(self):
+    """
+    Upper median, as the former statistics of parSearch.
+    """
+    return self.sorted[len(self.sorted) // 2] if self.sorted else None
+
+  def row(self):
+    """
+    [maxTipHD, maxHD, avgHD, stdHD, medHD, nNeedles, nOutliers], the statistics columns of the parSearch files.
+    """
+    return [self.maxTipHD, self.maxHD, self.mean if self.count else None, self.std, self.median, self.count,
+            len(self.outliers)]
+
+
+class ResultsSink(object):
+  """
+  CSV (and .npz) results file of a run, cf. module doc.
+  """
+
+  def __init__(self, fileName, flushRows=100, flushInterval=10., columnar=True):
+    """
+    :param fileName: CSV file, appended to if it exists
+    :param columnar: also save the rows by column to fileName without .csv + .npz at close(), after those of
+                     the archive of the former runs
+    """
+    self.fileName = fileName
+    self.flushRows = flushRows
+    self.flushInterval = flushInterval
+    self.columnarFileName = os.path.splitext(fileName)[0] + '.npz' if columnar else None
+    self.created = not os.path.exists(fileName)
+    self.file = open(fileName, 'ab')
+    self.writer = csv.writer(self.file)
+    self.buffer = []
+    self.header = None
+    self.columns = []
+    self.columnsDirty = False
+    self.lastFlush = time.time()
+    self.rows = 0
+    if self.columnarFileName and not self.created and os.path.exists(self.columnarFileName):
+      self.loadColumns()
+
+  def writeHeader(self, names):
+    """
+    Write a header row; its names are the keys of the columns in the .npz archive.
+    """
+    self.header = [str(name) for name in names]
+    self.buffer.append(list(names))
+    self.flush()
+
+  def write(self, rows):
+    """
+    Buffer a row (a sequence of values) or a list of rows.
+    """
+    if not len(rows):
+      return
+    if not isinstance(rows[0], (list, tuple, numpy.ndarray)):
+      rows = [rows]
+    for row in rows:
+      row = list(row)
+      self.buffer.append(row)
+      if self.columnarFileName:
+        while len(self.columns) < len(row):
+          self.columns.append([None] * self.rows)
+        for n, column in enumerate(self.columns):
+          column.append(row[n] if n < len(row) else None)
+        self.columnsDirty = True
+      self.rows += 1
+    if len(self.buffer) >= self.flushRows or time.time() - self.lastFlush >= self.flushInterval:
+      self.flush()
+
+  def flush(self):
+    if self.file is None:
+      return
+    if self.buffer:
+      self.writer.writerows(self.buffer)
+      self.buffer = []
+    self.file.flush()
+    self.lastFlush = time.time()
+
+  def columnName(self, n):
+    if self.header and n < len(self.header) and self.header[n]:
+      return self.header[n]
+    return 'column%d' % n
+
+  @staticmethod
+  def columnArray(values):
+    """
+    float64 array if all the values are numbers or booleans (None as NaN), array of strings otherwise.
+    """
+    if all(v is None or isinstance(v, (numbers.Number, numpy.bool_)) for v in values):
+      return numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+    return numpy.array(['' if v is None else str(v) for v in values])
+
+  @staticmethod
+  def columnValues(array):
+    """
+    Values of a column array, NaN and empty strings as None (the inverse of columnArray).
+    """
+    if array.dtype.kind == 'f':
+      return [None if numpy.isnan(v) else float(v) for v in array]
+    return [None if v == '' else str(v) for v in array]
+
+  def loadColumns(self):
+    """
+    Read the columns of the archive of the former runs, in the order of their 'columns' entry.
+    """
+    archive = numpy.load(self.columnarFileName)
+    try:
+      names = [str(name) for name in archive['columns']] if 'columns' in archive.files else sorted(archive.files)
+      self.columns = [self.columnValues(archive[name]) for name in names]
+    finally:
+      archive.close()
+    self.header = names
+    self.rows = max([len(column) for column in self.columns] or [0])
+
+  def saveColumns(self):
+    arrays = {}
+    names = []
+    for n, values in enumerate(self.columns):
+      name = self.columnName(n)
+      if name in arrays or name == 'columns':
+        name = 'column%d' % n
+      arrays[name] = self.columnArray(values)
+      names.append(name)
+    arrays['columns'] = numpy.array(names)
+    temporary = self.columnarFileName + '.tmp.npz'
+    numpy.savez_compressed(temporary, **arrays)
+    os.rename(temporary, self.columnarFileName)
+    self.columnsDirty = False
+
+  def close(self):
+    if self.file is None:
+      return
+    self.flush()
+    self.file.close()
+    self.file = None
+    if self.columnsDirty:
+      self.saveColumns()
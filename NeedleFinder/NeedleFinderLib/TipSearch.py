@@ -0,0 +1,119 @@
+"""
+Tip refinement around a clicked tip.
+
+The module's findTip scored every position of a 2X x 2Y window around the tip with a center-minus-ring response
+(8 times the center voxel minus the mean of the 4 voxels at the needle radius, weighted by the gradient
+ponderation) summed over the tip slice and the 3 slices below, attenuated by a Gaussian of the distance to the
+click, and kept the minimum, reading 20 voxels per position through GetScalarComponentAsDouble. The response is
+linear in the voxels, so here the 4 slices are summed once over the window (plus the ring margin), the ring
+difference is taken on the summed slab with shifted slices, and the result is multiplied by a cached Gaussian
+weight map. findTips refines many tips in one gather.
+"""
+
+import numpy
+
+from VolumeAccess import gatherZeroPadded
+
+__all__ = ['tipWindowOffsets', 'tipWeights', 'tipResponses', 'findTip', 'findTips']
+
+# slices summed by the response, relative to the tip (the tip slice and the 3 below)
+TIP_SLICES = numpy.arange(-3, 1)
+
+_weights = {}
+
+
+def tipWindowOffsets(X, coeff=1):
+  """
+  Voxel offsets of the window positions along an axis, int(I / coeff) for I in [-X, X), as findTip.
+  """
+  X = int(X)
+  return numpy.trunc(numpy.arange(-X, X) / float(coeff)).astype(int)
+
+
+def tipWeights(X, Y, coeff, sigmaValue):
+  """
+  Gaussian attenuation of the window positions (2X x 2Y), exp(-(r / 10)^2 / (2 (sigma / 10)^2)), r [voxels] being
+  the distance to the tip; cached.
+  """
+  key = (int(X), int(Y), coeff, sigmaValue)
+  weights = _weights.get(key)
+  if weights is None:
+    i = tipWindowOffsets(X, coeff)
+    j = tipWindowOffsets(Y, coeff)
+    r2 = i[:, None] ** 2 + j[None, :] ** 2
+    weights = numpy.exp(-(r2 / 100.) / (2 * (sigmaValue / 10.) ** 2))
+    weights.flags.writeable = False
+    if len(_weights) >= 16:
+      _weights.clear()
+    _weights[key] = weights
+  return weights
+
+
+def tipResponses(volume, tips, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y):
+  """
+  Weighted tip responses of the windows of the tips.
+
+  :param volume: voxel array [i, j, k] (out of extent voxels read as 0)
+  :param tips: N tips [ijk], truncated to voxels
+  :param radiusNeedle: needle radius [voxels]
+  :return: N x 2X x 2Y array, [n, a, b] being the response of tips[n] + (offsetsI[a], offsetsJ[b], 0)
+  """
+  tips = numpy.asarray(tips, dtype=numpy.float64).reshape(-1, 3).astype(int)
+  r = int(radiusNeedle)
+  offsetsI = tipWindowOffsets(X, coeff)
+  offsetsJ = tipWindowOffsets(Y, coeff)
+  if not len(tips) or not len(offsetsI) or not len(offsetsJ):
+    return numpy.zeros((len(tips), len(offsetsI), len(offsetsJ)))
+  # slab of the windows and their ring margin, summed over the slices
+  lowI, lowJ = offsetsI.min() - r, offsetsJ.min() - r
+  spanI = numpy.arange(lowI, offsetsI.max() + r + 1)
+  spanJ = numpy.arange(lowJ, offsetsJ.max() + r + 1)
+  i, j, k = numpy.broadcast_arrays((tips[:, 0, None] + spanI)[:, :, None, None],
+                                   (tips[:, 1, None] + spanJ)[:, None, :, None],
+                                   (tips[:, 2, None] + TIP_SLICES)[:, None, None, :])
+  slab = gatherZeroPadded(volume, i, j, k).sum(axis=3)
+  a = (offsetsI - lowI)[:, None]
+  b = (offsetsJ - lowJ)[None, :]
+  ring = slab[:, a + r, b] + slab[:, a - r, b] + slab[:, a, b + r] + slab[:, a, b - r]
+  responses = 8 * slab[:, a, b] - ring / 4. * gradientPonderation
+  return responses * tipWeights(X, Y, coeff, sigmaValue)
+
+
+def firstMinimum(responses):
+  """
+  Index of the minimum in scan order (the first one of equal values). findTip also replaced a running minimum of
+  exactly 0 by the next position, whatever its response; this is kept for windows with zero responses.
+  """
+  if not (responses == 0).any():
+    return int(numpy.argmin(responses))
+  best = 0
+  for n in range(1, len(responses)):
+    if responses[n] < responses[best] or responses[best] == 0:
+      best = n
+  return best
+
+
+def findTips(volume, tips, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y):
+  """
+  Refine tips [ijk] to the minimum of the weighted tip response in their windows, cf. module doc.
+
+  :return: list of refined tips [i, j, k] (ints); a tip with an empty window is only truncated to a voxel
+  """
+  responses = tipResponses(volume, tips, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y)
+  offsetsI = tipWindowOffsets(X, coeff)
+  offsetsJ = tipWindowOffsets(Y, coeff)
+  refined = []
+  for tip, response in zip(numpy.asarray(tips, dtype=numpy.float64).reshape(-1, 3).astype(int), responses):
+    tip = [int(x) for x in tip]
+    if response.size:
+      a, b = divmod(firstMinimum(response.ravel()), len(offsetsJ))
+      tip = [tip[0] + int(offsetsI[a]), tip[1] + int(offsetsJ[b]), tip[2]]
+    refined.append(tip)
+  return refined
+
+
+def findTip(volume, tip, radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y):
+  """
+  Refine one tip [ijk], cf. findTips.
+  """
+  return findTips(volume, [tip], radiusNeedle, coeff, sigmaValue, gradientPonderation, X, Y)[0]
@@ -0,0 +1,232 @@
+"""
+Structured profiling: nested timed spans, instant marks and counters.
+
+The module profiled by printing the name of every called method (profprint) and scattered time.clock() prints.
+A Tracer records spans (with tracer.span('name'): ..., or the traced decorator), marks (e.g. the profprint calls)
+and counters (tracer.count('rays scored', n)), aggregates them per name and per needle (the needle of the innermost
+enclosing span that has one), and exports them as a Chrome trace (JSON, chrome://tracing or Perfetto).
+
+Disabled, span() returns a shared no-op context and count() and mark() return at once, so that the instrumentation
+can stay in the detection loops. The shared tracer of the library and the module is Tracing.tracer.
+"""
+
+import json
+import os
+import threading
+from timeit import default_timer as timer
+
+__all__ = ['Tracer', 'tracer', 'traced']
+
+
+class NullSpan(object):
+  """
+  Span of a disabled tracer.
+  """
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+  __slots__ = ('tracer', 'name', 'needle', 'args', 'start')
+
+  def __init__(self, tracer, name, needle, args):
+    self.tracer = tracer
+    self.name = name
+    self.needle = needle
+    self.args = args
+
+  def __enter__(self):
+    self.tracer.stack().append(self)
+    self.start = timer()
+    return self
+
+  def __exit__(self, *args):
+    self.tracer.end(self, timer())
+    return False
+
+
+class Tracer(object):
+  """
+  Spans, marks and counters of a run, cf. module doc. The events of the Chrome trace are limited to maxEvents, the
+  statistics are kept for all.
+  """
+
+  def __init__(self, enabled=False, maxEvents=1000000):
+    self.enabled = enabled
+    self.maxEvents = maxEvents
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.reset()
+
+  def enable(self, enabled=True):
+    self.enabled = enabled
+
+  def reset(self):
+    """
+    Forget the recorded events and statistics.
+    """
+    with self.lock:
+      self.origin = timer()
+      self.events = []
+      self.dropped = 0
+      self.spans = {} # name -> [calls, total s, max s]
+      self.marks = {} # name -> calls
+      self.counters = {}
+      self.needles = {} # needle -> {'spans': {name: [calls, total s]}, 'counters': {name: n}}
+      self.countersChanged = False
+
+  def stack(self):
+    stack = getattr(self.local, 'stack', None)
+    if stack is None:
+      stack = self.local.stack = []
+    return stack
+
+  def currentNeedle(self):
+    for span in reversed(self.stack()):
+      if span.needle is not None:
+        return span.needle
+    return None
+
+  def span(self, name, needle=None, **args):
+    """
+    Context of a timed span; needle (name or number) attributes it and the enclosed spans and counts to a needle,
+    args are shown with the event.
+    """
+    if not self.enabled:
+      return NULL_SPAN
+    return Span(self, name, needle, args)
+
+  def end(self, span, end):
+    stack = self.stack()
+    if stack and stack[-1] is span:
+      stack.pop()
+    duration = end - span.start
+    needle = span.needle if span.needle is not None else self.currentNeedle()
+    with self.lock:
+      statistics = self.spans.get(span.name)
+      if statistics is None:
+        statistics = self.spans[span.name] = [0, 0., 0.]
+      statistics[0] += 1
+      statistics[1] += duration
+      statistics[2] = max(statistics[2], duration)
+      if needle is not None:
+        spans = self.needleEntry(needle)['spans']
+        statistics = spans.get(span.name)
+        if statistics is None:
+          statistics = spans[span.name] = [0, 0.]
+        statistics[0] += 1
+        statistics[1] += duration
+      args = dict(span.args)
+      if needle is not None:
+        args['needle'] = needle
+      self.event(dict(name=span.name, ph='X', ts=(span.start - self.origin) * 1e6, dur=duration * 1e6, args=args))
+      if self.countersChanged:
+        self.event(dict(name='counters', ph='C', ts=(end - self.origin) * 1e6, args=dict(self.counters)))
+        self.countersChanged = False
+
+  def mark(self, name, **args):
+    """
+    Instant event, counted per name.
+    """
+    if not self.enabled:
+      return
+    now = timer()
+    with self.lock:
+      self.marks[name] = self.marks.get(name, 0) + 1
+      self.event(dict(name=name, ph='i', s='t', ts=(now - self.origin) * 1e6, args=args))
+
+  def count(self, name, n=1):
+    """
+    Add n to a counter, in total and for the current needle.
+    """
+    if not self.enabled:
+      return
+    needle = self.currentNeedle()
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+      self.countersChanged = True
+      if needle is not None:
+        counters = self.needleEntry(needle)['counters']
+        counters[name] = counters.get(name, 0) + n
+
+  def needleEntry(self, needle):
+    entry = self.needles.get(needle)
+    if entry is None:
+      entry = self.needles[needle] = dict(spans={}, counters={})
+    return entry
+
+  def event(self, event):
+    if len(self.events) < self.maxEvents:
+      event['pid'] = os.getpid()
+      event['tid'] = threading.current_thread().ident
+      self.events.append(event)
+    else:
+      self.dropped += 1
+
+  def traced(self, name=None):
+    """
+    Decorator running a function in a span of its name (or name).
+    """
+    def decorator(function):
+      spanName = name or function.__name__
+      def wrapper(*args, **kwargs):
+        if not self.enabled:
+          return function(*args, **kwargs)
+        with self.span(spanName):
+          return function(*args, **kwargs)
+      wrapper.__name__ = function.__name__
+      wrapper.__doc__ = function.__doc__
+      return wrapper
+    return decorator
+
+  def summary(self):
+    """
+    Statistics as text lines: spans by total time, marks, counters and per needle time and counters.
+    """
+    with self.lock:
+      lines = ['%-40s %8s %12s %12s %12s' % ('span', 'calls', 'total [ms]', 'mean [ms]', 'max [ms]')]
+      for name, (calls, total, longest) in sorted(self.spans.items(), key=lambda item: -item[1][1]):
+        lines.append('%-40s %8d %12.2f %12.3f %12.3f' % (name, calls, total * 1e3, total * 1e3 / calls, longest * 1e3))
+      for name, calls in sorted(self.marks.items(), key=lambda item: -item[1]):
+        lines.append('%-40s %8d' % (name, calls))
+      for name, n in sorted(self.counters.items()):
+        lines.append('%-40s %21d' % (name, n))
+      for needle in sorted(self.needles, key=str):
+        entry = self.needles[needle]
+        spans = ', '.join('%s %.2f ms' % (name, s[1] * 1e3) for name, s in sorted(entry['spans'].items()))
+        counters = ', '.join('%s %d' % (name, n) for name, n in sorted(entry['counters'].items()))
+        lines.append('needle %s: %s; %s' % (needle, spans, counters))
+      if self.dropped:
+        lines.append('%d events over %d not in the trace' % (self.dropped, self.maxEvents))
+    return lines
+
+  def chromeTrace(self):
+    """
+    Chrome trace event format dict of the events, with the statistics as metadata.
+    """
+    with self.lock:
+      needles = dict((str(needle), entry) for needle, entry in self.needles.items())
+      return dict(traceEvents=list(self.events), displayTimeUnit='ms',
+                  otherData=dict(spans=dict(self.spans), marks=dict(self.marks), counters=dict(self.counters),
+                                 needles=needles, dropped=self.dropped))
+
+  def exportChromeTrace(self, fileName):
+    with open(fileName, 'w') as f:
+      json.dump(self.chromeTrace(), f)
+
+
+tracer = Tracer()
+
+
+def traced(name=None):
+  """
+  Decorator running a function in a span of the shared tracer.
+  """
+  return tracer.traced(name)
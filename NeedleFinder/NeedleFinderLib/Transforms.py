@@ -0,0 +1,117 @@
+"""
+IJK <-> RAS conversions with a plain 4x4 NumPy affine.
+
+TransformCache keeps the affine of each volume node, so that the per point conversions of the detectors
+don't build and invert VTK matrices every time.
+"""
+
+import threading
+import numpy
+
+__all__ = ['AffineTransform', 'TransformCache']
+
+
+class AffineTransform(object):
+  """
+  IJK to RAS affine of a volume and its inverse, for single points and N x 3 arrays.
+  """
+
+  def __init__(self, ijkToRAS, rasToIJK=None):
+    """
+    :param ijkToRAS: 4x4 matrix (nested lists or array)
+    :param rasToIJK: its inverse, computed if None
+    """
+    self.ijkToRAS = numpy.array(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+    if rasToIJK is None:
+      self.rasToIJK = numpy.linalg.inv(self.ijkToRAS)
+    else:
+      self.rasToIJK = numpy.array(rasToIJK, dtype=numpy.float64).reshape(4, 4)
+
+  @staticmethod
+  def elements(m):
+    return [[m.GetElement(i, j) for j in range(4)] for i in range(4)]
+
+  @classmethod
+  def fromVTKMatrix(cls, m):
+    """
+    :param m: vtkMatrix4x4, inverted with VTK like in the former ras2ijk
+    """
+    import vtk
+    inverse = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Invert(m, inverse)
+    return cls(cls.elements(m), cls.elements(inverse))
+
+  def spacing(self):
+    """
+    Voxel size along i, j, k (norms of the matrix columns).
+    """
+    return numpy.sqrt((self.ijkToRAS[:3, :3] ** 2).sum(axis=0)).tolist()
+
+  @staticmethod
+  def apply(m, points):
+    """
+    m applied to N x 3 points. The products are summed in the order of vtkMatrix4x4::Multiply4x4,
+    so the results are the same as with the VTK matrices.
+    """
+    p = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    out = numpy.empty(p.shape, dtype=numpy.float64)
+    for i in range(3):
+      out[:, i] = m[i, 0] * p[:, 0] + m[i, 1] * p[:, 1] + m[i, 2] * p[:, 2] + m[i, 3]
+    return out
+
+  def ijk2ras(self, ijk):
+    """
+    RAS coordinates of one IJK point, as a list.
+    """
+    return self.apply(self.ijkToRAS, ijk[:3])[0].tolist()
+
+  def ras2ijk(self, ras):
+    """
+    IJK coordinates of one RAS point, as a list.
+    """
+    return self.apply(self.rasToIJK, ras[:3])[0].tolist()
+
+  def ijk2rasArray(self, ijk):
+    """
+    RAS coordinates of N x 3 IJK points.
+    """
+    return self.apply(self.ijkToRAS, ijk)
+
+  def ras2ijkArray(self, ras):
+    """
+    IJK coordinates of N x 3 RAS points.
+    """
+    return self.apply(self.rasToIJK, ras)
+
+
+class TransformCache(object):
+  """
+  AffineTransform of volume nodes (vtkMRMLVolumeNode), rebuilt when the node was modified since,
+  e.g. by a change of its origin, spacing or directions.
+  """
+
+  def __init__(self, maxEntries=8):
+    self.maxEntries = maxEntries
+    self.entries = {}
+    self.lock = threading.Lock()
+
+  def get(self, volumeNode):
+    """
+    Transform of volumeNode, read from the node if not cached or out of date.
+    """
+    import vtk
+    mtime = volumeNode.GetMTime()
+    with self.lock:
+      entry = self.entries.get(volumeNode)
+      if entry is None or entry[0] != mtime:
+        if len(self.entries) >= self.maxEntries: # don't keep closed volumes alive
+          self.entries.clear()
+        m = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(m)
+        entry = (mtime, AffineTransform.fromVTKMatrix(m))
+        self.entries[volumeNode] = entry
+    return entry[1]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
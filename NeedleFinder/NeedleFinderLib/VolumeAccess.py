@@ -0,0 +1,178 @@
+"""
+Zero-copy voxel access.
+
+A VolumeAccessor wraps the scalars of a vtkImageData as a read-only NumPy view indexed [i, j, k],
+so that the detectors read voxels without going through imageData.GetScalarComponentAsDouble.
+Out of extent reads return 0, like the VTK accessor.
+"""
+
+import numpy
+
+__all__ = ['roundHalfAway', 'gatherZeroPadded', 'VolumeAccessor', 'ImageDataVoxels']
+
+
+def roundHalfAway(x):
+  """
+  Element-wise round half away from zero, i.e. the builtin round() of Python 2.
+  (numpy.round rounds half to even and would shift some samples by one voxel)
+  """
+  x = numpy.asarray(x, dtype=numpy.float64)
+  a = numpy.abs(x)
+  f = numpy.floor(a)
+  f += (a - f >= 0.5)
+  return numpy.copysign(f, x)
+
+
+def gatherZeroPadded(volume, i, j, k):
+  """
+  Fetch volume[i, j, k] for integer index arrays as float64.
+  Out of extent indices give 0, like vtkImageData.GetScalarComponentAsDouble.
+  """
+  dims = volume.shape
+  inside = (i >= 0) & (i < dims[0]) & (j >= 0) & (j < dims[1]) & (k >= 0) & (k < dims[2])
+  values = numpy.zeros(numpy.shape(i), dtype=numpy.float64)
+  values[inside] = volume[i[inside], j[inside], k[inside]]
+  return values
+
+
+class VolumeAccessor(object):
+  """
+  Read-only [i, j, k] view of a volume with bounds-checked scalar, batched and trilinear reads.
+  """
+
+  def __init__(self, array, mtime=None, source=None):
+    """
+    :param array: voxel array indexed [i, j, k] (not copied)
+    :param mtime: modification time of the image the view was made from
+    :param source: object owning the memory (kept alive as long as the view)
+    """
+    self._array = array
+    self.array = array.view()
+    self.array.flags.writeable = False
+    self.dims = self.array.shape
+    self.mtime = mtime
+    self.source = source
+    self._downsampled = None
+
+  def writableArray(self):
+    """
+    Writable [i, j, k] array on the same memory, for label edits
+    (the caller is responsible for marking the image as modified).
+    """
+    return self._array
+
+  @classmethod
+  def fromImageData(cls, imageData):
+    """
+    Wrap the first scalar component of a vtkImageData, without copy.
+    """
+    from vtk.util import numpy_support
+    dims = imageData.GetDimensions()
+    scalars = imageData.GetPointData().GetScalars()
+    a = numpy_support.vtk_to_numpy(scalars)
+    if a.ndim > 1:
+      a = a[:, 0]
+    a = a.reshape(dims[2], dims[1], dims[0]).transpose(2, 1, 0)
+    return cls(a, cls.modifiedTime(imageData), scalars)
+
+  @staticmethod
+  def modifiedTime(imageData):
+    """
+    Modification time of the image and of its scalar array.
+    """
+    return max(imageData.GetMTime(), imageData.GetPointData().GetScalars().GetMTime())
+
+  def isUpToDate(self, imageData):
+    """
+    True if the view still describes imageData (same scalar array, not modified since).
+    """
+    scalars = imageData.GetPointData().GetScalars()
+    return scalars is self.source and self.modifiedTime(imageData) == self.mtime
+
+  def downsampled(self):
+    """
+    VolumeAccessor of the 2x2x2 block means (float32, computed on first use), for coarse searches.
+    Voxel (i, j, k) of the fine volume lies at ((i - 0.5) / 2, (j - 0.5) / 2, (k - 0.5) / 2) in it.
+    """
+    if self._downsampled is None:
+      dims = self.dims
+      half = [(n + 1) // 2 for n in dims]
+      coarse = numpy.zeros(half, dtype=numpy.float32)
+      counts = numpy.zeros(half, dtype=numpy.float32)
+      for di in (0, 1):
+        for dj in (0, 1):
+          for dk in (0, 1):
+            block = self.array[di::2, dj::2, dk::2]
+            s = block.shape
+            coarse[:s[0], :s[1], :s[2]] += block
+            counts[:s[0], :s[1], :s[2]] += 1
+      coarse /= counts
+      self._downsampled = VolumeAccessor(coarse)
+    return self._downsampled
+
+  def inside(self, i, j, k):
+    """
+    True if the integer index lies in the volume extent.
+    """
+    return 0 <= i < self.dims[0] and 0 <= j < self.dims[1] and 0 <= k < self.dims[2]
+
+  def value(self, i, j, k):
+    """
+    Scalar value at integer index (i, j, k), 0 outside of the extent.
+    """
+    if 0 <= i < self.dims[0] and 0 <= j < self.dims[1] and 0 <= k < self.dims[2]:
+      return float(self.array[i, j, k])
+    return 0.0
+
+  def gather(self, i, j, k):
+    """
+    Values at integer index arrays i, j, k (same shape), 0 outside of the extent.
+    """
+    return gatherZeroPadded(self.array, numpy.asarray(i), numpy.asarray(j), numpy.asarray(k))
+
+  def gatherPoints(self, ijk):
+    """
+    Values at the rounded positions of an N x 3 array of (i, j, k) coordinates.
+    """
+    ijk = roundHalfAway(numpy.asarray(ijk, dtype=numpy.float64).reshape(-1, 3)).astype(numpy.int64)
+    return self.gather(ijk[:, 0], ijk[:, 1], ijk[:, 2])
+
+  def trilinear(self, x, y, z):
+    """
+    Trilinear interpolation at continuous index arrays x, y, z (same weights as NeedleFinderLogic.interp3).
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    z = numpy.asarray(z, dtype=numpy.float64)
+    xf, yf, zf = numpy.floor(x).astype(numpy.int64), numpy.floor(y).astype(numpy.int64), numpy.floor(z).astype(numpy.int64)
+    xc, yc, zc = numpy.ceil(x).astype(numpy.int64), numpy.ceil(y).astype(numpy.int64), numpy.ceil(z).astype(numpy.int64)
+    xd = x - xf
+    yd = y - yf
+    zd = z - zf
+    zdd = 1 - zd
+    i1 = self.gather(xf, yf, zf) * zdd + self.gather(xf, yf, zc) * zd
+    i2 = self.gather(xf, yc, zf) * zdd + self.gather(xf, yc, zc) * zd
+    j1 = self.gather(xc, yf, zf) * zdd + self.gather(xc, yf, zc) * zd
+    j2 = self.gather(xc, yc, zf) * zdd + self.gather(xc, yc, zc) * zd
+    w1 = i1 * (1 - yd) + i2 * yd
+    w2 = j1 * (1 - yd) + j2 * yd
+    return w1 * (1 - xd) + w2 * xd
+
+
+class ImageDataVoxels(object):
+  """
+  Scalar reads of a vtkImageData through GetScalarComponentAsDouble, for the voxel by voxel cone search
+  (the reference the vectorized one is compared with).
+  """
+
+  def __init__(self, imageData):
+    self.imageData = imageData
+    self.dims = imageData.GetDimensions()
+
+  def value(self, i, j, k):
+    """
+    Scalar value at integer index (i, j, k), 0 outside of the extent.
+    """
+    if 0 <= i < self.dims[0] and 0 <= j < self.dims[1] and 0 <= k < self.dims[2]:
+      return self.imageData.GetScalarComponentAsDouble(i, j, k, 0)
+    return 0.0
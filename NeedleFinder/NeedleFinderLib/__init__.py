@@ -0,0 +1,24 @@
+"""
+NeedleFinderLib: NumPy building blocks of the needle detection that do not depend on the Slicer GUI.
+"""
+from Tracing import *
+from Diagnostics import *
+from VolumeAccess import *
+from ConeSearch import *
+from TipSearch import *
+from CoarseSearch import *
+from FeatureVolumes import *
+from NeedleModel import *
+from Transforms import *
+from Curves import *
+from DistanceFields import *
+from Evaluation import *
+from Matching import *
+from Results import *
+from Artifacts import *
+from Detector import *
+from DetectionROI import *
+from Phantom import *
+from Cases import *
+from Benchmark import *
+from ParameterSearch import *